@@ -83,6 +83,18 @@ class ArgumentValidator(object):
         if int(value) < 1:
             raise MCVirtTypeError('Not a positive integer')
 
+    @staticmethod
+    def validate_drbd_rate(value):
+        """Validate a DRBD rate, in KiB/s, with an optional K/M/G suffix"""
+        if not re.match(r'^\d+[kKmMgG]?$', str(value)):
+            raise MCVirtTypeError('%s is not a valid DRBD rate' % value)
+
+    @staticmethod
+    def validate_time_of_day(value):
+        """Validate a time of day, in HH:MM format"""
+        if not re.match(r'^([01]\d|2[0-3]):[0-5]\d$', str(value)):
+            raise MCVirtTypeError('%s is not a valid time of day (HH:MM)' % value)
+
     @staticmethod
     def validate_boolean(variable):
         """Ensure variable is a boolean"""
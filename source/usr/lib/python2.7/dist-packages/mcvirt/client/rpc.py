@@ -102,6 +102,9 @@ class Connection(object):
 
         if 'has_lock' in dir(Pyro4.current_context):
             auth_dict[Annotations.HAS_LOCK] = Pyro4.current_context.has_lock
+            if (Pyro4.current_context.has_lock and
+                    'lock_context' in dir(Pyro4.current_context)):
+                auth_dict[Annotations.LOCK_CONTEXT] = Pyro4.current_context.lock_context
 
         auth_dict[Annotations.IGNORE_CLUSTER] = self.__ignore_cluster
         if 'ignore_cluster' in dir(Pyro4.current_context):
@@ -19,7 +19,13 @@
 
 import json
 import base64
+import hashlib
+import os
 import Pyro4
+import shutil
+import sys
+import threading
+import time
 
 import socket
 from texttable import Texttable
@@ -30,20 +36,29 @@ from mcvirt.exceptions import (NodeAlreadyPresent, NodeDoesNotExistException,
                                InvalidConnectionString, DrbdNotInstalledException,
                                CouldNotConnectToNodeException, InaccessibleNodeException,
                                MissingConfigurationException, NodeVersionMismatch,
-                               MCVirtTypeError)
+                               MCVirtTypeError, InvalidClusterSnapshotException,
+                               VmDirectoryAlreadyExistsException)
+from mcvirt.argument_validator import ArgumentValidator
+from mcvirt.config_file import ConfigFile
 from mcvirt.mcvirt_config import MCVirtConfig
 from mcvirt.auth.user_types.connection_user import ConnectionUser
 from mcvirt.auth.permissions import PERMISSIONS
 from mcvirt.client.rpc import Connection
 from mcvirt.cluster.remote import Node
+from mcvirt.cluster.health_monitor import DownNodePolicy
 from mcvirt.rpc.pyro_object import PyroObject
 from mcvirt.rpc.expose_method import Expose
 from mcvirt.syslogger import Syslogger
+from mcvirt.virtual_machine.virtual_machine import VirtualMachine
+from mcvirt.virtual_machine.virtual_machine_config import VirtualMachineConfig
 
 
 class Cluster(PyroObject):
     """Class to perform node management within the MCVirt cluster"""
 
+    # Version of the configuration snapshot format, used when joining nodes
+    SNAPSHOT_VERSION = 1
+
     @Expose()
     def generate_connection_info(self):
         """Generate required information to connect to this node from a remote node"""
@@ -114,7 +129,19 @@ class Cluster(PyroObject):
         def check_version(connection):
             node = connection.get_connection('node')
             return node.get_version()
-        node_versions = self.run_remote_command(check_version)
+
+        # Use the versions obtained by the node health monitor, only
+        # connecting to nodes whose version is not known
+        node_versions = {}
+        health_monitor = self._get_registered_object('node_health_monitor')
+        if health_monitor is not None:
+            for node in self.get_nodes():
+                version = health_monitor.get_node_version(node)
+                if version is not None:
+                    node_versions[node] = version
+        node_versions.update(self.run_remote_command(
+            check_version, nodes=[node for node in self.get_nodes() if node not in node_versions]
+        ))
         local_version = self._get_registered_object('node').get_version()
         for node in node_versions:
             if node_versions[node] != local_version:
@@ -331,136 +358,202 @@ class Cluster(PyroObject):
             remote_drbd = remote_node.get_connection('node_drbd')
             remote_drbd.enable(secret=MCVirtConfig().get_config()['drbd']['secret'])
 
-        # Sync users
-        self.sync_users(remote_node)
-
-        # Sync networks
-        self.sync_networks(remote_node)
+        # Transfer the users, networks, permissions and VMs to the new node as a
+        # single snapshot, which the node applies in one transaction
+        remote_cluster_instance.import_snapshot(self.export_snapshot())
 
-        # Sync global permissions
-        self.sync_permissions(remote_node)
-
-        # Sync VMs
-        self.sync_virtual_machines(remote_node)
+    def _get_distributed_user_types(self):
+        """Return the names of the user types that are shared across the cluster"""
+        user_factory = self._get_registered_object('user_factory')
+        return [user_type.__name__ for user_type in user_factory.get_user_types()
+                if user_type.DISTRIBUTED]
 
-        # Sync MCVirt configurations
-        self.sync_config(remote_node)
+    @staticmethod
+    def _get_snapshot_checksum(payload):
+        """Return the checksum of the contents of a configuration snapshot"""
+        return hashlib.sha256(json.dumps(payload, sort_keys=True)).hexdigest()
 
-    def sync_users(self, remote_node):
-        """Synchronise the local users with the remote node"""
-        # Remove all users on the remote node
-        remote_user_factory = remote_node.get_connection('user_factory')
-        for remote_user in remote_user_factory.get_all_users():
-            remote_node.annotate_object(remote_user)
-            if remote_user.is_locally_managed():
-                remote_user.delete()
+    def export_snapshot(self):
+        """Build a versioned snapshot of the global and VM configurations of the
+        cluster, used to populate a node that is joining the cluster
+        """
+        distributed_user_types = self._get_distributed_user_types()
+        virtual_machine_factory = self._get_registered_object('virtual_machine_factory')
 
-        user_factory = self._get_registered_object('user_factory')
-        for user in user_factory.get_all_users():
-            if user.is_locally_managed():
-                remote_user_factory.add_config(user.get_username(), user.get_config())
+        # Read all configurations whilst holding the update lock, so that the
+        # snapshot is consistent
+        with ConfigFile.UPDATE_LOCK:
+            config = MCVirtConfig().get_config()
+            virtual_machine_configs = {}
+            for vm_name in config['virtual_machines']:
+                vm_object = virtual_machine_factory.getVirtualMachineByName(vm_name)
+                virtual_machine_configs[vm_name] = vm_object.get_config_object().get_config()
+            replication_state = self._get_registered_object(
+                'config_replicator'
+            ).get_replication_state()
+
+        payload = {
+            'format_version': self.SNAPSHOT_VERSION,
+            'config_version': ConfigFile.CURRENT_VERSION,
+            'source_node': get_hostname(),
+            'created': int(time.time()),
+            'global': {
+                'users': dict((username, user_config)
+                              for username, user_config in config['users'].items()
+                              if user_config['user_type'] in distributed_user_types),
+                'superusers': config['superusers'],
+                'permissions': config['permissions'],
+                'networks': config['networks'],
+                'virtual_machines': config['virtual_machines'],
+                'drbd_allocations': config['drbd'].get('allocations'),
+                'git': config['git'],
+                'ldap': config['ldap'],
+                'migration': config['migration']
+            },
+            'virtual_machine_configs': virtual_machine_configs,
+            'replication_state': replication_state
+        }
+        return {'payload': payload, 'checksum': self._get_snapshot_checksum(payload)}
 
-    def sync_networks(self, remote_object):
-        """Add the local networks to the remote node"""
+    def _validate_snapshot(self, snapshot):
+        """Ensure that a configuration snapshot is intact, compatible with the
+        local node and does not conflict with objects on the local node
+        """
+        try:
+            payload = snapshot['payload']
+            for key in ['format_version', 'config_version', 'source_node',
+                        'global', 'virtual_machine_configs', 'replication_state']:
+                assert key in payload
+            for key in ['users', 'superusers', 'permissions', 'networks',
+                        'virtual_machines', 'drbd_allocations', 'git', 'ldap',
+                        'migration']:
+                assert key in payload['global']
+            checksum = snapshot['checksum']
+        except (KeyError, TypeError, AssertionError):
+            raise InvalidClusterSnapshotException('Configuration snapshot is malformed')
+
+        if payload['format_version'] != self.SNAPSHOT_VERSION:
+            raise InvalidClusterSnapshotException(
+                'Configuration snapshot format %s is not supported (expected %s)' %
+                (payload['format_version'], self.SNAPSHOT_VERSION))
+
+        if payload['config_version'] != ConfigFile.CURRENT_VERSION:
+            raise InvalidClusterSnapshotException(
+                'Configuration snapshot version %s does not match local configuration'
+                ' version %s' % (payload['config_version'], ConfigFile.CURRENT_VERSION))
+
+        if self._get_snapshot_checksum(payload) != checksum:
+            raise InvalidClusterSnapshotException('Configuration snapshot checksum is invalid')
+
+        if (sorted(payload['global']['virtual_machines']) !=
+                sorted(payload['virtual_machine_configs'].keys())):
+            raise InvalidClusterSnapshotException(
+                'Configuration snapshot does not contain the configuration for all VMs')
+
+        # Ensure that the interfaces for the networks exist on the local node
         network_factory = self._get_registered_object('network_factory')
+        for network_name, physical_interface in payload['global']['networks'].items():
+            ArgumentValidator.validate_network_name(network_name)
+            if not network_factory._interface_exists(physical_interface):
+                raise RemoteObjectConflict('Network interface %s does not exist on node %s' %
+                                           (physical_interface, get_hostname()))
 
-        # Remove all networks from remote node
-        remote_network_factory = remote_object.get_connection('network_factory')
-        for remote_network in remote_network_factory.get_all_network_objects():
-            remote_object.annotate_object(remote_network)
-            remote_network.delete()
-
-        for network in network_factory.get_all_network_objects():
-            remote_network_factory.create(name=network.get_name(),
-                                          physical_interface=network.get_adapter())
-
-    def sync_permissions(self, remote_object):
-        """Duplicate the global permissions on the local node onto the remote node"""
-        auth_instance = self._get_registered_object('auth')
-        remote_auth_instance = remote_object.get_connection('auth')
-        remote_user_factory = remote_object.get_connection('user_factory')
-
-        # Sync superusers
-        for superuser in auth_instance.get_superusers():
-            remote_user_object = remote_user_factory.get_user_by_username(superuser)
-            remote_object.annotate_object(remote_user_object)
-            if not remote_user_object.is_superuser():
-                remote_auth_instance.add_superuser(remote_user_object)
-
-        # Iterate over the permission groups, adding all of the members to the group
-        # on the remote node
-        for group in auth_instance.get_permission_groups():
-            users = auth_instance.get_users_in_permission_group(group)
-            for user in users:
-                user_object = remote_user_factory.get_user_by_username(user)
-                remote_object.annotate_object(user_object)
-                if (user_object.get_username() not in
-                        remote_auth_instance.get_users_in_permission_group(group)):
-                    remote_auth_instance.add_user_permission_group(group, user_object)
-
-    def sync_virtual_machines(self, remote_object):
-        """Duplicate the VM configurations on the local node onto the remote node"""
+        # Ensure that none of the VMs exist on the local node
         virtual_machine_factory = self._get_registered_object('virtual_machine_factory')
-        network_adapter_factory = self._get_registered_object('network_adapter_factory')
-        remote_virtual_machine_factory = remote_object.get_connection('virtual_machine_factory')
-
-        # Obtain list of local VMs
-        for vm_object in virtual_machine_factory.getAllVirtualMachines():
-            remote_virtual_machine_object = remote_virtual_machine_factory.create(
-                name=vm_object.get_name(), cpu_cores=vm_object.getCPU(),
-                memory_allocation=vm_object.getRAM(), hard_drives=[],
-                node=vm_object.getNode(), available_nodes=vm_object.getAvailableNodes()
-            )
-            remote_object.annotate_object(remote_virtual_machine_object)
+        for vm_name in payload['global']['virtual_machines']:
+            virtual_machine_factory.checkName(vm_name)
+            if os.path.exists(VirtualMachine._get_vm_dir(vm_name)):
+                raise VmDirectoryAlreadyExistsException(
+                    'VM directory already exists for %s on node %s' % (vm_name, get_hostname()))
 
-            # Add each of the disks to the VM
-            for hard_disk in vm_object.getHardDriveObjects():
-                remote_hard_drive_object = hard_disk.get_remote_object(remote_node=remote_object,
-                                                                       registered=False)
-                remote_hard_drive_object.addToVirtualMachine()
+        return payload
 
-            remote_network_factory = remote_object.get_connection('network_factory')
-            remote_network_adapter_factory = remote_object.get_connection(
-                'network_adapter_factory'
-            )
-            network_adapters = network_adapter_factory.getNetworkAdaptersByVirtualMachine(
-                vm_object
-            )
-            for network_adapter in network_adapters:
-                # Add network adapters to VM
-                remote_network = remote_network_factory.get_network_by_name(
-                    network_adapter.getConnectedNetwork())
-                remote_network_adapter_factory.create(remote_virtual_machine_object,
-                                                      remote_network,
-                                                      mac_address=network_adapter.getMacAddress())
-
-            # Sync permissions to VM on remote node
-            auth_instance = self._get_registered_object('auth')
-            remote_auth_instance = remote_object.get_connection('auth')
-            remote_user_factory = remote_object.get_connection('user_factory')
-            for group in auth_instance.get_permission_groups():
-                users = auth_instance.get_users_in_permission_group(group, vm_object)
-                for user in users:
-                    user_object = remote_user_factory.get_user_by_username(user)
-                    remote_object.annotate_object(user_object)
-                    remote_auth_instance.add_user_permission_group(group, user_object,
-                                                                   remote_virtual_machine_object)
-
-            # Set the VM node
-            remote_virtual_machine_object.setNodeRemote(vm_object.getNode())
-
-    def sync_config(self, remote_connection):
-        """Sync MCVirt configuration"""
-        config = MCVirtConfig().get_config()
-        remote_mcvirt_config_obj = remote_connection.get_connection('mcvirt_config')
-        remote_config = remote_mcvirt_config_obj.get_config_remote()
-
-        # Update Git and LDAP configuration to remote node
-        remote_config['git'] = config['git']
-        remote_config['ldap'] = config['ldap']
-        remote_mcvirt_config_obj.manual_update_config(remote_config,
-                                                      ('Update LDAP/Git configuration after'
-                                                       ' joining node to cluster.'))
+    @Expose(locking=True)
+    def import_snapshot(self, snapshot):
+        """Replace the users, networks, permissions and VMs on the local node with
+        those from a configuration snapshot of the cluster. The snapshot is applied
+        as a single transaction and committed in a single git commit.
+        """
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        payload = self._validate_snapshot(snapshot)
+        global_config = payload['global']
+        distributed_user_types = self._get_distributed_user_types()
+
+        network_factory = self._get_registered_object('network_factory')
+        mcvirt_config = MCVirtConfig()
+        original_config = mcvirt_config.get_config()
+        created_vm_dirs = []
+        defined_networks = []
+        config_files = [mcvirt_config.config_file]
+
+        try:
+            with ConfigFile.UPDATE_LOCK:
+                # Write the VM configurations
+                for vm_name, vm_config in payload['virtual_machine_configs'].items():
+                    vm_dir = VirtualMachine._get_vm_dir(vm_name)
+                    os.makedirs(vm_dir)
+                    created_vm_dirs.append(vm_dir)
+                    config_path = VirtualMachineConfig.get_config_path(vm_name)
+                    ConfigFile._writeJSON(vm_config, config_path)
+                    config_files.append(config_path)
+
+                # Replace the networks on the local node with those of the cluster
+                for network_name in original_config['networks']:
+                    network_factory._undefine_network(network_name)
+                for network_name, physical_interface in global_config['networks'].items():
+                    network_factory._define_network(network_name, physical_interface)
+                    defined_networks.append(network_name)
+
+                # Update the global configuration, retaining the users that are
+                # specific to the local node
+                config = mcvirt_config.get_config()
+                users = dict((username, user_config)
+                             for username, user_config in config['users'].items()
+                             if user_config['user_type'] not in distributed_user_types)
+                users.update(global_config['users'])
+                config['users'] = users
+                config['superusers'] = global_config['superusers']
+                config['permissions'] = global_config['permissions']
+                config['networks'] = global_config['networks']
+                config['virtual_machines'] = global_config['virtual_machines']
+                config['drbd']['allocations'] = global_config['drbd_allocations']
+                config['git'] = global_config['git']
+                config['ldap'] = global_config['ldap']
+                config['migration'] = global_config['migration']
+                ConfigFile._writeJSON(config, mcvirt_config.config_file)
+        except:
+            exc_info = sys.exc_info()
+
+            # Restore the original networks and remove the VM configurations
+            for network_name in defined_networks:
+                network_factory._undefine_network(network_name)
+            for network_name, physical_interface in original_config['networks'].items():
+                try:
+                    network_factory._define_network(network_name, physical_interface)
+                except Exception, e:
+                    Syslogger.logger().error('Failed to restore network %s: %s' %
+                                             (network_name, str(e)))
+            for vm_dir in created_vm_dirs:
+                shutil.rmtree(vm_dir, ignore_errors=True)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        # Remove cached objects for users that have been removed or replaced
+        user_factory = self._get_registered_object('user_factory')
+        for username, user_config in original_config['users'].items():
+            if (user_config['user_type'] in distributed_user_types and
+                    username in user_factory.CACHED_OBJECTS):
+                del user_factory.CACHED_OBJECTS[username]
+
+        # Continue configuration replication from the state of the snapshot
+        self._get_registered_object('config_replicator').set_replication_state(
+            payload['replication_state']
+        )
+
+        mcvirt_config.setConfigPermissions()
+        mcvirt_config.gitAddFiles(config_files,
+                                  'Imported configuration snapshot of %i VMs from %s' %
+                                  (len(global_config['virtual_machines']),
+                                   payload['source_node']))
 
     def check_remote_machine(self, remote_connection):
         """Perform checks on the remote node to ensure that there will be
@@ -590,13 +683,26 @@ class Cluster(PyroObject):
         cluster_config = self.get_cluster_config()
         return cluster_config['cluster_ip']
 
-    def get_remote_node(self, node, ignore_cluster_master=False, set_cluster_master=False):
-        """Obtain a Remote object for a node, caching the object"""
+    def get_remote_node(self, node, ignore_cluster_master=False, set_cluster_master=False,
+                        check_health=True):
+        """Obtain a Remote object for a node, caching the object.
+        Unless check_health is False, nodes that are known to be down are
+        treated as inaccessible without attempting to connect to them.
+        """
         if not self._is_cluster_master and not ignore_cluster_master:
             raise ClusterNotInitialisedException('Cannot get remote node %s' % node +
                                                  ' as the cluster is not initialised')
 
         node_config = self.get_node_config(node)
+        health_monitor = self._get_registered_object('node_health_monitor')
+        if check_health and health_monitor is not None and health_monitor.is_node_down(node):
+            if not self._cluster_disabled:
+                raise InaccessibleNodeException(
+                    'Cannot connect to node \'%s\': node is not responding to heartbeats' % node
+                )
+            Syslogger.logger().error('Node is not responding to heartbeats: %s (Ignored)' % node)
+            return None
+
         try:
             node_object = Node(
                 node, node_config,
@@ -631,17 +737,90 @@ class Cluster(PyroObject):
         return nodes
 
     def run_remote_command(self, callback_method, nodes=None, args=[], kwargs={},
-                           ignore_cluster_master=False):
-        """Run a remote command on all (or a given list of) remote nodes"""
+                           ignore_cluster_master=False, parallel=False,
+                           down_node_policy=DownNodePolicy.FAIL, return_errors=False):
+        """Run a remote command on all (or a given list of) remote nodes.
+        If parallel is set, the command is run on each of the nodes concurrently.
+        The down_node_policy determines whether nodes that are known to be down
+        cause the command to fail immediately, are skipped, or are connected to.
+        If return_errors is set, an exception connecting to or running the command
+        on a node is returned as the result for the node, rather than raised.
+        """
         return_data = {}
 
         # If the user has not specified a list of nodes, obtain all remote nodes
         if nodes is None:
             nodes = self.get_nodes()
+
+        health_monitor = self._get_registered_object('node_health_monitor')
+        if down_node_policy == DownNodePolicy.SKIP and health_monitor is not None:
+            down_nodes = [node for node in nodes if health_monitor.is_node_down(node)]
+            for node in down_nodes:
+                Syslogger.logger().warning('Skipping node that is not responding: %s' % node)
+            nodes = [node for node in nodes if node not in down_nodes]
+        check_health = (down_node_policy != DownNodePolicy.CONNECT)
+
+        if parallel:
+            return self._run_remote_command_parallel(
+                callback_method, nodes, args, kwargs, ignore_cluster_master, check_health,
+                return_errors
+            )
+
         for node in nodes:
-            node_object = self.get_remote_node(node, ignore_cluster_master=ignore_cluster_master)
-            if node_object is not None:
-                return_data[node] = callback_method(node_object, *args, **kwargs)
+            try:
+                node_object = self.get_remote_node(node,
+                                                   ignore_cluster_master=ignore_cluster_master,
+                                                   check_health=check_health)
+                if node_object is not None:
+                    return_data[node] = callback_method(node_object, *args, **kwargs)
+            except Exception, e:
+                if not return_errors:
+                    raise
+                return_data[node] = e
+        return return_data
+
+    def _run_remote_command_parallel(self, callback_method, nodes, args, kwargs,
+                                     ignore_cluster_master, check_health, return_errors=False):
+        """Run a remote command on each of the nodes in a separate thread,
+        re-raising the first exception once all threads have completed, unless
+        exceptions are returned as the result for each node
+        """
+        return_data = {}
+        exceptions = []
+
+        # The Pyro context (user, lock and cluster flags) is thread-local,
+        # so must be copied into each of the worker threads
+        context = dict(Pyro4.current_context.__dict__)
+
+        def run_on_node(node):
+            Pyro4.current_context.__dict__.update(context)
+            try:
+                node_object = self.get_remote_node(node,
+                                                   ignore_cluster_master=ignore_cluster_master,
+                                                   check_health=check_health)
+                if node_object is not None:
+                    return_data[node] = callback_method(node_object, *args, **kwargs)
+            except Exception, e:
+                if return_errors:
+                    return_data[node] = e
+                else:
+                    exceptions.append(sys.exc_info())
+            except:
+                exceptions.append(sys.exc_info())
+
+        threads = []
+        for node in nodes:
+            thread = threading.Thread(target=run_on_node, args=(node,),
+                                      name='RemoteCommand-%s' % node)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if exceptions:
+            exc_type, exc_value, exc_traceback = exceptions[0]
+            raise exc_type, exc_value, exc_traceback
+
         return return_data
 
     def check_node_exists(self, node_name):
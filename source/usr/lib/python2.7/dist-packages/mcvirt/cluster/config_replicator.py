@@ -0,0 +1,560 @@
+"""Provide replication of configuration changes between nodes"""
+
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+from collections import deque
+import hashlib
+import json
+import os
+import threading
+import time
+
+import Pyro4
+from texttable import Texttable
+
+from mcvirt.auth.permissions import PERMISSIONS
+from mcvirt.constants import DirectoryLocation
+from mcvirt.rpc.expose_method import Expose
+from mcvirt.rpc.pyro_object import PyroObject
+from mcvirt.syslogger import Syslogger
+from mcvirt.utils import get_hostname
+
+
+class ConfigLog(object):
+    """Store the change records of replicated configurations, along with the
+    version vector of the records that have been applied, the version of
+    each replicated configuration item and a logical clock.
+
+    Each record describes a change to a single configuration file, made on its
+    origin node, and has a sequence number that is incremented for each change
+    made on that node:
+        origin: node, seq: sequence number, time: time of change (epoch),
+        version: value of the logical clock of the origin node for the change,
+        file: path of the configuration file relative to the node storage directory,
+        set: list of [path, value] of items set, unset: list of paths of items removed
+    The logical clock is one greater than the greatest version of the records
+    recorded or applied by the node, so that the version of a change is greater
+    than that of any change that the origin node had seen, regardless of the
+    system clocks of the nodes.
+    The most recent MAX_RECORDS records for each origin are retained, so that
+    they can be sent to nodes that have not yet applied them.
+    """
+
+    MAX_RECORDS = 5000
+    RECORDS_FILE = 'records.log'
+    STATE_FILE = 'state.json'
+
+    def __init__(self, log_dir=DirectoryLocation.CONFIG_REPLICATION_DIR):
+        """Load the retained records and the replication state"""
+        self.log_dir = log_dir
+        self.records = {}
+        self.vector = {}
+        self.item_versions = {}
+        self.clock = 0
+        self.record_count = 0
+        self.persistent = True
+
+        try:
+            if not os.path.isdir(self.log_dir):
+                os.makedirs(self.log_dir)
+            self._load()
+        except (IOError, OSError), e:
+            # Continue with the records held in memory only
+            Syslogger.logger().error('Unable to open configuration replication log: %s' %
+                                     str(e))
+            self.persistent = False
+
+    def _get_path(self, file_name):
+        """Return the path of a file in the log directory"""
+        return os.path.join(self.log_dir, file_name)
+
+    def _load(self):
+        """Load the state and records from disk"""
+        try:
+            with open(self._get_path(self.STATE_FILE), 'r') as state_fh:
+                state = json.load(state_fh)
+            self.vector = state['vector']
+            self.clock = state['clock']
+            self.item_versions = state['item_versions']
+        except (IOError, ValueError, KeyError):
+            # Item versions from before the logical clock was stored are
+            # discarded, as they cannot be compared with the clock
+            pass
+
+        try:
+            with open(self._get_path(self.RECORDS_FILE), 'r') as records_fh:
+                for line in records_fh:
+                    try:
+                        self._retain(json.loads(line))
+                    except ValueError:
+                        # Ignore a partially written record
+                        pass
+        except IOError:
+            pass
+
+    def _retain(self, record):
+        """Add a record to the retained records"""
+        self.records.setdefault(
+            record['origin'], deque(maxlen=self.MAX_RECORDS)
+        ).append(record)
+        self.record_count += 1
+
+    def _compact(self):
+        """Rewrite the records file with only the retained records"""
+        temp_path = self._get_path(self.RECORDS_FILE + '.tmp')
+        with open(temp_path, 'w') as records_fh:
+            for origin_records in self.records.values():
+                for record in origin_records:
+                    records_fh.write(json.dumps(record, separators=(',', ':')) + '\n')
+        os.rename(temp_path, self._get_path(self.RECORDS_FILE))
+        self.record_count = sum(len(origin_records) for origin_records in self.records.values())
+
+    def save(self, new_records):
+        """Append new records to disk and write the replication state"""
+        if not self.persistent:
+            return
+        try:
+            with open(self._get_path(self.RECORDS_FILE), 'a') as records_fh:
+                for record in new_records:
+                    records_fh.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+            # Remove discarded records once the file is twice the size of the
+            # retained records
+            if self.record_count > 2 * self.MAX_RECORDS * max(len(self.records), 1):
+                self._compact()
+
+            temp_path = self._get_path(self.STATE_FILE + '.tmp')
+            with open(temp_path, 'w') as state_fh:
+                json.dump({'vector': self.vector, 'clock': self.clock,
+                           'item_versions': self.item_versions}, state_fh)
+            os.rename(temp_path, self._get_path(self.STATE_FILE))
+        except (IOError, OSError), e:
+            Syslogger.logger().error('Failed to write configuration replication log: %s' %
+                                     str(e))
+
+    def add(self, record):
+        """Retain a record, mark it as applied and advance the logical clock
+        to the version of the record
+        """
+        self._retain(record)
+        self.vector[record['origin']] = record['seq']
+        self.clock = max(self.clock, record.get('version', 0))
+
+    def get_next_version(self):
+        """Return the version for a new change made on the local node"""
+        return self.clock + 1
+
+    def get_records_since(self, vector, limit):
+        """Return retained records that are not covered by a version vector,
+        in sequence order for each origin, along with the origins for which
+        records required by the vector have been discarded
+        """
+        records = []
+        truncated = []
+        for origin, origin_records in self.records.items():
+            applied_seq = vector.get(origin, 0)
+            if not origin_records or origin_records[-1]['seq'] <= applied_seq:
+                continue
+            if origin_records[0]['seq'] > applied_seq + 1:
+                truncated.append(origin)
+            records.extend(record for record in origin_records if record['seq'] > applied_seq)
+        records.sort(key=lambda record: (record['origin'], record['seq']))
+        return records[:limit], truncated
+
+
+class ConfigReplicator(PyroObject):
+    """Replicate changes to configuration files to the other nodes in the cluster.
+
+    Changes made by the node acting as cluster master for a command are recorded
+    in the config log and pushed to the other nodes in batches by a background
+    thread. Periodically, each node requests the records that it has not applied
+    from each other node, using its version vector, so that nodes that were
+    unavailable catch up. Items are versioned by the logical clock value and origin
+    of the last change, so that the most recent change to an item is kept on all nodes.
+    """
+
+    INSTANCE = None
+    LOCK = threading.RLock()
+
+    # Maximum number of records sent to a node in a single call
+    BATCH_SIZE = 500
+
+    # Time (seconds) to wait for further changes before pushing records
+    FLUSH_INTERVAL = 1
+
+    # Time (seconds) between requests for missing records from other nodes
+    ANTI_ENTROPY_INTERVAL = 60
+
+    def __init__(self):
+        """Create member variables"""
+        self.config_log = None
+        self.condition = threading.Condition(threading.Lock())
+        self.new_records = []
+        self.connections = {}
+        self.thread = None
+
+    def initialise(self):
+        """Load the config log and start the replication thread"""
+        self.config_log = ConfigLog()
+        ConfigReplicator.INSTANCE = self
+        self.thread = threading.Thread(target=self._run, name='ConfigReplicator')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def get_file_key(config_file):
+        """Return the path of a configuration file, relative to the node storage directory"""
+        return os.path.relpath(config_file, DirectoryLocation.NODE_STORAGE_DIR)
+
+    @staticmethod
+    def get_config_file(file_key):
+        """Return the path of a configuration file on the local node"""
+        config_file = os.path.normpath(os.path.join(DirectoryLocation.NODE_STORAGE_DIR,
+                                                    file_key))
+        if not config_file.startswith(DirectoryLocation.NODE_STORAGE_DIR + '/'):
+            raise ValueError('Invalid configuration file: %s' % file_key)
+        return config_file
+
+    @staticmethod
+    def _get_item_key(path):
+        """Return the key used to store the version of a configuration item"""
+        return json.dumps(list(path))
+
+    @staticmethod
+    def record_change(config_file, original_state, state):
+        """Record the changes between two replicated states of a configuration file,
+        if the change is being made by the node acting as cluster master
+        """
+        replicator = ConfigReplicator.INSTANCE
+        if replicator is None:
+            return
+        if ('cluster_master' in dir(Pyro4.current_context) and
+                not Pyro4.current_context.cluster_master):
+            return
+
+        set_items = [[list(path), value] for path, value in state.items()
+                     if path not in original_state or original_state[path] != value]
+        unset_items = [list(path) for path in original_state if path not in state]
+        if not set_items and not unset_items:
+            return
+
+        file_key = ConfigReplicator.get_file_key(config_file)
+        with ConfigReplicator.LOCK:
+            config_log = replicator.config_log
+            record = {
+                'origin': get_hostname(),
+                'seq': config_log.vector.get(get_hostname(), 0) + 1,
+                'time': time.time(),
+                'version': config_log.get_next_version(),
+                'file': file_key,
+                'set': set_items,
+                'unset': unset_items
+            }
+            config_log.add(record)
+            item_versions = config_log.item_versions.setdefault(file_key, {})
+            for path in [item[0] for item in set_items] + unset_items:
+                item_versions[ConfigReplicator._get_item_key(path)] = [record['version'],
+                                                                       record['origin']]
+            config_log.save([record])
+
+        with replicator.condition:
+            replicator.new_records.append(record)
+            if len(replicator.new_records) >= replicator.BATCH_SIZE:
+                replicator.condition.notify()
+
+    @staticmethod
+    def _set_item(config, path, value):
+        """Set an item in a configuration, given its path"""
+        for key in path[:-1]:
+            config = config.setdefault(key, {})
+        config[path[-1]] = value
+
+    @staticmethod
+    def _unset_item(config, path):
+        """Remove an item from a configuration, given its path"""
+        for key in path[:-1]:
+            if key not in config:
+                return
+            config = config[key]
+        config.pop(path[-1], None)
+
+    def _apply_records(self, records):
+        """Apply records in sequence order for each origin, skipping records that
+        have been applied and stopping at any gap in the sequence. Return the
+        number of records added to the config log.
+        """
+        from mcvirt.config_file import ConfigFile
+        from mcvirt.mcvirt_config import MCVirtConfig
+
+        added = []
+        applied = []
+        loaded_files = {}
+        original_files = {}
+        with ConfigFile.UPDATE_LOCK:
+            with ConfigReplicator.LOCK:
+                config_log = self.config_log
+                for record in sorted(records, key=lambda record: (record['origin'],
+                                                                  record['seq'])):
+                    if (record['origin'] == get_hostname() or
+                            record['seq'] != config_log.vector.get(record['origin'], 0) + 1):
+                        continue
+
+                    config_file = self.get_config_file(record['file'])
+                    if not os.path.isfile(config_file):
+                        # The object does not exist on this node, such as a VM
+                        # that has not yet been created on it
+                        config_log.add(record)
+                        added.append(record)
+                        continue
+
+                    if config_file not in loaded_files:
+                        with open(config_file, 'r') as config_fh:
+                            loaded_files[config_file] = json.load(config_fh)
+                        original_files[config_file] = json.dumps(loaded_files[config_file],
+                                                                 sort_keys=True)
+                    config = loaded_files[config_file]
+
+                    # Only apply changes that are newer than the current version of each item
+                    item_versions = config_log.item_versions.setdefault(record['file'], {})
+                    record_version = [record.get('version', 0), record['origin']]
+                    for path, value in record['set']:
+                        item_key = self._get_item_key(path)
+                        if record_version >= item_versions.get(item_key, [0, '']):
+                            self._set_item(config, path, value)
+                            item_versions[item_key] = record_version
+                    for path in record['unset']:
+                        item_key = self._get_item_key(path)
+                        if record_version >= item_versions.get(item_key, [0, '']):
+                            self._unset_item(config, path)
+                            item_versions[item_key] = record_version
+
+                    config_log.add(record)
+                    added.append(record)
+                    applied.append(record)
+
+                # Only write configurations that have been modified, as changes
+                # may have already been made by the command on the origin node
+                changed_files = [config_file for config_file, config in loaded_files.items()
+                                 if json.dumps(config, sort_keys=True) !=
+                                 original_files[config_file]]
+                for config_file in changed_files:
+                    ConfigFile._writeJSON(loaded_files[config_file], config_file)
+                config_log.save(added)
+
+            if changed_files:
+                mcvirt_config = MCVirtConfig()
+                mcvirt_config.setConfigPermissions()
+                mcvirt_config.gitAddFiles(
+                    changed_files,
+                    'Applied %i replicated configuration changes' % len(applied)
+                )
+
+                # Update the node capacity totals for VMs whose configuration has changed
+                node_capacity = self._get_registered_object('node_capacity')
+                if node_capacity:
+                    node_capacity.update_config_files(changed_files)
+        return len(added)
+
+    @Expose()
+    def receive_config_records(self, records):
+        """Apply a batch of configuration change records pushed by a remote node"""
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        return self._apply_records(records)
+
+    @Expose()
+    def get_config_records(self, vector, limit=BATCH_SIZE):
+        """Return the records that are not covered by a remote node's version vector"""
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        with ConfigReplicator.LOCK:
+            records, truncated = self.config_log.get_records_since(vector, int(limit))
+        return {'records': records, 'truncated': truncated}
+
+    def get_replication_state(self):
+        """Return the version vector and item versions, used to initialise
+        the replication state of a node joining the cluster
+        """
+        with ConfigReplicator.LOCK:
+            return json.loads(json.dumps({'vector': self.config_log.vector,
+                                          'clock': self.config_log.clock,
+                                          'item_versions': self.config_log.item_versions}))
+
+    def set_replication_state(self, state):
+        """Set the replication state for a node that has joined the cluster"""
+        with ConfigReplicator.LOCK:
+            self.config_log.vector.update(state['vector'])
+            self.config_log.clock = max(self.config_log.clock, state['clock'])
+            self.config_log.item_versions = state['item_versions']
+            self.config_log.save([])
+
+    def _get_replicated_configs(self):
+        """Return the replicated configuration objects on the local node"""
+        from mcvirt.mcvirt_config import MCVirtConfig
+        config_objects = [MCVirtConfig()]
+        virtual_machine_factory = self._get_registered_object('virtual_machine_factory')
+        for vm_object in virtual_machine_factory.getAllVirtualMachines():
+            config_objects.append(vm_object.get_config_object())
+        return config_objects
+
+    @Expose()
+    def get_config_digest(self):
+        """Return the version vector and a digest of the replicated items of each
+        configuration file, so that nodes can be compared without transferring
+        the configurations
+        """
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        return self._get_config_digest()
+
+    def _get_config_digest(self):
+        """Return the version vector and configuration digests of the local node"""
+        digests = {}
+        for config_object in self._get_replicated_configs():
+            state = config_object._get_replicated_state(config_object.get_config())
+            state_data = json.dumps(sorted([list(path), value] for path, value in state.items()),
+                                    sort_keys=True)
+            digests[self.get_file_key(config_object.config_file)] = hashlib.sha256(
+                state_data
+            ).hexdigest()
+        with ConfigReplicator.LOCK:
+            vector = dict(self.config_log.vector)
+        return {'vector': vector, 'digests': digests}
+
+    @Expose()
+    def get_config_drift(self):
+        """Compare the configuration digests of the nodes in the cluster and
+        return a table of the configurations that differ from the local node
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_CLUSTER)
+        local_digest = self._get_config_digest()
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(('Node', 'Configuration', 'State'))
+
+        def compare_digest(node):
+            remote_digest = node.get_connection('config_replicator').get_config_digest()
+            for file_key in sorted(set(local_digest['digests'].keys()) |
+                                   set(remote_digest['digests'].keys())):
+                if file_key not in remote_digest['digests']:
+                    table.add_row((node.name, file_key, 'Missing on node'))
+                elif file_key not in local_digest['digests']:
+                    table.add_row((node.name, file_key, 'Missing on local node'))
+                elif local_digest['digests'][file_key] != remote_digest['digests'][file_key]:
+                    table.add_row((node.name, file_key, 'Differs'))
+
+            # Report origins for which the node has applied fewer changes
+            for origin, seq in sorted(local_digest['vector'].items()):
+                remote_seq = remote_digest['vector'].get(origin, 0)
+                if remote_seq < seq:
+                    table.add_row((node.name, 'Changes from %s' % origin,
+                                   '%i change(s) behind' % (seq - remote_seq)))
+
+        cluster = self._get_registered_object('cluster')
+        cluster.run_remote_command(compare_digest)
+        return table.draw()
+
+    def _get_remote_replicator(self, node):
+        """Return a cached connection to the config replicator of a remote node"""
+        if node not in self.connections:
+            cluster = self._get_registered_object('cluster')
+            remote_node = cluster.get_remote_node(node, ignore_cluster_master=True)
+            self.connections[node] = remote_node.get_connection('config_replicator')
+        return self.connections[node]
+
+    def _call_remote(self, node, method_name, *args):
+        """Call a method on the config replicator of a remote node, retrying once
+        with a new connection, as the session may have expired
+        """
+        try:
+            return getattr(self._get_remote_replicator(node), method_name)(*args)
+        except Exception:
+            self.connections.pop(node, None)
+            return getattr(self._get_remote_replicator(node), method_name)(*args)
+
+    def _push_records(self, nodes, records):
+        """Push new records to the remote nodes. Nodes that cannot be contacted
+        obtain the records during anti-entropy.
+        """
+        for node in nodes:
+            for index in range(0, len(records), self.BATCH_SIZE):
+                try:
+                    self._call_remote(node, 'receive_config_records',
+                                      records[index:index + self.BATCH_SIZE])
+                except Exception, e:
+                    self.connections.pop(node, None)
+                    Syslogger.logger().warning(
+                        'Failed to replicate configuration changes to %s: %s' % (node, str(e))
+                    )
+                    break
+
+    def _pull_records(self, node):
+        """Obtain and apply the records that have not been applied from a remote node"""
+        while True:
+            with ConfigReplicator.LOCK:
+                vector = dict(self.config_log.vector)
+            response = self._call_remote(node, 'get_config_records', vector, self.BATCH_SIZE)
+
+            # If the node no longer holds the records following those applied,
+            # continue from the oldest record that it holds
+            for origin in response['truncated']:
+                origin_records = [record for record in response['records']
+                                  if record['origin'] == origin]
+                if origin_records:
+                    Syslogger.logger().error(
+                        'Configuration changes from %s are no longer available from %s.'
+                        ' Configuration may differ between nodes.' % (origin, node)
+                    )
+                    with ConfigReplicator.LOCK:
+                        self.config_log.vector[origin] = origin_records[0]['seq'] - 1
+
+            if not self._apply_records(response['records']) or \
+                    len(response['records']) < self.BATCH_SIZE:
+                return
+
+    def _run(self):
+        """Push new records to remote nodes and periodically obtain missing records"""
+        next_anti_entropy = time.time()
+        while True:
+            with self.condition:
+                self.condition.wait(self.FLUSH_INTERVAL)
+                records = self.new_records
+                self.new_records = []
+
+            try:
+                nodes = self._get_registered_object('cluster').get_nodes()
+            except Exception, e:
+                Syslogger.logger().error('Unable to obtain nodes for config replication: %s' %
+                                         str(e))
+                continue
+
+            for node in self.connections.keys():
+                if node not in nodes:
+                    del self.connections[node]
+
+            if records:
+                self._push_records(nodes, records)
+
+            if time.time() >= next_anti_entropy:
+                next_anti_entropy = time.time() + self.ANTI_ENTROPY_INTERVAL
+                for node in nodes:
+                    try:
+                        self._pull_records(node)
+                    except Exception, e:
+                        self.connections.pop(node, None)
+                        Syslogger.logger().warning(
+                            'Failed to obtain configuration changes from %s: %s' %
+                            (node, str(e))
+                        )
@@ -0,0 +1,256 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+from collections import deque
+import threading
+import time
+
+from texttable import Texttable
+
+from mcvirt.auth.permissions import PERMISSIONS
+from mcvirt.cluster.remote import Node
+from mcvirt.rpc.expose_method import Expose
+from mcvirt.rpc.pyro_object import PyroObject
+from mcvirt.syslogger import Syslogger
+
+
+class NodeState(object):
+    """Liveness states of a remote node"""
+
+    UNKNOWN = 'Unknown'
+    UP = 'Up'
+    DOWN = 'Down'
+
+
+class DownNodePolicy(object):
+    """Handling of nodes that are known to be down when running remote commands"""
+
+    # Raise an exception without attempting to connect to the node
+    FAIL = 'fail'
+
+    # Do not run the command on the node
+    SKIP = 'skip'
+
+    # Attempt to connect to the node, regardless of its state
+    CONNECT = 'connect'
+
+
+class NodeHealthMonitor(PyroObject):
+    """Periodically send a heartbeat to each remote node, recording whether
+    the node is responding, the round-trip time of the heartbeat and the
+    version of MCVirt running on the node. The recorded state is used to
+    avoid waiting for connections to nodes that are known to be down.
+    """
+
+    # Time (seconds) between heartbeats
+    HEARTBEAT_INTERVAL = 5
+
+    # Time (seconds) after which a heartbeat that has not completed marks the node as down
+    HEARTBEAT_TIMEOUT = 3
+
+    # Time (seconds) after which the recorded state of a node is no longer used
+    STALE_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+
+    # Number of heartbeat round-trip times retained for each node
+    HISTORY_SIZE = 12
+
+    def __init__(self):
+        """Create member variables"""
+        self.lock = threading.Lock()
+        self.states = {}
+        self.connections = {}
+
+        # Start times of the heartbeats that are in progress, keyed by node
+        self.heartbeats = {}
+        self.thread = None
+
+    def initialise(self):
+        """Start the heartbeat thread"""
+        self.thread = threading.Thread(target=self._run, name='NodeHealthMonitor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _get_state(self, node):
+        """Return the state of a node, creating it if it does not exist.
+        The lock must be held by the caller.
+        """
+        if node not in self.states:
+            self.states[node] = {'status': NodeState.UNKNOWN, 'version': None, 'error': None,
+                                 'last_check': None, 'last_seen': None, 'failures': 0,
+                                 'rtt': deque(maxlen=self.HISTORY_SIZE)}
+        return self.states[node]
+
+    def _is_current(self, state):
+        """Determine if the state of a node was recorded recently enough to be used"""
+        return (state['last_check'] is not None and
+                time.time() - state['last_check'] <= self.STALE_TIMEOUT)
+
+    def is_node_down(self, node):
+        """Determine if a node is known to be down"""
+        with self.lock:
+            state = self.states.get(node)
+            return (state is not None and state['status'] == NodeState.DOWN and
+                    self._is_current(state))
+
+    def get_node_version(self, node):
+        """Return the version of MCVirt running on a node, if it is known to be up"""
+        with self.lock:
+            state = self.states.get(node)
+            if state is not None and state['status'] == NodeState.UP and self._is_current(state):
+                return state['version']
+        return None
+
+    def _record_success(self, node, version, rtt):
+        """Record a heartbeat response from a node"""
+        with self.lock:
+            state = self._get_state(node)
+            if state['status'] == NodeState.DOWN:
+                Syslogger.logger().info('Node %s is responding to heartbeats' % node)
+            state.update(status=NodeState.UP, version=version, error=None, failures=0,
+                         last_check=time.time(), last_seen=time.time())
+            state['rtt'].append(rtt)
+
+    def _record_failure(self, node, error):
+        """Record a heartbeat to a node that failed or did not complete in time"""
+        with self.lock:
+            state = self._get_state(node)
+            if state['status'] != NodeState.DOWN:
+                Syslogger.logger().warning('Node %s is not responding to heartbeats: %s' %
+                                           (node, error))
+            state.update(status=NodeState.DOWN, error=error, last_check=time.time())
+            state['failures'] += 1
+
+    def _send_heartbeat(self, node):
+        """Obtain the version of MCVirt running on a node, recording the round-trip
+        time of the request. The connection to each node is retained between
+        heartbeats, and re-created once if the request fails, as the session
+        may have expired.
+        """
+        try:
+            for attempt in range(2):
+                try:
+                    if node not in self.connections:
+                        node_config = self._get_registered_object('cluster').get_node_config(node)
+                        self.connections[node] = Node(node, node_config).get_connection('node')
+                    start_time = time.time()
+                    version = self.connections[node].get_version()
+                    self._record_success(node, version, time.time() - start_time)
+                    return
+                except Exception:
+                    self.connections.pop(node, None)
+                    if attempt:
+                        raise
+        except Exception, e:
+            self._record_failure(node, str(e) or e.__class__.__name__)
+        finally:
+            with self.lock:
+                self.heartbeats.pop(node, None)
+
+    def _run(self):
+        """Send heartbeats to each remote node"""
+        while True:
+            try:
+                nodes = self._get_registered_object('cluster').get_nodes(return_all=True)
+            except Exception, e:
+                Syslogger.logger().error('Unable to obtain nodes for heartbeat: %s' % str(e))
+                nodes = []
+
+            with self.lock:
+                for node in self.states.keys():
+                    if node not in nodes:
+                        del self.states[node]
+                        self.connections.pop(node, None)
+
+            for node in nodes:
+                with self.lock:
+                    heartbeat_start = self.heartbeats.get(node)
+                    if heartbeat_start is None:
+                        self.heartbeats[node] = time.time()
+
+                # Do not send another heartbeat whilst the previous heartbeat
+                # is blocked connecting to the node
+                if heartbeat_start is not None:
+                    continue
+
+                thread = threading.Thread(target=self._send_heartbeat, args=(node,),
+                                          name='Heartbeat-%s' % node)
+                thread.daemon = True
+                thread.start()
+
+            # Mark nodes with heartbeats that have not completed in time as down,
+            # rather than waiting for the connection to time out
+            time.sleep(self.HEARTBEAT_TIMEOUT)
+            with self.lock:
+                timed_out = [node for node, heartbeat_start in self.heartbeats.items()
+                             if time.time() - heartbeat_start > self.HEARTBEAT_TIMEOUT]
+            for node in timed_out:
+                self._record_failure(node, 'Heartbeat timed out')
+            time.sleep(max(self.HEARTBEAT_INTERVAL - self.HEARTBEAT_TIMEOUT, 0))
+
+    def _get_health(self):
+        """Return the state of each remote node"""
+        health = {}
+        with self.lock:
+            for node, state in self.states.items():
+                rtt = list(state['rtt'])
+                health[node] = {
+                    'status': state['status'] if self._is_current(state) else NodeState.UNKNOWN,
+                    'version': state['version'],
+                    'error': state['error'],
+                    'failures': state['failures'],
+                    'last_seen': state['last_seen'],
+                    'rtt': {
+                        'last': rtt[-1] if rtt else None,
+                        'average': sum(rtt) / len(rtt) if rtt else None,
+                        'maximum': max(rtt) if rtt else None
+                    }
+                }
+        return health
+
+    @Expose()
+    def get_health(self):
+        """Return the liveness, heartbeat round-trip times (seconds) and
+        MCVirt version of each remote node
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_CLUSTER)
+        return self._get_health()
+
+    @Expose()
+    def get_health_table(self):
+        """Return a table of the health of each remote node"""
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_CLUSTER)
+        local_version = self._get_registered_object('node').get_version()
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(('Node', 'Status', 'Version', 'RTT (ms)', 'Avg RTT (ms)',
+                      'Max RTT (ms)', 'Last seen', 'Failures', 'Error'))
+
+        def format_rtt(rtt):
+            return '%.1f' % (rtt * 1000) if rtt is not None else '-'
+
+        for node, health in sorted(self._get_health().items()):
+            version = health['version'] or '-'
+            if health['version'] and health['version'] != local_version:
+                version += ' (mismatch)'
+            last_seen = ('%is ago' % (time.time() - health['last_seen'])
+                         if health['last_seen'] else 'Never')
+            table.add_row((node, health['status'], version,
+                           format_rtt(health['rtt']['last']),
+                           format_rtt(health['rtt']['average']),
+                           format_rtt(health['rtt']['maximum']),
+                           last_seen, health['failures'], health['error'] or ''))
+        return table.draw()
@@ -0,0 +1,397 @@
+"""Provide lease-based locking of resources across the cluster"""
+
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+from contextlib import contextmanager
+from datetime import datetime
+import random
+import threading
+import time
+import uuid
+
+import Pyro4
+from texttable import Texttable
+
+from mcvirt.auth.permissions import PERMISSIONS
+from mcvirt.exceptions import (ClusterLockContentionException, ClusterLockExpiredException,
+                               ClusterLockQuorumException)
+from mcvirt.rpc.expose_method import Expose
+from mcvirt.rpc.pyro_object import PyroObject
+from mcvirt.syslogger import Syslogger
+from mcvirt.utils import get_hostname
+
+
+class ClusterLockManager(PyroObject):
+    """Grant leases on named resources, such as a VM, to commands.
+
+    The node running a command (the cluster master for the command) obtains
+    a lease on the resource from each node in the cluster. Each node grants
+    the lease if no other command holds a lease on the resource, or on the
+    'global' resource, which conflicts with all other resources. The lock
+    is only obtained if a majority of the nodes, including the local node,
+    grant the lease, so that the nodes on each side of a network partition
+    cannot both obtain a lock on the same resource. Leases expire unless
+    they are renewed, so the locks of a failed node are released. Each
+    lease has a fencing token, which increases for each lease granted by a
+    node. The tokens are sent with requests made to remote nodes whilst the
+    lock is held, so that requests from a command whose lease has expired
+    are rejected.
+    """
+
+    INSTANCE = None
+
+    # Resource used for commands that do not relate to a single object
+    GLOBAL_RESOURCE = 'global'
+
+    # Time (seconds) after which a lease expires if it has not been renewed
+    LEASE_TIMEOUT = 30
+
+    # Time (seconds) between renewals of the leases held by local commands
+    RENEW_INTERVAL = 10
+
+    # Time (seconds) to retry obtaining a lease that is held by another command
+    ACQUIRE_TIMEOUT = 5
+
+    # Maximum time (seconds) to wait between attempts to obtain a lease
+    RETRY_INTERVAL = 0.5
+
+    @staticmethod
+    def get_instance():
+        """Return the lock manager, creating it on first use"""
+        if ClusterLockManager.INSTANCE is None:
+            ClusterLockManager.INSTANCE = ClusterLockManager()
+        return ClusterLockManager.INSTANCE
+
+    def __init__(self):
+        """Create member variables"""
+        self.lock = threading.Lock()
+        self.leases = {}
+
+        # Fencing tokens are seeded from the current time, so that they
+        # continue to increase once the daemon has been restarted
+        self.last_token = int(time.time() * 1000)
+
+        # Resources and nodes of leases held by commands running on the local node,
+        # keyed by holder
+        self.held = {}
+        self.thread = None
+
+    def initialise(self):
+        """Start the lease renewal thread"""
+        self.thread = threading.Thread(target=self._renew_leases, name='ClusterLockManager')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def generate_holder():
+        """Return a unique ID for a command obtaining leases"""
+        return '%s:%s' % (get_hostname(), uuid.uuid4().hex)
+
+    @staticmethod
+    def _conflicts(resource, lease_resource):
+        """Determine if leases on two resources conflict. A lease on the global
+        resource conflicts with a lease on any other resource, in both directions,
+        so a global lease is only granted when no other command holds a lease.
+        The order in which resources are locked cannot cause a deadlock, as a
+        command that encounters a conflicting lease releases the leases that it
+        has obtained for the resource, rather than waiting whilst holding them.
+        """
+        return (resource == lease_resource or
+                ClusterLockManager.GLOBAL_RESOURCE in [resource, lease_resource])
+
+    def _expire_leases(self):
+        """Remove expired leases. The lock must be held by the caller."""
+        now = time.time()
+        for resource, lease in self.leases.items():
+            if lease['expiry'] < now:
+                Syslogger.logger().warning('Lease on %s held by %s has expired' %
+                                           (resource, lease['holder']))
+                del self.leases[resource]
+
+    def _grant_lease(self, resource, holder, node):
+        """Grant a lease on a resource, returning the fencing token of the lease.
+        If the lease conflicts with a lease held by another command, the
+        conflicting lease is returned instead.
+        """
+        with self.lock:
+            self._expire_leases()
+            for lease_resource, lease in self.leases.items():
+                if lease['holder'] != holder and self._conflicts(resource, lease_resource):
+                    return None, dict(lease, resource=lease_resource)
+
+            lease = self.leases.get(resource)
+            if lease is None:
+                self.last_token += 1
+                lease = {'holder': holder, 'node': node, 'token': self.last_token,
+                         'acquired': time.time()}
+                self.leases[resource] = lease
+            lease['expiry'] = time.time() + self.LEASE_TIMEOUT
+            return lease['token'], None
+
+    def _release_leases(self, holder, resources=None):
+        """Release the leases held by a command, or only those on the given resources"""
+        with self.lock:
+            for resource, lease in self.leases.items():
+                if lease['holder'] == holder and (resources is None or resource in resources):
+                    del self.leases[resource]
+
+    @Expose()
+    def grant_lease(self, resource, holder, node):
+        """Grant a lease on a resource to a command running on a remote node"""
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        token, conflict = self._grant_lease(resource, holder, node)
+        if conflict:
+            return {'token': None, 'holder': conflict['holder'], 'node': conflict['node'],
+                    'resource': conflict['resource']}
+        return {'token': token}
+
+    @Expose()
+    def release_leases(self, holder, resources=None):
+        """Release the leases held by a command running on a remote node"""
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        self._release_leases(holder, resources)
+
+    @Expose()
+    def renew_leases(self, holders):
+        """Renew the leases held by commands running on a remote node,
+        returning the holders that no longer hold a lease on this node
+        """
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        return self._renew_holder_leases(holders)
+
+    def _renew_holder_leases(self, holders):
+        """Extend the expiry of the leases held by the given commands on the local
+        node, returning the holders that no longer hold a lease on this node
+        """
+        with self.lock:
+            self._expire_leases()
+            renewed = set()
+            for lease in self.leases.values():
+                if lease['holder'] in holders:
+                    lease['expiry'] = time.time() + self.LEASE_TIMEOUT
+                    renewed.add(lease['holder'])
+        return [holder for holder in holders if holder not in renewed]
+
+    def validate_lock_context(self, lock_context):
+        """Ensure that a request sent by a command holding a lock has a fencing
+        token for a lease that is still held on this node
+        """
+        token = lock_context['tokens'].get(get_hostname())
+        if token is None:
+            # The node was not contactable when the lease was obtained
+            return
+        with self.lock:
+            self._expire_leases()
+            for lease in self.leases.values():
+                if lease['holder'] == lock_context['holder'] and lease['token'] == token:
+                    return
+        raise ClusterLockExpiredException(
+            'Lock held by %s has expired or been replaced' % lock_context['holder']
+        )
+
+    def _get_lock_nodes(self):
+        """Return the remote nodes from which leases are obtained"""
+        cluster = self._get_registered_object('cluster')
+        if cluster is None or ('STARTUP_PERIOD' in dir(Pyro4.current_context) and
+                               Pyro4.current_context.STARTUP_PERIOD):
+            return []
+        return sorted([node for node in cluster.get_nodes() if node != get_hostname()])
+
+    def _get_remote_lock_manager(self, node):
+        """Return the lock manager of a remote node, or None if it cannot be contacted"""
+        cluster = self._get_registered_object('cluster')
+        try:
+            remote_node = cluster.get_remote_node(node, ignore_cluster_master=True)
+            return remote_node.get_connection('cluster_lock_manager') if remote_node else None
+        except Exception, e:
+            Syslogger.logger().warning('Unable to obtain lock from %s: %s' % (node, str(e)))
+            return None
+
+    def _try_acquire(self, resource, holder, nodes):
+        """Attempt to obtain leases on a resource from the local and remote nodes.
+        Returns the fencing token from each node, or the conflicting lease. Leases
+        already obtained are released if a conflicting lease is found, or if the
+        leases are not granted by a majority of the nodes.
+        """
+        token, conflict = self._grant_lease(resource, holder, get_hostname())
+        if conflict:
+            return None, conflict
+        tokens = {get_hostname(): token}
+
+        for node in nodes:
+            remote_lock_manager = self._get_remote_lock_manager(node)
+            if remote_lock_manager is None:
+                # Nodes that cannot be contacted do not count towards the majority
+                continue
+            try:
+                response = remote_lock_manager.grant_lease(resource, holder, get_hostname())
+            except Pyro4.errors.CommunicationError, e:
+                # The node has stopped responding since the connection was obtained
+                Syslogger.logger().warning('Unable to obtain lock from %s: %s' % (node, str(e)))
+                continue
+            except Exception:
+                self._release(holder, [resource], tokens.keys())
+                raise
+            if response['token'] is None:
+                self._release(holder, [resource], tokens.keys())
+                return None, response
+            tokens[node] = response['token']
+
+        # Fail closed if the node is not in the majority of the cluster
+        quorum = (len(nodes) + 1) // 2 + 1
+        if len(tokens) < quorum:
+            self._release(holder, [resource], tokens.keys())
+            raise ClusterLockQuorumException(
+                'Unable to lock %s: only %i of %i nodes could be contacted' %
+                (resource, len(tokens), len(nodes) + 1)
+            )
+        return tokens, None
+
+    def acquire(self, resource, holder, cluster_wide=True):
+        """Obtain a lease on a resource for a command. If the resource is locked by
+        another command, retry for up to ACQUIRE_TIMEOUT seconds before failing,
+        rather than waiting for the other command to complete.
+        Returns the fencing tokens of the leases, keyed by node.
+        """
+        nodes = self._get_lock_nodes() if cluster_wide else []
+        give_up_time = time.time() + self.ACQUIRE_TIMEOUT
+        while True:
+            tokens, conflict = self._try_acquire(resource, holder, nodes)
+            if tokens is not None:
+                break
+            if time.time() >= give_up_time:
+                raise ClusterLockContentionException(
+                    '%s is locked by another command (%s on %s)' %
+                    (resource, conflict['resource'], conflict['node'])
+                )
+            time.sleep(random.uniform(0.1, self.RETRY_INTERVAL))
+
+        with self.lock:
+            held = self.held.setdefault(holder, {'resources': [], 'nodes': set()})
+            held['resources'].append(resource)
+            held['nodes'].update(tokens.keys())
+        return tokens
+
+    def _release(self, holder, resources, nodes):
+        """Release leases on the local and given remote nodes"""
+        self._release_leases(holder, resources)
+        for node in nodes:
+            if node == get_hostname():
+                continue
+            remote_lock_manager = self._get_remote_lock_manager(node)
+            if remote_lock_manager is None:
+                continue
+            try:
+                remote_lock_manager.release_leases(holder, resources)
+            except Exception, e:
+                # The lease will expire on the remote node
+                Syslogger.logger().warning('Failed to release lock on %s: %s' % (node, str(e)))
+
+    def release(self, holder, resources=None):
+        """Release the leases held by a command, or only those on the given resources"""
+        with self.lock:
+            held = self.held.get(holder)
+            if held is None:
+                return
+            if resources is None:
+                del self.held[holder]
+            else:
+                held['resources'] = [resource for resource in held['resources']
+                                     if resource not in resources]
+                if not held['resources']:
+                    del self.held[holder]
+            nodes = list(held['nodes'])
+        self._release(holder, resources, nodes)
+
+    @contextmanager
+    def lock_resource(self, resource):
+        """Obtain a lease on an additional resource whilst running a command that
+        already holds a lock, such as a resource shared between VMs. Leases are
+        only obtained by the node acting as cluster master for the command.
+        """
+        lock_context = (Pyro4.current_context.lock_context
+                        if 'lock_context' in dir(Pyro4.current_context) else None)
+        cluster_master = (Pyro4.current_context.cluster_master
+                          if 'cluster_master' in dir(Pyro4.current_context) else True)
+        if not lock_context or not cluster_master:
+            yield
+            return
+        with self.lock:
+            already_held = resource in self.held.get(lock_context['holder'],
+                                                     {}).get('resources', [])
+        if already_held:
+            yield
+            return
+
+        self.acquire(resource, lock_context['holder'])
+        try:
+            yield
+        finally:
+            self.release(lock_context['holder'], [resource])
+
+    def _renew_leases(self):
+        """Renew the leases held by local commands on each node"""
+        while True:
+            time.sleep(self.RENEW_INTERVAL)
+            with self.lock:
+                node_holders = {}
+                for holder, held in self.held.items():
+                    for node in held['nodes']:
+                        node_holders.setdefault(node, []).append(holder)
+
+            # Renew leases on the local node
+            for holder in self._renew_holder_leases(node_holders.get(get_hostname(), [])):
+                Syslogger.logger().error('Lock held by %s has been lost on %s' %
+                                         (holder, get_hostname()))
+
+            for node, holders in node_holders.items():
+                if node == get_hostname():
+                    continue
+                remote_lock_manager = self._get_remote_lock_manager(node)
+                if remote_lock_manager is None:
+                    continue
+                try:
+                    for holder in remote_lock_manager.renew_leases(holders):
+                        Syslogger.logger().error('Lock held by %s has been lost on %s' %
+                                                 (holder, node))
+                except Exception, e:
+                    Syslogger.logger().warning('Failed to renew locks on %s: %s' %
+                                               (node, str(e)))
+
+    def clear_leases(self):
+        """Remove all leases granted by the local node"""
+        with self.lock:
+            cleared = len(self.leases)
+            self.leases = {}
+            self.held = {}
+        return cleared
+
+    @Expose()
+    def get_lock_table(self):
+        """Return a table of the leases granted by the local node"""
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.SUPERUSER)
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(('Resource', 'Node', 'Holder', 'Token', 'Acquired', 'Expires in'))
+        with self.lock:
+            self._expire_leases()
+            for resource, lease in sorted(self.leases.items()):
+                table.add_row((resource, lease['node'], lease['holder'], lease['token'],
+                               str(datetime.fromtimestamp(int(lease['acquired']))),
+                               '%is' % (lease['expiry'] - time.time())))
+        return table.draw()
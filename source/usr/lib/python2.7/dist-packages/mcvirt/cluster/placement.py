@@ -0,0 +1,166 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+from texttable import Texttable
+
+from mcvirt.cluster.health_monitor import DownNodePolicy
+from mcvirt.exceptions import UnsuitableNodeException
+from mcvirt.utils import get_hostname
+
+
+class PlacementEngine(object):
+    """Rank the nodes in the cluster for hosting a new VM. The resources of
+    all nodes are obtained in a single parallel query, and each node is scored
+    on the memory, storage and CPU that would remain after adding the VM and
+    on the number of Drbd resources that the node already replicates.
+
+    Nodes that cannot be contacted, that do not support the storage type or
+    that do not have the space for the VM's disks are not eligible. A lack of
+    free memory reduces the score of a node, rather than excluding it, as the
+    VM is not started when it is created.
+    """
+
+    # Weights of each part of the score
+    MEMORY_WEIGHT = 0.4
+    DISK_WEIGHT = 0.3
+    CPU_WEIGHT = 0.2
+    DRBD_WEIGHT = 0.1
+
+    # vCPUs allocated per physical CPU at which the CPU score reaches zero
+    CPU_OVERCOMMIT = 4.0
+
+    # Number of Drbd resources at which the Drbd score is halved
+    DRBD_RESOURCE_SCALE = 10.0
+
+    def __init__(self, cluster, node):
+        """Store the cluster and local node objects"""
+        self.cluster = cluster
+        self.node = node
+
+    def get_node_facts(self, storage_type):
+        """Obtain the placement facts of the local node and all remote nodes,
+        querying the remote nodes in parallel. Nodes that could not be queried
+        have an error in place of their facts.
+        """
+        def get_facts(node_object):
+            return node_object.get_connection('node').get_placement_facts(storage_type)
+
+        node_facts = self.cluster.run_remote_command(callback_method=get_facts, parallel=True,
+                                                     down_node_policy=DownNodePolicy.SKIP,
+                                                     return_errors=True)
+        for node in self.cluster.get_nodes():
+            if node not in node_facts:
+                node_facts[node] = {'error': 'Node is not responding'}
+            elif isinstance(node_facts[node], Exception):
+                node_facts[node] = {'error': (str(node_facts[node]) or
+                                              node_facts[node].__class__.__name__)}
+        node_facts[get_hostname()] = self.node.get_placement_facts(storage_type)
+        return node_facts
+
+    def rank_nodes(self, node_facts, cpu_cores, memory_allocation, disk_size):
+        """Score each node for a VM with the given vCPUs, memory (KiB) and total
+        disk size (MiB). Returns the nodes, highest score first, with the reasons
+        for the score of each node.
+        """
+        max_free_disk = max([facts['free_disk'] for facts in node_facts.values()
+                             if facts.get('free_disk')] or [0])
+        ranking = []
+        for node, facts in node_facts.items():
+            rank = {'node': node, 'eligible': False, 'score': 0.0, 'reasons': [],
+                    'free_memory': None, 'free_disk': None, 'cpu_commitment': None,
+                    'drbd_resources': facts.get('drbd_resources')}
+            ranking.append(rank)
+            if 'error' in facts:
+                rank['reasons'].append(facts['error'])
+                continue
+            if not facts['storage_available']:
+                rank['reasons'].append('Storage type is not available')
+                continue
+
+            # Storage
+            disk_score = 1.0
+            if facts['free_disk'] is not None:
+                rank['free_disk'] = facts['free_disk'] - disk_size
+                if rank['free_disk'] < 0:
+                    rank['reasons'].append('Insufficient disk space')
+                    continue
+                if max_free_disk:
+                    disk_score = float(rank['free_disk']) / max_free_disk
+
+            # Memory
+            rank['free_memory'] = facts['free_memory'] - memory_allocation
+            memory_score = 0.0
+            if rank['free_memory'] < 0:
+                rank['reasons'].append('Insufficient free memory to run the VM')
+            elif facts['total_memory']:
+                memory_score = min(1.0, float(rank['free_memory']) / facts['total_memory'])
+
+            # CPU commitment, as vCPUs of running VMs per physical CPU
+            rank['cpu_commitment'] = (float(facts['allocated_cpu'] + cpu_cores) /
+                                      max(1, facts['cpu_count']))
+            cpu_score = max(0.0, 1.0 - rank['cpu_commitment'] / self.CPU_OVERCOMMIT)
+            if not cpu_score:
+                rank['reasons'].append('CPUs are overcommitted')
+
+            drbd_score = 1.0 / (1.0 + facts['drbd_resources'] / self.DRBD_RESOURCE_SCALE)
+
+            rank['eligible'] = True
+            rank['score'] = (self.MEMORY_WEIGHT * memory_score + self.DISK_WEIGHT * disk_score +
+                             self.CPU_WEIGHT * cpu_score + self.DRBD_WEIGHT * drbd_score)
+
+        return sorted(ranking, key=lambda rank: (not rank['eligible'], -rank['score'],
+                                                 rank['node']))
+
+    @staticmethod
+    def choose_nodes(ranking, node_count):
+        """Choose the nodes to host a VM from the ranking. The local node
+        is always used, as the VM is created from it.
+        """
+        local_rank = [rank for rank in ranking if rank['node'] == get_hostname()][0]
+        if not local_rank['eligible']:
+            raise UnsuitableNodeException('The local node is unable to host the VM: %s' %
+                                          ', '.join(local_rank['reasons']))
+
+        remote_nodes = [rank['node'] for rank in ranking
+                        if rank['eligible'] and rank['node'] != get_hostname()]
+        if len(remote_nodes) < node_count - 1:
+            raise UnsuitableNodeException(
+                '%i nodes are required, but only %i suitable nodes are available' %
+                (node_count, len(remote_nodes) + 1)
+            )
+        return [get_hostname()] + remote_nodes[:node_count - 1]
+
+    @staticmethod
+    def get_ranking_table(ranking, chosen_nodes=None):
+        """Return a table explaining the ranking of the nodes"""
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(('Node', 'Chosen', 'Score', 'Free memory after (MiB)',
+                      'Free disk after (MiB)', 'vCPU/CPU', 'Drbd resources', 'Notes'))
+        for rank in ranking:
+            table.add_row((
+                rank['node'],
+                'Yes' if chosen_nodes and rank['node'] in chosen_nodes else 'No',
+                '%.3f' % rank['score'] if rank['eligible'] else 'Ineligible',
+                rank['free_memory'] / 1024 if rank['free_memory'] is not None else '-',
+                rank['free_disk'] if rank['free_disk'] is not None else '-',
+                ('%.2f' % rank['cpu_commitment']
+                 if rank['cpu_commitment'] is not None else '-'),
+                rank['drbd_resources'] if rank['drbd_resources'] is not None else '-',
+                ', '.join(rank['reasons'])
+            ))
+        return table.draw()
@@ -21,6 +21,7 @@ import json
 import os
 import stat
 import pwd
+import threading
 
 from mcvirt.utils import get_hostname
 from mcvirt.system import System
@@ -34,9 +35,13 @@ from mcvirt.exceptions import UserDoesNotExistException
 class ConfigFile(PyroObject):
     """Provides operations to obtain and set the MCVirt configuration for a VM"""
 
-    CURRENT_VERSION = 10
+    CURRENT_VERSION = 16
     GIT = '/usr/bin/git'
 
+    # Lock to prevent concurrent updates of configuration files, which may be
+    # performed by worker threads, such as during autostart
+    UPDATE_LOCK = threading.RLock()
+
     def __init__(self):
         """Set member variables and obtains libvirt domain object"""
         raise NotImplementedError
@@ -64,19 +69,41 @@ class ConfigFile(PyroObject):
     def manual_update_config(self, config, reason=''):
         """Provide an exposed method for updating the config"""
         self._get_registered_object('auth').assert_permission(PERMISSIONS.SUPERUSER)
-        ConfigFile._writeJSON(config, self.config_file)
-        self.config = config
-        self.gitAdd(reason)
-        self.setConfigPermissions()
-
-    def update_config(self, callback_function, reason=''):
+        with ConfigFile.UPDATE_LOCK:
+            original_state = self._get_replicated_state(self.get_config())
+            ConfigFile._writeJSON(config, self.config_file)
+            self.config = config
+            self.gitAdd(reason)
+            self.setConfigPermissions()
+            self._record_change(original_state, config)
+
+    def update_config(self, callback_function, reason='', replicate=True):
         """Write a provided configuration back to the configuration file."""
-        config = self.get_config()
-        callback_function(config)
-        ConfigFile._writeJSON(config, self.config_file)
-        self.config = config
-        self.gitAdd(reason)
-        self.setConfigPermissions()
+        with ConfigFile.UPDATE_LOCK:
+            config = self.get_config()
+            original_state = self._get_replicated_state(self.get_config()) if replicate else None
+            callback_function(config)
+            ConfigFile._writeJSON(config, self.config_file)
+            self.config = config
+            self.gitAdd(reason)
+            self.setConfigPermissions()
+            self._record_change(original_state, config)
+
+    def _get_replicated_state(self, config):
+        """Return the items of the configuration that are replicated to the
+        other nodes in the cluster, keyed by their path in the configuration.
+        Configuration files are not replicated unless overridden.
+        """
+        return None
+
+    def _record_change(self, original_state, config):
+        """Record changes to the replicated items of the configuration in the
+        config log, so that they are replicated to the other nodes"""
+        if original_state is None:
+            return
+        from mcvirt.cluster.config_replicator import ConfigReplicator
+        ConfigReplicator.record_change(self.config_file, original_state,
+                                       self._get_replicated_state(config))
 
     def getPermissionConfig(self):
         """Obtain the permission config"""
@@ -125,9 +152,10 @@ class ConfigFile(PyroObject):
                     set_permission(os.path.join(path, 'vm'), directory=True)
                     set_permission(os.path.join(path, 'config.json'), directory=False)
 
-        # Set permission for base directory, node directory and ISO directory
+        # Set permission for base directory, node directory, ISO directory
+        # and disk image directory
         for directory in [DirectoryLocation.BASE_STORAGE_DIR, DirectoryLocation.NODE_STORAGE_DIR,
-                          DirectoryLocation.ISO_STORAGE_DIR]:
+                          DirectoryLocation.ISO_STORAGE_DIR, DirectoryLocation.DISK_IMAGE_DIR]:
             set_permission(directory, directory=True,
                            owner=pwd.getpwnam('libvirt-qemu').pw_uid)
 
@@ -147,12 +175,15 @@ class ConfigFile(PyroObject):
                 # Update the version number of the configuration file to
                 # the current version
                 config['version'] = self.CURRENT_VERSION
+
+            # Upgrades are performed on each node, so are not replicated
             self.update_config(
                 upgradeConfig,
                 'Updated configuration file \'%s\' from version \'%s\' to \'%s\'' %
                 (self.config_file,
                  current_version,
-                 self.CURRENT_VERSION))
+                 self.CURRENT_VERSION),
+                replicate=False)
 
     def _getVersion(self):
         """Return the version number of the configuration file"""
@@ -164,6 +195,11 @@ class ConfigFile(PyroObject):
 
     def gitAdd(self, message=''):
         """Commit changes to an added or modified configuration file"""
+        self.gitAddFiles([self.config_file], message)
+
+    def gitAddFiles(self, config_files, message=''):
+        """Commit changes to several added or modified configuration files
+        in a single commit"""
         if self._checkGitRepo():
             session_obj = self._get_registered_object('mcvirt_session')
             username = ''
@@ -177,13 +213,12 @@ class ConfigFile(PyroObject):
                 username = session_obj.get_proxy_user_object().get_username()
             message += "\nUser: %s\nNode: %s" % (username, get_hostname())
             try:
-                System.runCommand([self.GIT, 'add', self.config_file],
+                System.runCommand([self.GIT, 'add'] + list(config_files),
                                   cwd=DirectoryLocation.BASE_STORAGE_DIR)
                 System.runCommand([self.GIT,
                                    'commit',
                                    '-m',
-                                   message,
-                                   self.config_file],
+                                   message] + list(config_files),
                                   cwd=DirectoryLocation.BASE_STORAGE_DIR)
                 System.runCommand([self.GIT,
                                    'push'],
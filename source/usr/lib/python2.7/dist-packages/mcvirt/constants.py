@@ -29,9 +29,12 @@ class DirectoryLocation(object):
     NODE_STORAGE_DIR = BASE_STORAGE_DIR + '/' + get_hostname()
     BASE_VM_STORAGE_DIR = NODE_STORAGE_DIR + '/vm'
     ISO_STORAGE_DIR = NODE_STORAGE_DIR + '/iso'
+    DISK_IMAGE_DIR = NODE_STORAGE_DIR + '/disk'
     LOCK_FILE_DIR = '/var/run/lock/mcvirt'
     LOCK_FILE = LOCK_FILE_DIR + '/lock'
     LOG_FILE = '/var/log/mcvirt.log'
+    COMMAND_LOG_DIR = '/var/log/mcvirt-commands'
+    CONFIG_REPLICATION_DIR = '/var/lib/mcvirt-replication'
     DRBD_HOOK_CONFIG = NODE_STORAGE_DIR + '/drbd-hook-config.json'
 
 
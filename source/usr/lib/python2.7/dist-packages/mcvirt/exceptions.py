@@ -106,6 +106,12 @@ class RemoteObjectConflict(MCVirtException):
     pass
 
 
+class InvalidClusterSnapshotException(MCVirtException):
+    """The cluster configuration snapshot is invalid or incompatible"""
+
+    pass
+
+
 class ClusterNotInitialisedException(MCVirtException):
     """The cluster has not been initialised, so cannot connect to the remote node"""
 
@@ -228,6 +234,24 @@ class IsoInUseException(MCVirtException):
     pass
 
 
+class IsoChecksumMismatchException(MCVirtException):
+    """The checksum of the ISO does not match the expected checksum"""
+
+    pass
+
+
+class IncompleteIsoUploadException(MCVirtException):
+    """The ISO upload has not received all of the data"""
+
+    pass
+
+
+class IsoDownloadInProgressException(MCVirtException):
+    """The ISO is already being downloaded or uploaded"""
+
+    pass
+
+
 class DrbdNotInstalledException(MCVirtException):
     """Drbd is not installed"""
 
@@ -354,6 +378,18 @@ class DrbdVolumeNotInSyncException(MCVirtException):
     pass
 
 
+class DrbdAllocationConflictException(MCVirtException):
+    """The Drbd port or minor is already allocated to another resource"""
+
+    pass
+
+
+class InvalidResyncPolicyException(MCVirtException):
+    """The Drbd resync policy is not valid"""
+
+    pass
+
+
 class InsufficientSpaceException(MCVirtException):
     """A hard drive object was initialised when the volume group did not have enough space."""
 
@@ -384,6 +420,18 @@ class MigrationFailureExcpetion(MCVirtException):
     pass
 
 
+class InvalidMigrationOptionsException(MCVirtException):
+    """The live migration tuning options are not valid"""
+
+    pass
+
+
+class EvacuationInProgressException(MCVirtException):
+    """An evacuation of the node is already in progress"""
+
+    pass
+
+
 class InvalidVirtualMachineNameException(MCVirtException):
     """VM is being created with an invalid name"""
 
@@ -510,6 +558,18 @@ class DiskAlreadyExistsException(MCVirtException):
     pass
 
 
+class BackingImageDoesNotExistException(MCVirtException):
+    """The backing image for a disk overlay does not exist"""
+
+    pass
+
+
+class InvalidBackingImageException(MCVirtException):
+    """The backing image for a disk overlay is not in the disk image directory"""
+
+    pass
+
+
 class MCVirtCommandException(MCVirtException):
     """Provides an exception to be thrown after errors whilst calling external commands"""
 
@@ -636,6 +696,30 @@ class UnknownLdapError(MCVirtException):
     pass
 
 
+class ClusterLockContentionException(MCVirtException):
+    """The cluster lock on a resource is held by another command"""
+
+    pass
+
+
+class ClusterLockQuorumException(ClusterLockContentionException):
+    """The cluster lock could not be obtained from a majority of the nodes"""
+
+    pass
+
+
+class ClusterLockExpiredException(MCVirtException, Pyro4.errors.SecurityError):
+    """The cluster lock held by a remote command has expired"""
+
+    pass
+
+
+class InvalidMetricException(MCVirtException):
+    """The requested VM metric does not exist"""
+
+    pass
+
+
 for exception_class in get_all_submodules(MCVirtException):
     Pyro4.util.all_exceptions[
         '%s.%s' % (exception_class.__module__, exception_class.__name__)
@@ -20,15 +20,26 @@
 import os
 import urllib2
 import urlparse
-import tempfile
 import shutil
 import binascii
+import base64
+import hashlib
+import json
+import threading
+import time
+import Pyro4
+from texttable import Texttable
 
 from mcvirt.iso.iso import Iso
 from mcvirt.rpc.pyro_object import PyroObject
 from mcvirt.rpc.expose_method import Expose
 from mcvirt.constants import DirectoryLocation
-from mcvirt.exceptions import InvalidISOPathException
+from mcvirt.exceptions import (InvalidISOPathException, InsufficientPermissionsException,
+                               IsoChecksumMismatchException, IncompleteIsoUploadException,
+                               IsoDownloadInProgressException, IsoAlreadyExistsException,
+                               MCVirtException)
+from mcvirt.logger import Logger
+from mcvirt.syslogger import Syslogger
 from mcvirt.auth.permissions import PERMISSIONS
 from mcvirt.utils import get_hostname
 
@@ -39,6 +50,39 @@ class Factory(PyroObject):
     ISO_CLASS = Iso
     CACHED_OBJECTS = {}
 
+    # In-progress ISO uploads and downloads, keyed by ISO name, which are
+    # checked and modified whilst holding the transfer lock
+    UPLOADS = {}
+    DOWNLOADS = {}
+    TRANSFER_LOCK = threading.RLock()
+
+    # Directory, within the ISO directory, that partial uploads are written to,
+    # so that they are not listed as ISOs and can be moved into place atomically
+    UPLOAD_DIR = DirectoryLocation.ISO_STORAGE_DIR + '/.uploads'
+
+    # Index of the SHA256 checksums of the ISOs, allowing ISOs to be
+    # located by content and deduplicated
+    CATALOGUE_FILE = DirectoryLocation.ISO_STORAGE_DIR + '/.catalogue.json'
+    CATALOGUE_LOCK = threading.RLock()
+
+    # Size of the chunks used when replicating ISOs to other nodes
+    REPLICATION_CHUNK_SIZE = 4 * 1024 * 1024
+
+    # Index of the ISO attached to each of the VMs registered on the node,
+    # keyed by VM name. This is built when the daemon starts and updated as
+    # ISOs are attached and removed, to avoid obtaining the domain XML of
+    # every VM when determining whether an ISO is in use.
+    ISO_ATTACHMENTS = None
+    ATTACHMENT_LOCK = threading.RLock()
+
+    def initialise(self):
+        """Build the index of ISOs attached to VMs"""
+        try:
+            self._rebuild_attachment_index()
+        except Exception, e:
+            # The index will be built when it is first used
+            Syslogger.logger().error('Failed to build ISO attachment index: %s' % str(e))
+
     def get_remote_factory(self, node=None):
         if node is None or node == get_hostname():
             return self
@@ -47,6 +91,21 @@ class Factory(PyroObject):
         node.annotate_object(remote_factory)
         return remote_factory
 
+    @staticmethod
+    def get_iso_name(name):
+        """Return the name of an ISO supplied by a client, ensuring that it
+        cannot be used to access a path outside of the ISO directory
+        """
+        if '/' in name or '..' in name:
+            raise InvalidISOPathException('Error: \'%s\' is not a valid ISO name' % name)
+        name = Iso.get_filename_from_path(name)
+
+        # Hidden files, such as the catalogue and the upload directory,
+        # are not ISOs
+        if name.startswith('.'):
+            raise InvalidISOPathException('Error: \'%s\' is not a valid ISO name' % name)
+        return name
+
     @Expose()
     def get_isos(self):
         """Return a list of a ISOs"""
@@ -56,7 +115,8 @@ class Factory(PyroObject):
 
         for iso_name in file_list:
             iso_path = os.path.join(DirectoryLocation.ISO_STORAGE_DIR, iso_name)
-            if os.path.isfile(iso_path):
+            # Ignore hidden files, such as the ISO catalogue
+            if os.path.isfile(iso_path) and not iso_name.startswith('.'):
                 iso_list.append(iso_name)
         return iso_list
 
@@ -70,12 +130,84 @@ class Factory(PyroObject):
 
     @Expose()
     def get_iso_list(self, node=None):
-        """Return a user-readable list of ISOs"""
-        iso_list = self.get_remote_factory(node).get_isos()
+        """Return a user-readable list of ISOs and the number of VMs they are attached to"""
+        iso_factory = self.get_remote_factory(node)
+        iso_list = iso_factory.get_isos()
         if len(iso_list) == 0:
             return 'No ISOs found'
-        else:
-            return "\n".join(iso_list)
+
+        attachments = iso_factory.get_iso_attachments()
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(('Name', 'Attached VMs'))
+        for iso_name in sorted(iso_list):
+            table.add_row((iso_name, len(attachments.get(iso_name, []))))
+        return table.draw()
+
+    @staticmethod
+    def _get_attached_iso_name(vm_object):
+        """Return the name of the ISO attached to a VM, from its domain XML"""
+        domain_config = vm_object.getLibvirtConfig()
+        source_xml = domain_config.find('./devices/disk[@device="cdrom"]/source')
+        if source_xml is not None and source_xml.get('file'):
+            return Iso.get_filename_from_path(source_xml.get('file'))
+        return None
+
+    def _rebuild_attachment_index(self):
+        """Build the index of ISOs attached to the VMs registered on the node"""
+        virtual_machine_factory = self._get_registered_object('virtual_machine_factory')
+        attachments = {}
+        for vm_name in virtual_machine_factory.getAllVmNames(node=get_hostname()):
+            vm_object = virtual_machine_factory.getVirtualMachineByName(vm_name)
+            iso_name = self._get_attached_iso_name(vm_object)
+            if iso_name:
+                attachments[vm_name] = iso_name
+
+        with Factory.ATTACHMENT_LOCK:
+            Factory.ISO_ATTACHMENTS = attachments
+
+    def _set_iso_attachment(self, vm_name, iso_name):
+        """Record the ISO attached to a VM, or that no ISO is attached if iso_name is None"""
+        with Factory.ATTACHMENT_LOCK:
+            # If the index has not been built, it will be built from the
+            # domain XML when it is first used
+            if Factory.ISO_ATTACHMENTS is None:
+                return
+            if iso_name:
+                Factory.ISO_ATTACHMENTS[vm_name] = iso_name
+            elif vm_name in Factory.ISO_ATTACHMENTS:
+                del Factory.ISO_ATTACHMENTS[vm_name]
+
+    @Expose()
+    def refresh_iso_attachment(self, vm_name):
+        """Update the index of attached ISOs for a VM from its domain XML, such as
+        after the VM has been migrated to the node
+        """
+        virtual_machine_factory = self._get_registered_object('virtual_machine_factory')
+        vm_object = virtual_machine_factory.getVirtualMachineByName(vm_name)
+        self._set_iso_attachment(vm_name, self._get_attached_iso_name(vm_object))
+
+    @Expose()
+    def get_iso_attachments(self):
+        """Return the names of the VMs registered on the node that each ISO is attached to"""
+        with Factory.ATTACHMENT_LOCK:
+            if Factory.ISO_ATTACHMENTS is None:
+                self._rebuild_attachment_index()
+            attachments = dict(Factory.ISO_ATTACHMENTS)
+
+        # Remove VMs that are no longer registered on the node, such as
+        # VMs that have been migrated away
+        registered_vms = self._get_registered_object(
+            'virtual_machine_factory'
+        ).getAllVmNames(node=get_hostname())
+
+        iso_attachments = {}
+        for vm_name, iso_name in attachments.items():
+            if vm_name in registered_vms:
+                iso_attachments.setdefault(iso_name, []).append(vm_name)
+            else:
+                self._set_iso_attachment(vm_name, None)
+        return iso_attachments
 
     def add_iso(self, path):
         """Copy an ISO to ISOs directory"""
@@ -90,79 +222,329 @@ class Factory(PyroObject):
 
         return self.get_iso_by_name(filename)
 
-    @Expose(locking=True)
-    def add_from_url(self, url, name=None, node=None):
-        """Download an ISO from given URL and save in ISO directory"""
+    @Expose()
+    def add_from_url(self, url, name=None, node=None, checksum=None, wait=True):
+        """Download an ISO from given URL and save in ISO directory.
+        The download is performed in a background job, without holding the
+        method lock, and its progress is recorded in the log. If wait is False,
+        the name of the ISO is returned once the download has started.
+        """
         self._get_registered_object('auth').assert_permission(
             PERMISSIONS.MANAGE_ISO
         )
 
         if node is not None and node != get_hostname():
-            remote_node = self._get_registered_object('cluster').get_remote_node(node)
-            remote_factory = remote_node.get_connection('iso_factory')
-            remote_iso = remote_factory.add_from_url(url=url, name=name)
-            remote_node.annotate_object(remote_iso)
-            return remote_iso.get_name()
+            remote_factory = self.get_remote_factory(node)
+            return remote_factory.add_from_url(url=url, name=name, checksum=checksum,
+                                               wait=wait)
 
         # Work out name from URL if name is not supplied
         if name is None:
             # Parse URL to get path part
             url_parse = urlparse.urlparse(url)
             name = Iso.get_filename_from_path(url_parse.path)
+        name = self.get_iso_name(name)
 
-        # Get temporary directory to store ISO
-        temp_directory = tempfile.mkdtemp()
-        output_path = temp_directory + '/' + name
-
-        # Open file
-        iso = urllib2.urlopen(url)
+        Iso.overwrite_check(name, DirectoryLocation.ISO_STORAGE_DIR + '/' + name)
 
-        # Read file in 16KB chunks
-        chunk_size = 16 * 1024
+        if not os.path.isdir(self.UPLOAD_DIR):
+            os.makedirs(self.UPLOAD_DIR)
 
-        # Save ISO
-        with open(output_path, 'wb') as file:
+        if 'proxy_user' in dir(Pyro4.current_context) and Pyro4.current_context.proxy_user:
+            username = Pyro4.current_context.proxy_user
+        elif 'username' in dir(Pyro4.current_context):
+            username = Pyro4.current_context.username
+        else:
+            username = ''
+
+        # Check for, and register, the download atomically, as the method
+        # lock is not held
+        with Factory.TRANSFER_LOCK:
+            if name in Factory.DOWNLOADS or name in Factory.UPLOADS:
+                raise IsoDownloadInProgressException('ISO is already being added: %s' % name)
+            log = Logger.get_logger().create_log('add_from_url', user=username,
+                                                 object_name=name, object_type='iso')
+            download_job = IsoDownloadJob(self, url, name, checksum, log)
+            Factory.DOWNLOADS[name] = download_job
+        download_job.start()
+
+        if wait:
+            download_job.join()
+            if download_job.exception is not None:
+                raise download_job.exception
+        return name
+
+    def _read_catalogue(self):
+        """Return the catalogue of ISO checksums, keyed by ISO name"""
+        try:
+            with open(self.CATALOGUE_FILE, 'r') as catalogue_fh:
+                return json.load(catalogue_fh)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_catalogue(self, catalogue):
+        """Atomically replace the catalogue of ISO checksums"""
+        temp_file = '%s.tmp' % self.CATALOGUE_FILE
+        with open(temp_file, 'w') as catalogue_fh:
+            json.dump(catalogue, catalogue_fh)
+        os.rename(temp_file, self.CATALOGUE_FILE)
+
+    @staticmethod
+    def _calculate_checksum(path):
+        """Calculate the SHA256 checksum of a file"""
+        checksum = hashlib.sha256()
+        with open(path, 'rb') as iso_fh:
             while True:
-                chunk = iso.read(chunk_size)
-                if not chunk:
+                data = iso_fh.read(Factory.REPLICATION_CHUNK_SIZE)
+                if not data:
                     break
-                file.write(chunk)
-        iso.close()
+                checksum.update(data)
+        return checksum.hexdigest()
+
+    def _get_catalogue_entry(self, catalogue, iso_name):
+        """Return the catalogue entry for an ISO, calculating the checksum if
+        the ISO is not in the catalogue or has changed since it was indexed.
+        Returns True as the second element if the catalogue has been updated.
+        """
+        iso_stat = os.stat(os.path.join(DirectoryLocation.ISO_STORAGE_DIR, iso_name))
+        entry = catalogue.get(iso_name)
+        if (entry and entry['size'] == iso_stat.st_size and
+                entry['mtime'] == int(iso_stat.st_mtime)):
+            return entry, False
+
+        entry = {
+            'sha256': self._calculate_checksum(
+                os.path.join(DirectoryLocation.ISO_STORAGE_DIR, iso_name)
+            ),
+            'size': iso_stat.st_size,
+            'mtime': int(iso_stat.st_mtime)
+        }
+        catalogue[iso_name] = entry
+        return entry, True
+
+    @Expose()
+    def get_catalogue(self, node=None):
+        """Return the SHA256 checksum and size of each of the ISOs, updating
+        the catalogue for any ISOs that have been added or modified
+        """
+        if node is not None and node != get_hostname():
+            return self.get_remote_factory(node).get_catalogue()
+
+        with Factory.CATALOGUE_LOCK:
+            catalogue = self._read_catalogue()
+            iso_names = self.get_isos()
+            updated = False
+
+            # Remove ISOs that no longer exist
+            for iso_name in catalogue.keys():
+                if iso_name not in iso_names:
+                    del catalogue[iso_name]
+                    updated = True
+
+            for iso_name in iso_names:
+                _, entry_updated = self._get_catalogue_entry(catalogue, iso_name)
+                updated |= entry_updated
+
+            if updated:
+                self._write_catalogue(catalogue)
+        return catalogue
+
+    @Expose()
+    def get_iso_checksum(self, iso_name):
+        """Return the SHA256 checksum of an ISO, or None if the ISO does not exist"""
+        if iso_name not in self.get_isos():
+            return None
+
+        with Factory.CATALOGUE_LOCK:
+            catalogue = self._read_catalogue()
+            entry, updated = self._get_catalogue_entry(catalogue, iso_name)
+            if updated:
+                self._write_catalogue(catalogue)
+        return entry['sha256']
 
-        iso_object = self.add_iso(output_path)
+    @Expose()
+    def get_iso_name_by_checksum(self, checksum):
+        """Return the name of an ISO with the given SHA256 checksum, or None
+        if there is no such ISO on the node
+        """
+        for iso_name, entry in self.get_catalogue().items():
+            if entry['sha256'] == checksum.lower():
+                return iso_name
+        return None
+
+    def _add_to_catalogue(self, iso_name, checksum):
+        """Record the checksum of a newly added ISO, replacing the ISO with a
+        hard link to an existing ISO with the same content
+        """
+        iso_name = self.get_iso_name(iso_name)
+        iso_path = os.path.join(DirectoryLocation.ISO_STORAGE_DIR, iso_name)
+        with Factory.CATALOGUE_LOCK:
+            catalogue = self._read_catalogue()
+            for existing_name, entry in catalogue.items():
+                existing_path = os.path.join(DirectoryLocation.ISO_STORAGE_DIR, existing_name)
+                if (existing_name != iso_name and entry['sha256'] == checksum and
+                        os.path.isfile(existing_path)):
+                    temp_path = os.path.join(self.UPLOAD_DIR, '%s.link' % iso_name)
+                    if os.path.lexists(temp_path):
+                        os.remove(temp_path)
+                    os.link(existing_path, temp_path)
+                    os.rename(temp_path, iso_path)
+                    break
 
-        os.remove(output_path)
-        os.rmdir(temp_directory)
-        return iso_object.get_name()
+            iso_stat = os.stat(iso_path)
+            catalogue[iso_name] = {'sha256': checksum, 'size': iso_stat.st_size,
+                                   'mtime': int(iso_stat.st_mtime)}
+            self._write_catalogue(catalogue)
 
     @Expose(locking=True)
-    def add_iso_from_stream(self, path, name=None):
-        """Import ISO, writing binary data to the ISO file"""
+    def add_iso_by_checksum(self, checksum, name):
+        """Add an ISO by linking to an existing ISO with the given checksum,
+        returning False if no ISO with the checksum exists on the node
+        """
         self._get_registered_object('auth').assert_permission(
             PERMISSIONS.MANAGE_ISO
         )
-        if name is None:
-            name = Iso.get_filename_from_path(path)
+        name = self.get_iso_name(name)
+        existing_name = self.get_iso_name_by_checksum(checksum)
+        if existing_name is None:
+            return False
+
+        iso_path = os.path.join(DirectoryLocation.ISO_STORAGE_DIR, name)
+        Iso.overwrite_check(name, iso_path)
+        if not os.path.isdir(self.UPLOAD_DIR):
+            os.makedirs(self.UPLOAD_DIR)
+        self._add_to_catalogue(name, checksum.lower())
+        return True
 
-        # Get temporary directory to store ISO
-        temp_directory = tempfile.mkdtemp()
-        output_path = temp_directory + '/' + name
+    @Expose()
+    def replicate_iso(self, iso_name, nodes=None):
+        """Copy an ISO to other nodes in the cluster, streaming the ISO to the
+        nodes in parallel. Nodes that already hold an ISO with the same content
+        are skipped or, if the ISO is held under a different name, the existing
+        ISO is linked. Returns the action performed for each node.
+        """
+        self._get_registered_object('auth').assert_permission(
+            PERMISSIONS.MANAGE_ISO
+        )
+        return self._replicate_iso(iso_name, nodes=nodes)
+
+    def _replicate_iso(self, iso_name, nodes=None):
+        """Copy an ISO to other nodes in the cluster, without checking permissions"""
+        iso_name = self.get_iso_name(iso_name)
+        iso_object = self.get_iso_by_name(iso_name)
+        checksum = self.get_iso_checksum(iso_name)
+        size = os.path.getsize(iso_object.get_path())
+
+        cluster = self._get_registered_object('cluster')
+        if nodes is None:
+            nodes = cluster.get_nodes()
+
+        def replicate_to_node(node):
+            remote_factory = node.get_connection('iso_factory')
+            node.annotate_object(remote_factory)
+
+            remote_checksum = remote_factory.get_iso_checksum(iso_name)
+            if remote_checksum == checksum:
+                return 'present'
+            elif remote_checksum is not None:
+                raise IsoAlreadyExistsException(
+                    'A different ISO with the same name already exists on %s: %s' %
+                    (node.name, iso_name)
+                )
+
+            if remote_factory.add_iso_by_checksum(checksum, iso_name):
+                return 'linked'
+
+            iso_writer = remote_factory.add_iso_from_stream(iso_name, name=iso_name, size=size)
+            node.annotate_object(iso_writer)
+            offset = iso_writer.get_offset()
+            with open(iso_object.get_path(), 'rb') as iso_fh:
+                iso_fh.seek(offset)
+                while True:
+                    data = iso_fh.read(self.REPLICATION_CHUNK_SIZE)
+                    if not data:
+                        break
+                    iso_writer.write_chunk(offset, bytearray(data))
+                    offset += len(data)
+            iso_writer.write_end(checksum)
+            return 'copied'
+
+        return cluster.run_remote_command(callback_method=replicate_to_node, nodes=nodes,
+                                          parallel=True)
 
-        iso_writer = IsoWriter(output_path, self, temp_directory, path)
-        self._register_object(iso_writer)
+    @Expose(locking=True)
+    def add_iso_from_stream(self, path, name=None, size=None):
+        """Import ISO, writing binary data to the ISO file. If a previous upload of
+        the ISO, with the same size, was interrupted, the upload is resumed
+        from the data that has already been received (see IsoWriter.get_offset).
+        """
+        self._get_registered_object('auth').assert_permission(
+            PERMISSIONS.MANAGE_ISO
+        )
+        if name is None:
+            name = Iso.get_filename_from_path(path)
+        name = self.get_iso_name(name)
+        Iso.overwrite_check(name, DirectoryLocation.ISO_STORAGE_DIR + '/' + name)
+
+        if not os.path.isdir(self.UPLOAD_DIR):
+            os.makedirs(self.UPLOAD_DIR)
+
+        session_id = self._get_registered_object('mcvirt_session')._get_session_id()
+        with Factory.TRANSFER_LOCK:
+            if name in Factory.DOWNLOADS:
+                raise IsoDownloadInProgressException('ISO is already being added: %s' % name)
+
+            # Return the existing writer, if the ISO is already being uploaded
+            # by the session. An upload cannot be taken over by another session.
+            iso_writer = Factory.UPLOADS.get(name)
+            if iso_writer is not None and iso_writer.session_id != session_id:
+                raise IsoDownloadInProgressException('ISO is already being uploaded: %s' % name)
+            elif iso_writer is not None and iso_writer.size == size:
+                return iso_writer
+            elif iso_writer is not None:
+                iso_writer.cancel_upload()
+
+            iso_writer = IsoWriter(name, self, size, path)
+            self._register_object(iso_writer)
+            Factory.UPLOADS[name] = iso_writer
         return iso_writer
 
 
 class IsoWriter(PyroObject):
-    """Provide an interface for writing ISOs"""
+    """Provide an interface for writing ISOs. Chunks may be written concurrently
+    and out of order; the checksum is calculated over the contiguous data received
+    from the start of the file.
+    """
 
-    def __init__(self, temp_file, factory, temp_directory, path):
+    def __init__(self, name, factory, size, path):
         """Set methods to be able to create ISO from temp path."""
-        self.temp_file = temp_file
-        self.temp_directory = temp_directory
+        self.name = Factory.get_iso_name(name)
         self.factory = factory
+        self.size = size
         self.path = path
-        self.fh = open(self.temp_file, 'wb')
+        self.temp_file = os.path.join(factory.UPLOAD_DIR, '%s.part' % name)
+        self.state_file = os.path.join(factory.UPLOAD_DIR, '%s.json' % name)
+        self.lock = threading.Lock()
+        self.checksum = hashlib.sha256()
+        self.offset = 0
+        self.written_ranges = {}
+
+        # The upload is restricted to the session that created it, which
+        # has been checked for the MANAGE_ISO permission
+        self.session_id = factory._get_registered_object('mcvirt_session')._get_session_id()
+
+        # Resume a previous upload of the same size, discarding any data
+        # received after the contiguous data
+        self.fh = None
+        state = self._read_state()
+        if os.path.isfile(self.temp_file) and state and state.get('size') == size:
+            self.fh = open(self.temp_file, 'r+b')
+            self.fh.truncate(state.get('offset', 0))
+            self.fh.flush()
+            self._update_checksum(state.get('offset', 0))
+        else:
+            self.fh = open(self.temp_file, 'wb')
+            self._write_state()
 
     def __delete__(self):
         """Close FH on object deletion"""
@@ -171,27 +553,261 @@ class IsoWriter(PyroObject):
             self.fh = None
         self.unregister_object()
 
+    def _read_state(self):
+        """Return the state recorded for a previous upload"""
+        try:
+            with open(self.state_file, 'r') as state_fh:
+                return json.load(state_fh)
+        except (IOError, ValueError):
+            return None
+
+    def _write_state(self):
+        """Record the expected size of the upload and the offset up to which
+        all data has been received, allowing the upload to be resumed
+        """
+        with open(self.state_file, 'w') as state_fh:
+            json.dump({'size': self.size, 'path': self.path, 'offset': self.offset}, state_fh)
+
+    def _assert_upload_session(self):
+        """Ensure that the caller is the session that started the upload"""
+        if Pyro4.current_context.session_id != self.session_id:
+            raise InsufficientPermissionsException(
+                'ISO upload was started by another session'
+            )
+
+    @staticmethod
+    def _decode_chunk(data):
+        """Convert a chunk of data to a string. Serpent transfers binary
+        data (bytearrays) as a base64-encoded dict.
+        """
+        if isinstance(data, dict) and data.get('encoding') == 'base64':
+            return base64.b64decode(data['data'])
+        return str(data)
+
+    def _update_checksum(self, end_offset):
+        """Advance the checksum over the file data up to end_offset"""
+        read_fh = open(self.temp_file, 'rb')
+        try:
+            read_fh.seek(self.offset)
+            while self.offset < end_offset:
+                data = read_fh.read(min(4 * 1024 * 1024, end_offset - self.offset))
+                if not data:
+                    break
+                self.checksum.update(data)
+                self.offset += len(data)
+        finally:
+            read_fh.close()
+
+    @Expose()
+    def get_offset(self):
+        """Return the offset up to which all data has been received. An interrupted
+        upload should be resumed from this offset.
+        """
+        self._assert_upload_session()
+        return self.offset
+
+    @Expose()
+    def write_chunk(self, offset, data):
+        """Write a chunk of binary data at the given offset of the ISO file,
+        returning the offset up to which all data has been received
+        """
+        self._assert_upload_session()
+        data = self._decode_chunk(data)
+
+        with self.lock:
+            self.fh.seek(offset)
+            self.fh.write(data)
+            self.written_ranges[offset] = offset + len(data)
+
+            # Hash any data that is now contiguous with the hashed data
+            end_offset = self.offset
+            while end_offset in self.written_ranges:
+                end_offset = self.written_ranges.pop(end_offset)
+            if end_offset > self.offset:
+                self.fh.flush()
+                self._update_checksum(end_offset)
+                self._write_state()
+
+            return self.offset
+
     @Expose()
     def write_data(self, data):
-        """Write data to the ISO file"""
+        """Write hex-encoded data to the end of the ISO file"""
         self._get_registered_object('auth').assert_permission(
             PERMISSIONS.MANAGE_ISO
         )
-        self.fh.write(binascii.unhexlify(data))
+        data = binascii.unhexlify(data)
+        with self.lock:
+            self.fh.seek(0, os.SEEK_END)
+            self.fh.write(data)
+            self.fh.flush()
+            self._update_checksum(self.fh.tell())
+            self._write_state()
 
     @Expose()
-    def write_end(self):
-        """End writing object, close FH and import ISO"""
-        self._get_registered_object('auth').assert_permission(
-            PERMISSIONS.MANAGE_ISO
-        )
+    def write_end(self, checksum=None):
+        """End writing object, close FH and import ISO. If a SHA256 checksum
+        is provided, it is verified against the received data.
+        """
+        self._assert_upload_session()
+        with self.lock:
+            if self.fh:
+                self.fh.close()
+                self.fh = None
+
+            if self.size is not None and self.offset != self.size:
+                raise IncompleteIsoUploadException(
+                    'Received %s of %s bytes for ISO %s' % (self.offset, self.size, self.name)
+                )
+
+            if checksum is not None and checksum.lower() != self.checksum.hexdigest():
+                self.cancel_upload()
+                raise IsoChecksumMismatchException(
+                    'Checksum of uploaded ISO %s does not match' % self.name
+                )
+
+            # Move the ISO into place, within the same filesystem
+            iso_path = DirectoryLocation.ISO_STORAGE_DIR + '/' + self.name
+            Iso.overwrite_check(self.name, iso_path)
+            os.rename(self.temp_file, iso_path)
+            self._remove_upload()
+            self.factory._add_to_catalogue(self.name, self.checksum.hexdigest())
+
+        return self.factory.get_iso_by_name(self.name)
+
+    @Expose()
+    def get_checksum(self):
+        """Return the SHA256 checksum of the data received"""
+        self._assert_upload_session()
+        return self.checksum.hexdigest()
+
+    @Expose()
+    def cancel(self):
+        """Cancel the upload, removing the partial ISO"""
+        self._assert_upload_session()
+        self.cancel_upload()
+
+    def cancel_upload(self):
+        """Remove the partial ISO and unregister the writer"""
         if self.fh:
             self.fh.close()
             self.fh = None
+        if os.path.isfile(self.temp_file):
+            os.remove(self.temp_file)
+        self._remove_upload()
+
+    def _remove_upload(self):
+        """Remove the upload state and unregister the writer"""
+        if os.path.isfile(self.state_file):
+            os.remove(self.state_file)
+        with Factory.TRANSFER_LOCK:
+            if Factory.UPLOADS.get(self.name) is self:
+                del Factory.UPLOADS[self.name]
+        self.unregister_object()
 
-        iso_object = self.factory.add_iso(self.temp_file)
 
-        os.remove(self.temp_file)
-        os.rmdir(self.temp_directory)
-        self.unregister_object()
-        return iso_object
+class IsoDownloadJob(threading.Thread):
+    """Download an ISO in the background, resuming a previous partial download
+    of the ISO, if the server supports range requests
+    """
+
+    # Size of reads from the HTTP connection
+    CHUNK_SIZE = 1024 * 1024
+
+    # Minimum time (seconds) between progress updates in the log
+    PROGRESS_INTERVAL = 2
+
+    def __init__(self, factory, url, name, checksum, log):
+        """Store member variables"""
+        super(IsoDownloadJob, self).__init__(name='IsoDownload-%s' % name)
+        self.daemon = True
+        self.factory = factory
+        self.url = url
+        self.name = Factory.get_iso_name(name)
+        self.expected_checksum = checksum.lower() if checksum else None
+        self.log = log
+        self.exception = None
+        self.partial_path = os.path.join(factory.UPLOAD_DIR, '%s.download' % name)
+
+    def run(self):
+        """Perform the download, recording the result in the log"""
+        self.log.start()
+        try:
+            self._download()
+            self.log.finish_success()
+        except MCVirtException, e:
+            self.exception = e
+            self.log.finish_error(e)
+        except Exception, e:
+            self.exception = e
+            Syslogger.logger().error('Failed to download ISO %s: %s' % (self.name, str(e)))
+            self.log.finish_error_unknown(e)
+        finally:
+            with Factory.TRANSFER_LOCK:
+                if Factory.DOWNLOADS.get(self.name) is self:
+                    del Factory.DOWNLOADS[self.name]
+
+    def _download(self):
+        """Download the ISO to the partial file and move it into the ISO directory"""
+        checksum = hashlib.sha256()
+        offset = 0
+        request = urllib2.Request(self.url)
+
+        # Request the remainder of a previous partial download
+        if os.path.isfile(self.partial_path):
+            offset = os.path.getsize(self.partial_path)
+            request.add_header('Range', 'bytes=%s-' % offset)
+
+        response = urllib2.urlopen(request)
+        try:
+            if offset and response.getcode() == 206:
+                # Include the existing data in the checksum
+                with open(self.partial_path, 'rb') as partial_fh:
+                    while True:
+                        data = partial_fh.read(self.CHUNK_SIZE)
+                        if not data:
+                            break
+                        checksum.update(data)
+                mode = 'ab'
+            else:
+                # The server has returned the whole file
+                offset = 0
+                mode = 'wb'
+
+            content_length = response.info().getheader('Content-Length')
+            total_size = (offset + int(content_length)) if content_length else None
+
+            last_update = 0
+            with open(self.partial_path, mode) as iso_fh:
+                while True:
+                    data = response.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    iso_fh.write(data)
+                    checksum.update(data)
+                    offset += len(data)
+
+                    if total_size and time.time() - last_update > self.PROGRESS_INTERVAL:
+                        self.log.set_progress(int(offset * 100 / total_size))
+                        last_update = time.time()
+        finally:
+            response.close()
+
+        if total_size is not None and offset != total_size:
+            raise IncompleteIsoUploadException(
+                'Received %s of %s bytes for ISO %s' % (offset, total_size, self.name)
+            )
+
+        if self.expected_checksum and checksum.hexdigest() != self.expected_checksum:
+            os.remove(self.partial_path)
+            raise IsoChecksumMismatchException(
+                'Checksum of downloaded ISO %s does not match' % self.name
+            )
+
+        # Move the ISO into place, within the same filesystem
+        iso_path = DirectoryLocation.ISO_STORAGE_DIR + '/' + self.name
+        Iso.overwrite_check(self.name, iso_path)
+        os.rename(self.partial_path, iso_path)
+        self.factory._add_to_catalogue(self.name, checksum.hexdigest())
+        self.log.set_progress(100)
+        self.factory.get_iso_by_name(self.name)
@@ -24,7 +24,6 @@ import Pyro4
 from mcvirt.exceptions import (InvalidISOPathException, NameNotSpecifiedException,
                                IsoAlreadyExistsException, FailedToRemoveFileException,
                                IsoInUseException)
-from mcvirt.utils import get_hostname
 from mcvirt.rpc.pyro_object import PyroObject
 from mcvirt.rpc.expose_method import Expose
 from mcvirt.constants import DirectoryLocation
@@ -115,14 +114,8 @@ class Iso(PyroObject):
     @property
     def in_use(self):
         """Determine if the ISO is currently in use by a VM"""
-        virtual_machine_factory = self._get_registered_object('virtual_machine_factory')
-        for vm_name in virtual_machine_factory.getAllVmNames(node=get_hostname()):
-            vm_object = virtual_machine_factory.getVirtualMachineByName(vm_name)
-            disk_drive_object = vm_object.get_disk_drive()
-            vm_current_iso = disk_drive_object.getCurrentDisk()
-
-            # If the VM has an iso attached, check if the ISO is this one
-            if vm_current_iso and vm_current_iso.get_path() == self.get_path():
-                return vm_object.get_name()
+        attachments = self._get_registered_object('iso_factory').get_iso_attachments()
+        if attachments.get(self.get_name()):
+            return sorted(attachments[self.get_name()])[0]
 
         return False
@@ -16,6 +16,7 @@
 # along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
 
 import libvirt
+import threading
 
 from mcvirt.utils import get_hostname
 from mcvirt.rpc.pyro_object import PyroObject
@@ -26,6 +27,26 @@ class LibvirtConnector(PyroObject):
     """Obtains/manages Libvirt connections"""
 
     CACHED_CONNECTIONS = {}
+    EVENT_LOOP_THREAD = None
+
+    @staticmethod
+    def start_event_loop():
+        """Register the default libvirt event implementation and run it in a
+        background thread, so that domain events are delivered. This must be
+        performed before connections are opened.
+        """
+        if LibvirtConnector.EVENT_LOOP_THREAD is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run_event_loop():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        LibvirtConnector.EVENT_LOOP_THREAD = threading.Thread(target=run_event_loop,
+                                                              name='LibvirtEventLoop')
+        LibvirtConnector.EVENT_LOOP_THREAD.daemon = True
+        LibvirtConnector.EVENT_LOOP_THREAD.start()
 
     def get_connection(self, server=None):
         """Obtains a Libvirt connection for a given server"""
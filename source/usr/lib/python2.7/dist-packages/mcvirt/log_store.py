@@ -0,0 +1,258 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+from collections import deque
+import json
+import os
+import threading
+
+from mcvirt.constants import DirectoryLocation
+from mcvirt.syslogger import Syslogger
+
+
+class LogStore(object):
+    """Store command log records in a bounded in-memory ring buffer, backed by
+    an append-only log on disk. The on-disk log is split into segments, which
+    are rotated once they reach SEGMENT_SIZE, with at most MAX_SEGMENTS kept.
+    Each segment has an index of the time range, log IDs, users, objects and
+    statuses of its records, so that queries only read matching segments.
+
+    Records are dicts with compact keys:
+        i: log ID, n: node, u: user, m: method, o: object name, y: object type,
+        q/s/f: queue/start/finish time (epoch), st: status name, e: exception message
+    A log ID may be written more than once (queued and finished), with the
+    latest record for the ID taking precedence.
+    """
+
+    RING_SIZE = 1000
+    SEGMENT_SIZE = 4 * 1024 * 1024
+    MAX_SEGMENTS = 16
+    SEGMENT_PREFIX = 'commands-'
+
+    def __init__(self, log_dir=DirectoryLocation.COMMAND_LOG_DIR):
+        """Load the segment indexes and the most recent records"""
+        self.log_dir = log_dir
+        self.lock = threading.RLock()
+        self.ring = deque(maxlen=self.RING_SIZE)
+        self.segments = []
+        self.current_fh = None
+        self.next_id = 0
+        self.persistent = True
+
+        try:
+            if not os.path.isdir(self.log_dir):
+                os.makedirs(self.log_dir)
+            self._load()
+        except (IOError, OSError), e:
+            # Continue with the in-memory ring buffer only
+            Syslogger.logger().error('Unable to open command log store: %s' % str(e))
+            self.persistent = False
+
+    @staticmethod
+    def _new_index(first_id):
+        """Return an empty segment index"""
+        return {'first_id': first_id, 'min_id': None, 'last_id': None, 'start_time': None,
+                'end_time': None, 'users': set(), 'objects': set(), 'statuses': set()}
+
+    @staticmethod
+    def _update_index(index, record):
+        """Add a record to a segment index"""
+        # Segments may contain updated records for logs created in previous segments
+        if index['min_id'] is None or record['i'] < index['min_id']:
+            index['min_id'] = record['i']
+        index['last_id'] = max(index['last_id'], record['i'])
+        record_time = record['q']
+        if index['start_time'] is None or record_time < index['start_time']:
+            index['start_time'] = record_time
+        index['end_time'] = max(index['end_time'], record_time)
+        index['users'].add(record['u'])
+        index['objects'].add(record['o'])
+        index['statuses'].add(record['st'])
+
+    def _segment_path(self, first_id, extension='log'):
+        """Return the path of a segment (or its index) file"""
+        return os.path.join(self.log_dir,
+                            '%s%012d.%s' % (self.SEGMENT_PREFIX, first_id, extension))
+
+    def _read_segment(self, first_id):
+        """Return the records in a segment, ignoring any partially written record"""
+        records = []
+        try:
+            with open(self._segment_path(first_id), 'r') as segment_fh:
+                for line in segment_fh:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except IOError:
+            pass
+        return records
+
+    def _write_index(self, index):
+        """Write the index of a closed segment alongside it"""
+        index_data = dict(index)
+        for key in ['users', 'objects', 'statuses']:
+            index_data[key] = list(index[key])
+        with open(self._segment_path(index['first_id'], 'idx'), 'w') as index_fh:
+            json.dump(index_data, index_fh)
+
+    def _read_index(self, first_id):
+        """Read the index of a closed segment, rebuilding it if it is missing"""
+        try:
+            with open(self._segment_path(first_id, 'idx'), 'r') as index_fh:
+                index = json.load(index_fh)
+            for key in ['users', 'objects', 'statuses']:
+                index[key] = set(index[key])
+            return index
+        except (IOError, ValueError):
+            index = self._new_index(first_id)
+            for record in self._read_segment(first_id):
+                self._update_index(index, record)
+            return index
+
+    def _load(self):
+        """Load the indexes of the segments on disk and fill the ring buffer
+        from the current segment
+        """
+        first_ids = sorted([
+            int(file_name[len(self.SEGMENT_PREFIX):-4])
+            for file_name in os.listdir(self.log_dir)
+            if file_name.startswith(self.SEGMENT_PREFIX) and file_name.endswith('.log')
+        ])
+
+        for first_id in first_ids[:-1]:
+            self.segments.append(self._read_index(first_id))
+
+        # Rebuild the index of the current segment, which is not written until
+        # the segment is rotated
+        if first_ids:
+            index = self._new_index(first_ids[-1])
+            for record in self._read_segment(first_ids[-1]):
+                self._update_index(index, record)
+                self.ring.append(record)
+            self.segments.append(index)
+
+        last_ids = [index['last_id'] for index in self.segments if index['last_id'] is not None]
+        self.next_id = (max(last_ids) + 1) if last_ids else 0
+
+    def _open_segment(self):
+        """Return the file handle of the current segment, rotating the
+        segment if it has reached the maximum size
+        """
+        if self.current_fh is not None and self.current_fh.tell() >= self.SEGMENT_SIZE:
+            self.current_fh.close()
+            self.current_fh = None
+            self._write_index(self.segments[-1])
+            self.segments.append(self._new_index(self.next_id))
+
+            # Remove the oldest segments
+            while len(self.segments) > self.MAX_SEGMENTS:
+                index = self.segments.pop(0)
+                for extension in ['log', 'idx']:
+                    if os.path.exists(self._segment_path(index['first_id'], extension)):
+                        os.remove(self._segment_path(index['first_id'], extension))
+
+        if self.current_fh is None:
+            if not self.segments:
+                self.segments.append(self._new_index(self.next_id))
+            self.current_fh = open(self._segment_path(self.segments[-1]['first_id']), 'a')
+        return self.current_fh
+
+    def allocate_id(self):
+        """Return the ID for a new log"""
+        with self.lock:
+            log_id = self.next_id
+            self.next_id += 1
+            return log_id
+
+    def append(self, record):
+        """Add a record to the ring buffer and the on-disk log"""
+        with self.lock:
+            self.ring.append(record)
+            if not self.persistent:
+                return
+            try:
+                segment_fh = self._open_segment()
+                segment_fh.write(json.dumps(record, separators=(',', ':')) + '\n')
+                segment_fh.flush()
+                self._update_index(self.segments[-1], record)
+            except (IOError, OSError), e:
+                Syslogger.logger().error('Failed to write command log: %s' % str(e))
+
+    @staticmethod
+    def _matches(record, start_time, end_time, user, object_name, status, min_id, max_id):
+        """Determine if a record matches the query filters"""
+        return ((start_time is None or record['q'] >= start_time) and
+                (end_time is None or record['q'] <= end_time) and
+                (user is None or record['u'] == user) and
+                (object_name is None or record['o'] == object_name) and
+                (status is None or record['st'] == status) and
+                (min_id is None or record['i'] >= min_id) and
+                (max_id is None or record['i'] <= max_id))
+
+    @staticmethod
+    def _index_matches(index, start_time, end_time, user, object_name, status, min_id, max_id):
+        """Determine if a segment may contain records matching the query filters"""
+        if index['last_id'] is None:
+            return False
+        return ((start_time is None or index['end_time'] >= start_time) and
+                (end_time is None or index['start_time'] <= end_time) and
+                (user is None or user in index['users']) and
+                (object_name is None or object_name in index['objects']) and
+                (status is None or status in index['statuses']) and
+                (min_id is None or index['last_id'] >= min_id) and
+                (max_id is None or index['min_id'] <= max_id))
+
+    def query(self, start_time=None, end_time=None, user=None, object_name=None,
+              status=None, min_id=None, max_id=None, limit=None):
+        """Return the latest record for each log matching the filters, ordered
+        by log ID. If limit is set, the newest matching logs are returned.
+        """
+        filters = (start_time, end_time, user, object_name, status, min_id, max_id)
+        with self.lock:
+            ring_records = list(self.ring)
+            segments = [dict(index) for index in self.segments]
+
+        # Use the latest record for each log, so that logs are filtered
+        # on their final state
+        records = {}
+        for record in ring_records:
+            records[record['i']] = record
+        match_count = len([record for record in records.values()
+                           if self._matches(record, *filters)])
+
+        # Read segments, newest first, until enough logs have been found.
+        # Records in the ring buffer are the most recent for their logs.
+        if self.persistent:
+            for index in reversed(segments):
+                if limit is not None and match_count >= limit:
+                    break
+                if not self._index_matches(index, *filters):
+                    continue
+                segment_records = {}
+                for record in self._read_segment(index['first_id']):
+                    if record['i'] not in records:
+                        segment_records[record['i']] = record
+                records.update(segment_records)
+                match_count += len([record for record in segment_records.values()
+                                    if self._matches(record, *filters)])
+
+        matching = [records[log_id] for log_id in sorted(records.keys())
+                    if self._matches(records[log_id], *filters)]
+        if limit is not None:
+            matching = matching[-limit:]
+        return matching
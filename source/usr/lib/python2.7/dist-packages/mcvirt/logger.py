@@ -15,19 +15,34 @@
 # You should have received a copy of the GNU General Public License
 # along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
 
+from collections import deque
 from datetime import datetime
+import threading
+import time
 import Pyro4
 
 from mcvirt.rpc.pyro_object import PyroObject
 from mcvirt.syslogger import Syslogger
 from mcvirt.argument_validator import ArgumentValidator
 from mcvirt.utils import get_hostname
+from mcvirt.log_store import LogStore
+from mcvirt.exceptions import MCVirtTypeError
 
 
 class Logger(PyroObject):
 
-    LOGS = []
+    # Logs of commands that have not yet completed, keyed by log ID.
+    # Logs are also written to the log store, which holds completed logs.
+    ACTIVE_LOGS = {}
     LOGGER = None
+    STORE = None
+    REPLICATOR = None
+
+    # Last sequence number applied from each remote node, and the local log IDs
+    # of incomplete logs received from remote nodes
+    REMOTE_SEQUENCES = {}
+    REMOTE_LOG_IDS = {}
+    REMOTE_LOCK = threading.Lock()
 
     @staticmethod
     def get_logger():
@@ -35,91 +50,280 @@ class Logger(PyroObject):
             Logger.LOGGER = Logger()
         return Logger.LOGGER
 
-    @Pyro4.expose
-    def create_log_remote(self, *args, **kwargs):
-        """Remotely accessible create_log method"""
-        self._get_registered_object('auth').check_user_type('ClusterUser')
-        kwargs['local_only'] = True
-        log_object = self.create_log(*args, **kwargs)
-        self._register_object(log_object)
-        return log_object
+    @staticmethod
+    def get_store():
+        """Return the log store, opening it on first use"""
+        if Logger.STORE is None:
+            Logger.STORE = LogStore()
+        return Logger.STORE
+
+    def initialise(self):
+        """Start the replication of logs to remote nodes"""
+        Logger.REPLICATOR = LogReplicator(self)
+        Logger.REPLICATOR.start()
 
     def create_log(self, method_name, user, object_name, object_type, node=None, local_only=False):
-        """Create a log item and store"""
+        """Create a log item and store. Unless local_only is set, the log is
+        replicated to the other nodes in the cluster in the background.
+        """
         if node is None:
             node = get_hostname()
 
-        log_item = LogItem(method_name, user, object_name, object_type, node)
-        Logger.LOGS.append(log_item)
-        if not local_only and self._is_pyro_initialised:
-            def remote_command(remote_node):
-                remote_logger = remote_node.get_connection('logger')
-                remote_log = remote_logger.create_log_remote(
-                    method_name=method_name, user=user, object_name=object_name,
-                    object_type=object_type, node=node
-                )
-                remote_node.annotate_object(remote_log)
-                log_item.remote_logs.append(remote_log)
-            try:
-                cluster = self._get_registered_object('cluster')
-                cluster.run_remote_command(remote_command)
-            except:
-                pass
-
+        # Logs are only replicated by the node acting as cluster master for the command
+        replicate = (not local_only and self._is_pyro_initialised and
+                     self._is_cluster_master and Logger.REPLICATOR is not None)
+        log_item = LogItem(Logger.get_store().allocate_id(), method_name, user, object_name,
+                           object_type, node, replicate=replicate)
+        Logger.ACTIVE_LOGS[log_item.log_id] = log_item
+        log_item.save()
         return log_item
 
+    @Pyro4.expose
+    def receive_log_events(self, origin_node, epoch, events):
+        """Store a batch of log events replicated from a remote node. Events are
+        applied in sequence order, ignoring events that have already been applied.
+        The epoch identifies the daemon instance on the remote node, which
+        restarts the sequence numbers when it changes.
+        """
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        store = Logger.get_store()
+        with Logger.REMOTE_LOCK:
+            remote_sequence = Logger.REMOTE_SEQUENCES.get(origin_node)
+            if remote_sequence is None or remote_sequence['epoch'] != epoch:
+                # The final records of the incomplete logs of a previous
+                # daemon instance will not be received
+                self._remove_remote_log_ids(origin_node)
+                remote_sequence = {'epoch': epoch, 'sequence': 0}
+                Logger.REMOTE_SEQUENCES[origin_node] = remote_sequence
+
+            for event in sorted(events, key=lambda event: event['sequence']):
+                if event['sequence'] <= remote_sequence['sequence']:
+                    continue
+                elif event['sequence'] > remote_sequence['sequence'] + 1:
+                    # Events have been discarded by the remote node, which
+                    # may include the final records of incomplete logs
+                    self._remove_remote_log_ids(origin_node)
+
+                # Remote log IDs are mapped to local log IDs
+                record = dict(event['record'])
+                remote_log_key = (origin_node, epoch, record['i'])
+                if remote_log_key not in Logger.REMOTE_LOG_IDS:
+                    Logger.REMOTE_LOG_IDS[remote_log_key] = store.allocate_id()
+                record['i'] = Logger.REMOTE_LOG_IDS[remote_log_key]
+                if record['st'] in [LogState.SUCCESS['name'], LogState.FAILED['name']]:
+                    del Logger.REMOTE_LOG_IDS[remote_log_key]
+
+                store.append(record)
+                remote_sequence['sequence'] = event['sequence']
+
+    @staticmethod
+    def _remove_remote_log_ids(origin_node):
+        """Remove the local log IDs of the incomplete logs received from a remote node"""
+        for remote_log_key in Logger.REMOTE_LOG_IDS.keys():
+            if remote_log_key[0] == origin_node:
+                del Logger.REMOTE_LOG_IDS[remote_log_key]
+
+    def _get_records(self, **kwargs):
+        """Return the records matching a log store query, using the current
+        state of logs that have not yet completed
+        """
+        records = Logger.get_store().query(**kwargs)
+        for index, record in enumerate(records):
+            log_item = Logger.ACTIVE_LOGS.get(record['i'])
+            if log_item is not None:
+                records[index] = log_item.get_record()
+        return records
+
+    @staticmethod
+    def _format_record(record):
+        """Convert a log record into the dict returned by the log APIs"""
+        def format_time(timestamp):
+            return str(datetime.fromtimestamp(timestamp)) if timestamp else str(None)
+
+        return {
+            'id': record['i'],
+            'node': record['n'],
+            'queue_date': format_time(record['q']),
+            'start_date': format_time(record['s']),
+            'finish_date': format_time(record['f']),
+            'status': getattr(LogState, record['st'])['status'],
+            'status_name': record['st'],
+            'user': record['u'],
+            'method': record['m'],
+            'object_name': record['o'],
+            'object_type': record['y'],
+            'description': '%s %s %s' % ((record['m'] or '').capitalize(),
+                                         record['o'], record['y']),
+            'exception_message': record['e'],
+            'progress': record.get('p')
+        }
+
     @Pyro4.expose
     def get_logs(self, start_log=None, back=0, newer=False):
-        """Return a dict containing log information"""
+        """Return a dict containing log information, keyed by log ID"""
         if start_log is not None:
             ArgumentValidator.validate_integer(start_log)
         ArgumentValidator.validate_integer(back)
         ArgumentValidator.validate_boolean(newer)
 
-        if start_log is None:
-            start_log = len(Logger.LOGS) - 1
-
+        last_log = Logger.get_store().next_id - 1
+        if start_log is None or start_log > last_log:
+            start_log = last_log
         if start_log < 0:
             start_log = 0
-        if start_log > (len(Logger.LOGS) - 1):
-            start_log = len(Logger.LOGS) - 1
 
         if back:
-            start = 0 if (start_log - back) < 0 else (len(Logger.LOGS) - back)
-            finish = start_log + 1
+            # Return the current log and the logs preceding it, back logs in total
+            min_id, max_id = start_log - back + 1, start_log
         elif newer:
-            start = start_log + 1
-            # Length would provide an indicy out of the range,
-            # since len(['a']) = 1, but ['a'][1] == error
-            # However, this is made up for the fact that range(0, 2) = [0, 1]
-            finish = len(Logger.LOGS)
+            min_id, max_id = start_log + 1, None
         else:
-            # Start at the current log, to return it
-            # Finish at current log + 1 as range(1, 2) = [1]
-            start = start_log
-            finish = start_log + 1
-
-        return_logs = {}
-        for itx in range(start, finish):
-            if itx < 0:
+            # Return only the current log
+            min_id, max_id = start_log, start_log
+
+        return dict((record['i'], self._format_record(record))
+                    for record in self._get_records(min_id=min_id, max_id=max_id))
+
+    @Pyro4.expose
+    def query_logs(self, start_time=None, end_time=None, user=None, object_name=None,
+                   status=None, limit=100):
+        """Return the logs matching the filters, oldest first. Times are
+        given in seconds since the epoch and status is the status name,
+        e.g. 'FAILED'. At most limit (newest) logs are returned.
+        """
+        if status is not None and status not in LogState.NAMES:
+            raise MCVirtTypeError('Invalid log status: %s' % status)
+        ArgumentValidator.validate_positive_integer(limit)
+        return [self._format_record(record)
+                for record in self._get_records(start_time=start_time, end_time=end_time,
+                                                user=user, object_name=object_name,
+                                                status=status, limit=int(limit))]
+
+    @Pyro4.expose
+    def tail_logs(self, after_id=None, limit=100):
+        """Return the logs created after the given log ID, oldest first. If
+        no log ID is given, the latest logs are returned. The ID of the last
+        log returned can be used to poll for further logs.
+        """
+        ArgumentValidator.validate_positive_integer(limit)
+        if after_id is None:
+            records = self._get_records(limit=int(limit))
+        else:
+            ArgumentValidator.validate_integer(after_id)
+            records = self._get_records(min_id=int(after_id) + 1)[:int(limit)]
+        return [self._format_record(record) for record in records]
+
+
+class LogReplicator(object):
+    """Replicate log events to the other nodes in the cluster. Events are queued
+    whilst commands are run and sent to each node in batches by a background
+    thread, so that commands do not wait on remote nodes. Each event has a
+    sequence number, so that nodes apply events in order and only once.
+    """
+
+    # Maximum number of events sent to a node in a single call
+    BATCH_SIZE = 500
+
+    # Time (seconds) to wait for further events before sending a batch
+    FLUSH_INTERVAL = 1
+
+    # Maximum number of events held for a node that cannot be contacted,
+    # after which the oldest events are discarded
+    MAX_PENDING = 10000
+
+    # Time (seconds) to wait before retrying a node that could not be contacted
+    RETRY_INTERVAL = 30
+
+    def __init__(self, logger):
+        """Create member variables"""
+        self.logger = logger
+        self.condition = threading.Condition(threading.Lock())
+        self.epoch = str(time.time())
+        self.sequence = 0
+        self.events = []
+        self.pending = {}
+        self.connections = {}
+        self.retry_times = {}
+        self.thread = None
+
+    def start(self):
+        """Start the replication thread"""
+        self.thread = threading.Thread(target=self._run, name='LogReplicator')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def queue(self, record):
+        """Queue a log record for replication"""
+        with self.condition:
+            self.sequence += 1
+            self.events.append({'sequence': self.sequence, 'record': record})
+            if len(self.events) >= self.BATCH_SIZE:
+                self.condition.notify()
+
+    def _run(self):
+        """Distribute queued events to the pending events of each node and send them"""
+        while True:
+            with self.condition:
+                self.condition.wait(self.FLUSH_INTERVAL)
+                events = self.events
+                self.events = []
+
+            try:
+                nodes = self.logger._get_registered_object('cluster').get_nodes()
+            except Exception, e:
+                Syslogger.logger().error('Unable to obtain nodes for log replication: %s' %
+                                         str(e))
                 continue
-            if len(Logger.LOGS) < itx:
-                break
-            log = Logger.LOGS[itx]
-            return_logs[itx] = {
-                'start_date': str(log.start_time),
-                'status': log.status['status'],
-                'status_name': log.status['name'],
-                'user': log.user,
-                'method': log.method_name,
-                'object_name': log.object_name,
-                'object_type': log.object_type,
-                'description': '%s %s %s' % (log.method_name.capitalize(),
-                                             log.object_name,
-                                             log.object_type),
-                'exception_message': log.exception_message
-            }
-        return return_logs
+
+            # Remove nodes that have left the cluster
+            for node in self.pending.keys():
+                if node not in nodes:
+                    del self.pending[node]
+                    self.connections.pop(node, None)
+
+            for node in nodes:
+                node_pending = self.pending.setdefault(node, deque(maxlen=self.MAX_PENDING))
+                if len(node_pending) + len(events) > self.MAX_PENDING:
+                    Syslogger.logger().warning('Discarding log events for node %s' % node)
+                node_pending.extend(events)
+
+                if node_pending and time.time() >= self.retry_times.get(node, 0):
+                    self._send_pending(node, node_pending)
+
+    def _get_remote_logger(self, node):
+        """Return a cached connection to the logger of a remote node"""
+        if node not in self.connections:
+            cluster = self.logger._get_registered_object('cluster')
+            remote_node = cluster.get_remote_node(node, ignore_cluster_master=True)
+            remote_logger = remote_node.get_connection('logger')
+            remote_node.annotate_object(remote_logger)
+            self.connections[node] = remote_logger
+        return self.connections[node]
+
+    def _send_pending(self, node, node_pending):
+        """Send the pending events for a node, in batches"""
+        while node_pending:
+            batch = list(node_pending)[:self.BATCH_SIZE]
+            try:
+                try:
+                    self._get_remote_logger(node).receive_log_events(
+                        get_hostname(), self.epoch, batch
+                    )
+                except Exception:
+                    # Retry once with a new connection, as the session may have expired
+                    self.connections.pop(node, None)
+                    self._get_remote_logger(node).receive_log_events(
+                        get_hostname(), self.epoch, batch
+                    )
+            except Exception, e:
+                self.connections.pop(node, None)
+                self.retry_times[node] = time.time() + self.RETRY_INTERVAL
+                Syslogger.logger().warning('Failed to replicate logs to %s: %s' %
+                                           (node, str(e)))
+                return
+
+            for _ in range(len(batch)):
+                node_pending.popleft()
 
 
 class LogState(object):
@@ -143,24 +347,29 @@ class LogState(object):
         'name': 'FAILED'
     }
 
+    NAMES = ['QUEUED', 'RUNNING', 'SUCCESS', 'FAILED']
+
 
 class LogItem(PyroObject):
     """Log item for storing information about locking command status"""
 
-    def __init__(self, method_name, user, object_name, object_type, node):
+    def __init__(self, log_id, method_name, user, object_name, object_type, node,
+                 replicate=False):
         """Create member variables"""
         # Store information about method being run
+        self.log_id = log_id
         self.user = user
         self.object_name = object_name
         self.object_type = object_type
         self.method_name = method_name
-        self.remote_logs = []
         self.node = node
+        self.replicate = replicate
 
         # Store method state
         self.status = LogState.QUEUED
         self.exception_message = None
         self.exception_mcvirt = False
+        self.progress = None
 
         # Setup date objects for times
         self.queue_time = datetime.now()
@@ -175,6 +384,28 @@ class LogItem(PyroObject):
     def description(self):
         pass
 
+    def get_record(self):
+        """Return the log store record for the log"""
+        def get_timestamp(date):
+            return time.mktime(date.timetuple()) + (date.microsecond / 1e6) if date else None
+
+        return {'i': self.log_id, 'n': self.node, 'u': self.user, 'm': self.method_name,
+                'o': self.object_name, 'y': self.object_type,
+                'q': get_timestamp(self.queue_time), 's': get_timestamp(self.start_time),
+                'f': get_timestamp(self.finish_time), 'st': self.status['name'],
+                'e': self.exception_message, 'p': self.progress}
+
+    def save(self):
+        """Write the current state of the log to the log store, removing
+        the log from the active logs once it has completed
+        """
+        record = self.get_record()
+        Logger.get_store().append(record)
+        if self.replicate:
+            Logger.REPLICATOR.queue(record)
+        if self.status in [LogState.SUCCESS, LogState.FAILED]:
+            Logger.ACTIVE_LOGS.pop(self.log_id, None)
+
     @Pyro4.expose
     def start(self):
         self.start_time = datetime.now()
@@ -183,11 +414,12 @@ class LogItem(PyroObject):
             str(self.start_time), self.user or '', self.object_type or '', self.object_name or '',
             self.method_name or ''
         ]))
-        for remote_log in self.remote_logs:
-            try:
-                remote_log.start()
-            except:
-                pass
+        self.save()
+
+    @Pyro4.expose
+    def set_progress(self, progress):
+        """Update the progress (percentage) of a long-running command"""
+        self.progress = progress
 
     @Pyro4.expose
     def finish_success(self):
@@ -197,9 +429,8 @@ class LogItem(PyroObject):
             str(self.finish_time), self.user or '', self.object_type or '', self.object_name or '',
             self.method_name or ''
         ]))
-        for remote_log in self.remote_logs:
-            remote_log.finish_success()
-        self.unregister()
+        self.save()
+        self.unregister_object()
 
     @Pyro4.expose
     def finish_error_unknown(self, exception):
@@ -211,12 +442,8 @@ class LogItem(PyroObject):
             str(self.finish_time), self.user or '', self.object_type or '', self.object_name or '',
             self.method_name or '', self.exception_message or ''
         ]))
-        for remote_log in self.remote_logs:
-            try:
-                remote_log.finish_error_unknown(str(exception))
-            except:
-                pass
-        self.unregister()
+        self.save()
+        self.unregister_object()
 
     @Pyro4.expose
     def finish_error(self, exception):
@@ -228,22 +455,7 @@ class LogItem(PyroObject):
             str(self.finish_time), self.user or '', self.object_type or '', self.object_name or '',
             self.method_name or '', self.exception_message or ''
         ]))
-        for remote_log in self.remote_logs:
-            try:
-                remote_log.finish_error(str(exception))
-            except:
-                pass
-        self.unregister()
-
-    @Pyro4.expose
-    def unregister(self):
-        """Unregister connections to remote objects"""
-        for log in self.remote_logs:
-            try:
-                log.unregister()
-            except:
-                pass
-        self.remote_logs = []
+        self.save()
         self.unregister_object()
 
 
@@ -28,6 +28,10 @@ class MCVirtConfig(ConfigFile):
 
     REGENERATE_DRBD_CONFIG = False
 
+    # Global configuration items that are replicated to the other nodes in the
+    # cluster. Distributed users are also replicated.
+    REPLICATED_KEYS = ['superusers', 'permissions', 'git', 'ldap', 'migration']
+
     def __init__(self):
         """Set member variables and obtains libvirt domain object"""
         self.config_file = DirectoryLocation.NODE_STORAGE_DIR + '/config.json'
@@ -60,9 +64,25 @@ class MCVirtConfig(ConfigFile):
         config_ip = self.get_config()['cluster']['cluster_ip']
         return config_ip if config_ip else '0.0.0.0'
 
+    def _get_replicated_state(self, config):
+        """Return the global configuration items and users that are shared
+        between the nodes in the cluster"""
+        from mcvirt.auth.user_types.user_base import UserBase
+        distributed_user_types = [user_type.__name__ for user_type in UserBase.__subclasses__()
+                                  if user_type.DISTRIBUTED]
+        state = {}
+        for key in self.REPLICATED_KEYS:
+            if key in config:
+                state[(key,)] = config[key]
+        for username, user_config in config['users'].items():
+            if user_config['user_type'] in distributed_user_types:
+                state[('users', username)] = user_config
+        return state
+
     def create(self):
         """Create a basic VM configuration for new VMs"""
         from node.drbd import Drbd as NodeDrbd
+        from mcvirt.virtual_machine.migration_orchestrator import MigrationOrchestrator
 
         # Create basic config
         json_data = \
@@ -114,7 +134,14 @@ class MCVirtConfig(ConfigFile):
                     'username_attribute': None
                 },
                 'session_timeout': 30,
-                'autostart_interval': 300
+                'autostart_interval': 3600,
+                'autostart_limits': {
+                    'concurrency': 4,
+                    'minimum_free_memory': 512,
+                    'maximum_iowait': 50
+                },
+                'migration': MigrationOrchestrator.get_default_options(),
+                'metrics_interval': 10
             }
 
         # Write the configuration to disk
@@ -139,3 +166,27 @@ class MCVirtConfig(ConfigFile):
 
         if config['version'] < 8:
             config['autostart_interval'] = 300
+
+        if config['version'] < 11:
+            # The allocation table is built from the VM configurations on first use
+            config['drbd']['allocations'] = None
+
+        if config['version'] < 12:
+            config['drbd']['resync_policy'] = None
+
+        if config['version'] < 13:
+            config['autostart_limits'] = {'concurrency': 4, 'minimum_free_memory': 512,
+                                          'maximum_iowait': 50}
+
+        if config['version'] < 14:
+            # VMs are restarted from libvirt events, so the watchdog poll
+            # is only a safety net. Increase the previous default interval.
+            if config['autostart_interval'] == 300:
+                config['autostart_interval'] = 3600
+
+        if config['version'] < 15:
+            from mcvirt.virtual_machine.migration_orchestrator import MigrationOrchestrator
+            config['migration'] = MigrationOrchestrator.get_default_options()
+
+        if config['version'] < 16:
+            config['metrics_interval'] = 10
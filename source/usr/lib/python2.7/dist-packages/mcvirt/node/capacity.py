@@ -0,0 +1,235 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+import threading
+import time
+
+from texttable import Texttable
+
+from mcvirt.auth.permissions import PERMISSIONS
+from mcvirt.cluster.health_monitor import DownNodePolicy
+from mcvirt.constants import DirectoryLocation
+from mcvirt.mcvirt_config import MCVirtConfig
+from mcvirt.rpc.expose_method import Expose
+from mcvirt.rpc.pyro_object import PyroObject
+from mcvirt.syslogger import Syslogger
+from mcvirt.system import System
+from mcvirt.utils import get_hostname
+
+
+class NodeCapacity(PyroObject):
+    """Keep running totals of the resources allocated to VMs on the node: the
+    vCPUs and memory (KiB) of the VMs registered on the node and the disk (MiB)
+    of the VMs whose storage is on the node. The totals are built from the VM
+    configurations when the daemon starts and are then updated as each VM
+    configuration changes, so that the capacity of the node can be obtained
+    without reading the configuration of every VM.
+    """
+
+    # Time (seconds) for which the volume group statistics are cached
+    VG_STATS_TTL = 60
+
+    def __init__(self):
+        """Create member variables"""
+        self.lock = threading.RLock()
+        self.vms = {}
+        self.totals = {'cpu': 0, 'memory': 0, 'disk': 0, 'registered_vms': 0, 'hosted_vms': 0}
+        self.initialised = False
+        self.vg_stats = None
+        self.thread = None
+
+    def initialise(self):
+        """Build the totals from the VM configurations in the background"""
+        self.thread = threading.Thread(target=self._build_totals, name='NodeCapacity')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _build_totals(self):
+        """Add each VM to the totals"""
+        try:
+            for vm_name in MCVirtConfig().get_config()['virtual_machines']:
+                try:
+                    self.update_vm(vm_name)
+                except Exception, e:
+                    Syslogger.logger().error('Unable to obtain resources of %s: %s' %
+                                             (vm_name, str(e)))
+        finally:
+            self.initialised = True
+
+    def _get_disk_size(self, vm_name, disk_id):
+        """Return the size (MiB) of a disk of a VM"""
+        try:
+            vm_object = self._get_registered_object(
+                'virtual_machine_factory'
+            ).getVirtualMachineByName(vm_name)
+            disk_object = self._get_registered_object('hard_drive_factory').getObject(
+                vm_object, disk_id
+            )
+            return int(disk_object.getSize())
+        except Exception, e:
+            Syslogger.logger().warning('Unable to obtain size of disk %s of %s: %s' %
+                                       (disk_id, vm_name, str(e)))
+            return 0
+
+    def _apply_record(self, record, sign):
+        """Add (sign=1) or remove (sign=-1) the resources of a VM from the totals.
+        The lock must be held by the caller.
+        """
+        if record['registered']:
+            self.totals['cpu'] += sign * record['cpu']
+            self.totals['memory'] += sign * record['memory']
+            self.totals['registered_vms'] += sign
+        if record['hosted']:
+            self.totals['disk'] += sign * sum(record['disks'].values())
+            self.totals['hosted_vms'] += sign
+
+    def update_vm(self, vm_name, config=None, refresh_disks=False):
+        """Update the totals with the current configuration of a VM. Disk sizes
+        are only obtained for new disks, unless refresh_disks is set.
+        """
+        if config is None:
+            vm_factory = self._get_registered_object('virtual_machine_factory')
+            config = vm_factory.getVirtualMachineByName(vm_name).get_config_object().get_config()
+
+        with self.lock:
+            previous = self.vms.get(vm_name)
+        hosted = get_hostname() in config['available_nodes']
+        disks = {}
+        if hosted:
+            for disk_id in config['hard_disks']:
+                if previous and not refresh_disks and disk_id in previous['disks']:
+                    disks[disk_id] = previous['disks'][disk_id]
+                else:
+                    disks[disk_id] = self._get_disk_size(vm_name, disk_id)
+
+        record = {'registered': config['node'] == get_hostname(), 'hosted': hosted,
+                  'cpu': int(config['cpu_cores']), 'memory': int(config['memory_allocation']),
+                  'disks': disks}
+        with self.lock:
+            if vm_name in self.vms:
+                self._apply_record(self.vms[vm_name], -1)
+            self.vms[vm_name] = record
+            self._apply_record(record, 1)
+
+            # The volume group usage changes with the disks on the node
+            if previous is None or previous['disks'] != disks:
+                self.vg_stats = None
+
+    def update_config_files(self, config_files):
+        """Update the totals for the VMs whose configuration files have changed"""
+        for config_file in config_files:
+            vm_dir = os.path.dirname(config_file)
+            if os.path.dirname(vm_dir) == DirectoryLocation.BASE_VM_STORAGE_DIR:
+                self.update_vm(os.path.basename(vm_dir))
+
+    def remove_vm(self, vm_name):
+        """Remove a deleted VM from the totals"""
+        with self.lock:
+            if vm_name in self.vms:
+                self._apply_record(self.vms.pop(vm_name), -1)
+                self.vg_stats = None
+
+    def _get_vg_stats(self):
+        """Return the size and free space (MiB) of the VM storage volume group"""
+        with self.lock:
+            if self.vg_stats is not None and time.time() - self.vg_stats[0] < self.VG_STATS_TTL:
+                return self.vg_stats[1]
+
+        stats = {'vg_size': None, 'vg_free': None}
+        volume_group = MCVirtConfig().get_config()['vm_storage_vg']
+        if volume_group:
+            try:
+                _, out, _ = System.runCommand(['vgs', volume_group, '-o', 'vg_size,vg_free',
+                                               '--noheadings', '--nosuffix', '--units', 'm'])
+                vg_size, vg_free = out.split()
+                stats = {'vg_size': int(float(vg_size)), 'vg_free': int(float(vg_free))}
+            except Exception, e:
+                Syslogger.logger().warning('Unable to obtain volume group statistics: %s' %
+                                           str(e))
+        with self.lock:
+            self.vg_stats = (time.time(), stats)
+        return stats
+
+    @Expose()
+    def get_capacity(self):
+        """Return the physical resources of the node, from libvirt and the volume
+        group, with the resources allocated to VMs: vCPUs, memory (KiB) and disk (MiB)
+        """
+        connection = self._get_registered_object('libvirt_connector').get_connection()
+        info = connection.getInfo()
+        capacity = {'cpu_count': info[2], 'total_memory': info[1] * 1024,
+                    'free_memory': connection.getFreeMemory() / 1024,
+                    'initialised': self.initialised}
+        capacity.update(self._get_vg_stats())
+        with self.lock:
+            capacity.update(allocated_cpu=self.totals['cpu'],
+                            allocated_memory=self.totals['memory'],
+                            allocated_disk=self.totals['disk'],
+                            registered_vms=self.totals['registered_vms'],
+                            hosted_vms=self.totals['hosted_vms'])
+        return capacity
+
+    @Expose()
+    def get_capacity_table(self):
+        """Return a table of the capacity of each node in the cluster,
+        querying the remote nodes in parallel
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_CLUSTER)
+
+        def get_remote_capacity(node_object):
+            return node_object.get_connection('node_capacity').get_capacity()
+
+        cluster = self._get_registered_object('cluster')
+        capacities = cluster.run_remote_command(callback_method=get_remote_capacity,
+                                                parallel=True,
+                                                down_node_policy=DownNodePolicy.SKIP,
+                                                return_errors=True)
+        for node in cluster.get_nodes():
+            if node not in capacities:
+                capacities[node] = {'error': 'Node is not responding'}
+            elif isinstance(capacities[node], Exception):
+                capacities[node] = {'error': (str(capacities[node]) or
+                                              capacities[node].__class__.__name__)}
+        capacities[get_hostname()] = self.get_capacity()
+
+        def format_ratio(allocated, total):
+            if total:
+                return '%s / %s (%i%%)' % (allocated, total, allocated * 100 / total)
+            return '%s / -' % allocated
+
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(('Node', 'VMs', 'vCPU / CPU', 'Memory allocated / total (MiB)',
+                      'Free memory (MiB)', 'Disk allocated / VG size (MiB)', 'VG free (MiB)'))
+        for node, capacity in sorted(capacities.items()):
+            if 'error' in capacity:
+                table.add_row((node, '-', '-', '-', '-', '-', capacity['error']))
+                continue
+            vms = '%i' % capacity['registered_vms']
+            if not capacity['initialised']:
+                vms += ' (counting)'
+            table.add_row((
+                node, vms,
+                format_ratio(capacity['allocated_cpu'], capacity['cpu_count']),
+                format_ratio(capacity['allocated_memory'] / 1024,
+                             capacity['total_memory'] / 1024),
+                capacity['free_memory'] / 1024,
+                format_ratio(capacity['allocated_disk'], capacity['vg_size']),
+                capacity['vg_free'] if capacity['vg_free'] is not None else '-'
+            ))
+        return table.draw()
@@ -18,14 +18,23 @@
 # along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
 
 from Cheetah.Template import Template
+from enum import Enum
 import os
 from texttable import Texttable
 import Pyro4
 import string
 import json
+import re
+import subprocess
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import deque
 from binascii import hexlify
 
-from mcvirt.exceptions import DrbdNotInstalledException, DrbdAlreadyEnabled
+from mcvirt.exceptions import (DrbdNotInstalledException, DrbdAlreadyEnabled,
+                               MCVirtCommandException, DrbdAllocationConflictException,
+                               InvalidResyncPolicyException)
 from mcvirt.mcvirt_config import MCVirtConfig
 from mcvirt.system import System
 from mcvirt.auth.permissions import PERMISSIONS
@@ -33,6 +42,278 @@ from mcvirt.rpc.pyro_object import PyroObject
 from mcvirt.rpc.expose_method import Expose
 from mcvirt.utils import get_hostname
 from mcvirt.constants import DirectoryLocation
+from mcvirt.syslogger import Syslogger
+from mcvirt.argument_validator import ArgumentValidator
+
+
+class DrbdEventMonitor(object):
+    """Maintain the live state of the DRBD resources on the node, by consuming
+    the event stream from 'drbdsetup events2', and allow threads to wait on
+    state transitions without polling drbdadm
+    """
+
+    DRBDSETUP = '/sbin/drbdsetup'
+
+    # Number of historic states kept per resource, so that waiters can
+    # detect short-lived transitions (e.g. a verify of a small volume)
+    HISTORY_SIZE = 64
+
+    # Time to wait before restarting drbdsetup, if it exits
+    RESTART_DELAY = 5
+
+    # Map DRBD 9 connection states (events2) to the DRBD 8 'cstate' names
+    CONNECTION_STATE_MAP = {
+        'Connecting': 'WFConnection'
+    }
+
+    def __init__(self):
+        """Create member variables for the state and thread"""
+        self.condition = threading.Condition(threading.RLock())
+        self.resources = {}
+        self.history = {}
+        self.sequence = 0
+        self.initialised = False
+        self.running = False
+        self.process = None
+        self.thread = None
+
+    def start(self):
+        """Start the monitor thread, if it is not already running"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        if not os.path.isfile(self.DRBDSETUP):
+            Syslogger.logger().warning('drbdsetup not found - DRBD events will be polled')
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='DrbdEventMonitor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the monitor thread and the drbdsetup process"""
+        self.running = False
+        if self.process is not None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+        with self.condition:
+            self.initialised = False
+            self.condition.notify_all()
+
+    def is_available(self):
+        """Return whether the monitor holds an up-to-date view of the DRBD resources"""
+        return (self.running and self.initialised and
+                self.thread is not None and self.thread.is_alive())
+
+    def _run(self):
+        """Consume the drbdsetup event stream, restarting it if it exits"""
+        while self.running:
+            try:
+                self.process = subprocess.Popen(
+                    [self.DRBDSETUP, 'events2', '--statistics', 'all'],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                )
+                for line in iter(self.process.stdout.readline, ''):
+                    self._process_line(line)
+                self.process.wait()
+            except Exception, e:
+                Syslogger.logger().error('DRBD event monitor failed: %s' % str(e))
+
+            with self.condition:
+                # Discard the state, as events may have been missed
+                self.initialised = False
+                self.resources = {}
+                self.condition.notify_all()
+
+            if self.running:
+                Syslogger.logger().warning('drbdsetup events2 exited - restarting')
+                time.sleep(self.RESTART_DELAY)
+
+    def _process_line(self, line):
+        """Update the resource state from a single events2 line"""
+        fields = line.split()
+        if len(fields) < 2:
+            return
+
+        event_type, object_type = fields[0], fields[1]
+
+        # 'exists -' marks the end of the initial state dump
+        if event_type == 'exists' and object_type == '-':
+            with self.condition:
+                self.initialised = True
+                self.condition.notify_all()
+            return
+
+        if event_type not in ['exists', 'create', 'change', 'destroy']:
+            return
+
+        attributes = dict(field.split(':', 1) for field in fields[2:] if ':' in field)
+        resource_name = attributes.get('name')
+        if resource_name is None:
+            return
+
+        with self.condition:
+            if object_type == 'resource' and event_type == 'destroy':
+                if resource_name in self.resources:
+                    del self.resources[resource_name]
+            else:
+                resource = self.resources.setdefault(resource_name, {
+                    'role': 'Unknown', 'peer_role': 'Unknown',
+                    'connection': 'StandAlone', 'replication': None,
+                    'disk': 'Diskless', 'peer_disk': 'DUnknown',
+                    'done': None, 'sync_rate': None, 'out_of_sync_sample': None,
+                    'statistics': {}, 'peer_statistics': {}
+                })
+                self._update_resource(resource, event_type, object_type, attributes)
+
+            self.sequence += 1
+            self.history.setdefault(
+                resource_name, deque(maxlen=self.HISTORY_SIZE)
+            ).append((self.sequence, self._get_snapshot(resource_name)))
+            self.condition.notify_all()
+
+    def _update_resource(self, resource, event_type, object_type, attributes):
+        """Apply the attributes of an event to the stored resource state"""
+        if object_type == 'resource':
+            resource['role'] = attributes.get('role', resource['role'])
+
+        elif object_type == 'connection':
+            if event_type == 'destroy':
+                resource['connection'] = 'StandAlone'
+                resource['peer_role'] = 'Unknown'
+            else:
+                resource['connection'] = attributes.get('connection', resource['connection'])
+                resource['peer_role'] = attributes.get('role', resource['peer_role'])
+
+        elif object_type == 'device':
+            if event_type == 'destroy':
+                resource['disk'] = 'Diskless'
+            else:
+                resource['disk'] = attributes.get('disk', resource['disk'])
+                resource['statistics'].update(attributes)
+
+        elif object_type == 'peer-device':
+            if event_type == 'destroy':
+                resource['replication'] = None
+                resource['peer_disk'] = 'DUnknown'
+                resource['done'] = None
+                resource['sync_rate'] = None
+                resource['out_of_sync_sample'] = None
+            else:
+                resource['replication'] = attributes.get('replication',
+                                                         resource['replication'])
+                resource['peer_disk'] = attributes.get('peer-disk', resource['peer_disk'])
+                if 'done' in attributes:
+                    resource['done'] = float(attributes['done'])
+                elif 'replication' in attributes:
+                    resource['done'] = None
+                self._update_sync_rate(resource, attributes)
+                resource['peer_statistics'].update(attributes)
+
+    def _update_sync_rate(self, resource, attributes):
+        """Calculate the resync throughput (KiB/s) from the change in
+        out-of-sync data between consecutive peer-device events
+        """
+        if resource['done'] is None or 'out-of-sync' not in attributes:
+            resource['sync_rate'] = None
+            resource['out_of_sync_sample'] = None
+            return
+
+        sample = (time.time(), int(attributes['out-of-sync']))
+        previous_sample = resource['out_of_sync_sample']
+        if previous_sample is not None and sample[0] > previous_sample[0]:
+            resource['sync_rate'] = max(
+                int((previous_sample[1] - sample[1]) / (sample[0] - previous_sample[0])), 0
+            )
+        resource['out_of_sync_sample'] = sample
+
+    @staticmethod
+    def get_connection_state(connection, replication):
+        """Convert a DRBD 9 connection and replication state into
+        the equivalent DRBD 8 connection state
+        """
+        connection_state = DrbdEventMonitor.CONNECTION_STATE_MAP.get(connection, connection)
+        if (connection_state == 'Connected' and replication and
+                replication not in ['Off', 'Established']):
+            connection_state = replication
+        return connection_state
+
+    def _get_snapshot(self, resource_name):
+        """Return a copy of the state of a resource, using DRBD 8 state names"""
+        resource = self.resources.get(resource_name)
+        if resource is None:
+            return None
+
+        return {
+            'connection_state': self.get_connection_state(resource['connection'],
+                                                          resource['replication']),
+            'role': (resource['role'], resource['peer_role']),
+            'disk_state': (resource['disk'], resource['peer_disk']),
+            'minor': resource['statistics'].get('minor'),
+            'sync_percent': resource['done'],
+            'sync_rate': resource['sync_rate'],
+            'out_of_sync': (int(resource['peer_statistics']['out-of-sync'])
+                            if 'out-of-sync' in resource['peer_statistics'] else None),
+            'statistics': dict(resource['statistics']),
+            'peer_statistics': dict(resource['peer_statistics'])
+        }
+
+    def get_sequence(self):
+        """Return the sequence number of the latest event"""
+        with self.condition:
+            return self.sequence
+
+    def get_state(self, resource_name):
+        """Return the current state of a resource, or None if it is not present"""
+        with self.condition:
+            return self._get_snapshot(resource_name)
+
+    def get_all_states(self):
+        """Return the current state of all resources on the node"""
+        with self.condition:
+            return {resource_name: self._get_snapshot(resource_name)
+                    for resource_name in self.resources}
+
+    def wait_for(self, resource_name, predicate, since=None, timeout=None):
+        """Block until predicate returns True for the state of the resource.
+        If 'since' (a sequence number) is provided, any state recorded after it
+        is considered, so that transient states are not missed.
+        Returns True if the predicate was met, False on timeout and None if
+        the monitor became unavailable.
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                if not self.is_available():
+                    return None
+
+                if since is None:
+                    states = [self._get_snapshot(resource_name)]
+                else:
+                    states = [state for sequence, state in self.history.get(resource_name, [])
+                              if sequence > since]
+                if any(predicate(state) for state in states):
+                    return True
+
+                wait_time = 5
+                if end_time is not None:
+                    wait_time = min(wait_time, end_time - time.time())
+                    if wait_time <= 0:
+                        return False
+                self.condition.wait(wait_time)
+
+
+class ResyncPolicyMode(Enum):
+    """Modes for controlling the DRBD resync rate"""
+
+    # A constant resync rate
+    FIXED = 'fixed'
+    # The rate is adjusted by the DRBD resync controller (c-plan-ahead),
+    # between the minimum and maximum rates, backing off for application I/O
+    DYNAMIC = 'dynamic'
+    # A constant rate, with a separate rate during a daily 'peak' window
+    TIME_OF_DAY = 'time_of_day'
 
 
 class Drbd(PyroObject):
@@ -42,7 +323,19 @@ class Drbd(PyroObject):
     GLOBAL_CONFIG = CONFIG_DIRECTORY + '/global_common.conf'
     GLOBAL_CONFIG_TEMPLATE = DirectoryLocation.TEMPLATE_DIR + '/drbd_global.conf'
     DrbdADM = '/sbin/drbdadm'
+    PROC_DRBD = '/proc/drbd'
     CLUSTER_SIZE = 2
+    EVENT_MONITOR = None
+
+    # Default resync controller planning time (tenths of a second)
+    DEFAULT_PLAN_AHEAD = 20
+
+    # Resync options last applied for time-of-day policies, keyed by
+    # resource name (or None for the node-wide policy)
+    APPLIED_RESYNC_OPTIONS = {}
+
+    # Cluster lock resource held whilst allocating Drbd ports and minors
+    ALLOCATION_LOCK_RESOURCE = 'drbd_allocation'
 
     def initialise(self):
         """Ensure that DRBD user exists and that hook configuration
@@ -53,6 +346,13 @@ class Drbd(PyroObject):
             if MCVirtConfig.REGENERATE_DRBD_CONFIG:
                 MCVirtConfig.REGENERATE_DRBD_CONFIG = False
                 self.generate_config()
+            self.get_event_monitor().start()
+
+    def get_event_monitor(self):
+        """Return the DRBD event monitor for the node"""
+        if Drbd.EVENT_MONITOR is None:
+            Drbd.EVENT_MONITOR = DrbdEventMonitor()
+        return Drbd.EVENT_MONITOR
 
     def check_hook_configuration(self):
         """Ensure that DRBD user exists and that hook configuration
@@ -125,6 +425,9 @@ class Drbd(PyroObject):
             config['drbd']['enabled'] = 1
         MCVirtConfig().update_config(update_config, 'Enabled Drbd')
 
+        # Start monitoring DRBD events
+        self.get_event_monitor().start()
+
     def get_config(self):
         """Return the global Drbd configuration"""
         mcvirt_config = MCVirtConfig()
@@ -141,7 +444,9 @@ class Drbd(PyroObject):
                 'enabled': 0,
                 'secret': '',
                 'sync_rate': '10M',
-                'protocol': 'C'
+                'protocol': 'C',
+                'allocations': None,
+                'resync_policy': None
             }
         return default_config
 
@@ -150,8 +455,16 @@ class Drbd(PyroObject):
         # Obtain the MCVirt Drbd config
         drbd_config = self.get_config()
 
+        # Obtain the resync options from the node-wide policy, defaulting to
+        # the fixed sync rate
+        resync_options = self.get_resync_options(drbd_config.get('resync_policy'))
+        if resync_options is None:
+            resync_options = [('rate', drbd_config['sync_rate'])]
+        Drbd.APPLIED_RESYNC_OPTIONS[None] = resync_options
+
         # Replace the variables in the template with the local Drbd configuration
-        config_content = Template(file=self.GLOBAL_CONFIG_TEMPLATE, searchList=[drbd_config])
+        config_content = Template(file=self.GLOBAL_CONFIG_TEMPLATE,
+                                  searchList=[drbd_config, {'resync_options': resync_options}])
 
         # Write the Drbd configuration
         fh = open(self.GLOBAL_CONFIG, 'w')
@@ -176,6 +489,162 @@ class Drbd(PyroObject):
         if (len(self.get_all_drbd_hard_drive_object())):
             System.runCommand([Drbd.DrbdADM, 'adjust', resource])
 
+    @staticmethod
+    def validate_resync_policy(policy):
+        """Validate a resync policy, returning the policy with defaults applied"""
+        if policy is None:
+            return None
+
+        try:
+            mode = ResyncPolicyMode[str(policy.get('mode')).upper()]
+        except KeyError:
+            raise InvalidResyncPolicyException(
+                'Invalid resync policy mode: %s' % policy.get('mode')
+            )
+
+        if not policy.get('rate'):
+            raise InvalidResyncPolicyException('A resync rate must be specified')
+        validated_policy = {'mode': mode.name, 'rate': str(policy['rate'])}
+
+        if mode is ResyncPolicyMode.DYNAMIC:
+            if not policy.get('max_rate'):
+                raise InvalidResyncPolicyException(
+                    'A maximum rate must be specified for a dynamic resync policy'
+                )
+            validated_policy['max_rate'] = str(policy['max_rate'])
+            validated_policy['min_rate'] = str(policy.get('min_rate') or '0')
+            validated_policy['plan_ahead'] = int(policy.get('plan_ahead') or
+                                                 Drbd.DEFAULT_PLAN_AHEAD)
+            ArgumentValidator.validate_positive_integer(validated_policy['plan_ahead'])
+
+        elif mode is ResyncPolicyMode.TIME_OF_DAY:
+            for key in ['peak_rate', 'peak_start', 'peak_end']:
+                if not policy.get(key):
+                    raise InvalidResyncPolicyException(
+                        '%s must be specified for a time-of-day resync policy' % key
+                    )
+                validated_policy[key] = str(policy[key])
+            ArgumentValidator.validate_time_of_day(validated_policy['peak_start'])
+            ArgumentValidator.validate_time_of_day(validated_policy['peak_end'])
+
+        for key in ['rate', 'max_rate', 'min_rate', 'peak_rate']:
+            if key in validated_policy:
+                ArgumentValidator.validate_drbd_rate(validated_policy[key])
+
+        return validated_policy
+
+    @staticmethod
+    def get_resync_options(policy, current_time=None):
+        """Return the DRBD syncer options for a resync policy, at the given
+        time (defaulting to now), or None if no policy is set
+        """
+        if not policy:
+            return None
+
+        mode = ResyncPolicyMode[policy['mode']]
+        if mode is ResyncPolicyMode.DYNAMIC:
+            return [('rate', policy['rate']),
+                    ('c-plan-ahead', policy['plan_ahead']),
+                    ('c-max-rate', policy['max_rate']),
+                    ('c-min-rate', policy['min_rate'])]
+
+        rate = policy['rate']
+        if mode is ResyncPolicyMode.TIME_OF_DAY:
+            current_time = time.strftime('%H:%M', time.localtime(current_time))
+            start, end = policy['peak_start'], policy['peak_end']
+
+            # Windows that end before they start span midnight
+            if ((start <= end and start <= current_time < end) or
+                    (start > end and (current_time >= start or current_time < end))):
+                rate = policy['peak_rate']
+
+        # Disable the resync controller, so that the rate is constant
+        return [('rate', rate), ('c-plan-ahead', 0)]
+
+    @Expose()
+    def get_resync_policy(self):
+        """Return the node-wide resync policy"""
+        return self.get_config().get('resync_policy')
+
+    @Expose(locking=True)
+    def set_resync_policy(self, policy):
+        """Set the node-wide resync policy, on all nodes in the cluster,
+        and apply it to the running DRBD configuration
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_DRBD)
+        policy = self.validate_resync_policy(policy)
+
+        def update_config(config):
+            config['drbd']['resync_policy'] = policy
+        MCVirtConfig().update_config(update_config, 'Set Drbd resync policy')
+
+        if self._is_cluster_master:
+            def remote_command(node):
+                remote_drbd = node.get_connection('node_drbd')
+                remote_drbd.set_resync_policy(policy)
+            cluster = self._get_registered_object('cluster')
+            cluster.run_remote_command(callback_method=remote_command)
+
+        if self.is_enabled():
+            self.generate_config()
+
+    def get_pending_time_of_day_policies(self):
+        """Return whether the node-wide time-of-day resync policy has moved into,
+        or out of, its peak window, along with the hard drives whose time-of-day
+        resync policy has
+        """
+        if not self.is_enabled():
+            return False, []
+
+        policy = self.get_config().get('resync_policy')
+        node_policy_pending = bool(
+            policy and policy['mode'] == ResyncPolicyMode.TIME_OF_DAY.name and
+            self.get_resync_options(policy) != Drbd.APPLIED_RESYNC_OPTIONS.get(None)
+        )
+
+        pending_hdds = []
+        for hdd in self.get_all_drbd_hard_drive_object():
+            policy = hdd.resync_policy
+            if (policy and policy['mode'] == ResyncPolicyMode.TIME_OF_DAY.name and
+                    self.get_resync_options(policy) !=
+                    Drbd.APPLIED_RESYNC_OPTIONS.get(hdd.resource_name)):
+                pending_hdds.append(hdd)
+        return node_policy_pending, pending_hdds
+
+    @Expose(locking=True)
+    def apply_time_of_day_policies(self):
+        """Regenerate the configuration of resources whose time-of-day
+        resync policy has moved into, or out of, its peak window. The cluster
+        lock is held, so that the configuration is not modified by other commands.
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_DRBD)
+        node_policy_pending, pending_hdds = self.get_pending_time_of_day_policies()
+        if node_policy_pending:
+            self.generate_config()
+
+        for hdd in pending_hdds:
+            hdd._applyResyncPolicy()
+
+    def get_sync_progress(self, resource_name):
+        """Return the sync percentage, throughput (KiB/s), remaining data (KiB)
+        and estimated time remaining (seconds) of a resource on the local node
+        """
+        status = self._get_status().get(resource_name)
+        if status is None:
+            return None
+
+        eta = None
+        if status['sync_rate'] and status['out_of_sync'] is not None:
+            eta = int(status['out_of_sync'] / status['sync_rate'])
+
+        return {
+            'connection_state': status['connection_state'],
+            'sync_percent': status['sync_percent'],
+            'sync_rate': status['sync_rate'],
+            'out_of_sync': status['out_of_sync'],
+            'eta': eta
+        }
+
     def get_all_drbd_hard_drive_object(self, include_remote=False):
         """Obtain all hard drive objects that are backed by DRBD"""
         hard_drive_objects = []
@@ -192,11 +661,218 @@ class Drbd(PyroObject):
 
     def get_used_drbd_ports(self):
         """Return a list of used Drbd ports"""
-        return [hdd.drbd_port for hdd in self.get_all_drbd_hard_drive_object(include_remote=True)]
+        return [port for port, _ in self.get_allocations()['ports']]
 
     def get_used_drbd_minors(self):
         """Return a list of used Drbd minor IDs"""
-        return [hdd.drbd_minor for hdd in self.get_all_drbd_hard_drive_object(include_remote=True)]
+        return [minor for minor, _ in self.get_allocations()['minors']]
+
+    def get_allocations(self):
+        """Return the table of Drbd ports and minors allocated to resources in the
+        cluster, as lists of [ID, resource name], sorted by ID. The table is built
+        from the VM configurations if it has not yet been populated.
+        """
+        allocations = self.get_config().get('allocations')
+        if allocations is None:
+            allocations = {'ports': [], 'minors': []}
+            for hdd in self.get_all_drbd_hard_drive_object(include_remote=True):
+                if hdd._drbd_port is not None:
+                    allocations['ports'].append([int(hdd._drbd_port), hdd.resource_name])
+                if hdd._drbd_minor is not None:
+                    allocations['minors'].append([int(hdd._drbd_minor), hdd.resource_name])
+            allocations['ports'].sort()
+            allocations['minors'].sort()
+
+            def update_config(config):
+                config['drbd']['allocations'] = allocations
+            MCVirtConfig().update_config(update_config, 'Built Drbd allocation table')
+
+        return allocations
+
+    def get_free_port(self, initial_port, exclude=None):
+        """Return the lowest unallocated Drbd port, from initial_port,
+        that is not in the list of excluded ports
+        """
+        return self._get_free_id(self.get_used_drbd_ports(), initial_port, exclude or [])
+
+    def get_free_minor(self, initial_minor):
+        """Return the lowest unallocated Drbd minor, from initial_minor"""
+        return self._get_free_id(self.get_used_drbd_minors(), initial_minor, [])
+
+    @staticmethod
+    def _get_free_id(used_ids, start, exclude):
+        """Perform a binary search of the sorted, unique list of used IDs for the
+        first gap at or above start, skipping any excluded IDs
+        """
+        while True:
+            offset = bisect_left(used_ids, start)
+            lower, upper = offset, len(used_ids)
+
+            # Each ID in a contiguous run from start satisfies
+            # used_ids[index] == start + index - offset
+            while lower < upper:
+                middle = (lower + upper) // 2
+                if used_ids[middle] == start + middle - offset:
+                    lower = middle + 1
+                else:
+                    upper = middle
+
+            free_id = start + lower - offset
+            if free_id not in exclude:
+                return free_id
+            start = free_id + 1
+
+    def reserve_allocation(self, resource_name, port, minor):
+        """Record the port and minor as allocated to the resource"""
+        allocations = self.get_allocations()
+        for key, value in (('ports', int(port)), ('minors', int(minor))):
+            for allocated_id, allocated_resource in allocations[key]:
+                if allocated_id == value and allocated_resource != resource_name:
+                    raise DrbdAllocationConflictException(
+                        'Drbd %s %s is already allocated to %s' %
+                        (key[:-1], value, allocated_resource)
+                    )
+
+        def update_config(config):
+            for key, value in (('ports', int(port)), ('minors', int(minor))):
+                entries = [entry for entry in config['drbd']['allocations'][key]
+                           if entry[1] != resource_name]
+                insort(entries, [value, resource_name])
+                config['drbd']['allocations'][key] = entries
+        MCVirtConfig().update_config(
+            update_config, 'Allocated Drbd port %s and minor %s to %s' %
+            (port, minor, resource_name)
+        )
+
+    @Expose(locking=True)
+    def reserve_remote_allocation(self, resource_name, port, minor):
+        """Record the port and minor allocated to a resource by a remote node"""
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        self.reserve_allocation(resource_name, port, minor)
+
+    @Expose(locking=True)
+    def release_remote_allocations(self, resource_names):
+        """Remove the allocations of resources released by a remote node"""
+        self._get_registered_object('auth').assert_user_type('ClusterUser')
+        self.release_allocations(resource_names)
+
+    def release_allocations(self, resource_names):
+        """Remove the port and minor allocations for the given resources"""
+        allocations = self.get_allocations()
+        if not any(resource_name in resource_names
+                   for key in ('ports', 'minors')
+                   for _, resource_name in allocations[key]):
+            return
+
+        def update_config(config):
+            for key in ('ports', 'minors'):
+                config['drbd']['allocations'][key] = [
+                    entry for entry in config['drbd']['allocations'][key]
+                    if entry[1] not in resource_names
+                ]
+        MCVirtConfig().update_config(
+            update_config, 'Released Drbd allocations for %s' % ', '.join(resource_names)
+        )
+
+    @Expose()
+    def get_status(self):
+        """Return the status of all DRBD resources on the node"""
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_DRBD)
+        return self._get_status()
+
+    def _get_status(self):
+        """Obtain the status of all DRBD resources on the node in a single pass,
+        keyed by resource name
+        """
+        event_monitor = self.get_event_monitor()
+        if event_monitor.is_available():
+            return event_monitor.get_all_states()
+
+        # DRBD 8 reports the full resource status in /proc/drbd, whereas
+        # DRBD 9 only reports the version, so query drbdsetup instead
+        if os.path.isfile(self.PROC_DRBD):
+            with open(self.PROC_DRBD, 'r') as proc_fh:
+                proc_contents = proc_fh.read()
+            if proc_contents.startswith('version: 8.'):
+                return self._parse_proc_status(proc_contents)
+
+        try:
+            return self._get_drbdsetup_status()
+        except (MCVirtCommandException, ValueError):
+            return {}
+
+    def _parse_proc_status(self, proc_contents):
+        """Parse the DRBD 8 /proc/drbd status, mapping minors to resource names"""
+        minor_resources = {
+            int(hdd.drbd_minor): hdd.resource_name
+            for hdd in self.get_all_drbd_hard_drive_object()
+        }
+
+        status = {}
+        resource = None
+        for line in proc_contents.splitlines():
+            match = re.match(r'^\s*(\d+): cs:(\S+) ro:([^/\s]+)/(\S+) ds:([^/\s]+)/(\S+)', line)
+            if match:
+                resource = {
+                    'connection_state': match.group(2),
+                    'role': (match.group(3), match.group(4)),
+                    'disk_state': (match.group(5), match.group(6)),
+                    'minor': match.group(1),
+                    'sync_percent': None,
+                    'sync_rate': None,
+                    'out_of_sync': None
+                }
+                resource_name = minor_resources.get(int(match.group(1)),
+                                                    'minor%s' % match.group(1))
+                status[resource_name] = resource
+                continue
+
+            if resource is None:
+                continue
+
+            out_of_sync_match = re.search(r'oos:(\d+)', line)
+            if out_of_sync_match:
+                resource['out_of_sync'] = int(out_of_sync_match.group(1))
+
+            progress_match = re.search(r"(?:sync'ed|verified):\s*([\d.]+)%", line)
+            if progress_match:
+                resource['sync_percent'] = float(progress_match.group(1))
+
+            speed_match = re.search(r'speed:\s*([\d,]+)', line)
+            if speed_match:
+                resource['sync_rate'] = int(speed_match.group(1).replace(',', ''))
+
+        return status
+
+    def _get_drbdsetup_status(self):
+        """Obtain the status of the DRBD 9 resources from drbdsetup"""
+        _, stdout, _ = System.runCommand([DrbdEventMonitor.DRBDSETUP, 'status', '--json'])
+
+        status = {}
+        for resource in json.loads(stdout):
+            device = (resource.get('devices') or [{}])[0]
+            connection = (resource.get('connections') or [{}])[0]
+            peer_device = (connection.get('peer_devices') or [{}])[0]
+            replication = peer_device.get('replication-state')
+
+            sync_percent = None
+            if replication not in [None, 'Off', 'Established']:
+                sync_percent = peer_device.get('percent-in-sync')
+
+            status[resource['name']] = {
+                'connection_state': DrbdEventMonitor.get_connection_state(
+                    connection.get('connection-state', 'StandAlone'), replication
+                ),
+                'role': (resource.get('role', 'Unknown'),
+                         connection.get('peer-role', 'Unknown')),
+                'disk_state': (device.get('disk-state', 'Diskless'),
+                               peer_device.get('peer-disk-state', 'DUnknown')),
+                'minor': device.get('minor'),
+                'sync_percent': sync_percent,
+                'sync_rate': None,
+                'out_of_sync': peer_device.get('out-of-sync')
+            }
+        return status
 
     @Expose()
     def list(self):
@@ -205,42 +881,70 @@ class Drbd(PyroObject):
         table = Texttable()
         table.set_deco(Texttable.HEADER | Texttable.VLINES)
         table.header(('Volume Name', 'VM', 'Minor', 'Port', 'Role', 'Connection State',
-                      'Disk State', 'Sync Status'))
+                      'Disk State', 'Sync Status', 'Sync %', 'Throughput'))
 
         # Set column alignment and widths
-        table.set_cols_width((30, 20, 5, 5, 20, 20, 20, 13))
-        table.set_cols_align(('l', 'l', 'c', 'c', 'l', 'c', 'l', 'c'))
+        table.set_cols_width((30, 20, 5, 5, 20, 20, 20, 13, 6, 12))
+        table.set_cols_align(('l', 'l', 'c', 'c', 'l', 'c', 'l', 'c', 'r', 'r'))
 
-        # Iterate over Drbd objects, adding to the table
+        # Determine the node from which the status of each volume is obtained.
+        # Volumes of VMs registered on remote nodes are reported by that node.
+        drbd_volumes = []
         for drbd_object in self.get_all_drbd_hard_drive_object(True):
-            remote_node = None
-            if not drbd_object.get_vm_object().isRegisteredLocally():
-                node_name = drbd_object.get_vm_object().getNode()
-                available_nodes = drbd_object.get_vm_object().getAvailableNodes()
+            vm_object = drbd_object.get_vm_object()
+            if vm_object.isRegisteredLocally():
+                status_node = get_hostname()
+                node_name = 'Local'
+                sec_remote_node_name = 'Remote'
+            else:
+                available_nodes = vm_object.getAvailableNodes()
+                node_name = vm_object.getNode()
                 if node_name is None:
                     node_name, sec_remote_node_name = available_nodes
                 else:
                     available_nodes.remove(node_name)
                     sec_remote_node_name = available_nodes[0]
-                drbd_object, remote_node = drbd_object.get_remote_object(
-                    node_name=drbd_object.get_vm_object().getNode(), return_node=True
-                )
-            else:
-                node_name = 'Local'
-                sec_remote_node_name = 'Remote'
-            vm_object = drbd_object.get_vm_object()
-            if remote_node is not None:
-                remote_node.annotate_object(vm_object)
-            table.add_row((drbd_object.get_resource_name(),
+                status_node = node_name
+            drbd_volumes.append((drbd_object, vm_object, status_node,
+                                 node_name, sec_remote_node_name))
+
+        # Obtain the status of all resources, once per node, querying
+        # the remote nodes concurrently
+        node_statuses = {get_hostname(): self._get_status()}
+        remote_nodes = list(set([volume[2] for volume in drbd_volumes]) - set([get_hostname()]))
+        if remote_nodes:
+            cluster = self._get_registered_object('cluster')
+
+            def get_remote_status(node):
+                return node.get_connection('node_drbd').get_status()
+            node_statuses.update(cluster.run_remote_command(
+                callback_method=get_remote_status, nodes=remote_nodes, parallel=True
+            ))
+
+        # Iterate over Drbd objects, adding to the table
+        for drbd_object, vm_object, status_node, node_name, sec_remote_node_name in drbd_volumes:
+            status = node_statuses.get(status_node, {}).get(drbd_object.resource_name)
+            if status is None:
+                status = {
+                    'connection_state': 'Unconfigured',
+                    'role': ('Unknown', 'Unknown'),
+                    'disk_state': ('DUnknown', 'DUnknown'),
+                    'sync_percent': None,
+                    'sync_rate': None
+                }
+
+            table.add_row((drbd_object.resource_name,
                            vm_object.get_name(),
-                           drbd_object.get_drbd_minor(),
-                           drbd_object.get_drbd_port(),
-                           '%s: %s, %s: %s' % (node_name, drbd_object.drbdGetRole()[0][0],
-                                               sec_remote_node_name,
-                                               drbd_object.drbdGetRole()[1][0]),
-                           drbd_object.drbdGetConnectionState()[0],
-                           '%s: %s, %s: %s' % (node_name, drbd_object.drbdGetDiskState()[0][0],
-                                               sec_remote_node_name,
-                                               drbd_object.drbdGetDiskState()[1][0]),
-                           'In Sync' if drbd_object.isInSync() else 'Out of Sync'))
+                           drbd_object.drbd_minor,
+                           drbd_object.drbd_port,
+                           '%s: %s, %s: %s' % (node_name, status['role'][0],
+                                               sec_remote_node_name, status['role'][1]),
+                           status['connection_state'],
+                           '%s: %s, %s: %s' % (node_name, status['disk_state'][0],
+                                               sec_remote_node_name, status['disk_state'][1]),
+                           'In Sync' if drbd_object._isInSync() else 'Out of Sync',
+                           '-' if status['sync_percent'] is None
+                           else '%.1f' % status['sync_percent'],
+                           '-' if status['sync_rate'] is None
+                           else '%s KiB/s' % status['sync_rate']))
         return table.draw()
@@ -85,27 +85,10 @@ class Factory(PyroObject):
                 'Physical interface %s does not exist on local node: %s' % (physical_interface,
                                                                             get_hostname()))
 
-        # Create XML for network
-        network_xml = ET.Element('network')
-        network_xml.set('ipv6', 'no')
-        network_name_xml = ET.SubElement(network_xml, 'name')
-        network_name_xml.text = name
-
-        # Create 'forward'
-        network_forward_xml = ET.SubElement(network_xml, 'forward')
-        network_forward_xml.set('mode', 'bridge')
-
-        # Set interface bridge
-        network_bridge_xml = ET.SubElement(network_xml, 'bridge')
-        network_bridge_xml.set('name', physical_interface)
-
-        # Convert XML object to string
-        network_xml_string = ET.tostring(network_xml, encoding='utf8', method='xml')
-
         # Attempt to register network with LibVirt
         try:
             self._get_registered_object('libvirt_connector').get_connection(
-            ).networkDefineXML(network_xml_string)
+            ).networkDefineXML(self._get_network_xml(name, physical_interface))
         except:
             raise LibvirtException('An error occurred whilst registering network with LibVirt')
 
@@ -133,6 +116,61 @@ class Factory(PyroObject):
 
         return network_instance
 
+    @staticmethod
+    def _get_network_xml(name, physical_interface):
+        """Return the libvirt XML for a bridged network"""
+        # Create XML for network
+        network_xml = ET.Element('network')
+        network_xml.set('ipv6', 'no')
+        network_name_xml = ET.SubElement(network_xml, 'name')
+        network_name_xml.text = name
+
+        # Create 'forward'
+        network_forward_xml = ET.SubElement(network_xml, 'forward')
+        network_forward_xml.set('mode', 'bridge')
+
+        # Set interface bridge
+        network_bridge_xml = ET.SubElement(network_xml, 'bridge')
+        network_bridge_xml.set('name', physical_interface)
+
+        # Convert XML object to string
+        return ET.tostring(network_xml, encoding='utf8', method='xml')
+
+    def _define_network(self, name, physical_interface):
+        """Register, start and autostart a network in libvirt, without
+        updating the MCVirt configuration"""
+        try:
+            libvirt_network = self._get_registered_object('libvirt_connector').get_connection(
+            ).networkDefineXML(self._get_network_xml(name, physical_interface))
+            libvirt_network.create()
+            libvirt_network.setAutostart(True)
+        except libvirtError:
+            raise LibvirtException('An error occurred whilst registering network with LibVirt')
+
+    def _undefine_network(self, name):
+        """Stop and remove a network from libvirt, without updating the
+        MCVirt configuration"""
+        try:
+            libvirt_network = self._get_registered_object('libvirt_connector').get_connection(
+            ).networkLookupByName(name)
+        except libvirtError:
+            # The network is not registered with libvirt
+            return
+
+        try:
+            libvirt_network.destroy()
+        except libvirtError:
+            # The network is not running
+            pass
+
+        try:
+            libvirt_network.undefine()
+        except libvirtError:
+            raise LibvirtException('Failed to delete network from libvirt')
+
+        if name in Factory.CACHED_OBJECTS:
+            del Factory.CACHED_OBJECTS[name]
+
     @Expose()
     def get_network_by_name(self, network_name):
         """Return a network object of the network for a given name."""
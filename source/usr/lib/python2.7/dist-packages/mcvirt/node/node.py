@@ -17,22 +17,36 @@
 # You should have received a copy of the GNU General Public License
 # along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
 
+import multiprocessing
+import os
+import threading
+
+import libvirt
 import Pyro4
 
 from mcvirt.mcvirt_config import MCVirtConfig
 from mcvirt.auth.permissions import PERMISSIONS
 from mcvirt.rpc.pyro_object import PyroObject
 from mcvirt.rpc.expose_method import Expose
-from mcvirt.rpc.lock import MethodLock
+from mcvirt.cluster.lock_manager import ClusterLockManager
 from mcvirt.version import VERSION
 from mcvirt.argument_validator import ArgumentValidator
 from mcvirt.system import System
 from mcvirt.constants import DirectoryLocation
+from mcvirt.exceptions import EvacuationInProgressException
+from mcvirt.syslogger import Syslogger
+from mcvirt.thread.auto_start_scheduler import AutoStartScheduler
+from mcvirt.thread.evacuation_scheduler import EvacuationScheduler
+from mcvirt.utils import get_hostname
 
 
 class Node(PyroObject):
     """Provides methods to configure the local node."""
 
+    # Evacuation of the node that is in progress, or that last completed
+    EVACUATION = None
+    EVACUATION_LOCK = threading.Lock()
+
     @Expose(locking=True)
     def set_storage_volume_group(self, volume_group):
         """Update the MCVirt configuration to set the volume group for VM storage."""
@@ -52,7 +66,10 @@ class Node(PyroObject):
     def get_listen_ports(self):
         return self._get_listen_ports(include_remote=False)
 
-    def _get_listen_ports(self, include_remote=False):
+    def _get_listen_ports(self, include_remote=False, nodes=None):
+        """Return the TCP ports listening on the local node and, if include_remote
+        is set, on the given remote nodes (or all remote nodes)
+        """
         with open('/proc/net/tcp', 'r') as fh:
             net_tcp_contents = fh.read()
         ports = [int(line.split()[1].split(':')[1], 16)
@@ -62,7 +79,7 @@ class Node(PyroObject):
                 node_object = remote_object.get_connection('node')
                 ports.extend(node_object.get_listen_ports())
             cluster = self._get_registered_object('cluster')
-            cluster.run_remote_command(remote_command)
+            cluster.run_remote_command(remote_command, nodes=nodes)
         return ports
 
     @Expose(locking=True)
@@ -98,6 +115,107 @@ class Node(PyroObject):
                                         False, DirectoryLocation.BASE_STORAGE_DIR)
         return bool(out)
 
+    @Expose()
+    def get_free_resources(self):
+        """Return the free memory (KiB), CPU count and 1-minute load average of the node"""
+        return {'free_memory': AutoStartScheduler.get_free_memory() or 0,
+                'cpu_count': multiprocessing.cpu_count(),
+                'load_average': os.getloadavg()[0]}
+
+    @Expose()
+    def get_placement_facts(self, storage_type=None):
+        """Return the resources of the node used to place new VMs: the free
+        resources, the total memory (KiB), the vCPUs and memory (KiB) allocated
+        to running VMs, the free space (MiB) for the storage type and the number
+        of Drbd resources on the node
+        """
+        facts = self.get_free_resources()
+
+        connection = self._get_registered_object('libvirt_connector').get_connection()
+        facts['total_memory'] = connection.getInfo()[1] * 1024
+        facts['allocated_cpu'] = 0
+        facts['allocated_memory'] = 0
+        for domain in connection.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE):
+            _, max_memory, _, vcpus, _ = domain.info()
+            facts['allocated_cpu'] += vcpus
+            facts['allocated_memory'] += max_memory
+
+        # Free space is only known once the storage type has been chosen
+        facts['storage_available'] = True
+        facts['free_disk'] = None
+        if storage_type is not None:
+            hard_drive_factory = self._get_registered_object('hard_drive_factory')
+            storage_class = hard_drive_factory.getClass(storage_type)
+            facts['storage_available'] = (
+                storage_class in hard_drive_factory._getAvailableStorageTypes()
+            )
+            if facts['storage_available']:
+                facts['free_disk'] = int(storage_class.get_free_space(hard_drive_factory))
+
+        node_drbd = self._get_registered_object('node_drbd')
+        facts['drbd_resources'] = 0
+        if node_drbd.is_enabled():
+            event_monitor = node_drbd.get_event_monitor()
+            if event_monitor.is_available():
+                facts['drbd_resources'] = len(event_monitor.get_all_states())
+            else:
+                facts['drbd_resources'] = len(node_drbd.get_all_drbd_hard_drive_object())
+        return facts
+
+    @Expose()
+    def evacuate(self, concurrency=None, bandwidth=None, retries=None, dry_run=False):
+        """Migrate all VMs off the node, planning the destination of each VM from
+        the free resources of the other nodes and migrating several VMs concurrently.
+        Bandwidth (MiB/s) is the total limit for all concurrent migrations.
+        Returns the status of each VM.
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_NODE)
+        if concurrency is not None:
+            ArgumentValidator.validate_positive_integer(concurrency)
+        if bandwidth is not None:
+            ArgumentValidator.validate_positive_integer(bandwidth)
+        if retries is not None:
+            ArgumentValidator.validate_integer(retries)
+        ArgumentValidator.validate_boolean(dry_run)
+
+        # Obtain the free resources of the nodes that are up
+        cluster = self._get_registered_object('cluster')
+        node_resources = {}
+        for node in cluster.get_nodes():
+            try:
+                remote_node = cluster.get_remote_node(node)
+                node_resources[node] = remote_node.get_connection('node').get_free_resources()
+            except Exception, e:
+                Syslogger.logger().warning('Not evacuating to %s, as the resources of the '
+                                           'node could not be obtained: %s' % (node, str(e)))
+
+        vm_factory = self._get_registered_object('virtual_machine_factory')
+        scheduler = EvacuationScheduler(get_hostname(),
+                                        vm_factory.getAllVirtualMachines(node=get_hostname()),
+                                        concurrency=concurrency, bandwidth=bandwidth,
+                                        retries=retries)
+        scheduler.plan_migrations(node_resources)
+        if dry_run:
+            return scheduler.get_report_table()
+
+        with Node.EVACUATION_LOCK:
+            if Node.EVACUATION is not None and Node.EVACUATION.finish_time is None:
+                raise EvacuationInProgressException('The node is already being evacuated')
+            Node.EVACUATION = scheduler
+
+        scheduler.run()
+        return scheduler.get_report_table()
+
+    @Expose()
+    def get_evacuation_status(self):
+        """Return the status of the evacuation of the node that is in
+        progress, or that last completed
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_NODE)
+        if Node.EVACUATION is None:
+            return 'The node has not been evacuated'
+        return Node.EVACUATION.get_report_table()
+
     @Expose()
     def get_version(self):
         """Return the version of the running daemon"""
@@ -105,11 +223,9 @@ class Node(PyroObject):
 
     @Expose()
     def clear_method_lock(self):
-        """Force clear a method lock to escape deadlock"""
+        """Force clear the cluster locks held on the node to escape deadlock"""
         self._get_registered_object('auth').assert_permission(PERMISSIONS.SUPERUSER)
-        lock = MethodLock.get_lock()
-        if lock.locked():
-            lock.release()
+        if ClusterLockManager.get_instance().clear_leases():
             Pyro4.current_context.has_lock = False
             return True
         return False
@@ -18,8 +18,12 @@
 # along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
 
 import argparse
-import binascii
+import hashlib
 import os
+import Queue
+import threading
+import time
+import Pyro4
 
 from mcvirt.exceptions import (ArgumentParserException, DrbdVolumeNotInSyncException,
                                AuthenticationError)
@@ -43,6 +47,10 @@ class Parser(object):
 
     AUTH_FILE = '.mcvirt-auth'
 
+    # Size of the chunks, and number of concurrent connections, used to upload ISOs
+    ISO_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+    ISO_UPLOAD_CONNECTIONS = 4
+
     def __init__(self, verbose=True):
         """Configure the argument parser object."""
         self.USERNAME = None
@@ -137,6 +145,23 @@ class Parser(object):
                                           help='Copy an ISO to ISO directory')
         self.add_iso_methods.add_argument('--from-url', dest='add_url', action='store_true',
                                           help='Download and add an ISO')
+        self.add_iso_subparser.add_argument('--sha256', dest='iso_checksum', metavar='CHECKSUM',
+                                            help='SHA256 checksum to verify the downloaded ISO',
+                                            default=None)
+        self.add_iso_subparser.add_argument('--background', dest='iso_background',
+                                            action='store_true',
+                                            help='Return once the download has started')
+
+        self.replicate_iso_subparser = self.iso_subparser.add_parser(
+            'replicate', help='Copy an ISO to other nodes in the cluster',
+            parents=[self.parent_parser]
+        )
+        self.replicate_iso_subparser.add_argument('replicate_name', metavar='NAME', type=str,
+                                                  help='ISO to replicate')
+        self.replicate_iso_subparser.add_argument('--nodes', dest='replicate_nodes',
+                                                  metavar='Node', nargs='+', default=None,
+                                                  help='Nodes to copy the ISO to '
+                                                       '(default: all nodes)')
 
         for parser in [self.iso_parser, self.delete_iso_subparser, self.list_iso_subparser,
                        self.add_iso_subparser]:
@@ -229,14 +254,15 @@ class Parser(object):
         self.create_parser.add_argument('--nodes', dest='nodes', action='append',
                                         help='Specify the nodes that the VM will be' +
                                              ' hosted on, if a Drbd storage-type' +
-                                             ' is specified',
+                                             ' is specified. If not specified, the nodes' +
+                                             ' with the most free resources are used',
                                         default=[])
 
         self.create_parser.add_argument('vm_name', metavar='VM Name', type=str, help='Name of VM')
         # Determine if machine is configured to use Drbd
         self.create_parser.add_argument('--storage-type', dest='storage_type',
                                         metavar='Storage backing type',
-                                        type=str, default=None, choices=['Local', 'Drbd'])
+                                        type=str, default=None, choices=['Local', 'Drbd', 'Qcow2'])
         self.create_parser.add_argument('--hdd-driver', metavar='Hard Drive Driver',
                                         dest='hard_disk_driver', type=str,
                                         help='Driver for hard disk',
@@ -246,6 +272,10 @@ class Parser(object):
                                         help='Driver for graphics', default=None)
         self.create_parser.add_argument('--modification-flag', help='Add VM modification flag',
                                         dest='modification_flags', action='append')
+        self.create_parser.add_argument('--dry-run', dest='create_dry_run', action='store_true',
+                                        help=('Show the nodes that would be chosen to host '
+                                              'the VM, with the ranking of the nodes, without '
+                                              'creating the VM'))
 
         # Get arguments for deleting a VM
         self.delete_parser = self.subparsers.add_parser('delete', help='Delete VM',
@@ -314,7 +344,20 @@ class Parser(object):
                                         type=int, help='Remove a hard drive from a VM')
         self.update_parser.add_argument('--storage-type', dest='storage_type',
                                         metavar='Storage backing type', type=str,
-                                        default=None, choices=['Local', 'Drbd'])
+                                        default=None, choices=['Local', 'Drbd', 'Qcow2'])
+        self.update_parser.add_argument('--backing-image', dest='backing_image',
+                                        metavar='Backing Image', type=str, default=None,
+                                        help=('Create the new Qcow2 disk as an overlay of the '
+                                              'given image (name or path of an image in the '
+                                              'disk image directory)'))
+        self.update_parser.add_argument('--preallocation', dest='preallocation',
+                                        metavar='Preallocation', type=str, default=None,
+                                        choices=['OFF', 'METADATA', 'FALLOC', 'FULL'],
+                                        help='Preallocation mode for the new Qcow2 disk')
+        self.update_parser.add_argument('--copy-on-read', dest='copy_on_read',
+                                        action='store_true',
+                                        help=('Copy blocks read from the backing image into '
+                                              'the new Qcow2 disk'))
         self.update_parser.add_argument('--hdd-driver', metavar='Hard Drive Driver',
                                         dest='hard_disk_driver', type=str,
                                         help='Driver for hard disk',
@@ -354,6 +397,10 @@ class Parser(object):
         self.vm_autostart_mutual_group.add_argument('--autostart-disable', action='store_true',
                                                     dest='autostart_disable',
                                                     help='Disable autostart of VM')
+        self.update_parser.add_argument('--autostart-group', dest='autostart_group',
+                                        metavar='Group', type=int, default=None,
+                                        help=('Set the autostart group of the VM. VMs in '
+                                              'lower groups are started first.'))
         self.update_parser.add_argument('vm_name', metavar='VM Name', type=str, help='Name of VM')
         self.update_parser.add_argument('--add-flag', help='Add VM modification flag',
                                         dest='add_flags', action='append')
@@ -510,11 +557,54 @@ class Parser(object):
         self.duplicate_parser.add_argument('vm_name', metavar='VM Name', type=str,
                                            help='Name of duplicate VM')
 
+        # Create a parent parser for live migration options
+        self.migration_options_parser = argparse.ArgumentParser(add_help=False)
+        self.migration_options_parser.add_argument(
+            '--bandwidth', dest='migration_bandwidth', metavar='MiB/s', type=int,
+            help='Maximum bandwidth used by online migrations'
+        )
+        self.migration_options_parser.add_argument(
+            '--max-downtime', dest='migration_max_downtime', metavar='Milliseconds', type=int,
+            help='Maximum time that the VM may be paused to complete an online migration'
+        )
+        self.migration_options_parser.add_argument(
+            '--parallel-connections', dest='migration_parallel_connections',
+            metavar='Connections', type=int,
+            help='Number of connections used to transfer the memory of the VM'
+        )
+        self.migration_options_parser.add_argument(
+            '--compression', dest='migration_compression', choices=['xbzrle', 'zlib', 'zstd'],
+            help=('xbzrle: transfer the changes to memory pages. zlib/zstd: compress '
+                  'memory pages (uses parallel connections)')
+        )
+        self.migration_options_parser.add_argument(
+            '--auto-converge', dest='migration_auto_converge', action='store_const',
+            const=True, help='Throttle the VM CPUs if the migration is not converging'
+        )
+        self.migration_options_parser.add_argument(
+            '--no-auto-converge', dest='migration_auto_converge', action='store_const',
+            const=False, help='Do not throttle the VM CPUs'
+        )
+        self.migration_options_parser.add_argument(
+            '--post-copy', dest='migration_post_copy', action='store_const', const=True,
+            help=('Switch to post-copy, running the VM on the destination node whilst the '
+                  'remaining memory is transferred, if the migration has not completed '
+                  'after --post-copy-after seconds')
+        )
+        self.migration_options_parser.add_argument(
+            '--no-post-copy', dest='migration_post_copy', action='store_const', const=False,
+            help='Do not switch to post-copy'
+        )
+        self.migration_options_parser.add_argument(
+            '--post-copy-after', dest='migration_post_copy_after', metavar='Seconds', type=int,
+            help='Time after which the migration is switched to post-copy (default: 60)'
+        )
+
         # Get arguments for migrating a VM
         self.migrate_parser = self.subparsers.add_parser(
             'migrate',
             help='Perform migrations of virtual machines',
-            parents=[self.parent_parser]
+            parents=[self.parent_parser, self.migration_options_parser]
         )
         self.migrate_parser.add_argument(
             '--node',
@@ -597,6 +687,38 @@ class Parser(object):
             required=True,
             help='Hostname of the remote node to remove from the cluster')
 
+        self.cluster_subparser.add_parser(
+            'health',
+            help=('Show the liveness, heartbeat latency and MCVirt version'
+                  ' of the other nodes in the cluster'),
+            parents=[self.parent_parser]
+        )
+        self.cluster_subparser.add_parser(
+            'capacity',
+            help=('Show the vCPUs, memory and disk allocated to VMs on each node,'
+                  ' against the resources of the node'),
+            parents=[self.parent_parser]
+        )
+        self.cluster_subparser.add_parser(
+            'migration-defaults',
+            help=('Set the default online migration options for the cluster, or show'
+                  ' the defaults if no options are specified'),
+            parents=[self.parent_parser, self.migration_options_parser]
+        )
+        self.migration_progress_parser = self.cluster_subparser.add_parser(
+            'migration-progress',
+            help='Show the progress of an online migration of a VM',
+            parents=[self.parent_parser]
+        )
+        self.migration_progress_parser.add_argument('vm_name', metavar='VM Name',
+                                                    help='Name of the VM')
+        self.cluster_subparser.add_parser(
+            'check-config',
+            help=('Compare the replicated configuration of the local node with'
+                  ' the other nodes in the cluster'),
+            parents=[self.parent_parser]
+        )
+
         # Create subparser for commands relating to the local node configuration
         self.node_parser = self.subparsers.add_parser(
             'node',
@@ -626,6 +748,89 @@ class Parser(object):
                                                dest='get_autostart_interval',
                                                action='store_true',
                                                help='Return the current autostart interval.')
+        self.node_watchdog_parser.add_argument('--set-autostart-concurrency',
+                                               dest='autostart_concurrency',
+                                               metavar='Concurrent VM starts', type=int,
+                                               help=('Set the number of VMs that are '
+                                                     'started concurrently during autostart.'))
+        self.node_watchdog_parser.add_argument('--set-autostart-min-free-memory',
+                                               dest='autostart_min_free_memory',
+                                               metavar='Free memory (MiB)', type=int,
+                                               help=('Delay autostart of further VMs whilst '
+                                                     'the free memory is below this amount.'))
+        self.node_watchdog_parser.add_argument('--set-autostart-max-iowait',
+                                               dest='autostart_max_iowait',
+                                               metavar='I/O wait (%)', type=int,
+                                               help=('Delay autostart of further VMs whilst '
+                                                     'the I/O wait is above this percentage.'))
+        self.node_watchdog_parser.add_argument('--get-autostart-report',
+                                               dest='get_autostart_report',
+                                               action='store_true',
+                                               help='Show the start times of VMs during the '
+                                                    'last autostart.')
+        self.node_watchdog_parser.add_argument('--reset-restart-state',
+                                               dest='reset_restart_state',
+                                               metavar='VM Name', default=None,
+                                               help=('Clear the restart history of a VM, '
+                                                     'resuming restarts of a VM detected to '
+                                                     'be in a crash loop.'))
+
+        self.node_evacuation_parser = self.node_parser.add_argument_group(
+            'Evacuation', 'Migrate all VMs off the node, e.g. for maintenance'
+        )
+        self.node_evacuation_parser.add_argument('--evacuate', dest='evacuate',
+                                                 action='store_true',
+                                                 help=('Migrate all VMs to the other nodes in '
+                                                       'the cluster. Running VMs are migrated '
+                                                       'online.'))
+        self.node_evacuation_parser.add_argument('--evacuate-dry-run', dest='evacuate_dry_run',
+                                                 action='store_true',
+                                                 help=('Show the destination node planned for '
+                                                       'each VM, without migrating the VMs.'))
+        self.node_evacuation_parser.add_argument('--evacuation-concurrency',
+                                                 dest='evacuation_concurrency',
+                                                 metavar='Concurrent migrations', type=int,
+                                                 help=('Number of VMs migrated concurrently '
+                                                       '(default: 2).'))
+        self.node_evacuation_parser.add_argument('--evacuation-bandwidth',
+                                                 dest='evacuation_bandwidth',
+                                                 metavar='MiB/s', type=int,
+                                                 help=('Total bandwidth used by the concurrent '
+                                                       'online migrations.'))
+        self.node_evacuation_parser.add_argument('--evacuation-retries',
+                                                 dest='evacuation_retries',
+                                                 metavar='Retries', type=int,
+                                                 help=('Number of times that a failed migration '
+                                                       'is retried (default: 2).'))
+        self.node_evacuation_parser.add_argument('--get-evacuation-status',
+                                                 dest='get_evacuation_status',
+                                                 action='store_true',
+                                                 help=('Show the progress of the current, or '
+                                                       'last, evacuation of the node.'))
+
+        self.node_metrics_parser = self.node_parser.add_argument_group(
+            'Metrics', 'Show the CPU, disk, network and memory usage of the VMs on the node'
+        )
+        self.node_metrics_parser.add_argument('--top', dest='metrics_top',
+                                              metavar='Metric', default=None,
+                                              help=('Show the VMs with the highest average '
+                                                    'value of a metric, e.g. cpu, disk_read, '
+                                                    'disk_write, net_rx, net_tx, memory_rss.'))
+        self.node_metrics_parser.add_argument('--top-count', dest='metrics_top_count',
+                                              metavar='Number of VMs', type=int, default=5,
+                                              help='Number of VMs shown by --top (default: 5).')
+        self.node_metrics_parser.add_argument('--vm-metrics', dest='vm_metrics',
+                                              metavar='VM Name', default=None,
+                                              help='Show each sample of the metrics of a VM.')
+        self.node_metrics_parser.add_argument('--metrics-duration', dest='metrics_duration',
+                                              metavar='Seconds', type=int, default=60,
+                                              help=('Period of the samples shown by --top '
+                                                    'and --vm-metrics (default: 60).'))
+        self.node_metrics_parser.add_argument('--set-metrics-interval',
+                                              dest='metrics_interval',
+                                              metavar='Seconds', type=int,
+                                              help=('Set the interval between samples of the '
+                                                    'VM statistics.'))
 
         self.node_cluster_config = self.node_parser.add_argument_group(
             'Cluster', 'Configure the node-specific cluster configurations'
@@ -777,6 +982,72 @@ class Parser(object):
         self.drbd_subparser.add_parser('list', help='List Drbd volumes on the system',
                                        parents=[self.parent_parser])
 
+        self.drbd_resync_policy_parser = self.drbd_subparser.add_parser(
+            'resync-policy',
+            help=('Set the resync rate policy for the cluster, or for a single '
+                  'VM disk, if a VM is specified'),
+            parents=[self.parent_parser]
+        )
+        self.drbd_resync_policy_parser.add_argument(
+            '--vm', dest='vm_name', metavar='VM Name', default=None,
+            help='Set the policy for a disk of the VM, rather than for the cluster'
+        )
+        self.drbd_resync_policy_parser.add_argument(
+            '--disk-id', metavar='Disk Id', default=1, type=int,
+            help='Specify the Disk ID of the VM (default: 1)'
+        )
+        self.drbd_resync_policy_mode_group = \
+            self.drbd_resync_policy_parser.add_mutually_exclusive_group(required=True)
+        self.drbd_resync_policy_mode_group.add_argument(
+            '--mode', dest='resync_mode', choices=['fixed', 'dynamic', 'time_of_day'],
+            help=('fixed: resync at a constant rate. '
+                  'dynamic: allow the DRBD resync controller to vary the rate '
+                  'between --min-rate and --max-rate. '
+                  'time_of_day: use --peak-rate between --peak-start and --peak-end.')
+        )
+        self.drbd_resync_policy_mode_group.add_argument(
+            '--clear', dest='resync_clear', action='store_true',
+            help='Remove the policy, reverting to the node-wide policy or sync rate'
+        )
+        self.drbd_resync_policy_parser.add_argument(
+            '--rate', dest='resync_rate', metavar='Rate',
+            help='Resync rate, e.g. 10M (the initial rate for dynamic policies)'
+        )
+        self.drbd_resync_policy_parser.add_argument(
+            '--max-rate', dest='resync_max_rate', metavar='Rate',
+            help='Maximum resync rate for dynamic policies'
+        )
+        self.drbd_resync_policy_parser.add_argument(
+            '--min-rate', dest='resync_min_rate', metavar='Rate',
+            help='Resync rate guaranteed whilst there is application I/O, for dynamic policies'
+        )
+        self.drbd_resync_policy_parser.add_argument(
+            '--plan-ahead', dest='resync_plan_ahead', metavar='Tenths of a second', type=int,
+            help='Resync controller planning time, for dynamic policies (default: 20)'
+        )
+        self.drbd_resync_policy_parser.add_argument(
+            '--peak-rate', dest='resync_peak_rate', metavar='Rate',
+            help='Resync rate during the peak window, for time-of-day policies'
+        )
+        self.drbd_resync_policy_parser.add_argument(
+            '--peak-start', dest='resync_peak_start', metavar='HH:MM',
+            help='Start of the peak window, for time-of-day policies'
+        )
+        self.drbd_resync_policy_parser.add_argument(
+            '--peak-end', dest='resync_peak_end', metavar='HH:MM',
+            help='End of the peak window, for time-of-day policies'
+        )
+
+        self.drbd_progress_parser = self.drbd_subparser.add_parser(
+            'progress', help='Show the progress of a resync or verification of a VM disk',
+            parents=[self.parent_parser]
+        )
+        self.drbd_progress_parser.add_argument('vm_name', metavar='VM Name',
+                                               help='Name of the VM')
+        self.drbd_progress_parser.add_argument('--disk-id', metavar='Disk Id', default=1,
+                                               type=int,
+                                               help='Specify the Disk ID (default: 1)')
+
         # Create sub-parser for backup commands
         self.backup_parser = self.subparsers.add_parser('backup',
                                                         help='Performs backup-related tasks',
@@ -822,14 +1093,139 @@ class Parser(object):
                                                       help='Unlocks a VM', action='store_true')
         self.lock_parser.add_argument('vm_name', metavar='VM Name', type=str, help='Name of VM')
 
+        # Create sub-parser for viewing command logs
+        self.logs_parser = self.subparsers.add_parser('logs', help='View command logs',
+                                                      parents=[self.parent_parser])
+        self.logs_parser.add_argument('--user', dest='log_user', metavar='User', default=None,
+                                      help='Only show commands run by the user')
+        self.logs_parser.add_argument('--object', dest='log_object', metavar='Object',
+                                      default=None,
+                                      help='Only show commands run against the object')
+        self.logs_parser.add_argument('--status', dest='log_status', default=None,
+                                      choices=['QUEUED', 'RUNNING', 'SUCCESS', 'FAILED'],
+                                      help='Only show commands with the status')
+        self.logs_parser.add_argument('--since', dest='log_since', metavar='Minutes',
+                                      type=int, default=None,
+                                      help='Only show commands from the last number of minutes')
+        self.logs_parser.add_argument('--limit', dest='log_limit', type=int, default=20,
+                                      help='Maximum number of commands to show')
+        self.logs_parser.add_argument('--follow', dest='log_follow', action='store_true',
+                                      help='Continue to show new commands as they are run')
+
         self.exit_parser = self.subparsers.add_parser('exit', help='Exits the MCVirt shell',
                                                       parents=[self.parent_parser])
 
+    @staticmethod
+    def format_log(log):
+        """Return a single-line description of a command log"""
+        log_line = '%s %s %s %s %s: %s' % (
+            log['id'], log['queue_date'], log['node'], log['user'], log['status_name'],
+            log['description']
+        )
+        if log['exception_message']:
+            log_line += ' (%s)' % log['exception_message']
+        return log_line
+
+    @staticmethod
+    def get_migration_options(args):
+        """Return the live migration options that have been specified"""
+        options = {}
+        for option in ['bandwidth', 'max_downtime', 'parallel_connections', 'compression',
+                       'auto_converge', 'post_copy', 'post_copy_after']:
+            value = getattr(args, 'migration_%s' % option)
+            if value is not None:
+                options[option] = value
+        return options
+
+    @staticmethod
+    def format_migration_progress(progress):
+        """Return a description of the progress of a live migration"""
+        def format_size(size):
+            return '%.1fMiB' % (size / 1048576.0) if size is not None else '-'
+
+        description = 'Migrating to %s' % progress['destination']
+        if progress.get('percent') is None:
+            return description + ': waiting for migration to start'
+        description += ': %.1f%% complete, %s remaining, %s/s transfer, %s/s dirtied' % (
+            progress['percent'], format_size(progress['memory_remaining']),
+            format_size(progress['transfer_rate']), format_size(progress['dirty_rate'])
+        )
+        if progress['iteration'] is not None:
+            description += ', iteration %s' % progress['iteration']
+        if progress['post_copy']:
+            description += ', post-copy'
+        description += ', ETA: %s' % ('%ss' % progress['eta']
+                                      if progress['eta'] is not None else 'not converging')
+        return description
+
     def print_status(self, status):
         """Print if the user has specified that the parser should print statuses."""
         if self.verbose:
             print status
 
+    def upload_iso(self, rpc, iso_factory, path):
+        """Upload an ISO to the daemon, sending chunks over several concurrent
+        connections and resuming a previously interrupted upload
+        """
+        size = os.path.getsize(path)
+        iso_writer = iso_factory.add_iso_from_stream(path, size=size)
+        rpc.annotate_object(iso_writer)
+        offset = iso_writer.get_offset()
+        if offset:
+            self.print_status('Resuming upload from %s of %s bytes' % (offset, size))
+
+        checksum = hashlib.sha256()
+        chunk_queue = Queue.Queue(maxsize=(self.ISO_UPLOAD_CONNECTIONS * 2))
+        errors = []
+
+        def upload_chunks():
+            # Each thread uses its own connection to the writer object
+            writer_connection = Pyro4.Proxy(iso_writer._pyroUri)
+            rpc.annotate_object(writer_connection)
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is None:
+                    break
+                # Continue to consume chunks after a failure, so that
+                # the reader is not blocked
+                if errors:
+                    continue
+                try:
+                    # Send as a bytearray, which is transferred as binary data
+                    writer_connection.write_chunk(chunk[0], bytearray(chunk[1]))
+                except Exception, e:
+                    errors.append(e)
+
+        upload_threads = [threading.Thread(target=upload_chunks)
+                          for _ in range(self.ISO_UPLOAD_CONNECTIONS)]
+        for upload_thread in upload_threads:
+            upload_thread.start()
+
+        try:
+            with open(path, 'rb') as iso_fh:
+                # Include the data that has already been received in the checksum
+                while iso_fh.tell() < offset:
+                    checksum.update(iso_fh.read(min(self.ISO_UPLOAD_CHUNK_SIZE,
+                                                    offset - iso_fh.tell())))
+
+                while not errors:
+                    data_chunk = iso_fh.read(self.ISO_UPLOAD_CHUNK_SIZE)
+                    if not data_chunk:
+                        break
+                    checksum.update(data_chunk)
+                    chunk_queue.put((offset, data_chunk))
+                    offset += len(data_chunk)
+        finally:
+            for _ in upload_threads:
+                chunk_queue.put(None)
+            for upload_thread in upload_threads:
+                upload_thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return iso_writer.write_end(checksum=checksum.hexdigest())
+
     def parse_arguments(self, script_args=None):
         """Parse arguments and performs actions based on the arguments."""
         # If arguments have been specified, split, so that
@@ -978,17 +1374,23 @@ class Parser(object):
             vm_factory = rpc.get_connection('virtual_machine_factory')
             hard_disks = [args.disk_size] if args.disk_size is not None else []
             mod_flags = args.modification_flags or []
-            vm_object = vm_factory.create(
-                name=args.vm_name,
-                cpu_cores=args.cpu_count,
-                memory_allocation=memory_allocation,
-                hard_drives=hard_disks,
-                network_interfaces=args.networks,
-                storage_type=storage_type,
-                hard_drive_driver=args.hard_disk_driver,
-                graphics_driver=args.graphics_driver,
-                available_nodes=args.nodes,
-                modification_flags=mod_flags)
+            if args.create_dry_run:
+                self.print_status(vm_factory.get_placement_report(
+                    cpu_cores=args.cpu_count, memory_allocation=memory_allocation,
+                    hard_drives=hard_disks, storage_type=storage_type
+                ))
+            else:
+                vm_factory.create(
+                    name=args.vm_name,
+                    cpu_cores=args.cpu_count,
+                    memory_allocation=memory_allocation,
+                    hard_drives=hard_disks,
+                    network_interfaces=args.networks,
+                    storage_type=storage_type,
+                    hard_drive_driver=args.hard_disk_driver,
+                    graphics_driver=args.graphics_driver,
+                    available_nodes=args.nodes,
+                    modification_flags=mod_flags)
 
         elif action == 'delete':
             vm_factory = rpc.get_connection('virtual_machine_factory')
@@ -1060,10 +1462,22 @@ class Parser(object):
                 network_adapter_object.change_network(network_object)
 
             if args.add_disk:
+                if args.backing_image and args.preallocation:
+                    raise ArgumentParserException(
+                        '--preallocation cannot be used with --backing-image'
+                    )
                 hard_drive_factory = rpc.get_connection('hard_drive_factory')
+                hard_drive_config = {}
+                if args.backing_image:
+                    hard_drive_config['backing_file'] = args.backing_image
+                if args.preallocation:
+                    hard_drive_config['preallocation'] = args.preallocation
+                if args.copy_on_read:
+                    hard_drive_config['copy_on_read'] = True
                 hard_drive_factory.create(vm_object, size=args.add_disk,
                                           storage_type=args.storage_type,
-                                          driver=args.hard_disk_driver)
+                                          driver=args.hard_disk_driver,
+                                          **hard_drive_config)
             if args.delete_disk:
                 hard_drive_factory = rpc.get_connection('hard_drive_factory')
                 hard_drive_object = hard_drive_factory.getObject(vm_object, args.disk_id)
@@ -1089,6 +1503,9 @@ class Parser(object):
             else:
                 vm_object.set_autostart_state('NO_AUTOSTART')
 
+            if args.autostart_group is not None:
+                vm_object.set_autostart_group(args.autostart_group)
+
             if args.attach_usb_device:
                 usb_device = vm_object.get_usb_device(*args.attach_usb_device.split(','))
                 rpc.annotate_object(usb_device)
@@ -1213,7 +1630,8 @@ class Parser(object):
             vm_object = vm_factory.getVirtualMachineByName(args.vm_name)
             rpc.annotate_object(vm_object)
             if args.online_migration:
-                vm_object.onlineMigrate(args.destination_node)
+                vm_object.onlineMigrate(args.destination_node,
+                                        self.get_migration_options(args))
             else:
                 vm_object.offlineMigrate(
                     args.destination_node,
@@ -1244,6 +1662,33 @@ class Parser(object):
             if args.cluster_action == 'remove-node':
                 cluster_object.remove_node(args.node)
                 self.print_status('Successfully removed node %s' % args.node)
+            if args.cluster_action == 'health':
+                node_health_monitor = rpc.get_connection('node_health_monitor')
+                self.print_status(node_health_monitor.get_health_table())
+            if args.cluster_action == 'capacity':
+                node_capacity = rpc.get_connection('node_capacity')
+                self.print_status(node_capacity.get_capacity_table())
+            if args.cluster_action == 'migration-defaults':
+                vm_factory = rpc.get_connection('virtual_machine_factory')
+                migration_options = self.get_migration_options(args)
+                if migration_options:
+                    vm_factory.set_migration_defaults(migration_options)
+                    self.print_status('Successfully updated migration defaults')
+                else:
+                    for option, value in sorted(vm_factory.get_migration_defaults().items()):
+                        self.print_status('%s: %s' % (option, value))
+            if args.cluster_action == 'migration-progress':
+                vm_factory = rpc.get_connection('virtual_machine_factory')
+                vm_object = vm_factory.getVirtualMachineByName(args.vm_name)
+                rpc.annotate_object(vm_object)
+                progress = vm_object.getMigrationProgress()
+                if progress is None:
+                    self.print_status('VM is not being migrated')
+                else:
+                    self.print_status(self.format_migration_progress(progress))
+            if args.cluster_action == 'check-config':
+                config_replicator = rpc.get_connection('config_replicator')
+                self.print_status(config_replicator.get_config_drift())
 
         elif action == 'node':
             node = rpc.get_connection('node')
@@ -1264,6 +1709,47 @@ class Parser(object):
                 autostart_watchdog = rpc.get_connection('autostart_watchdog')
                 self.print_status(autostart_watchdog.get_autostart_interval())
 
+            if (args.autostart_concurrency is not None or
+                    args.autostart_min_free_memory is not None or
+                    args.autostart_max_iowait is not None):
+                autostart_watchdog = rpc.get_connection('autostart_watchdog')
+                autostart_watchdog.set_autostart_limits(
+                    concurrency=args.autostart_concurrency,
+                    minimum_free_memory=args.autostart_min_free_memory,
+                    maximum_iowait=args.autostart_max_iowait
+                )
+            if args.get_autostart_report:
+                autostart_watchdog = rpc.get_connection('autostart_watchdog')
+                self.print_status(autostart_watchdog.get_autostart_report())
+                self.print_status(autostart_watchdog.get_restart_report())
+            if args.reset_restart_state:
+                autostart_watchdog = rpc.get_connection('autostart_watchdog')
+                autostart_watchdog.reset_restart_state(args.reset_restart_state)
+
+            if args.evacuate or args.evacuate_dry_run:
+                self.print_status(node.evacuate(
+                    concurrency=args.evacuation_concurrency,
+                    bandwidth=args.evacuation_bandwidth,
+                    retries=args.evacuation_retries,
+                    dry_run=args.evacuate_dry_run
+                ))
+            if args.get_evacuation_status:
+                self.print_status(node.get_evacuation_status())
+
+            if args.metrics_interval is not None:
+                metrics_collector = rpc.get_connection('guest_metrics_collector')
+                metrics_collector.set_metrics_interval(args.metrics_interval)
+            if args.metrics_top:
+                metrics_collector = rpc.get_connection('guest_metrics_collector')
+                self.print_status(metrics_collector.get_top_table(
+                    args.metrics_top, args.metrics_top_count, args.metrics_duration
+                ))
+            if args.vm_metrics:
+                metrics_collector = rpc.get_connection('guest_metrics_collector')
+                self.print_status(metrics_collector.get_vm_metrics_table(
+                    args.vm_metrics, args.metrics_duration
+                ))
+
             if args.ldap_enable:
                 ldap.set_enable(True)
             elif args.ldap_disable:
@@ -1355,6 +1841,59 @@ class Parser(object):
             if args.drbd_action == 'list':
                 self.print_status(node_drbd.list())
 
+            if args.drbd_action == 'resync-policy':
+                policy = None
+                if not args.resync_clear:
+                    policy = {
+                        'mode': args.resync_mode,
+                        'rate': args.resync_rate,
+                        'max_rate': args.resync_max_rate,
+                        'min_rate': args.resync_min_rate,
+                        'plan_ahead': args.resync_plan_ahead,
+                        'peak_rate': args.resync_peak_rate,
+                        'peak_start': args.resync_peak_start,
+                        'peak_end': args.resync_peak_end
+                    }
+
+                if args.vm_name:
+                    vm_factory = rpc.get_connection('virtual_machine_factory')
+                    vm_object = vm_factory.getVirtualMachineByName(args.vm_name)
+                    hard_drive_factory = rpc.get_connection('hard_drive_factory')
+                    disk_object = hard_drive_factory.getObject(vm_object, args.disk_id)
+                    rpc.annotate_object(disk_object)
+                    disk_object.setResyncPolicy(policy)
+                else:
+                    node_drbd.set_resync_policy(policy)
+
+            if args.drbd_action == 'progress':
+                vm_factory = rpc.get_connection('virtual_machine_factory')
+                vm_object = vm_factory.getVirtualMachineByName(args.vm_name)
+                hard_drive_factory = rpc.get_connection('hard_drive_factory')
+                disk_object = hard_drive_factory.getObject(vm_object, args.disk_id)
+                rpc.annotate_object(disk_object)
+                progress = disk_object.getSyncProgress()
+                if progress is None:
+                    self.print_status('Drbd resource is not configured on the node')
+                elif progress['sync_percent'] is None:
+                    self.print_status('Connection state: %s (not syncing)' %
+                                      progress['connection_state'])
+                else:
+                    eta = ('%d:%02d:%02d' % (progress['eta'] // 3600,
+                                             (progress['eta'] // 60) % 60,
+                                             progress['eta'] % 60)
+                           if progress['eta'] is not None else 'Unknown')
+                    self.print_status(
+                        'Connection state: %s\nSynced: %.1f%%\nThroughput: %s\n'
+                        'Remaining: %s\nETA: %s' % (
+                            progress['connection_state'], progress['sync_percent'],
+                            ('%s KiB/s' % progress['sync_rate']
+                             if progress['sync_rate'] is not None else 'Unknown'),
+                            ('%s KiB' % progress['out_of_sync']
+                             if progress['out_of_sync'] is not None else 'Unknown'),
+                            eta
+                        )
+                    )
+
         elif action == 'backup':
             vm_factory = rpc.get_connection('virtual_machine_factory')
             vm_object = vm_factory.getVirtualMachineByName(args.vm_name)
@@ -1367,6 +1906,25 @@ class Parser(object):
             elif args.backup_action == 'delete-snapshot':
                 hard_drive_object.deleteBackupSnapshot()
 
+        elif action == 'logs':
+            logger = rpc.get_connection('logger')
+            start_time = (time.time() - (args.log_since * 60)) if args.log_since else None
+            logs = logger.query_logs(start_time=start_time, user=args.log_user,
+                                     object_name=args.log_object, status=args.log_status,
+                                     limit=args.log_limit)
+            for log in logs:
+                self.print_status(self.format_log(log))
+
+            last_id = logs[-1]['id'] if logs else None
+            while args.log_follow:
+                time.sleep(2)
+                for log in logger.tail_logs(after_id=last_id):
+                    last_id = log['id']
+                    if ((args.log_user is None or log['user'] == args.log_user) and
+                            (args.log_object is None or log['object_name'] == args.log_object) and
+                            (args.log_status is None or log['status_name'] == args.log_status)):
+                        self.print_status(self.format_log(log))
+
         elif action == 'lock':
             vm_factory = rpc.get_connection('virtual_machine_factory')
             vm_object = vm_factory.getVirtualMachineByName(args.vm_name)
@@ -1404,23 +1962,24 @@ class Parser(object):
             if args.iso_action == 'add' and args.add_path:
                 if args.iso_node:
                     raise ArgumentParserException('Cannot add to remote node from local path')
-                iso_writer = iso_factory.add_iso_from_stream(args.iso_name)
-                rpc.annotate_object(iso_writer)
-                with open(args.iso_name, 'rb') as iso_fh:
-                    while True:
-                        data_chunk = iso_fh.read(1024)
-                        if data_chunk:
-                            data_chunk = binascii.hexlify(data_chunk)
-                            iso_writer.write_data(data_chunk)
-                        else:
-                            break
-                iso_object = iso_writer.write_end()
+                iso_object = self.upload_iso(rpc, iso_factory, args.iso_name)
                 rpc.annotate_object(iso_object)
                 self.print_status('Successfully added ISO: %s' % iso_object.get_name())
 
             if args.iso_action == 'add' and args.add_url:
-                iso_name = iso_factory.add_from_url(args.iso_name, node=args.iso_node)
-                self.print_status('Successfully added ISO: %s' % iso_name)
+                iso_name = iso_factory.add_from_url(args.iso_name, node=args.iso_node,
+                                                    checksum=args.iso_checksum,
+                                                    wait=(not args.iso_background))
+                if args.iso_background:
+                    self.print_status('Started download of ISO: %s' % iso_name)
+                else:
+                    self.print_status('Successfully added ISO: %s' % iso_name)
+
+            if args.iso_action == 'replicate':
+                results = iso_factory.replicate_iso(args.replicate_name,
+                                                    nodes=args.replicate_nodes)
+                for node in sorted(results.keys()):
+                    self.print_status('%s: %s' % (node, results[node]))
 
             if args.iso_action == 'delete':
                 if args.iso_node:
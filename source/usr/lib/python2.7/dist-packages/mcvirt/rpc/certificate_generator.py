@@ -24,6 +24,7 @@ from mcvirt.system import System
 from mcvirt.exceptions import (CACertificateNotFoundException, OpenSSLNotFoundException,
                                MustGenerateCertificateException)
 from mcvirt.rpc.pyro_object import PyroObject
+from mcvirt.rpc.crypto_backend import CryptoBackend
 from mcvirt.rpc.expose_method import Expose
 from mcvirt.auth.permissions import PERMISSIONS
 from mcvirt.syslogger import Syslogger
@@ -39,9 +40,18 @@ class CertificateGenerator(PyroObject):
 
     OPENSSL = '/usr/bin/openssl'
 
+    # Validity of generated certificates
+    CERTIFICATE_DAYS = 10240
+
+    # Incremented whenever certificates are written or removed, so that
+    # cached SSL contexts are recreated
+    GENERATION = 0
+
     def __init__(self, server=None, remote=False):
-        """Store member variables and ensure that openSSL is installed"""
-        if not os.path.isfile(self.OPENSSL):
+        """Store member variables and ensure that openSSL is installed,
+        if the in-process crypto backend is not available
+        """
+        if not CryptoBackend.is_available() and not os.path.isfile(self.OPENSSL):
             raise OpenSSLNotFoundException('openssl not found: %s' % self.OPENSSL)
 
         if server == 'localhost' or server.startswith('127.') or server is None:
@@ -101,7 +111,7 @@ class CertificateGenerator(PyroObject):
         path = self._get_certificate_path('capriv.pem')
 
         if not self._ensure_exists(path, assert_raise=False):
-            System.runCommand([self.OPENSSL, 'genrsa', '-out', path, '4096'])
+            self._generate_key(path, 4096)
 
         return path
 
@@ -115,9 +125,14 @@ class CertificateGenerator(PyroObject):
 
         if not self._ensure_exists(path, assert_raise=False) and self.is_local:
             # Generate public key for CA
-            System.runCommand([self.OPENSSL, 'req', '-x509', '-new', '-nodes',
-                               '-key', self.ca_key_file, '-sha256', '-days', '10240', '-out', path,
-                               '-subj', '%s_ca' % self.ssl_dn])
+            if CryptoBackend.is_available():
+                CryptoBackend.generate_ca_certificate(self.ca_key_file, '%s_ca' % self.ssl_dn,
+                                                      path, self.CERTIFICATE_DAYS)
+            else:
+                System.runCommand([self.OPENSSL, 'req', '-x509', '-new', '-nodes',
+                                   '-key', self.ca_key_file, '-sha256',
+                                   '-days', str(self.CERTIFICATE_DAYS), '-out', path,
+                                   '-subj', '%s_ca' % self.ssl_dn])
 
             if self.is_local:
                 symlink_path = self._get_certificate_path('cacert.pem')
@@ -149,7 +164,7 @@ class CertificateGenerator(PyroObject):
         path = self._get_certificate_path('clientkey.pem')
 
         if not self._ensure_exists(path, assert_raise=False):
-            System.runCommand([self.OPENSSL, 'genrsa', '-out', path, '2048'])
+            self._generate_key(path, 2048)
 
         return path
 
@@ -171,16 +186,21 @@ class CertificateGenerator(PyroObject):
         path = self._get_certificate_path('servercert.pem')
 
         if not self._ensure_exists(path, assert_raise=False):
-            # Generate certificate request
-            ssl_csr = os.path.join(self.ssl_directory, '%s.csr' % self.server)
-            System.runCommand([self.OPENSSL, 'req', '-new', '-key', self.server_key_file,
-                               '-out', ssl_csr, '-subj', self.ssl_dn])
+            if CryptoBackend.is_available():
+                CryptoBackend.generate_certificate(self.server_key_file, self.ssl_dn,
+                                                   self.ca_pub_file, self.ca_key_file,
+                                                   path, self.CERTIFICATE_DAYS)
+            else:
+                # Generate certificate request
+                ssl_csr = os.path.join(self.ssl_directory, '%s.csr' % self.server)
+                System.runCommand([self.OPENSSL, 'req', '-new', '-key', self.server_key_file,
+                                   '-out', ssl_csr, '-subj', self.ssl_dn])
 
-            # Generate public key
-            System.runCommand([self.OPENSSL, 'x509', '-req', '-in', ssl_csr,
-                               '-CA', self.ca_pub_file, '-CAkey', self.ca_key_file,
-                               '-CAcreateserial', '-out', path, '-outform', 'PEM',
-                               '-days', '10240', '-sha256'])
+                # Generate public key
+                System.runCommand([self.OPENSSL, 'x509', '-req', '-in', ssl_csr,
+                                   '-CA', self.ca_pub_file, '-CAkey', self.ca_key_file,
+                                   '-CAcreateserial', '-out', path, '-outform', 'PEM',
+                                   '-days', str(self.CERTIFICATE_DAYS), '-sha256'])
 
         return path
 
@@ -193,12 +213,14 @@ class CertificateGenerator(PyroObject):
         path = self._get_certificate_path('serverkey.pem')
         if not self._ensure_exists(path, assert_raise=False):
             # Generate new SSL private key
-            System.runCommand([self.OPENSSL, 'genrsa', '-out', path, '2048'])
+            self._generate_key(path, 2048)
         return path
 
     @property
     def dh_params_file(self):
-        """Return the path to the DH parameters file, and create it if it does not exist"""
+        """Return the path to the DH parameters file, and create it if it does not exist.
+        This is only required by clients that do not support ECDHE.
+        """
         if not self.is_local:
             raise CACertificateNotFoundException('DH params file not available for remote node')
 
@@ -210,6 +232,15 @@ class CertificateGenerator(PyroObject):
             Syslogger.logger().info('DH parameters file generated')
         return path
 
+    def _generate_key(self, path, rsa_bits):
+        """Generate a private key, using an EC key if the in-process crypto
+        backend is available, otherwise an RSA key, using openssl
+        """
+        if CryptoBackend.is_available():
+            CryptoBackend.generate_key(path)
+        else:
+            System.runCommand([self.OPENSSL, 'genrsa', '-out', path, str(rsa_bits)])
+
     def _get_certificate_path(self, certname, base_dir=None, allow_remote=False):
         if base_dir is None:
             if allow_remote and self.remote:
@@ -238,6 +269,7 @@ class CertificateGenerator(PyroObject):
         """Create a local certificate file"""
         with open(certpath, 'w') as cert_fh:
             cert_fh.write(cert_contents)
+        CertificateGenerator.GENERATION += 1
 
     def check_certificates(self, check_client=True):
         """Ensure that the required certificates are available
@@ -264,6 +296,9 @@ class CertificateGenerator(PyroObject):
         return self._generate_csr()
 
     def _generate_csr(self):
+        if CryptoBackend.is_available():
+            return CryptoBackend.generate_csr(self.client_key_file, self.ssl_dn, self.client_csr)
+
         System.runCommand(['openssl', 'req', '-new', '-key', self.client_key_file,
                            '-out', self.client_csr, '-subj', self.ssl_dn])
         return self._read_file(self.client_csr)
@@ -277,11 +312,16 @@ class CertificateGenerator(PyroObject):
     def _sign_csr(self, csr):
         self.client_csr = csr
         local_server = CertificateGenerator('localhost')
-        System.runCommand(['openssl', 'x509', '-req', '-extensions', 'usr_cert',
-                           '-in', self.client_csr, '-CA', local_server.ca_pub_file,
-                           '-CAkey', local_server.ca_key_file, '-CAcreateserial',
-                           '-out', self.client_pub_file, '-outform', 'PEM', '-days', '10240',
-                           '-sha256'])
+        if CryptoBackend.is_available():
+            CryptoBackend.sign_csr(csr, local_server.ca_pub_file, local_server.ca_key_file,
+                                   self.client_pub_file, self.CERTIFICATE_DAYS)
+        else:
+            System.runCommand(['openssl', 'x509', '-req', '-extensions', 'usr_cert',
+                               '-in', self.client_csr, '-CA', local_server.ca_pub_file,
+                               '-CAkey', local_server.ca_key_file, '-CAcreateserial',
+                               '-out', self.client_pub_file, '-outform', 'PEM',
+                               '-days', str(self.CERTIFICATE_DAYS), '-sha256'])
+        CertificateGenerator.GENERATION += 1
 
         # Regenerate libvirtd configuration, allowing access to this certificate
         libvirt_config = self._get_registered_object('libvirt_config')
@@ -295,6 +335,7 @@ class CertificateGenerator(PyroObject):
         """Remove a certificate directory for a node"""
         self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_CLUSTER)
         shutil.rmtree(self.ssl_directory)
+        CertificateGenerator.GENERATION += 1
 
     @Expose()
     def add_public_key(self, key):
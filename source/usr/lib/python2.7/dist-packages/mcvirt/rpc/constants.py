@@ -28,5 +28,6 @@ class Annotations(object):
     CLUSTER_MASTER = 'CLMA'
     SESSION_ID = 'SEID'
     HAS_LOCK = 'HASL'
+    LOCK_CONTEXT = 'LKCT'
     IGNORE_Drbd = 'IGDR'
     IGNORE_CLUSTER = 'IGCL'
@@ -0,0 +1,158 @@
+"""Provides in-process generation of keys and certificates"""
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import datetime
+import os
+from binascii import hexlify
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    CRYPTOGRAPHY_AVAILABLE = True
+except ImportError:
+    CRYPTOGRAPHY_AVAILABLE = False
+
+
+class CryptoBackend(object):
+    """Generate EC keys, CSRs and certificates using the python cryptography
+    library, rather than running openssl
+    """
+
+    # Map of the DN attributes used by MCVirt to OIDs
+    NAME_ATTRIBUTES = [
+        ('C', 'COUNTRY_NAME'),
+        ('ST', 'STATE_OR_PROVINCE_NAME'),
+        ('L', 'LOCALITY_NAME'),
+        ('O', 'ORGANIZATION_NAME'),
+        ('CN', 'COMMON_NAME')
+    ]
+
+    @staticmethod
+    def is_available():
+        """Determine if the cryptography library is installed"""
+        return CRYPTOGRAPHY_AVAILABLE
+
+    @staticmethod
+    def _get_name(subject):
+        """Convert a DN in openssl argument format (/C=GB/.../CN=host) to an x509 Name"""
+        components = dict(component.split('=', 1)
+                          for component in subject.strip('/').split('/'))
+        return x509.Name([
+            x509.NameAttribute(getattr(NameOID, oid_name), unicode(components[attribute]))
+            for attribute, oid_name in CryptoBackend.NAME_ATTRIBUTES
+            if attribute in components
+        ])
+
+    @staticmethod
+    def _write_file(path, contents, private=False):
+        """Write a PEM file, only allowing the owner to read private keys"""
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600 if private else 0644)
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(contents)
+
+    @staticmethod
+    def _load_key(key_path):
+        """Load a PEM private key"""
+        with open(key_path, 'r') as key_fh:
+            return serialization.load_pem_private_key(key_fh.read(), password=None,
+                                                      backend=default_backend())
+
+    @staticmethod
+    def _load_certificate(cert_path):
+        """Load a PEM certificate"""
+        with open(cert_path, 'r') as cert_fh:
+            return x509.load_pem_x509_certificate(cert_fh.read(), default_backend())
+
+    @staticmethod
+    def generate_key(key_path):
+        """Generate an EC private key"""
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        CryptoBackend._write_file(
+            key_path,
+            key.private_bytes(encoding=serialization.Encoding.PEM,
+                              format=serialization.PrivateFormat.TraditionalOpenSSL,
+                              encryption_algorithm=serialization.NoEncryption()),
+            private=True
+        )
+
+    @staticmethod
+    def generate_csr(key_path, subject, csr_path):
+        """Generate a certificate request for the key and return its contents"""
+        csr = x509.CertificateSigningRequestBuilder().subject_name(
+            CryptoBackend._get_name(subject)
+        ).sign(CryptoBackend._load_key(key_path), hashes.SHA256(), default_backend())
+        csr_contents = csr.public_bytes(serialization.Encoding.PEM)
+        CryptoBackend._write_file(csr_path, csr_contents)
+        return csr_contents
+
+    @staticmethod
+    def _build_certificate(subject_name, public_key, issuer_name, days, ca):
+        """Return a certificate builder with the MCVirt extensions"""
+        now = datetime.datetime.utcnow()
+        return x509.CertificateBuilder().subject_name(
+            subject_name
+        ).issuer_name(
+            issuer_name
+        ).public_key(
+            public_key
+        ).serial_number(
+            # Positive 127-bit random serial number
+            int(hexlify(os.urandom(16)), 16) >> 1
+        ).not_valid_before(
+            now - datetime.timedelta(days=1)
+        ).not_valid_after(
+            now + datetime.timedelta(days=days)
+        ).add_extension(
+            x509.BasicConstraints(ca=ca, path_length=None), critical=ca
+        ).add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False
+        )
+
+    @staticmethod
+    def generate_ca_certificate(key_path, subject, cert_path, days):
+        """Generate a self-signed CA certificate"""
+        key = CryptoBackend._load_key(key_path)
+        name = CryptoBackend._get_name(subject)
+        certificate = CryptoBackend._build_certificate(
+            name, key.public_key(), name, days, ca=True
+        ).sign(key, hashes.SHA256(), default_backend())
+        CryptoBackend._write_file(cert_path, certificate.public_bytes(serialization.Encoding.PEM))
+
+    @staticmethod
+    def sign_csr(csr_contents, ca_cert_path, ca_key_path, cert_path, days):
+        """Sign a certificate request with the CA, returning the certificate contents"""
+        csr = x509.load_pem_x509_csr(str(csr_contents), default_backend())
+        ca_certificate = CryptoBackend._load_certificate(ca_cert_path)
+        certificate = CryptoBackend._build_certificate(
+            csr.subject, csr.public_key(), ca_certificate.subject, days, ca=False
+        ).sign(CryptoBackend._load_key(ca_key_path), hashes.SHA256(), default_backend())
+        cert_contents = certificate.public_bytes(serialization.Encoding.PEM)
+        CryptoBackend._write_file(cert_path, cert_contents)
+        return cert_contents
+
+    @staticmethod
+    def generate_certificate(key_path, subject, ca_cert_path, ca_key_path, cert_path, days):
+        """Generate a certificate for the key, signed by the CA"""
+        csr = x509.CertificateSigningRequestBuilder().subject_name(
+            CryptoBackend._get_name(subject)
+        ).sign(CryptoBackend._load_key(key_path), hashes.SHA256(), default_backend())
+        CryptoBackend.sign_csr(csr.public_bytes(serialization.Encoding.PEM),
+                               ca_cert_path, ca_key_path, cert_path, days)
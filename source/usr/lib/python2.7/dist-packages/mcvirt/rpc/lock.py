@@ -17,24 +17,21 @@
 # along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
 
 import Pyro4
-from threading import Lock
 
 from mcvirt.exceptions import MCVirtException
 from mcvirt.logger import Logger, getLogNames
 from mcvirt.syslogger import Syslogger
 
 
-class MethodLock(object):
-    """Class for storing/generating/obtaining a lock object"""
-
-    _lock = None
-
-    @classmethod
-    def get_lock(cls):
-        """Obtain the lock object and return"""
-        if cls._lock is None:
-            cls._lock = Lock()
-        return cls._lock
+def get_lock_resource(object_name, object_type):
+    """Return the name of the cluster lock resource for an object. Methods
+    that do not relate to a single object lock the entire cluster.
+    """
+    # Imported here, as the lock manager is an exposed object
+    from mcvirt.cluster.lock_manager import ClusterLockManager
+    if object_name and object_type:
+        return '%s:%s' % (object_type, object_name)
+    return ClusterLockManager.GLOBAL_RESOURCE
 
 
 def lock_log_and_call(callback, args, kwargs, instance_method, object_type):
@@ -44,7 +41,6 @@ def lock_log_and_call(callback, args, kwargs, instance_method, object_type):
                                            object_type,
                                            args=args,
                                            kwargs=kwargs)
-    lock = MethodLock.get_lock()
 
     # If the current Pyro connection has the lock, then do not attempt
     # to lock again, as this will be caused by a locking method calling
@@ -69,10 +65,28 @@ def lock_log_and_call(callback, args, kwargs, instance_method, object_type):
         log = None
 
     if requires_lock:
-        lock.acquire()
-        # @TODO: lock entire cluster - raise exception if it cannot
-        # be obtained in short period (~5 seconds)
+        from mcvirt.cluster.lock_manager import ClusterLockManager
+        lock_manager = ClusterLockManager.get_instance()
+        holder = ClusterLockManager.generate_holder()
+
+        # Only obtain the lease from remote nodes if this node is running the command
+        cluster_wide = (not ('cluster_master' in dir(Pyro4.current_context)) or
+                        Pyro4.current_context.cluster_master)
+        try:
+            tokens = lock_manager.acquire(get_lock_resource(object_name, object_type),
+                                          holder, cluster_wide=cluster_wide)
+        except MCVirtException as e:
+            if log:
+                log.finish_error(e)
+            raise
+        except Exception as e:
+            Syslogger.logger().error('Unknown exception occurred obtaining lock')
+            Syslogger.logger().error("".join(Pyro4.util.getPyroTraceback()))
+            if log:
+                log.finish_error_unknown(e)
+            raise
         Pyro4.current_context.has_lock = True
+        Pyro4.current_context.lock_context = {'holder': holder, 'tokens': tokens}
 
     if log:
         log.start()
@@ -85,9 +99,7 @@ def lock_log_and_call(callback, args, kwargs, instance_method, object_type):
         if log:
             log.finish_error(e)
         if requires_lock:
-            if lock.locked():
-                lock.release()
-            Pyro4.current_context.has_lock = False
+            _release_lock(lock_manager, holder)
         raise
     except Exception as e:
         Syslogger.logger().error('Unknown exception occurred in lock')
@@ -95,14 +107,17 @@ def lock_log_and_call(callback, args, kwargs, instance_method, object_type):
         if log:
             log.finish_error_unknown(e)
         if requires_lock:
-            if lock.locked():
-                lock.release()
-            Pyro4.current_context.has_lock = False
+            _release_lock(lock_manager, holder)
         raise
     if log:
         log.finish_success()
     if requires_lock:
-        if lock.locked():
-            lock.release()
-        Pyro4.current_context.has_lock = False
+        _release_lock(lock_manager, holder)
     return response
+
+
+def _release_lock(lock_manager, holder):
+    """Remove the lock from the current context and release the leases of the lock"""
+    Pyro4.current_context.has_lock = False
+    Pyro4.current_context.lock_context = None
+    lock_manager.release(holder)
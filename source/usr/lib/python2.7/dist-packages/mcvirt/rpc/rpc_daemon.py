@@ -32,10 +32,14 @@ from mcvirt.virtual_machine.hard_drive.factory import Factory as HardDriveFactor
 from mcvirt.auth.factory import Factory as UserFactory
 from mcvirt.auth.session import Session
 from mcvirt.cluster.cluster import Cluster
+from mcvirt.cluster.config_replicator import ConfigReplicator
+from mcvirt.cluster.lock_manager import ClusterLockManager
+from mcvirt.cluster.health_monitor import NodeHealthMonitor
 from mcvirt.virtual_machine.network_adapter.factory import Factory as NetworkAdapterFactory
 from mcvirt.logger import Logger
 from mcvirt.node.drbd import Drbd as NodeDrbd
 from mcvirt.node.node import Node
+from mcvirt.node.capacity import NodeCapacity
 from mcvirt.rpc.ssl_socket import SSLSocket
 from mcvirt.rpc.certificate_generator_factory import CertificateGeneratorFactory
 from mcvirt.node.libvirt_config import LibvirtConfig
@@ -49,6 +53,8 @@ from mcvirt.mcvirt_config import MCVirtConfig
 from mcvirt.exceptions import AuthenticationError
 from mcvirt.rpc.expose_method import Expose
 from mcvirt.thread.auto_start_watchdog import AutoStartWatchdog
+from mcvirt.thread.drbd_resync_scheduler import DrbdResyncScheduler
+from mcvirt.thread.metrics_collector import GuestMetricsCollector
 
 
 class BaseRpcDaemon(Pyro4.Daemon):
@@ -66,6 +72,35 @@ class BaseRpcDaemon(Pyro4.Daemon):
         # Store MCVirt instance
         self.registered_factories = {}
 
+    def _set_cluster_context(self, user_object, data):
+        """Set the cluster master and lock state of the connection for
+        connections from remote nodes
+        """
+        # If the user is a cluster/connection user, treat this connection
+        # as a cluster client (the command as been executed on a remote node)
+        # unless specified otherwise
+        if user_object.CLUSTER_USER:
+            if Annotations.CLUSTER_MASTER in data:
+                Pyro4.current_context.cluster_master = data[Annotations.CLUSTER_MASTER]
+            else:
+                Pyro4.current_context.cluster_master = False
+        else:
+            Pyro4.current_context.cluster_master = True
+
+        if user_object.CLUSTER_USER and Annotations.HAS_LOCK in data:
+            Pyro4.current_context.has_lock = data[Annotations.HAS_LOCK]
+        else:
+            Pyro4.current_context.has_lock = False
+
+        # Ensure that the lease of the command holding the lock has not expired,
+        # using the fencing token of the lease obtained from this node
+        if Pyro4.current_context.has_lock and Annotations.LOCK_CONTEXT in data:
+            lock_context = data[Annotations.LOCK_CONTEXT]
+            self.registered_factories['cluster_lock_manager'].validate_lock_context(
+                lock_context
+            )
+            Pyro4.current_context.lock_context = lock_context
+
     def validateHandshake(self, conn, data):  # Override name of upstream method # noqa
         """Perform authentication on new connections"""
         # Reset session_id for current context
@@ -75,6 +110,7 @@ class BaseRpcDaemon(Pyro4.Daemon):
         Pyro4.current_context.username = None
         Pyro4.current_context.proxy_user = None
         Pyro4.current_context.has_lock = False
+        Pyro4.current_context.lock_context = None
         Pyro4.current_context.cluster_master = True
 
         # Check and store username from connection
@@ -84,7 +120,6 @@ class BaseRpcDaemon(Pyro4.Daemon):
 
         # If a password has been provided
         try:
-            # @TODO - Re-factor as the logic below is duplicated for SESSION_ID in data clause
             if Annotations.PASSWORD in data:
                 # Store the password and perform authentication check
                 password = str(data[Annotations.PASSWORD])
@@ -101,22 +136,8 @@ class BaseRpcDaemon(Pyro4.Daemon):
                     if user_object.allow_proxy_user and Annotations.PROXY_USER in data:
                         Pyro4.current_context.proxy_user = data[Annotations.PROXY_USER]
 
-                    # If the user is a cluster/connection user, treat this connection
-                    # as a cluster client (the command as been executed on a remote node)
-                    # unless specified otherwise
+                    self._set_cluster_context(user_object, data)
                     auth = self.registered_factories['auth']
-                    if user_object.CLUSTER_USER:
-                        if Annotations.CLUSTER_MASTER in data:
-                            Pyro4.current_context.cluster_master = data[Annotations.CLUSTER_MASTER]
-                        else:
-                            Pyro4.current_context.cluster_master = False
-                    else:
-                        Pyro4.current_context.cluster_master = True
-
-                    if user_object.CLUSTER_USER and Annotations.HAS_LOCK in data:
-                        Pyro4.current_context.has_lock = data[Annotations.HAS_LOCK]
-                    else:
-                        Pyro4.current_context.has_lock = False
 
                     if (auth.check_permission(PERMISSIONS.CAN_IGNORE_CLUSTER,
                                               user_object=user_object) and
@@ -149,22 +170,8 @@ class BaseRpcDaemon(Pyro4.Daemon):
                     if user_object.allow_proxy_user and Annotations.PROXY_USER in data:
                         Pyro4.current_context.proxy_user = data[Annotations.PROXY_USER]
 
-                    # If the user is a cluster/connection user, treat this connection
-                    # as a cluster client (the command as been executed on a remote node)
-                    # unless specified otherwise
+                    self._set_cluster_context(user_object, data)
                     auth = self.registered_factories['auth']
-                    if user_object.CLUSTER_USER:
-                        if Annotations.CLUSTER_MASTER in data:
-                            Pyro4.current_context.cluster_master = data[Annotations.CLUSTER_MASTER]
-                        else:
-                            Pyro4.current_context.cluster_master = False
-                    else:
-                        Pyro4.current_context.cluster_master = True
-
-                    if user_object.CLUSTER_USER and Annotations.HAS_LOCK in data:
-                        Pyro4.current_context.has_lock = data[Annotations.HAS_LOCK]
-                    else:
-                        Pyro4.current_context.has_lock = False
 
                     if (auth.check_permission(PERMISSIONS.CAN_IGNORE_CLUSTER,
                                               user_object=user_object) and
@@ -225,6 +232,9 @@ class RpcNSMixinDaemon(object):
         self.obtain_connection()
 
         RpcNSMixinDaemon.DAEMON = BaseRpcDaemon(host=self.hostname)
+
+        # Start the libvirt event loop before any libvirt connections are opened
+        LibvirtConnector.start_event_loop()
         self.register_factories()
 
         # Ensure libvirt is configured
@@ -266,6 +276,8 @@ class RpcNSMixinDaemon(object):
                 timer.timer.cancel()
             except:
                 pass
+        if NodeDrbd.EVENT_MONITOR is not None:
+            NodeDrbd.EVENT_MONITOR.stop()
         RpcNSMixinDaemon.DAEMON.shutdown()
         Syslogger.logger().debug('finisehd shutdown')
 
@@ -310,6 +322,18 @@ class RpcNSMixinDaemon(object):
         cluster = Cluster()
         self.register(cluster, objectId='cluster', force=True)
 
+        # Create node health monitor and register with daemon
+        node_health_monitor = NodeHealthMonitor()
+        self.register(node_health_monitor, objectId='node_health_monitor', force=True)
+
+        # Create config replicator object and register with daemon
+        config_replicator = ConfigReplicator()
+        self.register(config_replicator, objectId='config_replicator', force=True)
+
+        # Create cluster lock manager and register with daemon
+        cluster_lock_manager = ClusterLockManager.get_instance()
+        self.register(cluster_lock_manager, objectId='cluster_lock_manager', force=True)
+
         # Create node Drbd object and register with daemon
         node_drbd = NodeDrbd()
         self.register(node_drbd, objectId='node_drbd', force=True)
@@ -322,6 +346,10 @@ class RpcNSMixinDaemon(object):
         node = Node()
         self.register(node, objectId='node', force=True)
 
+        # Create node capacity object and register with daemon
+        node_capacity = NodeCapacity()
+        self.register(node_capacity, objectId='node_capacity', force=True)
+
         # Create logger object and register with daemon
         logger = Logger.get_logger()
         self.register(logger, objectId='logger', force=True)
@@ -356,6 +384,16 @@ class RpcNSMixinDaemon(object):
         self.timer_objects.append(autostart_watchdog)
         self.register(autostart_watchdog, objectId='autostart_watchdog', force=True)
 
+        # Create Drbd resync scheduler object
+        drbd_resync_scheduler = DrbdResyncScheduler()
+        self.timer_objects.append(drbd_resync_scheduler)
+        self.register(drbd_resync_scheduler, objectId='drbd_resync_scheduler', force=True)
+
+        # Create guest metrics collector object
+        guest_metrics_collector = GuestMetricsCollector()
+        self.timer_objects.append(guest_metrics_collector)
+        self.register(guest_metrics_collector, objectId='guest_metrics_collector', force=True)
+
     def obtain_connection(self):
         """Attempt to obtain a connection to the name server."""
         while 1:
@@ -17,9 +17,13 @@
 # along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
 
 from Pyro4 import socketutil
+import os
 import ssl
 import socket
+import threading
+import time
 
+from mcvirt.rpc.certificate_generator import CertificateGenerator
 from mcvirt.rpc.certificate_generator_factory import CertificateGeneratorFactory
 
 
@@ -37,6 +41,123 @@ class SSLSocket(object):
                'ECDHE-RSA-DES-CBC3-SHA:EDH-RSA-DES-CBC3-SHA:AES128-GCM-SHA256:AES256-GCM-SHA384:' +
                'AES128-SHA256:AES256-SHA256:AES128-SHA:AES256-SHA:DES-CBC3-SHA:!DSS')
 
+    # Curve used for ECDHE key exchange, avoiding the need to generate DH parameters
+    ECDH_CURVE = 'prime256v1'
+
+    # Time (seconds) that reverse DNS lookups of peer IP addresses are cached for
+    REVERSE_LOOKUP_TTL = 300
+
+    # SSL contexts, keyed by 'server' or the peer hostname, containing the context,
+    # the certificate generation and the modification times of the certificate files
+    # that it was created from. Reusing a context avoids reloading the certificates
+    # and DH parameters for each connection.
+    CONTEXTS = {}
+    REVERSE_LOOKUPS = {}
+    CACHE_LOCK = threading.Lock()
+
+    @staticmethod
+    def _get_file_mtimes(paths):
+        """Return the modification times of the files, or None if any do not exist"""
+        try:
+            return [os.stat(path).st_mtime for path in paths]
+        except OSError:
+            return None
+
+    @staticmethod
+    def _get_cached_context(key):
+        """Return a cached context, if the certificates have not since been modified"""
+        with SSLSocket.CACHE_LOCK:
+            cached_context = SSLSocket.CONTEXTS.get(key)
+        if cached_context is None:
+            return None
+
+        context, generation, paths, mtimes = cached_context
+        if (generation != CertificateGenerator.GENERATION or
+                mtimes is None or SSLSocket._get_file_mtimes(paths) != mtimes):
+            return None
+        return context
+
+    @staticmethod
+    def _cache_context(key, context, generation, paths):
+        """Store a context in the cache"""
+        with SSLSocket.CACHE_LOCK:
+            SSLSocket.CONTEXTS[key] = (context, generation, paths,
+                                       SSLSocket._get_file_mtimes(paths))
+
+    @staticmethod
+    def _create_context():
+        """Create a new SSL context, with the MCVirt ciphers"""
+        ssl_context = ssl.create_default_context()
+        ssl_context.set_ciphers(SSLSocket.CIPHERS)
+        return ssl_context
+
+    @staticmethod
+    def get_server_context():
+        """Obtain the SSL context for the local daemon"""
+        context = SSLSocket._get_cached_context('server')
+        if context is None:
+            generation = CertificateGenerator.GENERATION
+            cert_gen_factory = CertificateGeneratorFactory()
+            cert_gen = cert_gen_factory.get_cert_generator(server='localhost')
+            cert_gen.check_certificates(check_client=False)
+
+            context = SSLSocket._create_context()
+            context.load_cert_chain(cert_gen.server_pub_file,
+                                    keyfile=cert_gen.server_key_file)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_OPTIONAL
+
+            # Use ECDHE for forward secrecy, only loading DH parameters
+            # if they have previously been generated
+            context.set_ecdh_curve(SSLSocket.ECDH_CURVE)
+            certificate_files = [cert_gen.server_pub_file, cert_gen.server_key_file]
+            dh_params_file = cert_gen._get_certificate_path('dh_params')
+            if os.path.exists(dh_params_file):
+                context.load_dh_params(dh_params_file)
+                certificate_files.append(dh_params_file)
+            SSLSocket._cache_context('server', context, generation, certificate_files)
+        return context
+
+    @staticmethod
+    def get_client_context(hostname):
+        """Obtain the SSL context for connecting to the given host"""
+        context = SSLSocket._get_cached_context(hostname)
+        if context is None:
+            generation = CertificateGenerator.GENERATION
+            cert_gen_factory = CertificateGeneratorFactory()
+            cert_gen = cert_gen_factory.get_cert_generator(hostname)
+
+            context = SSLSocket._create_context()
+            context.check_hostname = True
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(cafile=cert_gen.ca_pub_file)
+            SSLSocket._cache_context(hostname, context, generation, [cert_gen.ca_pub_file])
+        return context
+
+    @staticmethod
+    def get_peer_hostname(address):
+        """Return the hostname for a peer address, performing a (cached)
+        reverse lookup if the address is an IP address
+        """
+        try:
+            socket.inet_aton(address)
+        except socket.error:
+            return address
+
+        with SSLSocket.CACHE_LOCK:
+            cached_lookup = SSLSocket.REVERSE_LOOKUPS.get(address)
+        if cached_lookup is not None and cached_lookup[1] > time.time():
+            return cached_lookup[0]
+
+        try:
+            hostname = socket.gethostbyaddr(address)[0]
+        except socket.error:
+            hostname = address
+        with SSLSocket.CACHE_LOCK:
+            SSLSocket.REVERSE_LOOKUPS[address] = (hostname,
+                                                  time.time() + SSLSocket.REVERSE_LOOKUP_TTL)
+        return hostname
+
     @staticmethod
     def wrap_socket(socket_object, *args, **kwargs):
         """Wrap a Pyro socket connection with SSL"""
@@ -46,52 +167,37 @@ class SSLSocket(object):
             'server_side': server_side
         }
 
-        legacy = ('create_default_context' not in dir(ssl))
-
         # Support old Ubuntu 14.04 machines that have a python version < 2.7.9, which do
         # not support create_default_context in the SSL library
-        if legacy:
-            ssl_kwargs['ssl_version'] = ssl.PROTOCOL_TLSv1
-        else:
-            # Create an SSL context
-            ssl_context = ssl.create_default_context()
-            ssl_context.set_ciphers(SSLSocket.CIPHERS)
+        if 'create_default_context' not in dir(ssl):
+            return SSLSocket._wrap_socket_legacy(socket_object, server_side, ssl_kwargs,
+                                                 **kwargs)
+
+        if server_side:
+            return SSLSocket.get_server_context().wrap_socket(socket_object, **ssl_kwargs)
+
+        hostname = SSLSocket.get_peer_hostname(kwargs['connect'][0])
+        ssl_kwargs['server_hostname'] = hostname
+        ssl_context = SSLSocket.get_client_context(hostname)
+        return ssl_context.wrap_socket(socket_object, **ssl_kwargs)
 
+    @staticmethod
+    def _wrap_socket_legacy(socket_object, server_side, ssl_kwargs, **kwargs):
+        """Wrap a socket using the SSL library of python versions < 2.7.9"""
+        ssl_kwargs['ssl_version'] = ssl.PROTOCOL_TLSv1
         cert_gen_factory = CertificateGeneratorFactory()
         if server_side:
             cert_gen = cert_gen_factory.get_cert_generator(server='localhost')
             cert_gen.check_certificates(check_client=False)
-            if legacy:
-                ssl_kwargs['keyfile'] = cert_gen.server_key_file
-                ssl_kwargs['certfile'] = cert_gen.server_pub_file
-            else:
-                ssl_context.load_cert_chain(cert_gen.server_pub_file,
-                                            keyfile=cert_gen.server_key_file)
-                ssl_context.check_hostname = False
-                ssl_context.load_dh_params(cert_gen.dh_params_file)
-                ssl_context.verify_mode = ssl.CERT_OPTIONAL
+            ssl_kwargs['keyfile'] = cert_gen.server_key_file
+            ssl_kwargs['certfile'] = cert_gen.server_pub_file
         else:
-            # Determine if hostname is an IP address
-            try:
-                socket.inet_aton(kwargs['connect'][0])
-                hostname = socket.gethostbyaddr(kwargs['connect'][0])[0]
-            except socket.error:
-                hostname = kwargs['connect'][0]
-
+            hostname = SSLSocket.get_peer_hostname(kwargs['connect'][0])
             cert_gen = cert_gen_factory.get_cert_generator(hostname)
-            if legacy:
-                ssl_kwargs['cert_reqs'] = ssl.CERT_REQUIRED
-                ssl_kwargs['ca_certs'] = cert_gen.ca_pub_file
-            else:
-                ssl_context.check_hostname = True
-                ssl_kwargs['server_hostname'] = hostname
-                ssl_context.verify_mode = ssl.CERT_REQUIRED
-                ssl_context.load_verify_locations(cafile=cert_gen.ca_pub_file)
-
-        if legacy:
-            return ssl.wrap_socket(socket_object, **ssl_kwargs)
-        else:
-            return ssl_context.wrap_socket(socket_object, **ssl_kwargs)
+            ssl_kwargs['cert_reqs'] = ssl.CERT_REQUIRED
+            ssl_kwargs['ca_certs'] = cert_gen.ca_pub_file
+
+        return ssl.wrap_socket(socket_object, **ssl_kwargs)
 
     @staticmethod
     def create_ssl_socket(*args, **kwargs):
@@ -0,0 +1,150 @@
+# Copyright (c) 2014 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mcvirt.test.test_base import TestBase
+from mcvirt.cluster.config_replicator import ConfigLog, ConfigReplicator
+
+
+class ConfigReplicatorTests(TestBase):
+    """Provide unit tests for the configuration replication log"""
+
+    # Configuration file of a VM that does not exist on the node, so that
+    # applying records does not modify any configuration
+    TEST_FILE = 'vm/mcvirt-unittest-replication/config.json'
+
+    @staticmethod
+    def suite():
+        """Return a test suite"""
+        suite = unittest.TestSuite()
+        suite.addTest(ConfigReplicatorTests('test_get_records_since'))
+        suite.addTest(ConfigReplicatorTests('test_get_records_since_truncated'))
+        suite.addTest(ConfigReplicatorTests('test_apply_records_order'))
+        suite.addTest(ConfigReplicatorTests('test_apply_records_gap'))
+        suite.addTest(ConfigReplicatorTests('test_logical_clock'))
+        return suite
+
+    def setUp(self):
+        """Create a config log in a temporary directory"""
+        super(ConfigReplicatorTests, self).setUp()
+        self.log_dir = tempfile.mkdtemp()
+        self.config_log = ConfigLog(log_dir=self.log_dir)
+        self.replicator = ConfigReplicator()
+        self.replicator.config_log = self.config_log
+
+    def tearDown(self):
+        """Remove the temporary config log"""
+        shutil.rmtree(self.log_dir)
+        super(ConfigReplicatorTests, self).tearDown()
+
+    def get_record(self, origin, seq, version=None):
+        """Return a change record from a remote node"""
+        return {'origin': origin, 'seq': seq, 'time': 0,
+                'version': seq if version is None else version,
+                'file': self.TEST_FILE, 'set': [[['test'], seq]], 'unset': []}
+
+    def get_sequence(self, records):
+        """Return the origin and sequence number of each record"""
+        return [(record['origin'], record['seq']) for record in records]
+
+    def test_get_records_since(self):
+        """Test obtaining the records that are not covered by a version vector"""
+        for seq in range(1, 4):
+            self.config_log.add(self.get_record('remote-node-b', seq))
+            self.config_log.add(self.get_record('remote-node-a', seq))
+
+        records, truncated = self.config_log.get_records_since({'remote-node-a': 1}, 10)
+        self.assertEqual(self.get_sequence(records),
+                         [('remote-node-a', 2), ('remote-node-a', 3),
+                          ('remote-node-b', 1), ('remote-node-b', 2), ('remote-node-b', 3)])
+        self.assertEqual(truncated, [])
+
+        # Records are limited, retaining the sequence order
+        records, _ = self.config_log.get_records_since({'remote-node-a': 1}, 3)
+        self.assertEqual(self.get_sequence(records),
+                         [('remote-node-a', 2), ('remote-node-a', 3), ('remote-node-b', 1)])
+
+        # No records are returned once all have been applied
+        records, truncated = self.config_log.get_records_since(
+            {'remote-node-a': 3, 'remote-node-b': 3}, 10
+        )
+        self.assertEqual(records, [])
+        self.assertEqual(truncated, [])
+
+    def test_get_records_since_truncated(self):
+        """Test that origins whose required records have been discarded are reported"""
+        self.config_log.MAX_RECORDS = 3
+        for seq in range(1, 6):
+            self.config_log.add(self.get_record('remote-node-a', seq))
+
+        records, truncated = self.config_log.get_records_since({}, 10)
+        self.assertEqual(self.get_sequence(records),
+                         [('remote-node-a', 3), ('remote-node-a', 4), ('remote-node-a', 5)])
+        self.assertEqual(truncated, ['remote-node-a'])
+
+        # The record following those applied is retained
+        records, truncated = self.config_log.get_records_since({'remote-node-a': 2}, 10)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(truncated, [])
+
+    def test_apply_records_order(self):
+        """Test that records are applied in sequence order, regardless of the order received"""
+        records = [self.get_record('remote-node-a', 3), self.get_record('remote-node-b', 1),
+                   self.get_record('remote-node-a', 1), self.get_record('remote-node-a', 2)]
+        self.assertEqual(self.replicator._apply_records(records), 4)
+        self.assertEqual(self.config_log.vector, {'remote-node-a': 3, 'remote-node-b': 1})
+
+        # Records that have already been applied are skipped
+        self.assertEqual(self.replicator._apply_records(records), 0)
+
+    def test_apply_records_gap(self):
+        """Test that records are not applied beyond a gap in the sequence"""
+        records = [self.get_record('remote-node-a', seq) for seq in [1, 2, 4, 5]]
+        self.assertEqual(self.replicator._apply_records(records), 2)
+        self.assertEqual(self.config_log.vector, {'remote-node-a': 2})
+
+        # Once the missing record is obtained, the remaining records are applied
+        records = [self.get_record('remote-node-a', seq) for seq in [3, 4, 5]]
+        self.assertEqual(self.replicator._apply_records(records), 3)
+        self.assertEqual(self.config_log.vector, {'remote-node-a': 5})
+
+    def test_logical_clock(self):
+        """Test that the logical clock advances past the versions of applied records"""
+        self.assertEqual(self.config_log.get_next_version(), 1)
+        self.replicator._apply_records([self.get_record('remote-node-a', 1, version=10)])
+        self.assertEqual(self.config_log.get_next_version(), 11)
+
+        # Records with an earlier version do not move the clock backwards
+        self.replicator._apply_records([self.get_record('remote-node-b', 1, version=5)])
+        self.assertEqual(self.config_log.get_next_version(), 11)
+
+        # The clock is retained with the replication state
+        self.config_log.save([])
+        self.assertEqual(ConfigLog(log_dir=self.log_dir).get_next_version(), 11)
+
+        # Item versions from a state without a clock are discarded
+        with open(os.path.join(self.log_dir, ConfigLog.STATE_FILE), 'w') as state_fh:
+            json.dump({'vector': {}, 'item_versions': {self.TEST_FILE: {'["test"]': [1e9, '']}}},
+                      state_fh)
+        config_log = ConfigLog(log_dir=self.log_dir)
+        self.assertEqual(config_log.item_versions, {})
+        self.assertEqual(config_log.get_next_version(), 1)
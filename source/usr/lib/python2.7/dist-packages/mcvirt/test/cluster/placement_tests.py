@@ -0,0 +1,147 @@
+# Copyright (c) 2014 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+
+from mcvirt.test.test_base import TestBase
+from mcvirt.cluster.placement import PlacementEngine
+from mcvirt.exceptions import UnsuitableNodeException
+from mcvirt.utils import get_hostname
+
+
+class PlacementTests(TestBase):
+    """Provide unit tests for the placement engine"""
+
+    # Resources of the test VM: vCPUs, memory (KiB) and disk (MiB)
+    CPU_CORES = 2
+    MEMORY = 1024 * 1024
+    DISK_SIZE = 10240
+
+    @staticmethod
+    def suite():
+        """Return a test suite"""
+        suite = unittest.TestSuite()
+        suite.addTest(PlacementTests('test_rank_nodes'))
+        suite.addTest(PlacementTests('test_rank_nodes_ineligible'))
+        suite.addTest(PlacementTests('test_rank_nodes_insufficient_memory'))
+        suite.addTest(PlacementTests('test_choose_nodes'))
+        suite.addTest(PlacementTests('test_choose_nodes_unsuitable'))
+        return suite
+
+    def get_facts(self, free_memory=8 * 1024 * 1024, free_disk=102400, allocated_cpu=0,
+                  drbd_resources=0, storage_available=True):
+        """Return the placement facts of a node"""
+        return {'storage_available': storage_available, 'free_disk': free_disk,
+                'free_memory': free_memory, 'total_memory': 16 * 1024 * 1024,
+                'allocated_cpu': allocated_cpu, 'cpu_count': 8,
+                'drbd_resources': drbd_resources}
+
+    def rank_nodes(self, node_facts):
+        """Rank the nodes for the test VM"""
+        return PlacementEngine(None, None).rank_nodes(node_facts, self.CPU_CORES, self.MEMORY,
+                                                      self.DISK_SIZE)
+
+    def get_rank(self, ranking, node):
+        """Return the rank of a node"""
+        return [rank for rank in ranking if rank['node'] == node][0]
+
+    def test_rank_nodes(self):
+        """Test that nodes with more free resources are ranked higher"""
+        ranking = self.rank_nodes({
+            'node-busy': self.get_facts(free_memory=2 * 1024 * 1024, allocated_cpu=16,
+                                        drbd_resources=20),
+            'node-idle': self.get_facts(),
+            'node-low-disk': self.get_facts(free_disk=20480)
+        })
+        self.assertEqual([rank['node'] for rank in ranking],
+                         ['node-idle', 'node-low-disk', 'node-busy'])
+        self.assertTrue(all(rank['eligible'] for rank in ranking))
+
+        rank = self.get_rank(ranking, 'node-idle')
+        self.assertEqual(rank['free_memory'], 7 * 1024 * 1024)
+        self.assertEqual(rank['free_disk'], 102400 - self.DISK_SIZE)
+        self.assertEqual(rank['cpu_commitment'], 0.25)
+
+        # Nodes with equal scores are ordered by name
+        ranking = self.rank_nodes({'node-b': self.get_facts(), 'node-a': self.get_facts()})
+        self.assertEqual([rank['node'] for rank in ranking], ['node-a', 'node-b'])
+
+    def test_rank_nodes_ineligible(self):
+        """Test that nodes that cannot host the VM are ineligible and ranked last"""
+        ranking = self.rank_nodes({
+            'node-error': {'error': 'Node is not responding'},
+            'node-no-storage': self.get_facts(storage_available=False),
+            'node-full': self.get_facts(free_disk=1024),
+            'node-ok': self.get_facts(free_memory=0, allocated_cpu=64)
+        })
+        self.assertEqual(ranking[0]['node'], 'node-ok')
+        self.assertTrue(ranking[0]['eligible'])
+        for rank in ranking[1:]:
+            self.assertFalse(rank['eligible'])
+            self.assertEqual(rank['score'], 0.0)
+
+        self.assertEqual(self.get_rank(ranking, 'node-error')['reasons'],
+                         ['Node is not responding'])
+        self.assertEqual(self.get_rank(ranking, 'node-no-storage')['reasons'],
+                         ['Storage type is not available'])
+        self.assertEqual(self.get_rank(ranking, 'node-full')['reasons'],
+                         ['Insufficient disk space'])
+
+    def test_rank_nodes_insufficient_memory(self):
+        """Test that a lack of memory or CPU reduces the score, rather than excluding the node"""
+        ranking = self.rank_nodes({
+            'node-no-memory': self.get_facts(free_memory=0),
+            'node-overcommitted': self.get_facts(allocated_cpu=64),
+        })
+        no_memory_rank = self.get_rank(ranking, 'node-no-memory')
+        self.assertTrue(no_memory_rank['eligible'])
+        self.assertEqual(no_memory_rank['reasons'], ['Insufficient free memory to run the VM'])
+        overcommitted_rank = self.get_rank(ranking, 'node-overcommitted')
+        self.assertTrue(overcommitted_rank['eligible'])
+        self.assertEqual(overcommitted_rank['reasons'], ['CPUs are overcommitted'])
+        self.assertGreater(self.get_rank(self.rank_nodes({'node': self.get_facts()}),
+                                         'node')['score'],
+                           max(no_memory_rank['score'], overcommitted_rank['score']))
+
+    def test_choose_nodes(self):
+        """Test that the local node and the highest ranked remote nodes are chosen"""
+        ranking = self.rank_nodes({
+            get_hostname(): self.get_facts(free_memory=1024 * 1024),
+            'node-b': self.get_facts(),
+            'node-c': self.get_facts(free_disk=20480),
+            'node-d': self.get_facts(storage_available=False)
+        })
+        self.assertEqual(PlacementEngine.choose_nodes(ranking, 1), [get_hostname()])
+        self.assertEqual(PlacementEngine.choose_nodes(ranking, 2), [get_hostname(), 'node-b'])
+        self.assertEqual(PlacementEngine.choose_nodes(ranking, 3),
+                         [get_hostname(), 'node-b', 'node-c'])
+
+    def test_choose_nodes_unsuitable(self):
+        """Test that nodes are not chosen if the local node, or too few nodes, are eligible"""
+        ranking = self.rank_nodes({
+            get_hostname(): self.get_facts(),
+            'node-b': self.get_facts(storage_available=False)
+        })
+        with self.assertRaises(UnsuitableNodeException):
+            PlacementEngine.choose_nodes(ranking, 2)
+
+        ranking = self.rank_nodes({
+            get_hostname(): self.get_facts(free_disk=1024),
+            'node-b': self.get_facts()
+        })
+        with self.assertRaises(UnsuitableNodeException):
+            PlacementEngine.choose_nodes(ranking, 1)
@@ -17,9 +17,14 @@
 
 import unittest
 import threading
+import time
 
 from mcvirt.test.test_base import TestBase
 from mcvirt.rpc.expose_method import Expose
+from mcvirt.cluster.lock_manager import ClusterLockManager
+from mcvirt.utils import get_hostname
+from mcvirt.exceptions import (ClusterLockContentionException, ClusterLockExpiredException,
+                               ClusterLockQuorumException)
 
 
 class LockTests(TestBase):
@@ -33,27 +38,41 @@ class LockTests(TestBase):
         suite = unittest.TestSuite()
         suite.addTest(LockTests('test_method_lock_rpc'))
         suite.addTest(LockTests('test_method_lock_escape_return'))
+        suite.addTest(LockTests('test_lock_contention'))
+        suite.addTest(LockTests('test_lock_resources'))
+        suite.addTest(LockTests('test_lease_expiry'))
+        suite.addTest(LockTests('test_lease_renewal'))
+        suite.addTest(LockTests('test_fencing_token'))
+        suite.addTest(LockTests('test_lock_quorum'))
         return suite
 
     def test_method_lock_rpc(self):
-        """Test whether locks can be cleared over the RPC"""
+        """Test that a locking method fails once the lock has been held by another
+        method for the acquire timeout, and that locks can be cleared over the RPC
+        """
 
         thread_is_running_event = threading.Event()
         thread_should_stop_event = threading.Event()
+        exceptions = []
 
         @Expose(locking=True)
         def hold_lock_forever(self):
             while not thread_should_stop_event.is_set():
                 thread_is_running_event.set()
+                time.sleep(0.1)
 
         @Expose(locking=True)
         def take_lock(self):
             return True
 
+        def take_lock_thread():
+            try:
+                take_lock(self)
+            except Exception, e:
+                exceptions.append(e)
+
         # Test nothing else running
-        testing_thread = threading.Thread(target=take_lock, args=(self,))
-        testing_thread.start()
-        testing_thread.join(2)
+        self.assertTrue(take_lock(self))
 
         # Try to take a lock which has already been taken
         locking_thread = threading.Thread(target=hold_lock_forever, args=(self,))
@@ -62,23 +81,20 @@ class LockTests(TestBase):
         # wait for the locking thread to take its lock
         thread_is_running_event.wait()
 
-        testing_thread = threading.Thread(target=take_lock, args=(self,))
+        testing_thread = threading.Thread(target=take_lock_thread)
         testing_thread.start()
 
-        # This should fail:
-        testing_thread.join(2)
-
-        # check that the thread is still running after 2 seconds, because it'll still be locked.
+        # The thread retries whilst the lock is held, then fails
+        testing_thread.join(ClusterLockManager.ACQUIRE_TIMEOUT / 2.0)
         self.assertTrue(testing_thread.is_alive())
+        testing_thread.join(ClusterLockManager.ACQUIRE_TIMEOUT + 2)
+        self.assertFalse(testing_thread.is_alive())
+        self.assertEqual(len(exceptions), 1)
+        self.assertIsInstance(exceptions[0], ClusterLockContentionException)
 
-        # Fix the problem by clearing the lock
+        # Clear the lock, after which the lock can be obtained
         self.parser.parse_arguments("clear-method-lock")
-
-        # This should succeed:
-        testing_thread.join(2)
-
-        # check that the thread has stopped
-        self.assertFalse(testing_thread.is_alive())
+        self.assertTrue(take_lock(self))
 
         # Clean up
         thread_should_stop_event.set()
@@ -111,3 +127,130 @@ class LockTests(TestBase):
             # Clean up
             thread_should_stop_event.set()
             locking_thread.join()
+
+    def get_lock_manager(self):
+        """Return a lock manager, separate from the daemon, with short timeouts.
+        Leases must outlast the attempts to obtain a conflicting lease.
+        """
+        lock_manager = ClusterLockManager()
+        lock_manager.ACQUIRE_TIMEOUT = 1
+        lock_manager.LEASE_TIMEOUT = 3
+        return lock_manager
+
+    def test_lock_contention(self):
+        """Test that obtaining a lock held by another command fails after the acquire timeout"""
+        lock_manager = self.get_lock_manager()
+        lock_manager.acquire('virtual_machine:test', 'holder-1', cluster_wide=False)
+
+        start_time = time.time()
+        with self.assertRaises(ClusterLockContentionException):
+            lock_manager.acquire('virtual_machine:test', 'holder-2', cluster_wide=False)
+        duration = time.time() - start_time
+        self.assertGreaterEqual(duration, lock_manager.ACQUIRE_TIMEOUT)
+        self.assertLess(duration, lock_manager.ACQUIRE_TIMEOUT + 1)
+
+        # Once released, the lock can be obtained by another command
+        lock_manager.release('holder-1')
+        lock_manager.acquire('virtual_machine:test', 'holder-2', cluster_wide=False)
+        lock_manager.release('holder-2')
+
+    def test_lock_resources(self):
+        """Test that locks on different resources do not conflict, other
+        than with the global resource
+        """
+        lock_manager = self.get_lock_manager()
+        lock_manager.acquire('virtual_machine:test1', 'holder-1', cluster_wide=False)
+        lock_manager.acquire('virtual_machine:test2', 'holder-2', cluster_wide=False)
+
+        # A holder can obtain further resources whilst holding a lock
+        lock_manager.acquire('hard_drive:test1', 'holder-1', cluster_wide=False)
+
+        with self.assertRaises(ClusterLockContentionException):
+            lock_manager.acquire(ClusterLockManager.GLOBAL_RESOURCE, 'holder-3',
+                                 cluster_wide=False)
+
+        lock_manager.release('holder-1')
+        lock_manager.release('holder-2')
+        lock_manager.acquire(ClusterLockManager.GLOBAL_RESOURCE, 'holder-3', cluster_wide=False)
+        with self.assertRaises(ClusterLockContentionException):
+            lock_manager.acquire('virtual_machine:test1', 'holder-1', cluster_wide=False)
+        lock_manager.release('holder-3')
+
+    def test_lease_expiry(self):
+        """Test that a lease that is not renewed expires"""
+        lock_manager = self.get_lock_manager()
+        lock_manager.acquire('virtual_machine:test', 'holder-1', cluster_wide=False)
+        time.sleep(lock_manager.LEASE_TIMEOUT + 0.5)
+
+        lock_manager.acquire('virtual_machine:test', 'holder-2', cluster_wide=False)
+        self.assertEqual(lock_manager._renew_holder_leases(['holder-1', 'holder-2']),
+                         ['holder-1'])
+        lock_manager.release('holder-2')
+
+    def test_lease_renewal(self):
+        """Test that a renewed lease does not expire"""
+        lock_manager = self.get_lock_manager()
+        lock_manager.acquire('virtual_machine:test', 'holder-1', cluster_wide=False)
+        for _ in range(3):
+            time.sleep(lock_manager.LEASE_TIMEOUT / 2.0)
+            self.assertEqual(lock_manager._renew_holder_leases(['holder-1']), [])
+
+        with self.assertRaises(ClusterLockContentionException):
+            lock_manager.acquire('virtual_machine:test', 'holder-2', cluster_wide=False)
+        lock_manager.release('holder-1')
+
+    def test_fencing_token(self):
+        """Test that requests are rejected once the lease of their lock has been replaced"""
+        lock_manager = self.get_lock_manager()
+        tokens = lock_manager.acquire('virtual_machine:test', 'holder-1', cluster_wide=False)
+        lock_context = {'holder': 'holder-1', 'tokens': tokens}
+        lock_manager.validate_lock_context(lock_context)
+
+        # A token for a previous lease is rejected
+        with self.assertRaises(ClusterLockExpiredException):
+            lock_manager.validate_lock_context(
+                {'holder': 'holder-1',
+                 'tokens': dict((node, token - 1) for node, token in tokens.items())}
+            )
+
+        # Once the lease has expired and been granted to another command,
+        # the token is rejected, and the new lease has a greater token
+        time.sleep(lock_manager.LEASE_TIMEOUT + 0.5)
+        new_tokens = lock_manager.acquire('virtual_machine:test', 'holder-2',
+                                          cluster_wide=False)
+        self.assertGreater(new_tokens.values()[0], tokens.values()[0])
+        with self.assertRaises(ClusterLockExpiredException):
+            lock_manager.validate_lock_context(lock_context)
+        lock_manager.validate_lock_context({'holder': 'holder-2', 'tokens': new_tokens})
+
+        # Requests without a token for the node are accepted, as the node
+        # could not be contacted when the lock was obtained
+        lock_manager.validate_lock_context({'holder': 'holder-3', 'tokens': {}})
+        lock_manager.release('holder-2')
+
+    def test_lock_quorum(self):
+        """Test that a lock is only obtained if a majority of the nodes grant the lease"""
+        lock_manager = self.get_lock_manager()
+        remote_lock_manager = self.get_lock_manager()
+        remote_lock_managers = {'node-b': remote_lock_manager, 'node-c': None}
+        lock_manager._get_lock_nodes = lambda: sorted(remote_lock_managers.keys())
+        lock_manager._get_remote_lock_manager = lambda node: remote_lock_managers[node]
+        remote_lock_manager.grant_lease = (
+            lambda resource, holder, node: {'token': remote_lock_manager._grant_lease(
+                resource, holder, node
+            )[0]}
+        )
+        remote_lock_manager.release_leases = remote_lock_manager._release_leases
+
+        # Two of the three nodes grant the lease
+        tokens = lock_manager.acquire('virtual_machine:test', 'holder-1')
+        self.assertEqual(sorted(tokens.keys()), sorted([get_hostname(), 'node-b']))
+        lock_manager.release('holder-1')
+
+        # The lease is not obtained from the local node alone, and the
+        # local lease is released
+        remote_lock_managers['node-b'] = None
+        with self.assertRaises(ClusterLockQuorumException):
+            lock_manager.acquire('virtual_machine:test', 'holder-1')
+        lock_manager.acquire('virtual_machine:test', 'holder-2', cluster_wide=False)
+        lock_manager.release('holder-2')
@@ -0,0 +1,177 @@
+# Copyright (c) 2014 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mcvirt.test.test_base import TestBase
+from mcvirt.log_store import LogStore
+from mcvirt.logger import Logger
+
+
+class SmallLogStore(LogStore):
+    """Log store with a small ring buffer and segments, so that records
+    are read from the segments on disk and segments are rotated. Records
+    are approximately 130 bytes.
+    """
+
+    RING_SIZE = 5
+    SEGMENT_SIZE = 512
+    MAX_SEGMENTS = 3
+
+
+class LogStoreTests(TestBase):
+    """Provide unit tests for the command log store"""
+
+    @staticmethod
+    def suite():
+        """Return a test suite"""
+        suite = unittest.TestSuite()
+        suite.addTest(LogStoreTests('test_segment_rotation'))
+        suite.addTest(LogStoreTests('test_segment_index'))
+        suite.addTest(LogStoreTests('test_reload'))
+        suite.addTest(LogStoreTests('test_query_latest_record'))
+        suite.addTest(LogStoreTests('test_query_limit'))
+        suite.addTest(LogStoreTests('test_get_logs_back'))
+        return suite
+
+    def setUp(self):
+        """Create a log store in a temporary directory"""
+        super(LogStoreTests, self).setUp()
+        self.log_dir = tempfile.mkdtemp()
+        self.log_store = SmallLogStore(log_dir=self.log_dir)
+
+    def tearDown(self):
+        """Remove the temporary log store"""
+        shutil.rmtree(self.log_dir)
+        super(LogStoreTests, self).tearDown()
+
+    def add_record(self, user='mjc', object_name='test-vm', status='SUCCESS', log_id=None,
+                   queue_time=None):
+        """Add a record to the log store, returning its log ID"""
+        if log_id is None:
+            log_id = self.log_store.allocate_id()
+        self.log_store.append({'i': log_id, 'n': 'node', 'u': user, 'm': 'start',
+                               'o': object_name, 'y': 'virtual_machine',
+                               'q': log_id if queue_time is None else queue_time,
+                               's': None, 'f': None, 'st': status, 'e': None})
+        return log_id
+
+    def get_segment_files(self, extension):
+        """Return the segment files of the log store with the given extension"""
+        return sorted(file_name for file_name in os.listdir(self.log_dir)
+                      if file_name.endswith('.' + extension))
+
+    def test_segment_rotation(self):
+        """Test that segments are rotated and the oldest segments are removed"""
+        for _ in range(50):
+            self.add_record()
+
+        self.assertEqual(len(self.log_store.segments), SmallLogStore.MAX_SEGMENTS)
+        self.assertEqual(len(self.get_segment_files('log')), SmallLogStore.MAX_SEGMENTS)
+
+        # Indexes are written for the closed segments only
+        self.assertEqual(len(self.get_segment_files('idx')), SmallLogStore.MAX_SEGMENTS - 1)
+
+        # The retained segments hold consecutive records, up to the latest record
+        self.assertGreater(self.log_store.segments[0]['min_id'], 0)
+        self.assertEqual(self.log_store.segments[-1]['last_id'], 49)
+        for index, next_index in zip(self.log_store.segments, self.log_store.segments[1:]):
+            self.assertEqual(index['last_id'] + 1, next_index['min_id'])
+
+    def test_segment_index(self):
+        """Test that the segment indexes only match queries for the records they contain"""
+        for log_id in range(20):
+            self.add_record(user='user-%i' % (log_id % 2), queue_time=1000 + log_id)
+        index = self.log_store.segments[0]
+        filters = dict(start_time=None, end_time=None, user=None, object_name=None,
+                       status=None, min_id=None, max_id=None)
+
+        def index_matches(**kwargs):
+            query_filters = dict(filters)
+            query_filters.update(kwargs)
+            return LogStore._index_matches(index, **query_filters)
+
+        self.assertTrue(index_matches())
+        self.assertTrue(index_matches(user='user-1'))
+        self.assertFalse(index_matches(user='other-user'))
+        self.assertFalse(index_matches(object_name='other-vm'))
+        self.assertFalse(index_matches(status='FAILED'))
+        self.assertTrue(index_matches(start_time=index['start_time'],
+                                      end_time=index['start_time']))
+        self.assertFalse(index_matches(start_time=index['end_time'] + 1))
+        self.assertFalse(index_matches(min_id=index['last_id'] + 1))
+        self.assertTrue(index_matches(max_id=index['min_id']))
+
+    def test_reload(self):
+        """Test that the segments, indexes and ring buffer are loaded from disk"""
+        for _ in range(30):
+            self.add_record()
+        expected_segments = self.log_store.segments
+        expected_records = self.log_store.query()
+
+        # Remove the index of a closed segment, which must be rebuilt
+        os.remove(os.path.join(self.log_dir, self.get_segment_files('idx')[0]))
+
+        log_store = SmallLogStore(log_dir=self.log_dir)
+        self.assertEqual(log_store.segments, expected_segments)
+        self.assertEqual(log_store.query(), expected_records)
+        self.assertEqual(log_store.allocate_id(), 30)
+        self.assertEqual(list(log_store.ring)[-1]['i'], 29)
+
+    def test_query_latest_record(self):
+        """Test that logs are filtered on their latest record"""
+        self.log_store.SEGMENT_SIZE = 2048
+        log_id = self.add_record(status='QUEUED')
+        for _ in range(20):
+            self.add_record(object_name='other-vm')
+
+        # Update the log once the records for it have left the ring buffer
+        self.add_record(status='FAILED', log_id=log_id)
+
+        self.assertEqual([record['st'] for record in self.log_store.query(object_name='test-vm')],
+                         ['FAILED'])
+        self.assertEqual(self.log_store.query(status='QUEUED'), [])
+        self.assertEqual(len(self.log_store.query(status='FAILED')), 1)
+
+    def test_query_limit(self):
+        """Test that a query with a limit returns the newest matching logs, in order"""
+        self.log_store.SEGMENT_SIZE = 2048
+        for log_id in range(30):
+            self.add_record(user='user-%i' % (log_id % 3))
+
+        records = self.log_store.query(user='user-0', limit=4)
+        self.assertEqual([record['i'] for record in records], [18, 21, 24, 27])
+        records = self.log_store.query(min_id=10, max_id=12)
+        self.assertEqual([record['i'] for record in records], [10, 11, 12])
+
+    def test_get_logs_back(self):
+        """Test that the number of logs requested are returned, ending at the start log"""
+        self.log_store.SEGMENT_SIZE = 2048
+        for _ in range(10):
+            self.add_record()
+
+        store = Logger.STORE
+        Logger.STORE = self.log_store
+        try:
+            self.assertEqual(sorted(Logger().get_logs(start_log=6, back=3).keys()), [4, 5, 6])
+            self.assertEqual(sorted(Logger().get_logs(back=1).keys()), [9])
+            self.assertEqual(len(Logger().get_logs(back=20)), 10)
+        finally:
+            Logger.STORE = store
@@ -0,0 +1,122 @@
+# Copyright (c) 2014 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+
+from mcvirt.test.test_base import TestBase
+from mcvirt.thread.evacuation_scheduler import EvacuationScheduler, EvacuationStatus
+
+
+class EvacuationTestVm(object):
+    """Provide the attributes of a VM that are used to plan an evacuation"""
+
+    def __init__(self, name, memory, cpu=1, running=True, nodes=None):
+        """Store the VM attributes"""
+        self.name = name
+        self.memory = memory
+        self.cpu = cpu
+        self.is_running = running
+        self.nodes = nodes or ['source', 'node-a', 'node-b']
+
+    def get_name(self):
+        """Return the name of the VM"""
+        return self.name
+
+    def getRAM(self):
+        """Return the memory allocation (KiB) of the VM"""
+        return self.memory
+
+    def getCPU(self):
+        """Return the number of vCPUs of the VM"""
+        return self.cpu
+
+    def getAvailableNodes(self):
+        """Return the nodes that the VM can be run on"""
+        return self.nodes
+
+
+class EvacuationTests(TestBase):
+    """Provide unit tests for planning node evacuations"""
+
+    @staticmethod
+    def suite():
+        """Return a test suite"""
+        suite = unittest.TestSuite()
+        suite.addTest(EvacuationTests('test_plan_largest_first'))
+        suite.addTest(EvacuationTests('test_plan_memory'))
+        suite.addTest(EvacuationTests('test_plan_cpu'))
+        suite.addTest(EvacuationTests('test_plan_skipped'))
+        return suite
+
+    def plan(self, vm_objects, node_resources):
+        """Plan the evacuation of the VMs, returning the destination of each VM"""
+        scheduler = EvacuationScheduler('source', vm_objects)
+        plan = scheduler.plan_migrations(node_resources)
+        return dict((entry['name'], entry) for entry in plan), [entry['name'] for entry in plan]
+
+    def get_resources(self, free_memory, cpu_count=8, load_average=0.0):
+        """Return the resources of a node"""
+        return {'free_memory': free_memory, 'cpu_count': cpu_count,
+                'load_average': load_average}
+
+    def test_plan_largest_first(self):
+        """Test that the largest VMs are planned and migrated first"""
+        plan, order = self.plan([EvacuationTestVm('small', 1024), EvacuationTestVm('large', 4096),
+                                 EvacuationTestVm('medium', 2048)],
+                                {'node-a': self.get_resources(8192)})
+        self.assertEqual(order, ['large', 'medium', 'small'])
+        for entry in plan.values():
+            self.assertEqual(entry['destination'], 'node-a')
+            self.assertEqual(entry['status'], EvacuationStatus.PENDING)
+
+    def test_plan_memory(self):
+        """Test that running VMs are spread by free memory, which is reduced as VMs
+        are planned, and that stopped VMs do not use memory on the destination
+        """
+        plan, _ = self.plan([EvacuationTestVm('vm-1', 4096), EvacuationTestVm('vm-2', 3072),
+                             EvacuationTestVm('vm-3', 2048),
+                             EvacuationTestVm('stopped', 8192, running=False)],
+                            {'node-a': self.get_resources(6144),
+                             'node-b': self.get_resources(5120)})
+        self.assertEqual(plan['stopped']['destination'], 'node-a')
+        self.assertFalse(plan['stopped']['online'])
+        self.assertEqual(plan['vm-1']['destination'], 'node-a')
+        self.assertEqual(plan['vm-2']['destination'], 'node-b')
+        self.assertEqual(plan['vm-3']['destination'], 'node-a')
+        self.assertTrue(plan['vm-1']['online'])
+
+    def test_plan_cpu(self):
+        """Test that nodes with enough idle CPU for the VM are preferred"""
+        plan, _ = self.plan([EvacuationTestVm('vm-1', 1024, cpu=4)],
+                            {'node-a': self.get_resources(8192, cpu_count=4, load_average=2.0),
+                             'node-b': self.get_resources(2048, cpu_count=8)})
+        self.assertEqual(plan['vm-1']['destination'], 'node-b')
+
+    def test_plan_skipped(self):
+        """Test that VMs that cannot be run on, or do not fit on, another node are skipped"""
+        plan, _ = self.plan([EvacuationTestVm('local-only', 1024, nodes=['source']),
+                             EvacuationTestVm('too-large', 16384),
+                             EvacuationTestVm('too-large-stopped', 16384, running=False)],
+                            {'node-a': self.get_resources(8192)})
+        self.assertEqual(plan['local-only']['status'], EvacuationStatus.SKIPPED)
+        self.assertEqual(plan['local-only']['error'], 'No other available node can run the VM')
+        self.assertEqual(plan['too-large']['status'], EvacuationStatus.SKIPPED)
+        self.assertEqual(plan['too-large']['error'],
+                         'Insufficient free memory on the available nodes')
+        self.assertIsNone(plan['too-large']['destination'])
+        self.assertEqual(plan['too-large-stopped']['status'], EvacuationStatus.PENDING)
+        self.assertEqual(plan['too-large-stopped']['destination'], 'node-a')
@@ -0,0 +1,103 @@
+# Copyright (c) 2014 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+
+from mcvirt.test.test_base import TestBase
+from mcvirt.thread.metrics_collector import MetricRingBuffer, GuestMetricsCollector
+
+
+class MetricsTests(TestBase):
+    """Provide unit tests for the storage and calculation of guest metrics"""
+
+    @staticmethod
+    def suite():
+        """Return a test suite"""
+        suite = unittest.TestSuite()
+        suite.addTest(MetricsTests('test_ring_buffer'))
+        suite.addTest(MetricsTests('test_ring_buffer_wraparound'))
+        suite.addTest(MetricsTests('test_ring_buffer_since'))
+        suite.addTest(MetricsTests('test_counter_rate'))
+        suite.addTest(MetricsTests('test_counter_reset'))
+        suite.addTest(MetricsTests('test_gauge'))
+        return suite
+
+    def get_ring_buffer(self, sample_count, size=5):
+        """Return a ring buffer containing samples at times 1 to sample_count"""
+        ring_buffer = MetricRingBuffer(size, ['cpu_time', 'balloon_current'])
+        for sample_time in range(1, sample_count + 1):
+            ring_buffer.append(float(sample_time), {'cpu_time': sample_time * 10})
+        return ring_buffer
+
+    def test_ring_buffer(self):
+        """Test obtaining the samples of a ring buffer that is not full"""
+        self.assertEqual(MetricRingBuffer(5, ['cpu_time']).get_samples(), ([], {'cpu_time': []}))
+        self.assertIsNone(MetricRingBuffer(5, ['cpu_time']).get_last_time())
+
+        times, values = self.get_ring_buffer(3).get_samples()
+        self.assertEqual(times, [1.0, 2.0, 3.0])
+        self.assertEqual(values['cpu_time'], [10.0, 20.0, 30.0])
+
+        # Metrics that are missing from a sample are recorded as zero
+        self.assertEqual(values['balloon_current'], [0.0, 0.0, 0.0])
+
+    def test_ring_buffer_wraparound(self):
+        """Test that the oldest samples are replaced once the ring buffer is full"""
+        ring_buffer = self.get_ring_buffer(12)
+        times, values = ring_buffer.get_samples()
+        self.assertEqual(times, [8.0, 9.0, 10.0, 11.0, 12.0])
+        self.assertEqual(values['cpu_time'], [80.0, 90.0, 100.0, 110.0, 120.0])
+        self.assertEqual(ring_buffer.get_last_time(), 12.0)
+
+        # Samples are ordered from the oldest when the buffer has wrapped exactly
+        times, _ = self.get_ring_buffer(10).get_samples()
+        self.assertEqual(times, [6.0, 7.0, 8.0, 9.0, 10.0])
+
+    def test_ring_buffer_since(self):
+        """Test that samples since a time include the preceding sample"""
+        ring_buffer = self.get_ring_buffer(12)
+        self.assertEqual(ring_buffer.get_samples(since=10.0)[0], [9.0, 10.0, 11.0, 12.0])
+        self.assertEqual(ring_buffer.get_samples(since=9.5)[0], [9.0, 10.0, 11.0, 12.0])
+
+        # All samples are returned if the period precedes the oldest sample
+        self.assertEqual(ring_buffer.get_samples(since=1.0)[0], [8.0, 9.0, 10.0, 11.0, 12.0])
+
+        # No samples are returned if the period follows the latest sample
+        self.assertEqual(ring_buffer.get_samples(since=13.0), ([], {'cpu_time': [],
+                                                                    'balloon_current': []}))
+
+    def test_counter_rate(self):
+        """Test that the rate of counters is calculated between consecutive samples"""
+        times = [0.0, 10.0, 20.0]
+        values = {'block_read_bytes': [0, 10240, 30720]}
+        self.assertEqual(GuestMetricsCollector._get_series_values(times, values, 'disk_read'),
+                         [(10.0, 1.0), (20.0, 2.0)])
+
+    def test_counter_reset(self):
+        """Test that counters that have been reset, by the VM restarting, are skipped"""
+        # The last sample has the same time as the previous sample, so has no rate
+        times = [0.0, 10.0, 20.0, 30.0, 30.0]
+        values = {'cpu_time': [0, 5000000000, 1000000000, 3000000000, 4000000000]}
+        self.assertEqual(GuestMetricsCollector._get_series_values(times, values, 'cpu'),
+                         [(10.0, 50.0), (30.0, 20.0)])
+
+    def test_gauge(self):
+        """Test that gauges are scaled, rather than converted to a rate"""
+        times = [0.0, 10.0]
+        values = {'balloon_current': [1048576, 524288]}
+        self.assertEqual(GuestMetricsCollector._get_series_values(times, values, 'memory'),
+                         [(0.0, 1024.0), (10.0, 512.0)])
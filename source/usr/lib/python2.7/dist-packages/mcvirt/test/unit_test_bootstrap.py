@@ -21,6 +21,11 @@ import threading
 from mcvirt.client.rpc import Connection
 from mcvirt.test.node.network_tests import NetworkTests
 from mcvirt.test.lock.lock_tests import LockTests
+from mcvirt.test.cluster.config_replicator_tests import ConfigReplicatorTests
+from mcvirt.test.log_store_tests import LogStoreTests
+from mcvirt.test.cluster.placement_tests import PlacementTests
+from mcvirt.test.node.evacuation_tests import EvacuationTests
+from mcvirt.test.node.metrics_tests import MetricsTests
 from mcvirt.test.ldap_tests import LdapTests
 from mcvirt.test.node.node_tests import NodeTests
 from mcvirt.test.virtual_machine.virtual_machine_tests import VirtualMachineTests
@@ -56,6 +61,11 @@ class UnitTestBootstrap(object):
         validation_test_suite = ValidationTests.suite()
         lock_tests_suite = LockTests.suite()
         ldap_tests_suite = LdapTests.suite()
+        config_replicator_tests_suite = ConfigReplicatorTests.suite()
+        log_store_tests_suite = LogStoreTests.suite()
+        placement_tests_suite = PlacementTests.suite()
+        evacuation_tests_suite = EvacuationTests.suite()
+        metrics_tests_suite = MetricsTests.suite()
 
         OnlineMigrateTests.RPC_DAEMON = self.daemon
         AuthTests.RPC_DAEMON = self.daemon
@@ -71,7 +81,12 @@ class UnitTestBootstrap(object):
             online_migrate_test_suite,
             validation_test_suite,
             lock_tests_suite,
-            ldap_tests_suite
+            ldap_tests_suite,
+            config_replicator_tests_suite,
+            log_store_tests_suite,
+            placement_tests_suite,
+            evacuation_tests_suite,
+            metrics_tests_suite
         ])
 
     def daemon_loop_condition(self):
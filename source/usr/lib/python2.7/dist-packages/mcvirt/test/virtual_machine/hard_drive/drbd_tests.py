@@ -19,6 +19,7 @@ import unittest
 import time
 
 from mcvirt.virtual_machine.hard_drive.drbd import DrbdConnectionState
+from mcvirt.node.drbd import Drbd as NodeDrbd
 from mcvirt.exceptions import DrbdVolumeNotInSyncException
 from mcvirt.system import System
 from mcvirt.test.test_base import TestBase, skip_drbd
@@ -32,6 +33,7 @@ class DrbdTests(TestBase):
         """Return a test suite of the Virtual Machine tests"""
         suite = unittest.TestSuite()
         suite.addTest(DrbdTests('test_verify'))
+        suite.addTest(DrbdTests('test_get_free_id'))
 
         return suite
 
@@ -84,3 +86,20 @@ class DrbdTests(TestBase):
         # Attempt to start the VM, ensuring an exception is raised
         with self.assertRaises(DrbdVolumeNotInSyncException):
             test_vm_object.start()
+
+    def test_get_free_id(self):
+        """Test the search for the lowest unallocated Drbd port or minor"""
+        # No IDs are used from the start
+        self.assertEqual(NodeDrbd._get_free_id([], 7789, []), 7789)
+        self.assertEqual(NodeDrbd._get_free_id([1, 2, 3], 7789, []), 7789)
+
+        # The first gap in the IDs from the start is used
+        self.assertEqual(NodeDrbd._get_free_id([7789, 7790, 7792], 7789, []), 7791)
+        self.assertEqual(NodeDrbd._get_free_id([7788, 7790, 7791], 7789, []), 7789)
+        self.assertEqual(NodeDrbd._get_free_id(range(0, 1000), 0, []), 1000)
+        self.assertEqual(NodeDrbd._get_free_id(range(0, 500) + range(501, 1000), 0, []), 500)
+        self.assertEqual(NodeDrbd._get_free_id(range(0, 1000), 200, []), 1000)
+
+        # Excluded IDs, such as ports listening on the nodes, are skipped
+        self.assertEqual(NodeDrbd._get_free_id([7789, 7790], 7789, [7791, 7792]), 7793)
+        self.assertEqual(NodeDrbd._get_free_id([7789, 7791], 7789, [7790, 7793]), 7792)
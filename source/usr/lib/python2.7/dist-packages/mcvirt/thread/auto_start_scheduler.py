@@ -0,0 +1,170 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import threading
+import time
+import Pyro4
+
+from mcvirt.syslogger import Syslogger
+
+
+class AutoStartScheduler(object):
+    """Start a set of VMs concurrently. VMs are started in order of their
+    autostart group, with all VMs in a group being started before the next
+    group. Whilst VMs are being started, further starts are delayed if the
+    node is low on free memory or the storage is busy (high I/O wait).
+    """
+
+    # Interval (seconds) between checks of the node resources, whilst
+    # waiting to start a VM
+    THROTTLE_INTERVAL = 2
+
+    # Maximum time (seconds) to delay a VM start due to node resources
+    THROTTLE_TIMEOUT = 120
+
+    MEMINFO = '/proc/meminfo'
+    PROC_STAT = '/proc/stat'
+
+    def __init__(self, vm_objects, concurrency, minimum_free_memory, maximum_iowait):
+        """Store member variables"""
+        self.vm_objects = vm_objects
+        self.concurrency = max(1, int(concurrency))
+        self.minimum_free_memory = minimum_free_memory
+        self.maximum_iowait = maximum_iowait
+        self.in_progress = 0
+        self.in_progress_lock = threading.Lock()
+        self.report = []
+        self.last_cpu_times = None
+
+    @staticmethod
+    def get_free_memory():
+        """Return the memory (KiB) available for starting VMs"""
+        with open(AutoStartScheduler.MEMINFO, 'r') as meminfo_fh:
+            for line in meminfo_fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])
+        return None
+
+    def get_iowait(self):
+        """Return the percentage of CPU time spent waiting for I/O since
+        the previous call, or None on the first call
+        """
+        with open(self.PROC_STAT, 'r') as stat_fh:
+            cpu_times = [int(value) for value in stat_fh.readline().split()[1:]]
+
+        last_cpu_times = self.last_cpu_times
+        self.last_cpu_times = cpu_times
+        if last_cpu_times is None:
+            return None
+
+        deltas = [current - last for current, last in zip(cpu_times, last_cpu_times)]
+        if sum(deltas) <= 0:
+            return 0
+        # The fifth field of the cpu line is the I/O wait time
+        return (deltas[4] * 100) / sum(deltas)
+
+    def _wait_for_resources(self, vm_object):
+        """Delay the start of a VM whilst other VMs are being started and the
+        node does not have enough free memory or the storage is busy.
+        Returns the time spent waiting.
+        """
+        start_time = time.time()
+        required_memory = int(vm_object.getRAM()) + (self.minimum_free_memory * 1024)
+        self.get_iowait()
+
+        while self.in_progress and time.time() - start_time < self.THROTTLE_TIMEOUT:
+            free_memory = self.get_free_memory()
+            iowait = self.get_iowait()
+            if ((free_memory is None or free_memory >= required_memory) and
+                    (self.maximum_iowait is None or iowait is None or
+                     iowait <= self.maximum_iowait)):
+                break
+            time.sleep(self.THROTTLE_INTERVAL)
+
+        return time.time() - start_time
+
+    def _start_vm(self, vm_object, vm_report, semaphore):
+        """Start a VM, recording the result in the report"""
+        # Each start obtains a cluster lock on the VM being started
+        Pyro4.current_context.INTERNAL_REQUEST = True
+
+        start_time = time.time()
+        try:
+            Syslogger.logger().info('Autostarting: %s' % vm_object.get_name())
+            vm_object.start()
+            vm_report['status'] = 'Started'
+            Syslogger.logger().info('Autostart successful: %s' % vm_object.get_name())
+        except Exception, e:
+            vm_report['status'] = 'Failed'
+            vm_report['error'] = str(e)
+            Syslogger.logger().error('Failed to autostart: %s: %s' %
+                                     (vm_object.get_name(), str(e)))
+        finally:
+            vm_report['duration'] = time.time() - start_time
+            Pyro4.current_context.INTERNAL_REQUEST = False
+            with self.in_progress_lock:
+                self.in_progress -= 1
+            semaphore.release()
+
+    def _start_group(self, group, vm_objects):
+        """Start the VMs in a group, with at most the configured number of
+        VMs being started at once
+        """
+        semaphore = threading.BoundedSemaphore(self.concurrency)
+        threads = []
+        for vm_object in vm_objects:
+            semaphore.acquire()
+            thread_started = False
+            try:
+                vm_report = {'name': vm_object.get_name(), 'group': group, 'status': 'Starting',
+                             'wait': self._wait_for_resources(vm_object), 'duration': None,
+                             'error': None}
+                self.report.append(vm_report)
+
+                with self.in_progress_lock:
+                    self.in_progress += 1
+                try:
+                    thread = threading.Thread(target=self._start_vm,
+                                              args=(vm_object, vm_report, semaphore),
+                                              name='AutoStart-%s' % vm_object.get_name())
+                    thread.start()
+                    thread_started = True
+                finally:
+                    if not thread_started:
+                        with self.in_progress_lock:
+                            self.in_progress -= 1
+                threads.append(thread)
+            finally:
+                # Once started, the thread releases the semaphore
+                if not thread_started:
+                    semaphore.release()
+
+        for thread in threads:
+            thread.join()
+
+    def run(self):
+        """Start the VMs, group by group, returning the start report"""
+        groups = {}
+        for vm_object in self.vm_objects:
+            groups.setdefault(vm_object._get_autostart_group(), []).append(vm_object)
+
+        for group in sorted(groups.keys()):
+            self._start_group(
+                group, sorted(groups[group], key=lambda vm_object: vm_object.get_name())
+            )
+
+        return self.report
@@ -15,17 +15,50 @@
 # You should have received a copy of the GNU General Public License
 # along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
 
+import threading
+import time
+import libvirt
 import Pyro4
+from texttable import Texttable
 
 from mcvirt.thread.repeat_timer import RepeatTimer
 from mcvirt.constants import AutoStartStates
 from mcvirt.rpc.expose_method import Expose
 from mcvirt.argument_validator import ArgumentValidator
 from mcvirt.auth.permissions import PERMISSIONS
+from mcvirt.syslogger import Syslogger
 
 
 class AutoStartWatchdog(RepeatTimer):
-    """Object to perform regular checks to determine that VMs are running"""
+    """Object to restart ON_POLL VMs that stop unexpectedly. VMs are restarted
+    in response to libvirt lifecycle events, with the regular poll
+    performed as a safety net for missed events.
+    """
+
+    # Delay (seconds) before restarting a VM that has stopped unexpectedly,
+    # which is doubled for each further restart within the crash loop window
+    RESTART_DELAY = 5
+    MAXIMUM_RESTART_DELAY = 300
+
+    # A VM that stops unexpectedly more than CRASH_LOOP_LIMIT times within
+    # CRASH_LOOP_WINDOW seconds is no longer restarted, until it is reset
+    CRASH_LOOP_LIMIT = 5
+    CRASH_LOOP_WINDOW = 1800
+
+    # Time (seconds) for which a VM stopped through MCVirt is not
+    # considered to have stopped unexpectedly
+    INTENTIONAL_STOP_TIMEOUT = 600
+
+    # Lifecycle event details that indicate that a VM has stopped unexpectedly
+    UNEXPECTED_STOP_DETAILS = [libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED,
+                               libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED,
+                               libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN]
+
+    RESTART_STATES = {}
+    INTENTIONAL_STOPS = {}
+    STATE_LOCK = threading.RLock()
+    EVENT_CONNECTION = None
+    EVENT_CALLBACK_ID = None
 
     @property
     def interval(self):
@@ -68,8 +101,194 @@ class AutoStartWatchdog(RepeatTimer):
                 self.repeat = True
                 self.repeat_run()
 
+    @Expose()
+    def get_autostart_limits(self):
+        """Return the limits applied when autostarting VMs on the node"""
+        return self._get_registered_object('mcvirt_config')().get_config()['autostart_limits']
+
+    @Expose(locking=True)
+    def set_autostart_limits(self, concurrency=None, minimum_free_memory=None,
+                             maximum_iowait=None):
+        """Update the limits applied when autostarting VMs on the node: the
+        number of VMs started concurrently, the free memory (MiB) to retain
+        and the maximum I/O wait (percent) whilst VMs are being started
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_NODE)
+        limits = {}
+        if concurrency is not None:
+            ArgumentValidator.validate_positive_integer(concurrency)
+            limits['concurrency'] = int(concurrency)
+        if minimum_free_memory is not None:
+            ArgumentValidator.validate_integer(minimum_free_memory)
+            limits['minimum_free_memory'] = int(minimum_free_memory)
+        if maximum_iowait is not None:
+            ArgumentValidator.validate_integer(maximum_iowait)
+            limits['maximum_iowait'] = int(maximum_iowait)
+
+        def update_config(config):
+            config['autostart_limits'].update(limits)
+        self._get_registered_object('mcvirt_config')().update_config(update_config,
+                                                                     'Update autostart limits')
+
+        if self._is_cluster_master:
+
+            def remote_update(node):
+                autostart_watchdog = node.get_connection('autostart_watchdog')
+                autostart_watchdog.set_autostart_limits(**limits)
+            cluster = self._get_registered_object('cluster')
+            cluster.run_remote_command(remote_update)
+
+    @Expose()
+    def get_autostart_report(self):
+        """Return the start times of the VMs in the last autostart"""
+        return self._get_registered_object('virtual_machine_factory').get_autostart_report()
+
+    @Expose()
+    def get_restart_report(self):
+        """Return a table of the VMs that have been restarted after
+        stopping unexpectedly
+        """
+        with AutoStartWatchdog.STATE_LOCK:
+            restart_states = dict(AutoStartWatchdog.RESTART_STATES)
+        if not restart_states:
+            return 'No VMs have been restarted'
+
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(('VM Name', 'Recent restarts', 'Last stop', 'Crash loop'))
+        for vm_name in sorted(restart_states.keys()):
+            restart_state = restart_states[vm_name]
+            table.add_row((vm_name, len(restart_state['restarts']),
+                           time.strftime('%Y-%m-%d %H:%M:%S',
+                                         time.localtime(restart_state['last_stop'])),
+                           'Yes' if restart_state['crash_loop'] else 'No'))
+        return table.draw()
+
+    @Expose(locking=True)
+    def reset_restart_state(self, vm_name):
+        """Clear the restart history of a VM, allowing a VM that has been
+        detected to be in a crash loop to be restarted again
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_NODE)
+        ArgumentValidator.validate_hostname(vm_name)
+        with AutoStartWatchdog.STATE_LOCK:
+            if vm_name in AutoStartWatchdog.RESTART_STATES:
+                del AutoStartWatchdog.RESTART_STATES[vm_name]
+
+    def record_intentional_stop(self, vm_name):
+        """Record that a VM is being stopped through MCVirt, so that it
+        is not restarted
+        """
+        with AutoStartWatchdog.STATE_LOCK:
+            AutoStartWatchdog.INTENTIONAL_STOPS[vm_name] = time.time()
+
+    def clear_intentional_stop(self, vm_name):
+        """Remove the record of an intentional stop of a VM, if the stop failed"""
+        with AutoStartWatchdog.STATE_LOCK:
+            AutoStartWatchdog.INTENTIONAL_STOPS.pop(vm_name, None)
+
+    def _register_domain_events(self):
+        """Register for lifecycle events on the local libvirt connection, if
+        the connection has changed since the events were last registered
+        """
+        connection = self._get_registered_object('libvirt_connector').get_connection()
+        if connection is AutoStartWatchdog.EVENT_CONNECTION:
+            return
+
+        if AutoStartWatchdog.EVENT_CONNECTION is not None:
+            try:
+                AutoStartWatchdog.EVENT_CONNECTION.domainEventDeregisterAny(
+                    AutoStartWatchdog.EVENT_CALLBACK_ID
+                )
+            except libvirt.libvirtError:
+                pass
+
+        try:
+            AutoStartWatchdog.EVENT_CALLBACK_ID = connection.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._domain_event, None
+            )
+            AutoStartWatchdog.EVENT_CONNECTION = connection
+        except libvirt.libvirtError, e:
+            Syslogger.logger().error('Failed to register for libvirt events: %s' % str(e))
+
+    def _domain_event(self, connection, domain, event, detail, opaque):
+        """Handle a libvirt lifecycle event. This is called from the libvirt
+        event loop, so must not block.
+        """
+        if event != libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            return
+
+        vm_name = domain.name()
+        with AutoStartWatchdog.STATE_LOCK:
+            stop_time = AutoStartWatchdog.INTENTIONAL_STOPS.pop(vm_name, None)
+        if detail not in self.UNEXPECTED_STOP_DETAILS:
+            return
+        if stop_time is not None and time.time() - stop_time < self.INTENTIONAL_STOP_TIMEOUT:
+            return
+
+        Syslogger.logger().warning('VM stopped unexpectedly: %s' % vm_name)
+        self._schedule_restart(vm_name)
+
+    def _schedule_restart(self, vm_name):
+        """Schedule the restart of a VM, backing off for each recent restart
+        and abandoning restarts of VMs that are in a crash loop
+        """
+        with AutoStartWatchdog.STATE_LOCK:
+            restart_state = AutoStartWatchdog.RESTART_STATES.setdefault(
+                vm_name, {'restarts': [], 'crash_loop': False, 'timer': None, 'last_stop': None}
+            )
+            current_time = time.time()
+            restart_state['last_stop'] = current_time
+            restart_state['restarts'] = [
+                restart_time for restart_time in restart_state['restarts']
+                if current_time - restart_time < self.CRASH_LOOP_WINDOW
+            ]
+
+            if restart_state['crash_loop']:
+                return
+            if len(restart_state['restarts']) >= self.CRASH_LOOP_LIMIT:
+                restart_state['crash_loop'] = True
+                Syslogger.logger().error(
+                    'VM %s has stopped %s times in %s seconds and will not be restarted' %
+                    (vm_name, len(restart_state['restarts']), self.CRASH_LOOP_WINDOW)
+                )
+                return
+            if restart_state['timer'] is not None and restart_state['timer'].is_alive():
+                return
+
+            delay = min(self.RESTART_DELAY * (2 ** len(restart_state['restarts'])),
+                        self.MAXIMUM_RESTART_DELAY)
+            restart_state['restarts'].append(current_time)
+            restart_state['timer'] = threading.Timer(delay, self._restart_vm, args=(vm_name,))
+            restart_state['timer'].daemon = True
+            restart_state['timer'].start()
+
+    def _restart_vm(self, vm_name):
+        """Restart a VM that has stopped unexpectedly, if it is still
+        registered on the node, stopped and set to autostart on poll
+        """
+        Pyro4.current_context.INTERNAL_REQUEST = True
+        try:
+            vm_factory = self._get_registered_object('virtual_machine_factory')
+            vm_object = vm_factory.getVirtualMachineByName(vm_name)
+            if (vm_object.isRegisteredLocally() and vm_object.is_stopped and
+                    vm_object._get_autostart_state() is AutoStartStates.ON_POLL):
+                Syslogger.logger().info('Restarting: %s' % vm_name)
+                vm_object.start()
+        except Exception, e:
+            Syslogger.logger().error('Failed to restart %s: %s' % (vm_name, str(e)))
+        finally:
+            Pyro4.current_context.INTERNAL_REQUEST = False
+
+    def _get_crash_loop_vms(self):
+        """Return the names of VMs that are in a crash loop"""
+        with AutoStartWatchdog.STATE_LOCK:
+            return [vm_name for vm_name, restart_state in
+                    AutoStartWatchdog.RESTART_STATES.items() if restart_state['crash_loop']]
+
     def initialise(self):
-        """Perform the ON_BOOT autostart and start timer"""
+        """Register for libvirt events, perform the ON_BOOT autostart and start timer"""
+        self._register_domain_events()
         Pyro4.current_context.INTERNAL_REQUEST = True
         vm_factory = self._get_registered_object('virtual_machine_factory')
         vm_factory.autostart(AutoStartStates.ON_BOOT)
@@ -77,8 +296,11 @@ class AutoStartWatchdog(RepeatTimer):
         super(AutoStartWatchdog, self).initialise()
 
     def run(self):
-        """Perform ON_POLL autostart"""
+        """Ensure that libvirt events are registered and perform the ON_POLL
+        autostart for any VMs that have been missed
+        """
+        self._register_domain_events()
         Pyro4.current_context.INTERNAL_REQUEST = True
         vm_factory = self._get_registered_object('virtual_machine_factory')
-        vm_factory.autostart(AutoStartStates.ON_POLL)
+        vm_factory.autostart(AutoStartStates.ON_POLL, exclude=self._get_crash_loop_vms())
         Pyro4.current_context.INTERNAL_REQUEST = False
@@ -0,0 +1,53 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import Pyro4
+
+from mcvirt.exceptions import ClusterLockContentionException
+from mcvirt.thread.repeat_timer import RepeatTimer
+from mcvirt.syslogger import Syslogger
+
+
+class DrbdResyncScheduler(RepeatTimer):
+    """Object to apply time-of-day Drbd resync policies as their peak windows
+    start and end
+    """
+
+    # Check the policies every minute, the granularity of the peak windows
+    INTERVAL = 60
+
+    @property
+    def interval(self):
+        """Return the timer interval"""
+        return self.INTERVAL
+
+    def run(self):
+        """Apply any time-of-day resync policies whose window has changed. The
+        policies are only applied, obtaining the cluster lock, once a window has
+        changed and are retried on the next run if the lock is held.
+        """
+        Pyro4.current_context.INTERNAL_REQUEST = True
+        try:
+            node_drbd = self._get_registered_object('node_drbd')
+            node_policy_pending, pending_hdds = node_drbd.get_pending_time_of_day_policies()
+            if node_policy_pending or pending_hdds:
+                node_drbd.apply_time_of_day_policies()
+        except ClusterLockContentionException:
+            Syslogger.logger().info('Cluster is locked, Drbd resync policies will be retried')
+        except Exception, e:
+            Syslogger.logger().error('Failed to apply Drbd resync policies: %s' % str(e))
+        Pyro4.current_context.INTERNAL_REQUEST = False
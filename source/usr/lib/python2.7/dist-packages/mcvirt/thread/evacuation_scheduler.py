@@ -0,0 +1,247 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import threading
+import time
+import Pyro4
+
+from texttable import Texttable
+
+from mcvirt.syslogger import Syslogger
+
+
+class EvacuationStatus(object):
+    """States of the migration of a VM during an evacuation"""
+
+    PENDING = 'Pending'
+    MIGRATING = 'Migrating'
+    RETRYING = 'Retrying'
+    MIGRATED = 'Migrated'
+    FAILED = 'Failed'
+    SKIPPED = 'Skipped'
+
+
+class EvacuationScheduler(object):
+    """Migrate all VMs off a node. A destination node is planned for each VM
+    from the nodes that the VM can be run on, using the free memory and CPU
+    of the nodes. VMs are migrated largest first, with the configured number
+    of migrations running concurrently and the bandwidth limit split between
+    them. Running VMs are migrated online and stopped VMs offline, with
+    failed migrations being retried.
+    """
+
+    # Default number of concurrent migrations
+    CONCURRENCY = 2
+
+    # Default number of times that a failed migration is retried
+    RETRIES = 2
+
+    # Time (seconds) to wait before retrying a failed migration
+    RETRY_INTERVAL = 10
+
+    def __init__(self, node_name, vm_objects, concurrency=None, bandwidth=None, retries=None):
+        """Store member variables"""
+        self.node_name = node_name
+        self.vm_objects = vm_objects
+        self.concurrency = max(1, int(concurrency or self.CONCURRENCY))
+        self.bandwidth = bandwidth
+        self.retries = self.RETRIES if retries is None else max(0, int(retries))
+        self.plan = []
+        self.start_time = None
+        self.finish_time = None
+        self.report_lock = threading.Lock()
+
+    def plan_migrations(self, node_resources):
+        """Plan the destination node of each VM. Node resources contains the
+        free memory (KiB), CPU count and load average of each of the nodes
+        that are available to receive VMs.
+        """
+        remaining = {}
+        for node, resources in node_resources.items():
+            remaining[node] = {'memory': resources['free_memory'],
+                               'cpu': resources['cpu_count'] - resources['load_average']}
+
+        self.plan = []
+        vm_objects = sorted(self.vm_objects, key=lambda vm_object: -int(vm_object.getRAM()))
+        for vm_object in vm_objects:
+            memory = int(vm_object.getRAM())
+            cpu = int(vm_object.getCPU())
+            online = vm_object.is_running
+            entry = {'name': vm_object.get_name(), 'vm_object': vm_object, 'memory': memory,
+                     'online': online, 'destination': None,
+                     'status': EvacuationStatus.PENDING, 'attempts': 0, 'duration': None,
+                     'error': None}
+            self.plan.append(entry)
+
+            candidates = [node for node in vm_object.getAvailableNodes() if node in remaining]
+            if not candidates:
+                entry['status'] = EvacuationStatus.SKIPPED
+                entry['error'] = 'No other available node can run the VM'
+                continue
+
+            # Stopped VMs do not use memory on the destination node until they are started
+            if online:
+                candidates = [node for node in candidates
+                              if remaining[node]['memory'] >= memory]
+                if not candidates:
+                    entry['status'] = EvacuationStatus.SKIPPED
+                    entry['error'] = 'Insufficient free memory on the available nodes'
+                    continue
+
+            # Prefer nodes with enough idle CPU for the VM, then the most free memory
+            destination = max(sorted(candidates),
+                              key=lambda node: (remaining[node]['cpu'] >= cpu,
+                                                remaining[node]['memory']))
+            entry['destination'] = destination
+            if online:
+                remaining[destination]['memory'] -= memory
+                remaining[destination]['cpu'] -= cpu
+
+        return self.plan
+
+    def _set_entry(self, entry, **values):
+        """Update the report entry of a VM"""
+        with self.report_lock:
+            entry.update(values)
+
+    def _migrate_vm(self, entry, context, semaphore):
+        """Migrate a VM, retrying failed migrations"""
+        # The user context is copied from the evacuation, but each
+        # migration obtains the cluster lock on its own VM
+        Pyro4.current_context.__dict__.update(context)
+        Pyro4.current_context.has_lock = False
+        Pyro4.current_context.lock_context = None
+
+        vm_object = entry['vm_object']
+        migration_options = {}
+        if self.bandwidth:
+            migration_options['bandwidth'] = max(1, int(self.bandwidth) / self.concurrency)
+
+        start_time = time.time()
+        try:
+            for attempt in range(self.retries + 1):
+                # The power state of the VM may have changed since the migration was planned
+                online = vm_object.is_running
+                self._set_entry(entry, status=EvacuationStatus.MIGRATING, online=online,
+                                attempts=attempt + 1)
+                try:
+                    Syslogger.logger().info('Evacuating %s to %s' %
+                                            (entry['name'], entry['destination']))
+                    if online:
+                        vm_object.onlineMigrate(entry['destination'], migration_options)
+                    else:
+                        vm_object.offlineMigrate(entry['destination'])
+                    self._set_entry(entry, status=EvacuationStatus.MIGRATED, error=None)
+                    return
+                except Exception, e:
+                    Syslogger.logger().error('Failed to evacuate %s (attempt %i): %s' %
+                                             (entry['name'], attempt + 1, str(e)))
+                    if attempt < self.retries:
+                        self._set_entry(entry, status=EvacuationStatus.RETRYING, error=str(e))
+                        time.sleep(self.RETRY_INTERVAL)
+                    else:
+                        self._set_entry(entry, status=EvacuationStatus.FAILED, error=str(e))
+        finally:
+            self._set_entry(entry, duration=time.time() - start_time)
+            semaphore.release()
+
+    def run(self):
+        """Migrate the planned VMs, returning the report of the evacuation"""
+        self.start_time = time.time()
+        context = dict(Pyro4.current_context.__dict__)
+        semaphore = threading.BoundedSemaphore(self.concurrency)
+        threads = []
+        try:
+            for entry in self.plan:
+                if entry['status'] != EvacuationStatus.PENDING:
+                    continue
+                semaphore.acquire()
+                thread = threading.Thread(target=self._migrate_vm,
+                                          args=(entry, context, semaphore),
+                                          name='Evacuate-%s' % entry['name'])
+                thread.start()
+                threads.append(thread)
+        finally:
+            for thread in threads:
+                thread.join()
+            self.finish_time = time.time()
+        return self.get_report()
+
+    def get_report(self):
+        """Return the status of each VM in the evacuation"""
+        with self.report_lock:
+            return [dict((key, value) for key, value in entry.items() if key != 'vm_object')
+                    for entry in self.plan]
+
+    def get_progress(self):
+        """Return the aggregate progress of the evacuation: the number of VMs
+        in each state and the estimated time (seconds) to complete the evacuation,
+        based on the average duration of the completed migrations
+        """
+        report = self.get_report()
+        counts = {}
+        for entry in report:
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+
+        elapsed = None
+        if self.start_time is not None:
+            elapsed = (self.finish_time or time.time()) - self.start_time
+
+        eta = None
+        durations = [entry['duration'] for entry in report
+                     if entry['status'] == EvacuationStatus.MIGRATED]
+        outstanding = len([entry for entry in report
+                           if entry['status'] in [EvacuationStatus.PENDING,
+                                                  EvacuationStatus.MIGRATING,
+                                                  EvacuationStatus.RETRYING]])
+        if self.finish_time is not None:
+            eta = 0
+        elif durations:
+            # Migrations run concurrently, so the outstanding migrations
+            # complete in batches of the concurrency
+            batches = (outstanding + self.concurrency - 1) / self.concurrency
+            eta = int(batches * sum(durations) / len(durations))
+
+        return {'node': self.node_name, 'total': len(report), 'counts': counts,
+                'elapsed': elapsed, 'eta': eta, 'complete': self.finish_time is not None}
+
+    def get_report_table(self):
+        """Return a table of the status of each VM, with the aggregate progress"""
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(('VM Name', 'Type', 'Memory (MiB)', 'Destination', 'Status',
+                      'Attempts', 'Duration (s)', 'Error'))
+        for entry in self.get_report():
+            table.add_row((entry['name'], 'Online' if entry['online'] else 'Offline',
+                           entry['memory'] / 1024, entry['destination'] or '-',
+                           entry['status'], entry['attempts'],
+                           ('%.1f' % entry['duration']
+                            if entry['duration'] is not None else '-'),
+                           entry['error'] or ''))
+
+        progress = self.get_progress()
+        summary = 'Evacuation of %s: %s' % (
+            self.node_name,
+            ', '.join(['%i %s' % (count, status.lower())
+                       for status, count in sorted(progress['counts'].items())])
+            or 'no VMs'
+        )
+        if progress['elapsed'] is not None:
+            summary += ', %.1fs elapsed' % progress['elapsed']
+        if not progress['complete'] and progress['eta'] is not None:
+            summary += ', estimated %is remaining' % progress['eta']
+        return '%s\n%s' % (summary, table.draw())
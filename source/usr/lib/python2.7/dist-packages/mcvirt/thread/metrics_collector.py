@@ -0,0 +1,346 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+from array import array
+import threading
+import time
+
+import libvirt
+from texttable import Texttable
+
+from mcvirt.argument_validator import ArgumentValidator
+from mcvirt.auth.permissions import PERMISSIONS
+from mcvirt.exceptions import InvalidMetricException
+from mcvirt.rpc.expose_method import Expose
+from mcvirt.syslogger import Syslogger
+from mcvirt.thread.repeat_timer import RepeatTimer
+
+
+class MetricRingBuffer(object):
+    """Fixed-size buffer of the samples of a VM, holding the sample times and
+    the value of each metric in numeric arrays. Once the buffer is full, each
+    new sample replaces the oldest sample.
+    """
+
+    def __init__(self, size, metrics):
+        """Allocate the arrays for the samples"""
+        self.size = size
+        self.position = 0
+        self.count = 0
+        self.times = array('d', [0.0]) * size
+        self.values = dict((metric, array('d', [0.0]) * size) for metric in metrics)
+
+    def append(self, sample_time, values):
+        """Add a sample, replacing the oldest sample if the buffer is full"""
+        self.times[self.position] = sample_time
+        for metric, buffer_values in self.values.items():
+            buffer_values[self.position] = values.get(metric, 0)
+        self.position = (self.position + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def get_last_time(self):
+        """Return the time of the latest sample"""
+        return self.times[(self.position - 1) % self.size] if self.count else None
+
+    def get_samples(self, since=None):
+        """Return the samples, oldest first, as the sample times and the values
+        of each metric. If since is specified, only the samples from that time
+        are returned, along with the sample preceding it, so that rates can be
+        calculated for the whole period.
+        """
+        indexes = [(self.position - self.count + offset) % self.size
+                   for offset in range(self.count)]
+        if since is not None:
+            first = 0
+            for offset, index in enumerate(indexes):
+                if self.times[index] >= since:
+                    first = max(0, offset - 1)
+                    break
+            else:
+                first = len(indexes)
+            indexes = indexes[first:]
+        return ([self.times[index] for index in indexes],
+                dict((metric, [buffer_values[index] for index in indexes])
+                     for metric, buffer_values in self.values.items()))
+
+
+class GuestMetricsCollector(RepeatTimer):
+    """Sample the CPU, disk, network and memory statistics of the VMs running on
+    the node. The statistics of all VMs are obtained with a single libvirt
+    getAllDomainStats call at each interval and stored in a ring buffer for
+    each VM, from which the rate of each counter is calculated when queried.
+    """
+
+    # Number of samples retained for each VM
+    HISTORY_SIZE = 360
+
+    # Statistics of each sample: the counters (cumulative values) and gauges
+    COUNTERS = ['cpu_time', 'block_read_bytes', 'block_write_bytes', 'block_read_requests',
+                'block_write_requests', 'net_rx_bytes', 'net_tx_bytes', 'net_rx_packets',
+                'net_tx_packets']
+    GAUGES = ['balloon_current', 'balloon_rss']
+
+    # Libvirt statistics summed into each counter, for block and network devices
+    DEVICE_STATISTICS = {
+        'block': {'rd.bytes': 'block_read_bytes', 'wr.bytes': 'block_write_bytes',
+                  'rd.reqs': 'block_read_requests', 'wr.reqs': 'block_write_requests'},
+        'net': {'rx.bytes': 'net_rx_bytes', 'tx.bytes': 'net_tx_bytes',
+                'rx.pkts': 'net_rx_packets', 'tx.pkts': 'net_tx_packets'}
+    }
+
+    # Series that can be queried, with the statistic, whether the statistic is a
+    # counter (for which the rate is calculated), the scale applied and the unit
+    SERIES = {
+        'cpu': ('cpu_time', True, 100.0 / 1000000000, '% CPU'),
+        'disk_read': ('block_read_bytes', True, 1.0 / 1024, 'KiB/s'),
+        'disk_write': ('block_write_bytes', True, 1.0 / 1024, 'KiB/s'),
+        'disk_read_iops': ('block_read_requests', True, 1.0, 'IOPS'),
+        'disk_write_iops': ('block_write_requests', True, 1.0, 'IOPS'),
+        'net_rx': ('net_rx_bytes', True, 1.0 / 1024, 'KiB/s'),
+        'net_tx': ('net_tx_bytes', True, 1.0 / 1024, 'KiB/s'),
+        'net_rx_packets': ('net_rx_packets', True, 1.0, 'packets/s'),
+        'net_tx_packets': ('net_tx_packets', True, 1.0, 'packets/s'),
+        'memory': ('balloon_current', False, 1.0 / 1024, 'MiB'),
+        'memory_rss': ('balloon_rss', False, 1.0 / 1024, 'MiB')
+    }
+
+    BUFFERS = {}
+    BUFFER_LOCK = threading.Lock()
+    SAMPLE_LOCK = threading.Lock()
+
+    def __init__(self):
+        """Sample at a fixed interval, regardless of the duration of each sample"""
+        super(GuestMetricsCollector, self).__init__(repeat_after_run=False)
+
+    @property
+    def interval(self):
+        """Return the timer interval"""
+        return self.get_metrics_interval()
+
+    @Expose()
+    def get_metrics_interval(self):
+        """Return the interval (seconds) between samples of the VM statistics"""
+        return self._get_registered_object('mcvirt_config')().get_config()['metrics_interval']
+
+    @Expose(locking=True)
+    def set_metrics_interval(self, interval_time):
+        """Update the interval (seconds) between samples of the VM statistics"""
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_NODE)
+        ArgumentValidator.validate_positive_integer(interval_time)
+        interval_time = int(interval_time)
+
+        def update_config(config):
+            config['metrics_interval'] = interval_time
+        self._get_registered_object('mcvirt_config')().update_config(update_config,
+                                                                     'Update metrics interval')
+
+        # Restart the timer with the new interval
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.repeat = True
+        self.initialise()
+
+    @staticmethod
+    def parse_domain_stats(stats):
+        """Return the values of the counters and gauges of a VM from the libvirt
+        domain statistics, summing the statistics of each block and network device
+        """
+        values = {'cpu_time': stats.get('cpu.time', 0),
+                  'balloon_current': stats.get('balloon.current', 0),
+                  'balloon_rss': stats.get('balloon.rss', 0)}
+        for device_type, statistics in GuestMetricsCollector.DEVICE_STATISTICS.items():
+            for metric in statistics.values():
+                values[metric] = 0
+            for device in range(stats.get('%s.count' % device_type, 0)):
+                for statistic, metric in statistics.items():
+                    values[metric] += stats.get('%s.%i.%s' % (device_type, device, statistic), 0)
+        return values
+
+    def run(self):
+        """Sample the statistics of all running VMs"""
+        # Skip the sample if the previous sample has not completed
+        if not GuestMetricsCollector.SAMPLE_LOCK.acquire(False):
+            return
+        try:
+            self.sample()
+        except Exception, e:
+            Syslogger.logger().error('Failed to sample VM statistics: %s' % str(e))
+        finally:
+            GuestMetricsCollector.SAMPLE_LOCK.release()
+
+    def sample(self):
+        """Obtain the statistics of all running VMs from libvirt and add them
+        to the ring buffer of each VM
+        """
+        connection = self._get_registered_object('libvirt_connector').get_connection()
+        domain_stats = connection.getAllDomainStats(
+            libvirt.VIR_DOMAIN_STATS_CPU_TOTAL | libvirt.VIR_DOMAIN_STATS_BALLOON |
+            libvirt.VIR_DOMAIN_STATS_BLOCK | libvirt.VIR_DOMAIN_STATS_INTERFACE,
+            libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE
+        )
+        sample_time = time.time()
+        with GuestMetricsCollector.BUFFER_LOCK:
+            for domain, stats in domain_stats:
+                vm_name = domain.name()
+                if vm_name not in GuestMetricsCollector.BUFFERS:
+                    GuestMetricsCollector.BUFFERS[vm_name] = MetricRingBuffer(
+                        self.HISTORY_SIZE, self.COUNTERS + self.GAUGES
+                    )
+                GuestMetricsCollector.BUFFERS[vm_name].append(
+                    sample_time, self.parse_domain_stats(stats)
+                )
+
+            # Remove the samples of VMs that have not run on the node for the
+            # period covered by the buffers
+            expiry = sample_time - self.HISTORY_SIZE * max(1, self.interval)
+            for vm_name, ring_buffer in GuestMetricsCollector.BUFFERS.items():
+                if ring_buffer.get_last_time() < expiry:
+                    del GuestMetricsCollector.BUFFERS[vm_name]
+
+    @staticmethod
+    def _check_series(series):
+        """Ensure that the series is valid"""
+        if series not in GuestMetricsCollector.SERIES:
+            raise InvalidMetricException('Metric must be one of: %s' %
+                                         ', '.join(sorted(GuestMetricsCollector.SERIES.keys())))
+
+    @staticmethod
+    def _get_series_values(times, values, series):
+        """Return the points of a series for the samples of a VM, as the time
+        and value of each point. The rate of counters is calculated between
+        consecutive samples, skipping counters that have been reset by the
+        VM restarting.
+        """
+        statistic, is_counter, scale, _ = GuestMetricsCollector.SERIES[series]
+        statistic_values = values[statistic]
+        if not is_counter:
+            return [(sample_time, value * scale)
+                    for sample_time, value in zip(times, statistic_values)]
+
+        points = []
+        for index in range(1, len(times)):
+            duration = times[index] - times[index - 1]
+            change = statistic_values[index] - statistic_values[index - 1]
+            if duration > 0 and change >= 0:
+                points.append((times[index], change * scale / duration))
+        return points
+
+    def _get_vm_samples(self, vm_name, duration):
+        """Return the samples of a VM for the period, or None if the VM has not been sampled"""
+        with GuestMetricsCollector.BUFFER_LOCK:
+            ring_buffer = GuestMetricsCollector.BUFFERS.get(vm_name)
+            if ring_buffer is None:
+                return None
+            return ring_buffer.get_samples(since=(time.time() - duration
+                                                  if duration else None))
+
+    @Expose()
+    def get_vm_metrics(self, vm_name, series=None, duration=None):
+        """Return the series of a VM over the period (seconds), or the whole
+        history if no duration is specified. Returns a dictionary of each
+        series, with a list of the time and value of each point.
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_NODE)
+        ArgumentValidator.validate_hostname(vm_name)
+        if duration is not None:
+            ArgumentValidator.validate_positive_integer(duration)
+            duration = int(duration)
+        series_names = series or sorted(self.SERIES.keys())
+        for series_name in series_names:
+            self._check_series(series_name)
+
+        samples = self._get_vm_samples(vm_name, duration)
+        if samples is None:
+            return None
+        times, values = samples
+        return dict((series_name, self._get_series_values(times, values, series_name))
+                    for series_name in series_names)
+
+    @Expose()
+    def get_top_vms(self, series='cpu', count=5, duration=60):
+        """Return the VMs with the highest values of a series, averaged over the
+        period (seconds), highest first, as the VM name and the average value
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_NODE)
+        self._check_series(series)
+        ArgumentValidator.validate_positive_integer(count)
+        ArgumentValidator.validate_positive_integer(duration)
+
+        since = time.time() - int(duration)
+        with GuestMetricsCollector.BUFFER_LOCK:
+            vm_samples = [(vm_name, ring_buffer.get_samples(since=since))
+                          for vm_name, ring_buffer in GuestMetricsCollector.BUFFERS.items()
+                          if ring_buffer.get_last_time() >= since]
+
+        averages = []
+        for vm_name, (times, values) in vm_samples:
+            points = self._get_series_values(times, values, series)
+            if points:
+                averages.append((vm_name, sum([value for _, value in points]) / len(points)))
+        return sorted(averages, key=lambda average: (-average[1], average[0]))[:int(count)]
+
+    @Expose()
+    def get_top_table(self, series='cpu', count=5, duration=60):
+        """Return a table of the VMs with the highest values of a series,
+        showing the average of the other series for each VM
+        """
+        top_vms = self.get_top_vms(series, count, duration)
+        if not top_vms:
+            return 'No VMs have been sampled'
+
+        table_series = [series] + [series_name for series_name in
+                                   ['cpu', 'disk_read', 'disk_write', 'net_rx', 'net_tx',
+                                    'memory_rss'] if series_name != series]
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(['VM Name'] + ['%s (%s)' % (series_name, self.SERIES[series_name][3])
+                                    for series_name in table_series])
+        for vm_name, _ in top_vms:
+            metrics = self.get_vm_metrics(vm_name, table_series, duration)
+            row = [vm_name]
+            for series_name in table_series:
+                points = metrics[series_name] if metrics else []
+                row.append('%.1f' % (sum([value for _, value in points]) / len(points))
+                           if points else '-')
+            table.add_row(row)
+        return table.draw()
+
+    @Expose()
+    def get_vm_metrics_table(self, vm_name, duration=None):
+        """Return a table of the metrics of a VM, with a row for each sample"""
+        series_names = ['cpu', 'disk_read', 'disk_write', 'disk_read_iops', 'disk_write_iops',
+                        'net_rx', 'net_tx', 'memory', 'memory_rss']
+        metrics = self.get_vm_metrics(vm_name, series_names, duration)
+        if metrics is None:
+            return 'VM has not been sampled on this node'
+
+        rows = {}
+        for series_name in series_names:
+            for sample_time, value in metrics[series_name]:
+                rows.setdefault(sample_time, {})[series_name] = value
+
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(['Time'] + ['%s (%s)' % (series_name, self.SERIES[series_name][3])
+                                 for series_name in series_names])
+        for sample_time in sorted(rows.keys()):
+            table.add_row([time.strftime('%H:%M:%S', time.localtime(sample_time))] +
+                          ['%.1f' % rows[sample_time][series_name]
+                           if series_name in rows[sample_time] else '-'
+                           for series_name in series_names])
+        return table.draw()
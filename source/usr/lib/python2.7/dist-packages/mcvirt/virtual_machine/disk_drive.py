@@ -59,6 +59,10 @@ class DiskDrive(PyroObject):
         if libvirt_object.updateDeviceFlags(cdrom_xml_string, flags):
             raise LibvirtException('An error occurred whilst attaching ISO')
 
+        self._get_registered_object('iso_factory')._set_iso_attachment(
+            self.vm_object.get_name(), iso_object.get_name()
+        )
+
     def removeISO(self, live=False):
         """Removes ISO attached to the disk drive of a VM"""
 
@@ -78,6 +82,10 @@ class DiskDrive(PyroObject):
             if self.vm_object._getLibvirtDomainObject().updateDeviceFlags(cdrom_xml_string, flags):
                 raise LibvirtException('An error occurred whilst detaching ISO')
 
+        self._get_registered_object('iso_factory')._set_iso_attachment(
+            self.vm_object.get_name(), None
+        )
+
     def getCurrentDisk(self):
         """Returns the path of the disk currently attached to the VM"""
         # Import cdrom XML template
@@ -92,15 +100,26 @@ class DiskDrive(PyroObject):
 
     def preOnlineMigrationChecks(self, destination_node_name):
         """Performs pre-online-migration checks"""
-        # Determines if an attached ISO is present on the remote node
-        if self.getCurrentDisk():
-            # @TODO Update
-            cluster_instance = self._get_registered_object('cluster')
-            return_data = cluster_instance.run_remote_command('iso-get_isos', {},
-                                                              nodes=[destination_node_name])
-            if self.getCurrentDisk().get_name() not in return_data[destination_node_name]:
+        # Ensure that an attached ISO is present on the remote node, with the same
+        # content. ISOs can be copied to the remote node using replicate_iso.
+        current_iso = self.getCurrentDisk()
+        if current_iso:
+            iso_name = current_iso.get_name()
+            checksum = self._get_registered_object('iso_factory').get_iso_checksum(iso_name)
+
+            def get_remote_checksum(node):
+                return node.get_connection('iso_factory').get_iso_checksum(iso_name)
+            remote_checksum = self._get_registered_object('cluster').run_remote_command(
+                callback_method=get_remote_checksum, nodes=[destination_node_name]
+            )[destination_node_name]
+
+            if remote_checksum is None:
                 raise IsoNotPresentOnDestinationNodeException(
                     'The ISO attached to \'%s\' (%s) is not present on %s' %
-                    (self.vm_object.get_name(), self.getCurrentDisk().get_name(),
-                     destination_node_name)
+                    (self.vm_object.get_name(), iso_name, destination_node_name)
+                )
+            elif remote_checksum != checksum:
+                raise IsoNotPresentOnDestinationNodeException(
+                    'The ISO attached to \'%s\' (%s) differs from the ISO on %s' %
+                    (self.vm_object.get_name(), iso_name, destination_node_name)
                 )
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
 
+import libvirt
 import Pyro4
 from texttable import Texttable
 from os.path import exists as os_path_exists
@@ -30,7 +31,7 @@ from mcvirt.exceptions import (InvalidNodesException, DrbdNotEnabledOnNode,
                                InvalidVirtualMachineNameException, VmAlreadyExistsException,
                                ClusterNotInitialisedException, NodeDoesNotExistException,
                                VmDirectoryAlreadyExistsException, InvalidGraphicsDriverException,
-                               MCVirtTypeError)
+                               MCVirtTypeError, UnsuitableNodeException)
 from mcvirt.rpc.pyro_object import PyroObject
 from mcvirt.rpc.expose_method import Expose
 from mcvirt.utils import get_hostname
@@ -38,6 +39,9 @@ from mcvirt.argument_validator import ArgumentValidator
 from mcvirt.virtual_machine.hard_drive.base import Driver as HardDriveDriver
 from mcvirt.constants import AutoStartStates
 from mcvirt.syslogger import Syslogger
+from mcvirt.thread.auto_start_scheduler import AutoStartScheduler
+from mcvirt.virtual_machine.migration_orchestrator import MigrationOrchestrator
+from mcvirt.cluster.placement import PlacementEngine
 
 
 class GraphicsDriver(Enum):
@@ -58,24 +62,95 @@ class Factory(PyroObject):
     DEFAULT_GRAPHICS_DRIVER = GraphicsDriver.VMVGA.value
     CACHED_OBJECTS = {}
 
-    def autostart(self, start_type=AutoStartStates.ON_POLL):
-        """Autostart VMs"""
+    # Start report of the last autostart in which VMs were started
+    AUTOSTART_REPORT = None
+
+    def autostart(self, start_type=AutoStartStates.ON_POLL, exclude=None):
+        """Autostart VMs, starting VMs concurrently using the node autostart limits"""
         Syslogger.logger().info('Starting autostart: %s' % start_type.name)
-        for vm in self.getAllVirtualMachines():
-            if (vm.isRegisteredLocally() and vm.is_stopped and
-                    vm._get_autostart_state() in
-                    [AutoStartStates.ON_POLL, AutoStartStates.ON_BOOT] and
-                    (start_type == vm._get_autostart_state() or
-                     start_type == AutoStartStates.ON_BOOT)):
-                try:
-                    Syslogger.logger().info('Autostarting: %s' % vm.get_name())
-                    vm.start()
-                    Syslogger.logger().info('Autostart successful: %s' % vm.get_name())
-                except Exception, e:
-                    Syslogger.logger().error('Failed to autostart: %s: %s' %
-                                             (vm.get_name(), str(e)))
+
+        # Only inspect the VMs whose domains are not running on the node
+        inactive_domains = self._get_registered_object(
+            'libvirt_connector'
+        ).get_connection().listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE)
+
+        # Ignore libvirt domains that are not managed by MCVirt
+        mcvirt_vms = self.getAllVmNames()
+        vm_names = [domain.name() for domain in inactive_domains
+                    if domain.name() in mcvirt_vms]
+
+        vm_objects = []
+        for vm_name in vm_names:
+            if exclude and vm_name in exclude:
+                continue
+            try:
+                vm = self.getVirtualMachineByName(vm_name)
+                if (vm.isRegisteredLocally() and vm.is_stopped and
+                        vm._get_autostart_state() in
+                        [AutoStartStates.ON_POLL, AutoStartStates.ON_BOOT] and
+                        (start_type == vm._get_autostart_state() or
+                         start_type == AutoStartStates.ON_BOOT)):
+                    vm_objects.append(vm)
+            except Exception, e:
+                Syslogger.logger().error('Unable to determine autostart state of %s: %s' %
+                                         (vm_name, str(e)))
+
+        if vm_objects:
+            limits = MCVirtConfig().get_config()['autostart_limits']
+            scheduler = AutoStartScheduler(vm_objects, limits['concurrency'],
+                                           limits['minimum_free_memory'],
+                                           limits['maximum_iowait'])
+            start_time = time.time()
+            report = scheduler.run()
+            Factory.AUTOSTART_REPORT = {'start_type': start_type.name,
+                                        'start_time': start_time,
+                                        'duration': time.time() - start_time,
+                                        'vms': report}
         Syslogger.logger().info('Finished autostsart: %s' % start_type.name)
 
+    @Expose()
+    def get_autostart_report(self):
+        """Return a table of the start times of VMs in the last autostart
+        in which VMs were started
+        """
+        report = Factory.AUTOSTART_REPORT
+        if report is None:
+            return 'No VMs have been autostarted'
+
+        table = Texttable()
+        table.set_deco(Texttable.HEADER | Texttable.VLINES)
+        table.header(('VM Name', 'Group', 'Status', 'Throttled (s)', 'Start time (s)'))
+        for vm_report in report['vms']:
+            table.add_row((vm_report['name'], vm_report['group'], vm_report['status'],
+                           '%.1f' % vm_report['wait'],
+                           ('%.1f' % vm_report['duration']
+                            if vm_report['duration'] is not None else '-')))
+        return ('Autostart (%s) at %s, taking %.1f seconds\n%s' %
+                (report['start_type'],
+                 time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(report['start_time'])),
+                 report['duration'], table.draw()))
+
+    @Expose()
+    def get_migration_defaults(self):
+        """Return the cluster default live migration options"""
+        return MigrationOrchestrator.validate_options(
+            MCVirtConfig().get_config().get('migration', {})
+        )
+
+    @Expose(locking=True)
+    def set_migration_defaults(self, options):
+        """Update the cluster default live migration options. The options are
+        replicated to the other nodes in the cluster with the configuration.
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MANAGE_CLUSTER)
+        migration_options = self.get_migration_defaults()
+        migration_options.update(options)
+        migration_options = MigrationOrchestrator.validate_options(migration_options)
+
+        def update_config(config):
+            config['migration'] = migration_options
+        MCVirtConfig().update_config(update_config, 'Update live migration defaults')
+
     @Expose()
     def getVirtualMachineByName(self, vm_name):
         """Obtain a VM object, based on VM name"""
@@ -176,6 +251,47 @@ class Factory(PyroObject):
         if driver not in [i.value for i in list(GraphicsDriver)]:
             raise InvalidGraphicsDriverException('Invalid graphics driver \'%s\'' % driver)
 
+    def _rank_nodes(self, cpu_cores, memory_allocation, hard_drives, storage_type):
+        """Rank the nodes in the cluster for hosting a new VM, using the free
+        resources of the nodes
+        """
+        placement_engine = PlacementEngine(self._get_registered_object('cluster'),
+                                           self._get_registered_object('node'))
+        return placement_engine.rank_nodes(
+            placement_engine.get_node_facts(storage_type), int(cpu_cores),
+            int(memory_allocation), sum([int(size) for size in hard_drives])
+        )
+
+    def _get_placement_node_count(self, storage_type):
+        """Return the number of nodes that host a VM using the storage type"""
+        if storage_type == 'Drbd':
+            return self._get_registered_object('node_drbd').CLUSTER_SIZE
+        return 1
+
+    @Expose()
+    def get_placement_report(self, cpu_cores, memory_allocation, hard_drives=None,
+                             storage_type=None):
+        """Return the nodes that would be chosen to host a new VM, with the
+        ranking of the nodes, without creating the VM
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.CREATE_VM)
+        hard_drives = [] if hard_drives is None else hard_drives
+        ArgumentValidator.validate_positive_integer(cpu_cores)
+        ArgumentValidator.validate_positive_integer(memory_allocation)
+        for hard_drive in hard_drives:
+            ArgumentValidator.validate_positive_integer(hard_drive)
+
+        ranking = self._rank_nodes(cpu_cores, memory_allocation, hard_drives, storage_type)
+        try:
+            chosen_nodes = PlacementEngine.choose_nodes(
+                ranking, self._get_placement_node_count(storage_type)
+            )
+            summary = 'VM would be hosted on: %s' % ', '.join(chosen_nodes)
+        except UnsuitableNodeException, e:
+            chosen_nodes = []
+            summary = 'VM cannot be placed: %s' % str(e)
+        return '%s\n%s' % (summary, PlacementEngine.get_ranking_table(ranking, chosen_nodes))
+
     @Expose(locking=True, instance_method=True)
     def create(self, *args, **kwargs):
         """Exposed method for creating a VM, that performs a permission check"""
@@ -248,7 +364,14 @@ class Factory(PyroObject):
         all_nodes.append(get_hostname())
 
         if len(available_nodes) == 0:
-            if storage_type == 'Drbd':
+            if storage_type == 'Drbd' and self._is_cluster_master:
+                # If the available nodes are not specified, choose the nodes
+                # with the most free resources
+                available_nodes = PlacementEngine.choose_nodes(
+                    self._rank_nodes(cpu_cores, memory_allocation, hard_drives, storage_type),
+                    node_drbd.CLUSTER_SIZE
+                )
+            elif storage_type == 'Drbd':
                 # If the available nodes are not specified, use the
                 # nodes in the cluster
                 available_nodes = all_nodes
@@ -256,9 +379,8 @@ class Factory(PyroObject):
                 # For local VMs, only use the local node as the available nodes
                 available_nodes = [get_hostname()]
 
-        # If there are more than the maximum number of Drbd machines in the cluster,
-        # add an option that forces the user to specify the nodes for the Drbd VM
-        # to be added to
+        # Ensure that the number of nodes specified for a Drbd VM matches the
+        # number of nodes that Drbd replicates between
         if storage_type == 'Drbd' and len(available_nodes) != node_drbd.CLUSTER_SIZE:
             raise InvalidNodesException('Exactly %i nodes must be specified'
                                         % node_drbd.CLUSTER_SIZE)
@@ -310,6 +432,7 @@ class Factory(PyroObject):
         # Obtain an object for the new VM, to use to create disks/network interfaces
         vm_object = self.getVirtualMachineByName(name)
         vm_object.get_config_object().gitAdd('Created VM \'%s\'' % vm_object.get_name())
+        self._get_registered_object('node_capacity').update_vm(name)
 
         if node == get_hostname():
             # Register VM with LibVirt. If MCVirt has not been initialised on this node,
@@ -63,6 +63,9 @@ class Base(PyroObject):
     SNAPSHOT_SUFFIX = '_snapshot'
     SNAPSHOT_SIZE = '500M'
 
+    # Whether the storage type can be chosen when a storage type is not specified
+    AUTO_SELECTABLE = True
+
     def __init__(self, vm_object, custom_volume_group=None, disk_id=None, driver=None):
         """Set member variables"""
         self._disk_id = disk_id
@@ -304,6 +307,11 @@ class Base(PyroObject):
         """Returns whether the storage type is available on the node"""
         raise NotImplementedError
 
+    @staticmethod
+    def get_free_space(pyro_object):
+        """Returns the free space (MiB) available for the storage type on the node"""
+        return pyro_object._get_registered_object('node').get_free_vg_space()
+
     @Expose(locking=True)
     def removeFromVirtualMachine(self, unregister=False, all_nodes=True):
         """Remove the hard drive from a VM configuration and perform all nodes
@@ -651,6 +659,13 @@ class Base(PyroObject):
         """Increases the size of a VM hard drive, given the size to increase the drive by"""
         raise NotImplementedError
 
+    def _update_capacity(self):
+        """Update the disk allocated to the VM in the node capacity totals,
+        once the size of the disk has changed"""
+        node_capacity = self._get_registered_object('node_capacity')
+        if node_capacity:
+            node_capacity.update_vm(self.vm_object.get_name(), refresh_disks=True)
+
     def _check_exists(self):
         """Checks if the disk exists"""
         raise NotImplementedError
@@ -25,6 +25,7 @@ from Cheetah.Template import Template
 
 from mcvirt.virtual_machine.hard_drive.base import Base
 from mcvirt.node.drbd import Drbd as NodeDrbd
+from mcvirt.cluster.lock_manager import ClusterLockManager
 from mcvirt.auth.permissions import PERMISSIONS
 from mcvirt.system import System
 from mcvirt.rpc.expose_method import Expose
@@ -158,6 +159,7 @@ class Drbd(Base):
 
     CREATE_PROGRESS = Enum('CREATE_PROGRESS',
                            ['START',
+                            'RESERVE_ALLOCATION',
                             'CREATE_RAW_LV',
                             'CREATE_META_LV',
                             'CREATE_Drbd_CONFIG',
@@ -215,6 +217,15 @@ class Drbd(Base):
 
     INITIAL_PORT = 7789
     INITIAL_MINOR = 1
+
+    # Interval between state checks, if the DRBD event monitor is unavailable
+    STATE_POLL_INTERVAL = 5
+
+    # Maximum interval between attempts to set the resource as secondary
+    SECONDARY_RETRY_INTERVAL = 1
+
+    # Time (seconds) to wait for devices to be released when rolling back a migration
+    MIGRATION_ROLLBACK_TIMEOUT = 30
     Drbd_RAW_SUFFIX = 'raw'
     Drbd_META_SUFFIX = 'meta'
     Drbd_CONFIG_TEMPLATE = DirectoryLocation.TEMPLATE_DIR + '/drbd_resource.conf'
@@ -223,18 +234,24 @@ class Drbd(Base):
     # The maximum number of storage devices for the current type
     MAXIMUM_DEVICES = 4
 
-    def __init__(self, drbd_minor=None, drbd_port=None, *args, **kwargs):
+    def __init__(self, drbd_minor=None, drbd_port=None, resync_policy=None, *args, **kwargs):
         """Set member variables"""
         # Get Drbde configuration from disk configuration
         self._sync_state = True
         self._drbd_port = drbd_port
         self._drbd_minor = drbd_minor
+        self._resync_policy = resync_policy
         super(Drbd, self).__init__(*args, **kwargs)
 
     @property
     def config_properties(self):
         """Return the disk object config items"""
-        return super(Drbd, self).config_properties + ['drbd_port', 'drbd_minor']
+        return super(Drbd, self).config_properties + ['drbd_port', 'drbd_minor', 'resync_policy']
+
+    @property
+    def resync_policy(self):
+        """Return the resync policy for the volume, overriding the node-wide policy"""
+        return self._resync_policy
 
     @Expose()
     def get_resource_name(self):
@@ -303,13 +320,27 @@ class Drbd(Base):
             raise DrbdNotEnabledOnNode('Drbd is not enabled on this node')
 
         remote_nodes = self.vm_object._get_remote_nodes()
-
-        # Ensure DRBD port is determined before obtaining a remote object
-        self.drbd_port
+        cluster = self._get_registered_object('cluster')
 
         # Keep track of progress, so the storage stack can be torn down if something goes wrong
         progress = Drbd.CREATE_PROGRESS.START
         try:
+            # Determine the DRBD port and minor whilst holding the cluster lock on the
+            # allocation table and reserve them on every node in the cluster, not only
+            # the nodes that the VM is available on, so that volumes being created on
+            # any node are not allocated the same port or minor
+            with ClusterLockManager.get_instance().lock_resource(
+                    NodeDrbd.ALLOCATION_LOCK_RESOURCE):
+                self._reserveDrbdAllocation()
+                progress = Drbd.CREATE_PROGRESS.RESERVE_ALLOCATION
+
+                def remoteCommand(node):
+                    node.get_connection('node_drbd').reserve_remote_allocation(
+                        self.resource_name, self.drbd_port, self.drbd_minor
+                    )
+                cluster.run_remote_command(callback_method=remoteCommand,
+                                           nodes=cluster.get_nodes())
+
             # Create Drbd raw logical volume
             raw_logical_volume_name = self._getLogicalVolumeName(self.Drbd_RAW_SUFFIX)
             self._createLogicalVolume(raw_logical_volume_name,
@@ -342,8 +373,6 @@ class Drbd(Base):
             self._generateDrbdConfig()
             progress = Drbd.CREATE_PROGRESS.CREATE_Drbd_CONFIG
 
-            cluster = self._get_registered_object('cluster')
-
             def remoteCommand(node):
                 remote_disk = self.get_remote_object(remote_node=node, registered=False)
                 remote_disk.generateDrbdConfig()
@@ -371,9 +400,11 @@ class Drbd(Base):
                                        nodes=remote_nodes)
             progress = Drbd.CREATE_PROGRESS.Drbd_UP_R
 
-            # Wait for 5 seconds to let Drbd initialise
-            # TODO: Monitor Drbd status instead.
-            time.sleep(5)
+            # Wait (for up to 5 seconds) for the Drbd resource to connect to its peer
+            self._waitForConnectionState(
+                lambda state: state in Drbd.Drbd_STATES['CONNECTION']['CONNECTED'],
+                timeout=5
+            )
 
             # Add to virtual machine
             self._sync_state = True
@@ -447,6 +478,21 @@ class Drbd(Base):
                 self._removeLogicalVolume(raw_logical_volume_name,
                                           perform_on_nodes=True)
 
+            # Once the volume has been added to the VM, the allocation is
+            # released when it is removed from the VM
+            if (Drbd.CREATE_PROGRESS.RESERVE_ALLOCATION.value <= progress.value <
+                    Drbd.CREATE_PROGRESS.ADD_TO_VM.value):
+                self._get_registered_object('node_drbd').release_allocations(
+                    [self.resource_name]
+                )
+
+                def remoteCommand(node):
+                    node.get_connection('node_drbd').release_remote_allocations(
+                        [self.resource_name]
+                    )
+                cluster.run_remote_command(callback_method=remoteCommand,
+                                           nodes=cluster.get_nodes())
+
             raise
 
     def removeStorage(self, *args, **kwargs):
@@ -543,6 +589,7 @@ class Drbd(Base):
 
         # Re-Connect DRBD volume
         self._drbdConnect()
+        self._update_capacity()
 
     @Expose(locking=True)
     def drbd_resize(self, *args, **kwargs):
@@ -550,7 +597,8 @@ class Drbd(Base):
            with permission checking"""
         self._get_registered_object('auth').assert_user_type('ClusterUser')
 
-        return self._drbd_resize(*args, **kwargs)
+        self._drbd_resize(*args, **kwargs)
+        self._update_capacity()
 
     def _drbd_resize(self):
         """Performs a Drbd 'up' on the hard drive Drbd resource"""
@@ -578,11 +626,13 @@ class Drbd(Base):
 
     def _drbdDown(self):
         """Performs a Drbd 'down' on the hard drive Drbd resource"""
+        event_sequence = self._getDrbdEventSequence()
         try:
             System.runCommand([NodeDrbd.DrbdADM, 'down', self.resource_name])
         except MCVirtCommandException:
-            # If the Drbd down fails, attempt to wait 5 seconds and try again
-            time.sleep(5)
+            # If the Drbd down fails, wait for the resource state to change
+            # (for up to 5 seconds) and try again
+            self._waitForDrbdStateChange(since=event_sequence, timeout=5)
             System.runCommand([NodeDrbd.DrbdADM, 'down', self.resource_name])
 
     @Expose(locking=True)
@@ -701,17 +751,27 @@ class Drbd(Base):
 
         return self._drbdSetSecondary(*args, **kwargs)
 
-    def _drbdSetSecondary(self):
+    def _drbdSetSecondary(self, timeout=5):
         """Performs a Drbd 'secondary' on the hard drive Drbd resource"""
         # Attempt to set the disk as secondary
         set_secondary_command = [NodeDrbd.DrbdADM, 'secondary',
                                  self.resource_name]
-        try:
-            System.runCommand(set_secondary_command)
-        except MCVirtCommandException:
-            # If this fails, wait for 5 seconds, and attempt once more
-            time.sleep(5)
-            System.runCommand(set_secondary_command)
+        end_time = time.time() + timeout
+        while True:
+            event_sequence = self._getDrbdEventSequence()
+            try:
+                System.runCommand(set_secondary_command)
+                return
+            except MCVirtCommandException:
+                # If this fails, as the device may still be held open, wait for
+                # the resource state to change and retry until the timeout
+                remaining_time = end_time - time.time()
+                if remaining_time <= 0:
+                    raise
+                self._waitForDrbdStateChange(
+                    since=event_sequence,
+                    timeout=min(remaining_time, self.SECONDARY_RETRY_INTERVAL)
+                )
 
     def _drbdOverwritePeer(self):
         """Force Drbd to overwrite the data on the peer"""
@@ -808,6 +868,76 @@ class Drbd(Base):
         (local_state, remote_state) = states.split('/')
         return (DrbdRoleState(local_state), DrbdRoleState(remote_state))
 
+    def _getDrbdEventMonitor(self):
+        """Return the node DRBD event monitor"""
+        return self._get_registered_object('node_drbd').get_event_monitor()
+
+    def _getDrbdEventSequence(self):
+        """Return the current DRBD event sequence number, used to detect
+        transitions that occur after an action has been performed"""
+        return self._getDrbdEventMonitor().get_sequence()
+
+    def _waitForDrbdState(self, monitor_predicate, poll_predicate, since=None, timeout=None):
+        """Wait for the Drbd resource to reach a state, using the DRBD event monitor.
+        If the event monitor is unavailable, the state is polled using drbdadm.
+        Returns whether the state was reached before the timeout.
+        """
+        result = self._getDrbdEventMonitor().wait_for(
+            self.resource_name,
+            lambda state: state is not None and monitor_predicate(state),
+            since=since, timeout=timeout
+        )
+        if result is not None:
+            return result
+
+        end_time = None if timeout is None else time.time() + timeout
+        while True:
+            if poll_predicate():
+                return True
+            if end_time is not None and time.time() >= end_time:
+                return False
+            sleep_time = self.STATE_POLL_INTERVAL
+            if end_time is not None:
+                sleep_time = min(sleep_time, end_time - time.time())
+            time.sleep(max(sleep_time, 0))
+
+    def _waitForConnectionState(self, predicate, since=None, timeout=None):
+        """Wait for the connection state of the resource to match the predicate"""
+        def monitor_predicate(state):
+            try:
+                connection_state = DrbdConnectionState(state['connection_state'])
+            except ValueError:
+                # Ignore states that are not reported by DRBD 8
+                return False
+            return predicate(connection_state)
+
+        return self._waitForDrbdState(
+            monitor_predicate,
+            lambda: predicate(self._drbdGetConnectionState()),
+            since=since, timeout=timeout
+        )
+
+    def _waitForRole(self, predicate, since=None, timeout=None):
+        """Wait for the local/remote roles of the resource to match the predicate"""
+        def monitor_predicate(state):
+            try:
+                roles = tuple(DrbdRoleState(role) for role in state['role'])
+            except ValueError:
+                return False
+            return predicate(roles)
+
+        return self._waitForDrbdState(
+            monitor_predicate,
+            lambda: predicate(self._drbdGetRole()),
+            since=since, timeout=timeout
+        )
+
+    def _waitForDrbdStateChange(self, since, timeout):
+        """Wait for any change in the state of the resource after the given event"""
+        if self._getDrbdEventMonitor().wait_for(self.resource_name, lambda state: True,
+                                                since=since, timeout=timeout) is None:
+            time.sleep(timeout)
+
     def preMigrationChecks(self):
         """Ensures that the Drbd state of the disk is in a state suitable for migration"""
         # Ensure disk state is up-to-date on both local and remote nodes
@@ -842,15 +972,10 @@ class Drbd(Base):
         self._drbdSetSecondary()
 
         # Attempt to wait for Drbd to update status to secondary
-        # If, after 15 seconds, the local volume is still not
-        # primary, let the setTwiPrimariesConfig function raise
+        # If, after 10 seconds, the local volume is still not
+        # secondary, let the setTwoPrimariesConfig function raise
         # an appropriate exception
-        for i in range(1, 3):
-            local_role, _ = self._drbdGetRole()
-            if local_role is DrbdRoleState.SECONDARY:
-                break
-            else:
-                time.sleep(5)
+        self._waitForRole(lambda roles: roles[0] is DrbdRoleState.SECONDARY, timeout=10)
 
         # Disable the Drbd volume from being a dual-primary mode
         self._setTwoPrimariesConfig(allow=False)
@@ -941,20 +1066,20 @@ class Drbd(Base):
 
         try:
             # Perform a drbdadm verification
+            event_sequence = self._getDrbdEventSequence()
             System.runCommand([NodeDrbd.DrbdADM, 'verify',
                                self.resource_name])
 
             # Monitor the Drbd status, until the VM has started syncing
-            while True:
-                if self._drbdGetConnectionState() == DrbdConnectionState.VERIFY_S:
-                    break
-                time.sleep(5)
+            self._waitForConnectionState(
+                lambda state: state == DrbdConnectionState.VERIFY_S,
+                since=event_sequence
+            )
 
             # Monitor the Drbd status, until the VM has finished syncing
-            while True:
-                if self._drbdGetConnectionState() != DrbdConnectionState.VERIFY_S:
-                    break
-                time.sleep(5)
+            self._waitForConnectionState(
+                lambda state: state != DrbdConnectionState.VERIFY_S
+            )
 
         except Exception:
             # If an exception is thrown during the verify, mark the VM as
@@ -967,6 +1092,52 @@ class Drbd(Base):
             raise DrbdVolumeNotInSyncException('The Drbd verification for \'%s\' failed' %
                                                self.resource_name)
 
+    @Expose(locking=True)
+    def setResyncPolicy(self, policy):
+        """Set the resync policy for the volume, on all nodes in the cluster,
+        and apply it to the running Drbd configuration. A policy of None
+        reverts to the node-wide policy.
+        """
+        self._get_registered_object('auth').assert_permission(
+            PERMISSIONS.MANAGE_DRBD, self.vm_object)
+        policy = NodeDrbd.validate_resync_policy(policy)
+
+        def update_config(vm_config):
+            vm_config['hard_disks'][str(self.disk_id)]['resync_policy'] = policy
+        self.vm_object.get_config_object().update_config(
+            update_config, 'Set Drbd resync policy for \'%s\'' % self.resource_name
+        )
+        self._resync_policy = policy
+
+        if self._is_cluster_master:
+            def remote_command(node):
+                self.get_remote_object(remote_node=node).setResyncPolicy(policy)
+            cluster = self._get_registered_object('cluster')
+            cluster.run_remote_command(callback_method=remote_command)
+
+        if get_hostname() in self.vm_object.getAvailableNodes():
+            self._applyResyncPolicy()
+
+    def _applyResyncPolicy(self):
+        """Regenerate the resource configuration and adjust the running resource"""
+        self._generateDrbdConfig()
+        self._get_registered_object('node_drbd').adjust_drbd_config(self.resource_name)
+
+    @Expose()
+    def getSyncProgress(self):
+        """Return the progress of a resync or verification of the volume, with the
+        sync percentage, throughput (KiB/s), remaining data (KiB) and ETA (seconds)
+        """
+        self._get_registered_object('auth').assert_permission(
+            PERMISSIONS.MANAGE_DRBD, self.vm_object)
+
+        if get_hostname() not in self.vm_object.getAvailableNodes():
+            remote_object = self.get_remote_object(
+                node_name=(self.vm_object.getNode() or self.vm_object.getAvailableNodes()[0]))
+            return remote_object.getSyncProgress()
+
+        return self._get_registered_object('node_drbd').get_sync_progress(self.resource_name)
+
     @Expose()
     def resync(self, source_node=None, auto_determine=False):
         """Perform a resync of a Drbd hard drive"""
@@ -1003,21 +1174,21 @@ class Drbd(Base):
                 self.resource_name)
 
         if source_node == get_hostname():
+            event_sequence = self._getDrbdEventSequence()
             System.runCommand([NodeDrbd.DrbdADM, 'invalidate-remote',
                                self.resource_name])
 
             # Monitor the Drbd status, until the VM has started syncing
-            while True:
-                if self._drbdGetConnectionState() == DrbdConnectionState.SYNC_SOURCE:
-                    break
-                time.sleep(5)
+            self._waitForConnectionState(
+                lambda state: state == DrbdConnectionState.SYNC_SOURCE,
+                since=event_sequence
+            )
 
             # Monitor the Drbd status, until the VM has finished syncing
-            while True:
-                if self._drbdGetConnectionState() != DrbdConnectionState.SYNC_SOURCE:
-                    break
-                time.sleep(5)
-        elif not self._cluster_disable:
+            self._waitForConnectionState(
+                lambda state: state != DrbdConnectionState.SYNC_SOURCE
+            )
+        elif not self._cluster_disabled:
             remote_object = self.get_remote_object(remote_node=source_node)
             remote_object.resync(source_node=source_node)
 
@@ -1100,42 +1271,40 @@ class Drbd(Base):
 
     def _getAvailableDrbdPort(self):
         """Obtains the next available Drbd port"""
-        # Obtain list of currently used Drbd ports
-        node_drbd = self._get_registered_object('node_drbd')
-        used_ports = node_drbd.get_used_drbd_ports()
-        available_port = None
+        # Obtain the lowest port that is neither allocated in the cluster-wide
+        # allocation table nor in use by another service on the local node or
+        # the remote nodes that the volume is replicated to
         node_object = self._get_registered_object('node')
-        listening_ports = node_object._get_listen_ports(include_remote=True)
-
-        # Determine a free port
-        test_port = self.INITIAL_PORT
-
-        while (available_port is None):
-
-            if test_port in used_ports or test_port in listening_ports:
-                test_port += 1
-            else:
-                available_port = test_port
-
-        return available_port
+        remote_nodes = self.vm_object._get_remote_nodes()
+        listening_ports = node_object._get_listen_ports(include_remote=bool(remote_nodes),
+                                                        nodes=remote_nodes)
+        return self._get_registered_object('node_drbd').get_free_port(
+            self.INITIAL_PORT, exclude=listening_ports
+        )
 
     def _getAvailableDrbdMinor(self):
         """Obtains the next available Drbd minor"""
-        # Obtain list of currently used Drbd minors
-        node_drbd = self._get_registered_object('node_drbd')
-        used_minor_ids = node_drbd.get_used_drbd_minors()
-        available_minor_id = None
+        return self._get_registered_object('node_drbd').get_free_minor(Drbd.INITIAL_MINOR)
 
-        # Determine a free minor
-        test_minor_id = Drbd.INITIAL_MINOR
+    def _reserveDrbdAllocation(self):
+        """Record the port and minor of the volume in the node's allocation table"""
+        self._get_registered_object('node_drbd').reserve_allocation(
+            self.resource_name, self.drbd_port, self.drbd_minor
+        )
 
-        while (available_minor_id is None):
-            if test_minor_id in used_minor_ids:
-                test_minor_id += 1
-            else:
-                available_minor_id = test_minor_id
+    @Expose(locking=True)
+    def addToVirtualMachine(self, register=True):
+        """Reserve the Drbd port and minor and add the hard drive to the
+        virtual machine, on all nodes in the cluster"""
+        self._reserveDrbdAllocation()
+        super(Drbd, self).addToVirtualMachine(register=register)
 
-        return available_minor_id
+    @Expose(locking=True)
+    def removeFromVirtualMachine(self, unregister=False, all_nodes=True):
+        """Remove the hard drive from the VM configuration and release the
+        Drbd port and minor, on all nodes in the cluster"""
+        super(Drbd, self).removeFromVirtualMachine(unregister=unregister, all_nodes=all_nodes)
+        self._get_registered_object('node_drbd').release_allocations([self.resource_name])
 
     def _getLogicalVolumeName(self, lv_type):
         """Returns the logical volume name for a given logical volume type"""
@@ -1176,6 +1345,10 @@ class Drbd(Base):
            with permission checking"""
         self._get_registered_object('auth').assert_user_type('ClusterUser')
 
+        # Ensure that the allocation is recorded on nodes that the volume
+        # is being moved to
+        self._reserveDrbdAllocation()
+
         return self._generateDrbdConfig(*args, **kwargs)
 
     def _generateDrbdConfig(self):
@@ -1192,8 +1365,10 @@ class Drbd(Base):
                 'raw_lv_path': raw_lv_path,
                 'meta_lv_path': meta_lv_path,
                 'drbd_port': self.drbd_port,
+                'resync_options': NodeDrbd.get_resync_options(self.resync_policy),
                 'nodes': []
             }
+        NodeDrbd.APPLIED_RESYNC_OPTIONS[self.resource_name] = drbd_config['resync_options']
 
         # Add local node to the Drbd config
         cluster_object = self._get_registered_object('cluster')
@@ -1268,6 +1443,7 @@ class Drbd(Base):
         config = super(Drbd, self)._getMCVirtConfig()
         config['drbd_port'] = self.drbd_port
         config['drbd_minor'] = self.drbd_minor
+        config['resync_policy'] = self.resync_policy
         config['sync_state'] = self._sync_state
         return config
 
@@ -21,6 +21,7 @@ from mcvirt.exceptions import (UnknownStorageTypeException, HardDriveDoesNotExis
                                InsufficientSpaceException)
 from mcvirt.virtual_machine.hard_drive.local import Local
 from mcvirt.virtual_machine.hard_drive.drbd import Drbd
+from mcvirt.virtual_machine.hard_drive.qcow2 import Qcow2
 from mcvirt.virtual_machine.hard_drive.base import Base
 from mcvirt.auth.permissions import PERMISSIONS
 from mcvirt.rpc.pyro_object import PyroObject
@@ -31,7 +32,7 @@ from mcvirt.rpc.expose_method import Expose
 class Factory(PyroObject):
     """Provides a factory for creating hard drive/hard drive config objects"""
 
-    STORAGE_TYPES = [Local, Drbd]
+    STORAGE_TYPES = [Local, Drbd, Qcow2]
     DEFAULT_STORAGE_TYPE = 'Local'
     OBJECT_TYPE = 'hard disk'
     HARD_DRIVE_CLASS = Base
@@ -76,6 +77,9 @@ class Factory(PyroObject):
                 raise UnknownStorageTypeException('%s is not supported by node %s' %
                                                   (storage_type, get_hostname()))
         else:
+            available_storage_types = [available_storage for available_storage
+                                       in available_storage_types
+                                       if available_storage.AUTO_SELECTABLE]
             if len(available_storage_types) > 1:
                 raise UnknownStorageTypeException('Storage type must be specified')
             elif len(available_storage_types) == 1:
@@ -83,7 +87,7 @@ class Factory(PyroObject):
             else:
                 raise UnknownStorageTypeException('There are no storage types available')
 
-        free = self._get_registered_object('node').get_free_vg_space()
+        free = self.getClass(storage_type).get_free_space(self)
         if free < size:
             raise InsufficientSpaceException('Attempted to create a disk with %i MiB, but there '
                                              'is only %i MiB of free space available on node %s.' %
@@ -100,8 +104,11 @@ class Factory(PyroObject):
         return storage_type
 
     @Expose(locking=True)
-    def create(self, vm_object, size, storage_type, driver):
-        """Performs the creation of a hard drive, using a given storage type"""
+    def create(self, vm_object, size, storage_type, driver, **config):
+        """Performs the creation of a hard drive, using a given storage type.
+        Any additional storage-specific configuration (e.g. backing_file) is passed
+        to the hard drive object.
+        """
         vm_object = self._convert_remote_object(vm_object)
 
         # Ensure that the user has permissions to add create storage
@@ -110,6 +117,9 @@ class Factory(PyroObject):
             vm_object
         )
 
+        # Default to the storage type of the existing disks on the VM
+        storage_type = storage_type or vm_object.getStorageType()
+
         remote_nodes = [node for node in vm_object.getAvailableNodes() if node != get_hostname()]
         storage_type = self.ensure_hdd_valid(size, storage_type, remote_nodes)
 
@@ -120,7 +130,7 @@ class Factory(PyroObject):
                     'Storage type does not match VMs current storage type'
                 )
 
-        hdd_object = self.getClass(storage_type)(vm_object=vm_object, driver=driver)
+        hdd_object = self.getClass(storage_type)(vm_object=vm_object, driver=driver, **config)
         self._register_object(hdd_object)
         hdd_object.create(size=size)
         return hdd_object
@@ -88,6 +88,7 @@ class Local(Base):
             raise ExternalStorageCommandErrorException(
                 "Error whilst extending logical volume:\n" + str(e)
             )
+        self._update_capacity()
 
     def _check_exists(self):
         """Checks if a disk exists, which is required before any operations
@@ -0,0 +1,296 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+import json
+import os
+from enum import Enum
+
+from mcvirt.system import System
+from mcvirt.exceptions import (VmAlreadyStartedException, VmIsCloneException,
+                               ExternalStorageCommandErrorException,
+                               DiskAlreadyExistsException,
+                               CannotMigrateLocalDiskException,
+                               BackingImageDoesNotExistException,
+                               InvalidBackingImageException,
+                               InvalidArgumentException,
+                               MCVirtCommandException)
+from mcvirt.virtual_machine.hard_drive.base import Base
+from mcvirt.auth.permissions import PERMISSIONS
+from mcvirt.rpc.expose_method import Expose
+from mcvirt.constants import DirectoryLocation
+
+
+class Preallocation(Enum):
+    """Enums for the qcow2 preallocation modes supported by qemu-img"""
+
+    OFF = 'off'
+    METADATA = 'metadata'
+    FALLOC = 'falloc'
+    FULL = 'full'
+
+
+class Qcow2(Base):
+    """Provides operations to manage file-backed qcow2 hard drives, used by VMs"""
+
+    QEMU_IMG = '/usr/bin/qemu-img'
+    MAXIMUM_DEVICES = 4
+    CACHE_MODE = 'none'
+    DEFAULT_PREALLOCATION = Preallocation.METADATA.name
+
+    # Qcow2 is not selected implicitly, so that nodes with a volume group
+    # continue to default to Local storage
+    AUTO_SELECTABLE = False
+
+    def __init__(self, image_name=None, backing_file=None, preallocation=None,
+                 copy_on_read=False, *args, **kwargs):
+        """Set member variables"""
+        self._image_name = image_name
+        self._backing_file = backing_file
+        self._preallocation = preallocation
+        self._copy_on_read = copy_on_read
+        super(Qcow2, self).__init__(*args, **kwargs)
+
+    @property
+    def config_properties(self):
+        """Return the disk object config items"""
+        return super(Qcow2, self).config_properties + ['image_name', 'backing_file',
+                                                       'preallocation', 'copy_on_read']
+
+    @property
+    def image_name(self):
+        """Return the file name of the qcow2 image"""
+        if self._image_name:
+            return self._image_name
+        vm_name = self.vm_object.get_name()
+        return 'mcvirt_vm-%s-disk-%s.qcow2' % (vm_name, self.disk_id)
+
+    @property
+    def backing_file(self):
+        """Return the path of the backing image, if the disk is an overlay.
+        Backing images must be within the disk image directory.
+        """
+        if not self._backing_file:
+            return None
+        backing_file = os.path.normpath(os.path.join(DirectoryLocation.DISK_IMAGE_DIR,
+                                                     self._backing_file))
+        if not backing_file.startswith(DirectoryLocation.DISK_IMAGE_DIR + '/'):
+            raise InvalidBackingImageException(
+                'Backing image must be in %s: %s' % (DirectoryLocation.DISK_IMAGE_DIR,
+                                                     self._backing_file)
+            )
+        return backing_file
+
+    @property
+    def preallocation(self):
+        """Return the preallocation mode used when creating the image"""
+        if self._preallocation is None:
+            self._preallocation = self.DEFAULT_PREALLOCATION
+        return self._preallocation
+
+    @property
+    def copy_on_read(self):
+        """Return whether blocks read from the backing image are copied into the overlay"""
+        return bool(self._copy_on_read)
+
+    @staticmethod
+    def isAvailable(pyro_object):
+        """Determine if qcow2 storage is available on the node"""
+        return os.path.isfile(Qcow2.QEMU_IMG)
+
+    @staticmethod
+    def get_free_space(pyro_object):
+        """Return the free space (MiB) on the filesystem holding the disk images"""
+        path = DirectoryLocation.DISK_IMAGE_DIR
+        if not os.path.isdir(path):
+            path = DirectoryLocation.NODE_STORAGE_DIR
+        stat = os.statvfs(path)
+        return int(stat.f_bavail * stat.f_frsize / (1024 * 1024))
+
+    def _run_qemu_img(self, args, error_message):
+        """Run qemu-img, converting failures into a storage exception"""
+        try:
+            return System.runCommand([self.QEMU_IMG] + list(args))
+        except MCVirtCommandException, e:
+            raise ExternalStorageCommandErrorException(
+                "%s:\n%s" % (error_message, str(e))
+            )
+
+    def _get_image_info(self):
+        """Return the qemu-img information for the disk image"""
+        _, command_output, _ = self._run_qemu_img(
+            ['info', '--output=json', self._getDiskPath()],
+            'Error whilst obtaining disk image information'
+        )
+        return json.loads(command_output)
+
+    @Expose(locking=True)
+    def increaseSize(self, increase_size):
+        """Increases the size of a VM hard drive, given the size to increase the drive by"""
+        self._get_registered_object('auth').assert_permission(
+            PERMISSIONS.MODIFY_VM, self.vm_object
+        )
+
+        # Ensure disk exists
+        self._ensure_exists()
+
+        # Ensure VM is stopped
+        from mcvirt.virtual_machine.virtual_machine import PowerStates
+        if (self.vm_object._getPowerState() is not PowerStates.STOPPED):
+            raise VmAlreadyStartedException('VM must be stopped before increasing disk size')
+
+        # Ensure that VM has not been cloned and is not a clone, as resizing
+        # a backing image would corrupt the overlays that depend on it
+        if (self.vm_object.getCloneParent() or self.vm_object.getCloneChildren()):
+            raise VmIsCloneException('Cannot increase the disk of a cloned VM or a clone.')
+
+        self._run_qemu_img(['resize', self._getDiskPath(), '+%sM' % increase_size],
+                           'Error whilst resizing disk image')
+        self._update_capacity()
+
+    def _check_exists(self):
+        """Checks if a disk exists, which is required before any operations
+        can be performed on the disk"""
+        return os.path.isfile(self._getDiskPath())
+
+    def _removeStorage(self):
+        """Removes the backing disk image"""
+        self._ensure_exists()
+        os.remove(self._getDiskPath())
+
+    def getSize(self):
+        """Gets the size of the disk (in MB)"""
+        self._ensure_exists()
+        return int(self._get_image_info()['virtual-size'] / (1024 * 1024))
+
+    def clone(self, destination_vm_object):
+        """Clone a VM by creating an overlay image, backed by the current
+        disk image, and attaching it to the new VM object"""
+        self._ensure_exists()
+        new_disk = Qcow2(vm_object=destination_vm_object, driver=self.driver,
+                         disk_id=self.disk_id, backing_file=self._getDiskPath(),
+                         copy_on_read=self.copy_on_read)
+        self._register_object(new_disk)
+        new_disk.create(self.getSize())
+        return new_disk
+
+    def duplicate(self, destination_vm_object):
+        """Copy the hard drive, flattening any backing chain, and attach
+        it to the new VM object"""
+        self._ensure_exists()
+
+        new_disk = Qcow2(vm_object=destination_vm_object, driver=self.driver,
+                         disk_id=self.disk_id, preallocation=self.preallocation,
+                         copy_on_read=self.copy_on_read)
+        self._register_object(new_disk)
+
+        destination_path = new_disk._getDiskPath()
+        if os.path.lexists(destination_path):
+            raise DiskAlreadyExistsException('Disk already exists: %s' % destination_path)
+
+        # Convert the image into a standalone qcow2 image, rather than
+        # copying the raw file, so that the new disk does not share the backing image
+        self._run_qemu_img(['convert', '-O', 'qcow2',
+                            '-o', 'preallocation=%s' % Preallocation[new_disk.preallocation].value,
+                            self._getDiskPath(), destination_path],
+                           'Error whilst duplicating disk image')
+        try:
+            new_disk.addToVirtualMachine()
+        except:
+            os.remove(destination_path)
+            raise
+
+        return new_disk
+
+    def create(self, size):
+        """Creates a new disk image, attaches the disk to the VM and records the disk
+        in the VM configuration"""
+        disk_path = self._getDiskPath()
+
+        # Ensure the disk doesn't already exist
+        if os.path.lexists(disk_path):
+            raise DiskAlreadyExistsException('Disk already exists: %s' % disk_path)
+
+        if not os.path.isdir(DirectoryLocation.DISK_IMAGE_DIR):
+            os.makedirs(DirectoryLocation.DISK_IMAGE_DIR)
+
+        command_args = ['create', '-f', 'qcow2']
+        if self.backing_file:
+            # Preallocation cannot be combined with a backing file
+            if self._preallocation is not None:
+                raise InvalidArgumentException(
+                    'Preallocation cannot be used with a backing image'
+                )
+            if not os.path.isfile(self.backing_file):
+                raise BackingImageDoesNotExistException(
+                    'Backing image does not exist: %s' % self.backing_file
+                )
+            # Record the backing format, so that qemu/libvirt do not need to probe it
+            command_args += ['-b', self.backing_file, '-F', 'qcow2']
+        else:
+            command_args += ['-o', 'preallocation=%s' % Preallocation[self.preallocation].value]
+        command_args += [disk_path, '%sM' % size]
+
+        # Create the disk image
+        self._run_qemu_img(command_args, 'Error whilst creating disk image')
+
+        # Attach to VM and create disk object
+        try:
+            self.addToVirtualMachine()
+        except:
+            os.remove(disk_path)
+            raise
+
+    def activateDisk(self):
+        """Ensures the disk image is present, as no activation is required"""
+        self._ensure_exists()
+
+    def deactivateDisk(self):
+        """Ensures the disk image is present, as no deactivation is required"""
+        self._ensure_exists()
+
+    def preMigrationChecks(self):
+        """Perform pre-migration checks"""
+        raise CannotMigrateLocalDiskException('VMs using qcow2 disks cannot be migrated')
+
+    def _getDiskPath(self):
+        """Returns the path of the qcow2 disk image"""
+        return os.path.join(DirectoryLocation.DISK_IMAGE_DIR, self.image_name)
+
+    def _generateLibvirtXml(self):
+        """Creates a libvirt XML configuration for a file-backed qcow2 disk"""
+        device_xml = super(Qcow2, self)._generateLibvirtXml()
+        device_xml.set('type', 'file')
+
+        driver_xml = device_xml.find('./driver')
+        driver_xml.set('type', 'qcow2')
+        if self.copy_on_read:
+            driver_xml.set('copy_on_read', 'on')
+
+        source_xml = device_xml.find('./source')
+        del source_xml.attrib['dev']
+        source_xml.set('file', self._getDiskPath())
+
+        return device_xml
+
+    def _getMCVirtConfig(self):
+        """Returns the MCVirt hard drive configuration for the qcow2 hard drive"""
+        config = super(Qcow2, self)._getMCVirtConfig()
+        config['image_name'] = self.image_name
+        config['backing_file'] = self._backing_file
+        config['preallocation'] = self.preallocation
+        config['copy_on_read'] = self.copy_on_read
+        return config
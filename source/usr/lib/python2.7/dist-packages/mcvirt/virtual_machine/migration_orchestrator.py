@@ -0,0 +1,304 @@
+# Copyright (c) 2016 - I.T. Dev Ltd
+#
+# This file is part of MCVirt.
+#
+# MCVirt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# MCVirt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MCVirt.  If not, see <http://www.gnu.org/licenses/>
+
+from contextlib import contextmanager
+import sys
+import threading
+import time
+
+import libvirt
+import Pyro4
+
+from mcvirt.argument_validator import ArgumentValidator
+from mcvirt.exceptions import InvalidMigrationOptionsException, MCVirtTypeError
+from mcvirt.syslogger import Syslogger
+
+
+class MigrationOrchestrator(object):
+    """Perform the phases of a VM migration, running the steps of each phase
+    on all of the VM's disks concurrently and recording the duration of
+    each phase.
+
+    Live migrations are tuned using the following options, with the cluster
+    defaults stored in the MCVirt configuration:
+        bandwidth: maximum bandwidth (MiB/s), max_downtime: maximum time (ms)
+        that the VM is paused to complete the migration, parallel_connections:
+        number of connections used to transfer memory, compression: 'xbzrle'
+        (transfer changes to pages), or 'zlib'/'zstd' (compress pages sent over
+        parallel connections), auto_converge: throttle the VM CPUs if the
+        migration is not converging, post_copy: switch to post-copy (running
+        the VM on the destination whilst the remaining memory is transferred)
+        after post_copy_after seconds, if the migration has not completed
+    """
+
+    # Interval (seconds) between updates of the progress of a live migration
+    PROGRESS_INTERVAL = 2
+
+    # Compression methods for each option, and whether they require parallel connections
+    COMPRESSION_METHODS = {'xbzrle': ('xbzrle', False), 'zlib': ('zlib', True),
+                           'zstd': ('zstd', True)}
+
+    # Progress of the live migrations running on the node, keyed by VM name
+    PROGRESS = {}
+    PROGRESS_LOCK = threading.Lock()
+
+    def __init__(self, vm_name, destination_node):
+        """Store member variables"""
+        self.vm_name = vm_name
+        self.destination_node = destination_node
+        self.timings = []
+
+    @staticmethod
+    def get_default_options():
+        """Return the default live migration options"""
+        return {'bandwidth': None, 'max_downtime': None, 'parallel_connections': None,
+                'compression': None, 'auto_converge': False, 'post_copy': False,
+                'post_copy_after': 60}
+
+    @staticmethod
+    def validate_options(options):
+        """Validate live migration options, returning the options
+        with defaults applied for any that are not specified
+        """
+        validated_options = MigrationOrchestrator.get_default_options()
+        for key, value in options.items():
+            if key not in validated_options:
+                raise InvalidMigrationOptionsException('Unknown migration option: %s' % key)
+            if value is None:
+                validated_options[key] = None
+                continue
+            try:
+                if key in ['bandwidth', 'max_downtime', 'parallel_connections',
+                           'post_copy_after']:
+                    ArgumentValidator.validate_positive_integer(value)
+                    value = int(value)
+                elif key in ['auto_converge', 'post_copy']:
+                    ArgumentValidator.validate_boolean(value)
+            except MCVirtTypeError, e:
+                raise InvalidMigrationOptionsException('Invalid value for %s: %s' %
+                                                       (key, str(e)))
+            if key == 'compression' and value not in MigrationOrchestrator.COMPRESSION_METHODS:
+                raise InvalidMigrationOptionsException(
+                    'Compression must be one of: %s' %
+                    ', '.join(sorted(MigrationOrchestrator.COMPRESSION_METHODS.keys()))
+                )
+            validated_options[key] = value
+
+        if validated_options['post_copy_after'] is None:
+            validated_options['post_copy_after'] = \
+                MigrationOrchestrator.get_default_options()['post_copy_after']
+        if validated_options['post_copy'] and (
+                validated_options['parallel_connections'] or
+                (validated_options['compression'] and
+                 MigrationOrchestrator.COMPRESSION_METHODS[validated_options['compression']][1])):
+            raise InvalidMigrationOptionsException(
+                'Post-copy cannot be used with parallel connections'
+            )
+        return validated_options
+
+    @staticmethod
+    def _get_libvirt_constant(name):
+        """Return a libvirt constant, raising an exception if the
+        installed version of libvirt does not support it
+        """
+        if not hasattr(libvirt, name):
+            raise InvalidMigrationOptionsException(
+                'The installed version of libvirt does not support %s' % name
+            )
+        return getattr(libvirt, name)
+
+    @staticmethod
+    def get_libvirt_parameters(options):
+        """Return the migrate3 parameters and additional flags for live migration options"""
+        get_constant = MigrationOrchestrator._get_libvirt_constant
+        params = {}
+        flags = 0
+        if options['bandwidth']:
+            params[get_constant('VIR_MIGRATE_PARAM_BANDWIDTH')] = options['bandwidth']
+
+        parallel_connections = options['parallel_connections']
+        if options['compression']:
+            method, requires_parallel = \
+                MigrationOrchestrator.COMPRESSION_METHODS[options['compression']]
+            flags |= get_constant('VIR_MIGRATE_COMPRESSED')
+            params[get_constant('VIR_MIGRATE_PARAM_COMPRESSION')] = method
+            if requires_parallel and not parallel_connections:
+                parallel_connections = 2
+        if parallel_connections:
+            flags |= get_constant('VIR_MIGRATE_PARALLEL')
+            params[get_constant('VIR_MIGRATE_PARAM_PARALLEL_CONNECTIONS')] = \
+                parallel_connections
+
+        if options['auto_converge']:
+            flags |= get_constant('VIR_MIGRATE_AUTO_CONVERGE')
+        if options['post_copy']:
+            flags |= get_constant('VIR_MIGRATE_POSTCOPY')
+        return params, flags
+
+    @staticmethod
+    def get_job_progress(stats):
+        """Return the progress of a migration from the libvirt job statistics:
+        memory total, processed and remaining (bytes), transfer and dirty
+        rates (bytes/s), percentage complete and estimated time remaining (seconds)
+        """
+        total = stats.get('memory_total')
+        remaining = stats.get('memory_remaining')
+        transfer_rate = stats.get('memory_bps')
+        dirty_rate = None
+        if 'memory_dirty_rate' in stats:
+            dirty_rate = stats['memory_dirty_rate'] * stats.get('memory_page_size', 4096)
+
+        percent = None
+        if total and remaining is not None:
+            percent = 100.0 * (total - remaining) / total
+
+        # Memory is only transferred faster than it is dirtied at the
+        # difference between the rates
+        eta = None
+        if remaining is not None and transfer_rate:
+            effective_rate = transfer_rate - (dirty_rate or 0)
+            if effective_rate > 0:
+                eta = int(remaining / effective_rate)
+
+        return {'memory_total': total, 'memory_processed': stats.get('memory_processed'),
+                'memory_remaining': remaining, 'transfer_rate': transfer_rate,
+                'dirty_rate': dirty_rate, 'iteration': stats.get('memory_iteration'),
+                'elapsed': (stats['time_elapsed'] / 1000.0
+                            if 'time_elapsed' in stats else None),
+                'percent': percent, 'eta': eta}
+
+    @staticmethod
+    def get_progress(vm_name):
+        """Return the progress of a live migration of a VM running on the node"""
+        with MigrationOrchestrator.PROGRESS_LOCK:
+            progress = MigrationOrchestrator.PROGRESS.get(vm_name)
+            return dict(progress) if progress else None
+
+    def _set_progress(self, **progress):
+        """Update the recorded progress of the live migration"""
+        with MigrationOrchestrator.PROGRESS_LOCK:
+            MigrationOrchestrator.PROGRESS.setdefault(self.vm_name, {}).update(progress)
+
+    def _monitor_migration(self, domain, options, stop_event):
+        """Record the progress of a live migration from the libvirt job statistics,
+        applying the maximum downtime once the migration job has started and
+        switching to post-copy once the post-copy delay has elapsed
+        """
+        downtime_applied = not options['max_downtime']
+        post_copy_started = False
+        start_time = time.time()
+        while not stop_event.wait(self.PROGRESS_INTERVAL):
+            try:
+                stats = domain.jobStats()
+                if stats.get('type', libvirt.VIR_DOMAIN_JOB_NONE) == libvirt.VIR_DOMAIN_JOB_NONE:
+                    continue
+
+                if not downtime_applied:
+                    domain.migrateSetMaxDowntime(options['max_downtime'], 0)
+                    downtime_applied = True
+
+                # Only switch to post-copy once all memory has been sent at least once
+                if (options['post_copy'] and not post_copy_started and
+                        time.time() - start_time >= options['post_copy_after'] and
+                        stats.get('memory_iteration', 0) >= 2):
+                    Syslogger.logger().info('Switching migration of %s to post-copy' %
+                                            self.vm_name)
+                    domain.migrateStartPostCopy(0)
+                    post_copy_started = True
+
+                self._set_progress(post_copy=post_copy_started,
+                                   **self.get_job_progress(stats))
+            except Exception, e:
+                Syslogger.logger().debug('Unable to obtain migration progress for %s: %s' %
+                                         (self.vm_name, str(e)))
+
+    @contextmanager
+    def monitor_migration(self, domain, options):
+        """Monitor the progress of a live migration whilst it is performed"""
+        self._set_progress(destination=self.destination_node, started=time.time(),
+                           options=options, post_copy=False)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._monitor_migration,
+                                  args=(domain, options, stop_event),
+                                  name='MigrationMonitor-%s' % self.vm_name)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield
+        finally:
+            stop_event.set()
+            thread.join()
+            with MigrationOrchestrator.PROGRESS_LOCK:
+                MigrationOrchestrator.PROGRESS.pop(self.vm_name, None)
+
+    @contextmanager
+    def phase(self, name):
+        """Record the duration of a phase of the migration"""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start_time
+            self.timings.append((name, duration))
+            Syslogger.logger().debug('Migration of %s: %s took %.2fs' %
+                                     (self.vm_name, name, duration))
+
+    def run_disk_phase(self, name, disk_objects, callback):
+        """Run the callback for each disk in a separate thread, re-raising the
+        first exception once the callback has completed for all disks
+        """
+        with self.phase(name):
+            if len(disk_objects) == 1:
+                callback(disk_objects[0])
+                return
+
+            exceptions = []
+
+            # The Pyro context (user, lock and cluster flags) is thread-local,
+            # so must be copied into each of the worker threads
+            context = dict(Pyro4.current_context.__dict__)
+
+            def run_for_disk(disk_object):
+                Pyro4.current_context.__dict__.update(context)
+                try:
+                    callback(disk_object)
+                except:
+                    exceptions.append(sys.exc_info())
+
+            threads = []
+            for disk_object in disk_objects:
+                thread = threading.Thread(target=run_for_disk, args=(disk_object,),
+                                          name='Migrate-%s-%s' % (self.vm_name, name))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+            if exceptions:
+                exc_type, exc_value, exc_traceback = exceptions[0]
+                raise exc_type, exc_value, exc_traceback
+
+    def get_summary(self):
+        """Return a description of the duration of each phase"""
+        return ', '.join(['%s: %.2fs' % (name, duration) for name, duration in self.timings])
+
+    def log_summary(self, success):
+        """Log the duration of each phase of the migration"""
+        Syslogger.logger().info('Migration of %s to %s %s (%s)' % (
+            self.vm_name, self.destination_node,
+            'completed' if success else 'failed', self.get_summary()
+        ))
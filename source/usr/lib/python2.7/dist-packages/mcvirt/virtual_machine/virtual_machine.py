@@ -20,6 +20,7 @@
 import xml.etree.ElementTree as ET
 import libvirt
 import shutil
+import sys
 from texttable import Texttable
 import time
 import Pyro4
@@ -42,11 +43,13 @@ from mcvirt.mcvirt_config import MCVirtConfig
 from mcvirt.virtual_machine.disk_drive import DiskDrive
 from mcvirt.virtual_machine.usb_device import UsbDevice
 from mcvirt.virtual_machine.virtual_machine_config import VirtualMachineConfig
+from mcvirt.virtual_machine.migration_orchestrator import MigrationOrchestrator
 from mcvirt.auth.permissions import PERMISSIONS
 from mcvirt.rpc.pyro_object import PyroObject
 from mcvirt.rpc.expose_method import Expose
 from mcvirt.utils import get_hostname
 from mcvirt.argument_validator import ArgumentValidator
+from mcvirt.syslogger import Syslogger
 
 
 class Modification(Enum):
@@ -145,10 +148,15 @@ class VirtualMachine(PyroObject):
         if self.isRegisteredLocally():
             # Determine if VM is running
             if self._getPowerState() is PowerStates.RUNNING:
+                # Record the stop before it is performed, as the stop event may be
+                # received before the call returns, removing the record if it fails
+                autostart_watchdog = self._get_registered_object('autostart_watchdog')
+                autostart_watchdog.record_intentional_stop(self.get_name())
                 try:
                     # Stop the VM
                     self._getLibvirtDomainObject().destroy()
                 except Exception, e:
+                    autostart_watchdog.clear_intentional_stop(self.get_name())
                     raise LibvirtException('Failed to stop VM: %s' % e)
             else:
                 raise VmAlreadyStoppedException('The VM is already shutdown')
@@ -173,10 +181,15 @@ class VirtualMachine(PyroObject):
         if self.isRegisteredLocally():
             # Determine if VM is running
             if self._getPowerState() is PowerStates.RUNNING:
+                # Record the stop before it is performed, as the stop event may be
+                # received before the call returns, removing the record if it fails
+                autostart_watchdog = self._get_registered_object('autostart_watchdog')
+                autostart_watchdog.record_intentional_stop(self.get_name())
                 try:
                     # Shutdown the VM
                     self._getLibvirtDomainObject().shutdown()
                 except Exception, e:
+                    autostart_watchdog.clear_intentional_stop(self.get_name())
                     raise LibvirtException('Failed to stop VM: %s' % e)
             else:
                 raise VmAlreadyStoppedException('The VM is already shutdown')
@@ -452,12 +465,21 @@ class VirtualMachine(PyroObject):
             for disk_object in self.getHardDriveObjects():
                 disk_object.delete()
 
+        # Release the Drbd ports and minors of any disks that remain in the VM configuration
+        self._get_registered_object('node_drbd').release_allocations([
+            hdd_object.resource_name for hdd_object in self.getHardDriveObjects()
+            if hdd_object.get_type() == 'Drbd'
+        ])
+
         # 'Undefine' object from LibVirt
         if self.isRegisteredLocally():
             try:
                 self._getLibvirtDomainObject().undefine()
             except:
                 raise LibvirtException('Failed to delete VM from libvirt')
+            self._get_registered_object('iso_factory')._set_iso_attachment(
+                self.get_name(), None
+            )
 
         # If VM is a clone of another VM, remove it from the configuration
         # of the parent
@@ -486,6 +508,7 @@ class VirtualMachine(PyroObject):
             updateMCVirtConfig,
             'Removed VM \'%s\' from global MCVirt config' %
             self.name)
+        self._get_registered_object('node_capacity').remove_vm(self.get_name())
 
         if self._is_cluster_master and not local_only:
             def remote_command(remote_object):
@@ -863,35 +886,73 @@ class VirtualMachine(PyroObject):
         if start_after_migration:
             remote_vm.start()
 
+    @Expose()
+    def getMigrationProgress(self):
+        """Return the progress of a live migration of the VM: memory remaining
+        (bytes), transfer and dirty rates (bytes/s), percentage complete and
+        estimated time remaining (seconds). None is returned if the VM is not
+        being migrated.
+        """
+        self._get_registered_object('auth').assert_permission(PERMISSIONS.MIGRATE_VM, self)
+        progress = MigrationOrchestrator.get_progress(self.get_name())
+        if progress is None and self._is_cluster_master:
+            # The migration is performed by the node that the VM was running on,
+            # which may not be the local node
+            for node in self._get_registered_object('cluster').get_nodes():
+                try:
+                    remote_node = self._get_registered_object('cluster').get_remote_node(node)
+                    remote_vm_factory = remote_node.get_connection('virtual_machine_factory')
+                    remote_vm = remote_vm_factory.getVirtualMachineByName(self.get_name())
+                    remote_node.annotate_object(remote_vm)
+                    progress = remote_vm.getMigrationProgress()
+                except Exception:
+                    progress = None
+                if progress is not None:
+                    break
+        return progress
+
     @Expose(locking=True)
-    def onlineMigrate(self, destination_node_name):
-        """Performs an online migration of a VM to another node in the cluster"""
+    def onlineMigrate(self, destination_node_name, migration_options=None):
+        """Performs an online migration of a VM to another node in the cluster.
+        Migration options override the cluster default live migration options.
+        """
         ArgumentValidator.validate_hostname(destination_node_name)
 
         # Ensure user has permission to migrate VM
         self._get_registered_object('auth').assert_permission(PERMISSIONS.MIGRATE_VM, self)
 
+        factory = self._get_registered_object('virtual_machine_factory')
+        options = factory.get_migration_defaults()
+        if migration_options:
+            options.update(migration_options)
+        options = MigrationOrchestrator.validate_options(options)
+        migration_params, option_flags = MigrationOrchestrator.get_libvirt_parameters(options)
+
         if destination_node_name not in self.getAvailableNodes():
             raise UnsuitableNodeException('Node %s is not a valid node for this VM' %
                                           destination_node_name)
 
-        factory = self._get_registered_object('virtual_machine_factory')
-
         # Ensure VM is registered locally and unlocked
         self.ensureRegisteredLocally()
         self.ensureUnlocked()
 
-        # Perform pre-migration checks
-        self._preMigrationChecks(destination_node_name)
+        # Perform each phase of the migration on all disks concurrently,
+        # recording the duration of each phase
+        orchestrator = MigrationOrchestrator(self.get_name(), destination_node_name)
 
-        # Perform online-migration-specific checks
-        self._preOnlineMigrationChecks(destination_node_name)
+        with orchestrator.phase('checks'):
+            # Perform pre-migration checks
+            self._preMigrationChecks(destination_node_name)
+
+            # Perform online-migration-specific checks
+            self._preOnlineMigrationChecks(destination_node_name)
 
         # Obtain cluster instance
         cluster = self._get_registered_object('cluster')
 
         # Obtain node object for destination node
         destination_node = cluster.get_remote_node(destination_node_name)
+        disk_objects = self.getHardDriveObjects()
 
         # Begin pre-migration tasks
         try:
@@ -905,8 +966,10 @@ class VirtualMachine(PyroObject):
             self._setNode(None)
 
             # Perform pre-migration tasks on disk objects
-            for disk_object in self.getHardDriveObjects():
-                disk_object.preOnlineMigration(destination_node)
+            orchestrator.run_disk_phase(
+                'prepare', disk_objects,
+                lambda disk_object: disk_object.preOnlineMigration(destination_node)
+            )
 
             # Build migration flags
             migration_flags = (
@@ -917,60 +980,89 @@ class VirtualMachine(PyroObject):
                 # Undefine the domain on the source node
                 libvirt.VIR_MIGRATE_UNDEFINE_SOURCE |
                 # Abort migration on I/O errors
-                libvirt.VIR_MIGRATE_ABORT_ON_ERROR
+                libvirt.VIR_MIGRATE_ABORT_ON_ERROR |
+                # Bandwidth, compression, auto-converge and post-copy options
+                option_flags
             )
 
-            # Perform migration
-            libvirt_domain_object = self._getLibvirtDomainObject()
-            status = libvirt_domain_object.migrate3(
-                destination_libvirt_connection,
-                params={},
-                flags=migration_flags
-            )
+            # Perform migration, recording the progress of the migration job
+            with orchestrator.phase('migrate'):
+                libvirt_domain_object = self._getLibvirtDomainObject()
+                with orchestrator.monitor_migration(libvirt_domain_object, options):
+                    status = libvirt_domain_object.migrate3(
+                        destination_libvirt_connection,
+                        params=migration_params,
+                        flags=migration_flags
+                    )
 
             if not status:
                 raise MigrationFailureExcpetion('Libvirt migration failed')
 
             # Perform post steps on hard disks and check disks
-            for disk_object in self.getHardDriveObjects():
+            def post_migration(disk_object):
                 disk_object.postOnlineMigration()
                 disk_object._checkDrbdStatus()
+            orchestrator.run_disk_phase('post-migration', disk_objects, post_migration)
 
             # Set the VM node to the destination node node
             self._setNode(destination_node_name)
 
+            # Update the index of attached ISOs on both nodes
+            self._get_registered_object('iso_factory')._set_iso_attachment(
+                self.get_name(), None
+            )
+            remote_iso_factory = destination_node.get_connection('iso_factory')
+            destination_node.annotate_object(remote_iso_factory)
+            remote_iso_factory.refresh_iso_attachment(self.get_name())
+
         except Exception:
-            # Wait 10 seconds before performing the tear-down, as Drbd
-            # will hold the block device open for a short period
-            time.sleep(10)
-
-            if self.get_name() in factory.getAllVmNames(node=get_hostname()):
-                # Set Drbd on remote node to secondary
-                for disk_object in self.getHardDriveObjects():
-                    remote_disk = disk_object.get_remote_object(remote_node=destination_node)
-                    remote_disk.drbdSetSecondary()
-
-                # Re-register VM as being registered on the local node
-                self._setNode(get_hostname())
-
-            if self.get_name() in factory.getAllVmNames(node=destination_node_name):
-                # Otherwise, if VM is registered on remote node, set the
-                # local Drbd state to secondary
-                for disk_object in self.getHardDriveObjects():
-                    time.sleep(10)
-                    disk_object._drbdSetSecondary()
-
-                # Register VM as being registered on the local node
-                self._setNode(destination_node_name)
-
-            # Reset disks
-            for disk_object in self.getHardDriveObjects():
-                # Reset dual-primary configuration
-                disk_object._setTwoPrimariesConfig(allow=False)
+            # Roll back the migration, re-raising the original exception
+            # once the migration summary has been logged
+            exc_info = sys.exc_info()
+            try:
+                # Drbd will hold the block devices open for a short period, so
+                # setting the disks to secondary is retried until they are released
+                if self.get_name() in factory.getAllVmNames(node=get_hostname()):
+                    # Set Drbd on remote node to secondary
+                    def set_remote_secondary(disk_object):
+                        remote_disk = disk_object.get_remote_object(remote_node=destination_node)
+                        remote_disk.drbdSetSecondary(
+                            timeout=disk_object.MIGRATION_ROLLBACK_TIMEOUT
+                        )
+                    orchestrator.run_disk_phase('rollback', disk_objects, set_remote_secondary)
+
+                    # Re-register VM as being registered on the local node
+                    self._setNode(get_hostname())
+
+                if self.get_name() in factory.getAllVmNames(node=destination_node_name):
+                    # Otherwise, if VM is registered on remote node, set the
+                    # local Drbd state to secondary
+                    orchestrator.run_disk_phase(
+                        'rollback', disk_objects,
+                        lambda disk_object: disk_object._drbdSetSecondary(
+                            timeout=disk_object.MIGRATION_ROLLBACK_TIMEOUT
+                        )
+                    )
+
+                    # Register VM as being registered on the local node
+                    self._setNode(destination_node_name)
+
+                # Reset disks
+                def reset_disk(disk_object):
+                    # Reset dual-primary configuration
+                    disk_object._setTwoPrimariesConfig(allow=False)
+
+                    # Mark hard drives as being out-of-sync
+                    disk_object.setSyncState(False)
+                orchestrator.run_disk_phase('reset', disk_objects, reset_disk)
+            except Exception, e:
+                Syslogger.logger().error('Failed to roll back migration of %s: %s' %
+                                         (self.get_name(), str(e)))
+            finally:
+                orchestrator.log_summary(success=False)
+            raise exc_info[0], exc_info[1], exc_info[2]
 
-                # Mark hard drives as being out-of-sync
-                disk_object.setSyncState(False)
-            raise
+        orchestrator.log_summary(success=True)
 
         # Perform post migration checks
         # Ensure VM is no longer registered with libvirt on the local node
@@ -1362,6 +1454,7 @@ class VirtualMachine(PyroObject):
             self._getLibvirtDomainObject().undefine()
         except:
             raise LibvirtException('Failed to delete VM from libvirt')
+        self._get_registered_object('iso_factory')._set_iso_attachment(self.get_name(), None)
 
         # De-activate the disk objects
         for disk_object in self.getHardDriveObjects():
@@ -1496,6 +1589,26 @@ class VirtualMachine(PyroObject):
         """Return the autostart enum"""
         return AutoStartStates(self.get_config_object().get_config()['autostart'])
 
+    @Expose(locking=True)
+    def set_autostart_group(self, group):
+        """Set the autostart group of the VM. VMs in lower groups are
+        started before VMs in higher groups.
+        """
+        self._get_registered_object('auth').assert_permission(
+            PERMISSIONS.MODIFY_VM, self
+        )
+        ArgumentValidator.validate_integer(group)
+        self.update_config(['autostart_group'], int(group), 'Update autostart group')
+
+    @Expose()
+    def get_autostart_group(self):
+        """Return the autostart group of the VM"""
+        return self._get_autostart_group()
+
+    def _get_autostart_group(self):
+        """Return the autostart group of the VM"""
+        return self.get_config_object().get_config()['autostart_group']
+
     @Expose()
     def getLockState(self):
         """Return the lock state for the VM"""
@@ -44,6 +44,19 @@ class VirtualMachineConfig(ConfigFile):
         from mcvirt.virtual_machine.virtual_machine import VirtualMachine
         return ('%s/config.json' % VirtualMachine._get_vm_dir(vm_name))
 
+    def _get_replicated_state(self, config):
+        """Return the items of the VM configuration, which are shared between the
+        nodes in the cluster"""
+        return dict(((key,), value) for key, value in config.items() if key != 'version')
+
+    def _record_change(self, original_state, config):
+        """Record the change for replication and update the resources
+        allocated to the VM in the node capacity totals"""
+        super(VirtualMachineConfig, self)._record_change(original_state, config)
+        node_capacity = self.vm_object._get_registered_object('node_capacity')
+        if node_capacity:
+            node_capacity.update_vm(self.vm_object.get_name(), config)
+
     @staticmethod
     def create(vm_name, available_nodes, cpu_cores, memory_allocation, graphics_driver):
         """Creates a basic VM configuration for new VMs"""
@@ -71,6 +84,7 @@ class VirtualMachineConfig(ConfigFile):
                 'graphics_driver': graphics_driver,
                 'modifications': [],
                 'autostart': AutoStartStates.NO_AUTOSTART.value,
+                'autostart_group': 0,
                 'uuid': None
             }
 
@@ -133,3 +147,6 @@ class VirtualMachineConfig(ConfigFile):
             if 'volume_group' in config:
                 config['custom_volume_group'] = config['volume_group']
                 del(config['volume_group'])
+
+        if self._getVersion() < 13:
+            config['autostart_group'] = 0